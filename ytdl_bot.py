@@ -19,6 +19,26 @@ import traceback
 import urllib.parse
 import base64
 import hashlib
+import hmac
+import math
+import random
+import threading
+import sqlite3
+import contextlib
+import contextvars
+import copy
+import importlib.util
+import itertools
+import logging
+import logging.handlers
+import mmap
+import queue
+from collections import Counter, OrderedDict, deque
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; state files are then unlocked
+    fcntl = None
 
 from commands import Path, Time, Video, MiB, KiB, GiB, JsonDict
 
@@ -29,15 +49,14 @@ except ImportError:
     print("install pytelegrambotapi")
     sys.exit(1)
 
-try:
-    from telethon import TelegramClient
-    from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeFilename, DocumentAttributeAudio
-except ImportError:
+# Telethon is imported on first upload (see make_telethon_client); only check it is installed
+if importlib.util.find_spec("telethon") is None:
     print("install telethon")
     sys.exit(1)
 
 try:
     import aiohttp
+    from aiohttp import web
 except ImportError:
     print("install aiohttp")
     sys.exit(1)
@@ -56,6 +75,17 @@ except ImportError:
     SPOTIFY_CLIENT_ID = None
     SPOTIFY_CLIENT_SECRET = None
 
+try:
+    from secrets import YTDL_WEBHOOK_URL
+except ImportError:
+    YTDL_WEBHOOK_URL = None
+
+# Required for webhook mode; without it the bot keeps polling
+try:
+    from secrets import YTDL_WEBHOOK_SECRET
+except ImportError:
+    YTDL_WEBHOOK_SECRET = None
+
 YTDL_ADMIN_CHAT_ID = MY_CHAT_ID
 
 __version__ = "2.9.1"
@@ -63,12 +93,24 @@ __version__ = "2.9.1"
 # Shared aiohttp session (lazy initialization)
 _AIOHTTP_SESSION = None
 
+# Connection pool tuning for the shared session
+HTTP_CONNECTION_LIMIT = 100
+HTTP_CONNECTION_LIMIT_PER_HOST = 10
+HTTP_DNS_CACHE_TTL = 300
+HTTP_KEEPALIVE_TIMEOUT = 60
+
 
 async def get_aiohttp_session():
     """Get or create shared aiohttp session."""
     global _AIOHTTP_SESSION
     if _AIOHTTP_SESSION is None or _AIOHTTP_SESSION.closed:
-        _AIOHTTP_SESSION = aiohttp.ClientSession()
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTION_LIMIT,
+            limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+        _AIOHTTP_SESSION = aiohttp.ClientSession(connector=connector)
     return _AIOHTTP_SESSION
 
 
@@ -82,8 +124,395 @@ async def close_aiohttp_session():
         _AIOHTTP_SESSION = None
 
 
+CACHE_MISS = object()
+
+
+class TTLCache:
+    """Small in-memory LRU cache with a per-entry time-to-live."""
+
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=CACHE_MISS):
+        """Return cached value or default if missing or expired."""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if time.monotonic() >= expires:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store value, evicting the least recently used entries."""
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LazyObject:
+    """Stand-in for a module-level object that is built on first attribute access.
+
+    Keeps importing this module free of side effects (session files, state
+    JSON reads and writes): test modes, workers and the benchmarks only build
+    what they touch. The global can still be replaced outright.
+    """
+
+    __slots__ = ("_factory", "_instance", "_lock")
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    object.__setattr__(self, "_instance", self._factory())
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._get(), name)
+
+
+def is_initialized(obj):
+    """False for a LazyObject that has not been built yet."""
+    return not isinstance(obj, LazyObject) or obj._instance is not None
+
+
+# Logging: log() only puts records on an in-memory queue; a listener thread
+# formats them and writes the console and the rotating LOG_PATH file (one
+# JSON object per line), so a slow terminal or disk never stalls the event
+# loop. Inside run_job() every record also carries the job id, stage and
+# elapsed time, including records from tasks and threads the job starts.
+LOG = logging.getLogger("ytdl")
+LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "ytdl_bot.log")
+LOG_MAX_BYTES = 10 * MiB
+LOG_BACKUP_COUNT = 5
+LOG_QUEUE_SIZE = 10000  # records beyond this are dropped rather than waited on
+LOG_CONSOLE_LEVEL = "INFO"
+LOG_CONSOLE_FORMAT = "%(asctime)s %(levelname)s [%(tag)s]%(job_label)s %(message)s"
+JOB_CONTEXT = contextvars.ContextVar("ytdl_job", default=None)
+_LOG_LISTENER = None
+
+
+def log(tag, message, level=logging.INFO, exc_info=False, **fields):
+    """Log message under [tag]; keyword fields are kept as structured data in the log file."""
+    LOG.log(level, message, exc_info=exc_info, extra={"tag": tag, "fields": fields})
+
+
+class JobContext:
+    """Correlation fields of the job running in the current task."""
+
+    def __init__(self, job_id, kind):
+        self.job_id = job_id
+        self.kind = kind
+        self.stage = None
+        self.started = self.stage_started = time.monotonic()
+
+
+@contextlib.contextmanager
+def job_context(job_id, kind):
+    """Tag log records emitted inside the block with job_id."""
+    job = JobContext(job_id, kind)
+    token = JOB_CONTEXT.set(job)
+    try:
+        yield job
+    finally:
+        JOB_CONTEXT.reset(token)
+
+
+def log_stage(stage):
+    """Move the current job to a new stage, logging how long the previous one took."""
+    job = JOB_CONTEXT.get()
+    if job is None:
+        return
+    now = time.monotonic()
+    if job.stage is not None:
+        log("JOB", f"{job.stage} took {now - job.stage_started:.1f}s", level=logging.DEBUG,
+            stage_seconds=round(now - job.stage_started, 3))
+    job.stage, job.stage_started = stage, now
+
+
+class JobContextFilter(logging.Filter):
+    """Copies the caller's job id, stage and elapsed time onto each record.
+
+    Attached to the queue handler, so it runs in the logging task or thread
+    and sees that caller's JOB_CONTEXT.
+    """
+
+    def filter(self, record):
+        record.tag = getattr(record, "tag", record.name)
+        record.fields = getattr(record, "fields", {})
+        job = JOB_CONTEXT.get()
+        if job is None:
+            record.job = record.stage = record.elapsed = None
+            record.job_label = ""
+        else:
+            record.job = job.job_id
+            record.stage = job.stage
+            record.elapsed = round(time.monotonic() - job.started, 3)
+            record.job_label = f" [job {job.job_id}{'/' + job.stage if job.stage else ''}]"
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of waiting."""
+
+    def prepare(self, record):
+        # Keep the traceback apart from the message so the file gets it as its own field
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICS.inc("ytdl_log_records_dropped_total")
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: time, level, tag, message, job fields and keyword fields."""
+
+    def format(self, record):
+        entry = dict(record.fields)
+        entry.update(time=self.formatTime(record), level=record.levelname, tag=record.tag,
+                     message=record.getMessage())
+        for name in ("job", "stage", "elapsed", "exc_text"):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(console_level=LOG_CONSOLE_LEVEL, log_path=LOG_PATH):
+    """Send LOG records through a queue to the console and, unless log_path is None, a rotating file."""
+    global _LOG_LISTENER
+    stop_logging()
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter(LOG_CONSOLE_FORMAT))
+    handlers = [console]
+    if log_path:
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+        file_handler.setFormatter(JsonLogFormatter())
+        handlers.append(file_handler)
+
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(records)
+    queue_handler.addFilter(JobContextFilter())
+    LOG.handlers[:] = [queue_handler]
+    LOG.setLevel(logging.DEBUG if log_path else console_level)
+    LOG.propagate = False
+    _LOG_LISTENER = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _LOG_LISTENER.start()
+    return _LOG_LISTENER
+
+
+def stop_logging():
+    """Write out queued records and detach the handlers installed by setup_logging()."""
+    global _LOG_LISTENER
+    if _LOG_LISTENER is None:
+        return
+    _LOG_LISTENER.stop()
+    for handler in _LOG_LISTENER.handlers:
+        handler.close()
+    LOG.handlers.clear()
+    LOG.setLevel(logging.NOTSET)
+    LOG.propagate = True
+    _LOG_LISTENER = None
+
+
+# Metrics: stage latencies, retry/failure counters and gauges, served as
+# Prometheus text on METRICS_HOST:METRICS_PORT/metrics (worker N uses
+# METRICS_PORT + 1 + N). METRICS_PORT = None (--metrics-port 0) disables
+# the endpoint.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_SAMPLE_SIZE = 500
+STAGE_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+THROUGHPUT_BUCKETS = tuple(n * MiB for n in (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+
+
+class Metrics:
+    """In-process metrics registry: histograms, counters and gauges.
+
+    Thread-safe, since stages such as compression run in worker threads.
+    Histograms also keep the last METRICS_SAMPLE_SIZE samples for
+    percentiles in /stats.
+    """
+
+    def __init__(self, sample_size=METRICS_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.histograms = {}  # name -> labels -> {"buckets", "counts", "sum", "count", "samples"}
+        self.counters = {}    # name -> labels -> value
+        self.gauges = {}      # name -> labels -> value
+        self.gauge_fns = {}   # name -> callable returning a number
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name, value, buckets=STAGE_BUCKETS, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {}).get(key)
+            if series is None:
+                series = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0,
+                          "samples": deque(maxlen=self.sample_size)}
+                self.histograms[name][key] = series
+            for i, bound in enumerate(series["buckets"]):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+            series["samples"].append(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def add_gauge(self, name, amount, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            series = self.gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def gauge_fn(self, name, fn):
+        """Register a gauge whose value is read when metrics are rendered."""
+        self.gauge_fns[name] = fn
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def percentiles(self, name, pcts=(50, 95)):
+        """{stage label value: (count, {pct: value})} from recent samples."""
+        result = {}
+        with self._lock:
+            for key, series in self.histograms.get(name, {}).items():
+                samples = sorted(series["samples"])
+                if not samples:
+                    continue
+                label = ",".join(value for _, value in key) or name
+                result[label] = (series["count"], {
+                    pct: samples[min(len(samples) - 1, int(pct / 100 * len(samples)))] for pct in pcts})
+        return result
+
+    def snapshot(self):
+        """JSON-serializable copy of histograms, counters and gauges, for merge()."""
+        with self._lock:
+            return {
+                "histograms": {name: [[key, {**series, "samples": list(series["samples"])}]
+                                      for key, series in series_by_key.items()]
+                               for name, series_by_key in self.histograms.items()},
+                "counters": {name: list(series.items()) for name, series in self.counters.items()},
+                "gauges": {name: list(series.items()) for name, series in self.gauges.items()},
+            }
+
+    def merge(self, snapshot):
+        """Add another process's snapshot() into this registry."""
+        with self._lock:
+            for name, series_list in snapshot["histograms"].items():
+                for key, other in series_list:
+                    key = tuple(map(tuple, key))
+                    series = self.histograms.setdefault(name, {}).get(key)
+                    if series is None:
+                        series = {"buckets": tuple(other["buckets"]), "counts": [0] * len(other["buckets"]),
+                                  "sum": 0.0, "count": 0, "samples": deque(maxlen=self.sample_size)}
+                        self.histograms[name][key] = series
+                    series["counts"] = [a + b for a, b in zip(series["counts"], other["counts"])]
+                    series["sum"] += other["sum"]
+                    series["count"] += other["count"]
+                    series["samples"].extend(other["samples"])
+            for kind in ("counters", "gauges"):
+                registry = getattr(self, kind)
+                for name, series_list in snapshot[kind].items():
+                    series = registry.setdefault(name, {})
+                    for key, value in series_list:
+                        key = tuple(map(tuple, key))
+                        series[key] = series.get(key, 0) + value
+
+    @staticmethod
+    def _format(name, key, value, extra=()):
+        labels = ",".join(f'{k}="{v}"' for k, v in (*key, *extra))
+        return f"{name}{{{labels}}} {value:g}" if labels else f"{name} {value:g}"
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series_by_key in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, series in sorted(series_by_key.items()):
+                    for bound, count in zip(series["buckets"], series["counts"]):
+                        lines.append(self._format(f"{name}_bucket", key, count, (("le", f"{bound:g}"),)))
+                    lines.append(self._format(f"{name}_bucket", key, series["count"], (("le", "+Inf"),)))
+                    lines.append(self._format(f"{name}_sum", key, series["sum"]))
+                    lines.append(self._format(f"{name}_count", key, series["count"]))
+            for name, series_by_key in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series_by_key.items()):
+                    lines.append(self._format(name, key, value))
+            gauges = {name: dict(series) for name, series in self.gauges.items()}
+        for name, fn in self.gauge_fns.items():
+            try:
+                gauges[name] = {(): fn()}
+            except Exception as e:
+                log("METRICS", f"Gauge {name} failed: {e}", level=logging.WARNING)
+        for name, series_by_key in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            for key, value in sorted(series_by_key.items()):
+                lines.append(self._format(name, key, value))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
 # Spotify token cache
 SPOTIFY_TOKEN = {"token": None, "expires": 0}
+SPOTIFY_TOKEN_LOCK = asyncio.Lock()
+
+# Spotify search cache, keyed by the cleaned title. Misses expire sooner
+# so a track that appears on Spotify later is picked up.
+SPOTIFY_CACHE_SIZE = 2048
+SPOTIFY_CACHE_TTL = 24 * 3600
+SPOTIFY_NEGATIVE_TTL = 15 * 60
+SPOTIFY_CACHE = TTLCache(SPOTIFY_CACHE_SIZE, SPOTIFY_CACHE_TTL)
 
 
 async def get_spotify_token():
@@ -92,6 +521,16 @@ async def get_spotify_token():
     if SPOTIFY_TOKEN["token"] and time.time() < SPOTIFY_TOKEN["expires"]:
         return SPOTIFY_TOKEN["token"]
 
+    # Single-flight: concurrent callers wait for one refresh instead of
+    # each requesting their own token
+    async with SPOTIFY_TOKEN_LOCK:
+        if SPOTIFY_TOKEN["token"] and time.time() < SPOTIFY_TOKEN["expires"]:
+            return SPOTIFY_TOKEN["token"]
+        return await _refresh_spotify_token()
+
+
+async def _refresh_spotify_token():
+    """Request a new Spotify token and store it in SPOTIFY_TOKEN."""
     try:
         auth_str = f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}"
         auth_b64 = base64.b64encode(auth_str.encode()).decode()
@@ -109,54 +548,67 @@ async def get_spotify_token():
                 SPOTIFY_TOKEN["expires"] = time.time() + data["expires_in"] - 60
                 return SPOTIFY_TOKEN["token"]
     except Exception as e:
-        print(f"Error getting Spotify token: {e}")
+        log("SPOTIFY", f"Error getting Spotify token: {e}", level=logging.WARNING)
     return None
 
 
+# YouTube title noise removed before searching Spotify, combined into one
+# alternation so cleaning is a single pass over the title
+TITLE_NOISE_PATTERNS = [
+    r'\(Official\s*(?:Music\s*)?Video\)',
+    r'\(Official\s*Audio\)',
+    r'\(Lyric\s*Video\)',
+    r'\(Lyrics\)',
+    r'\[Official\s*(?:Music\s*)?Video\]',
+    r'\[Official\s*Audio\]',
+    r'\[Lyric\s*Video\]',
+    r'\[Lyrics\]',
+    r'\(HD\)',
+    r'\[HD\]',
+    r'\(4K\)',
+    r'\[4K\]',
+    r'\(Audio\)',
+    r'\[Audio\]',
+    r'\(Visualizer\)',
+    r'\[Visualizer\]',
+    r'【.*?】',
+    r'\|.*$',  # Remove everything after |
+]
+TITLE_NOISE_RE = re.compile('|'.join(TITLE_NOISE_PATTERNS), re.IGNORECASE)
+
+
 def clean_title_for_search(title):
     """Clean YouTube title for better Spotify search results."""
-    # Remove common YouTube suffixes
-    patterns = [
-        r'\(Official\s*(Music\s*)?Video\)',
-        r'\(Official\s*Audio\)',
-        r'\(Lyric\s*Video\)',
-        r'\(Lyrics\)',
-        r'\[Official\s*(Music\s*)?Video\]',
-        r'\[Official\s*Audio\]',
-        r'\[Lyric\s*Video\]',
-        r'\[Lyrics\]',
-        r'\(HD\)',
-        r'\[HD\]',
-        r'\(4K\)',
-        r'\[4K\]',
-        r'\(Audio\)',
-        r'\[Audio\]',
-        r'\(Visualizer\)',
-        r'\[Visualizer\]',
-        r'【.*?】',
-        r'\|.*$',  # Remove everything after |
-    ]
-
-    cleaned = title
-    for pattern in patterns:
-        cleaned = re.sub(pattern, '', cleaned, flags=re.IGNORECASE)
+    cleaned = TITLE_NOISE_RE.sub('', title)
 
     # Remove extra whitespace
-    cleaned = ' '.join(cleaned.split())
-    return cleaned.strip()
+    return ' '.join(cleaned.split())
 
 
-async def search_spotify(title):
-    """Search Spotify for a track and return track info dict."""
-    if not SPOTIFY_ENABLED:
-        return None
+def clean_titles_for_search(titles):
+    """Clean a batch of titles (e.g. playlist entries) for Spotify search."""
+    sub = TITLE_NOISE_RE.sub
+    return [' '.join(sub('', title).split()) for title in titles]
 
-    token = await get_spotify_token()
-    if not token:
+
+async def search_spotify(title, clean=True):
+    """Search Spotify for a track and return track info dict.
+
+    Pass clean=False if title already went through clean_title_for_search.
+    """
+    if not SPOTIFY_ENABLED:
         return None
 
     try:
-        cleaned_title = clean_title_for_search(title)
+        cleaned_title = clean_title_for_search(title) if clean else title
+        cache_key = cleaned_title.lower()
+        cached = SPOTIFY_CACHE.get(cache_key)
+        if cached is not CACHE_MISS:
+            return cached
+
+        token = await get_spotify_token()
+        if not token:
+            return None
         query = urllib.parse.quote(cleaned_title)
 
         session = await get_aiohttp_session()
@@ -171,13 +623,16 @@ async def search_spotify(title):
                 if tracks:
                     track = tracks[0]
                     artists = ", ".join(a["name"] for a in track["artists"])
-                    return {
+                    info = {
                         "url": track["external_urls"]["spotify"],
                         "artist": artists,
                         "name": track["name"]
                     }
+                    SPOTIFY_CACHE.set(cache_key, info)
+                    return info
+                SPOTIFY_CACHE.set(cache_key, None, ttl=SPOTIFY_NEGATIVE_TTL)
     except Exception as e:
-        print(f"Error searching Spotify: {e}")
+        log("SPOTIFY", f"Error searching Spotify: {e}", level=logging.WARNING)
     return None
 
 # Constants
@@ -190,15 +645,25 @@ BITRATE_SAFETY_MARGIN = 0.9
 BOT = AsyncTeleBot(YTDL_TELEGRAM_TOKEN)
 
 # Telethon client for large uploads
-TELETHON_CLIENT = TelegramClient(
-    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ytdl_session'),
-    APP_ID,
-    APP_API_HASH
-)
+SESSION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ytdl_session')
+
+
+def make_telethon_client(session_path):
+    """Create a Telethon client (opens or creates the session file)."""
+    from telethon import TelegramClient
+    return TelegramClient(session_path, APP_ID, APP_API_HASH)
+
+
+TELETHON_CLIENT = LazyObject(lambda: make_telethon_client(SESSION_PATH))
 
 # Config paths
 CONFIG_DIR = Path.combine(os.path.dirname(os.path.abspath(__file__)), "configs")
 USERS_JSON_PATH = Path.combine(CONFIG_DIR, "ytdl_users.json")
+PLAYLISTS_JSON_PATH = Path.combine(CONFIG_DIR, "ytdl_playlists.json")
+THROUGHPUT_JSON_PATH = Path.combine(CONFIG_DIR, "ytdl_throughput.json")
+JOBS_DB_PATH = Path.combine(CONFIG_DIR, "ytdl_jobs.sqlite3")
+UPLOADS_JSON_PATH = Path.combine(CONFIG_DIR, "ytdl_uploads.json")
+FINGERPRINTS_JSON_PATH = Path.combine(CONFIG_DIR, "ytdl_fingerprints.json")
 
 # Temporary storage for pending URL choices (message_id -> {url, user_id, timestamp})
 PENDING_CHOICES = {}
@@ -286,18 +751,400 @@ class UserManager:
         return self.config["pending_requests"].get(str(user_id))
 
 
-# Initialize user manager
-USER_MANAGER = UserManager(USERS_JSON_PATH)
+class PlaylistState:
+    """Persists playlist job progress so interrupted jobs can be resumed.
+
+    Worker processes share the file, so every change re-reads it under a
+    file lock before saving.
+    """
+
+    def __init__(self, json_path):
+        self.json_path = json_path
+        config_dir = os.path.dirname(json_path)
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir)
+        self.config = JsonDict(json_path)
+        if "jobs" not in self.config:
+            self.config["jobs"] = {}
+            self.config.save()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the state file lock and reload the latest saved jobs."""
+        with open(self.json_path + ".lock", "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.config = JsonDict(self.json_path)
+            self.config.setdefault("jobs", {})
+            yield
+
+    @staticmethod
+    def job_key(chat_id, url, audio_only):
+        """Key identifying a playlist job."""
+        return f"{chat_id}:{'audio' if audio_only else 'video'}:{url}"
+
+    def start(self, chat_id, user_id, url, title, total, audio_only=False):
+        """Create a job or return the existing one (keeping finished entries)."""
+        key = self.job_key(chat_id, url, audio_only)
+        with self._locked():
+            job = self.config["jobs"].get(key)
+            if job is None:
+                job = {
+                    "chat_id": chat_id,
+                    "user_id": user_id,
+                    "url": url,
+                    "title": title,
+                    "audio_only": audio_only,
+                    "done": [],
+                    "started": Time.dotted()
+                }
+                self.config["jobs"][key] = job
+            job["total"] = total
+            self.config.save()
+        return job
+
+    def mark_done(self, chat_id, url, audio_only, index):
+        """Record an uploaded playlist entry."""
+        with self._locked():
+            job = self.config["jobs"].get(self.job_key(chat_id, url, audio_only))
+            if job is not None and index not in job["done"]:
+                job["done"].append(index)
+                self.config.save()
+
+    def finish(self, chat_id, url, audio_only):
+        """Forget a completed job."""
+        with self._locked():
+            if self.config["jobs"].pop(self.job_key(chat_id, url, audio_only), None) is not None:
+                self.config.save()
+
+    def unfinished(self):
+        """All jobs that have not completed yet."""
+        with self._locked():
+            return list(self.config["jobs"].values())
+
+
+UPLOAD_CACHE_SIZE = 5000
+
+
+class UploadCache:
+    """Persisted map of source URL to the Telegram document it was uploaded as.
+
+    Inline queries answer from it with the already uploaded file. Worker
+    processes add entries, so writes re-read the file under a lock and
+    lookups reload it when it changed on disk.
+    """
+
+    def __init__(self, json_path, max_entries=UPLOAD_CACHE_SIZE):
+        self.json_path = json_path
+        self.max_entries = max_entries
+        config_dir = os.path.dirname(json_path)
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir)
+        self.config = JsonDict(json_path)
+        self.config.setdefault("uploads", {})
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.path.getmtime(self.json_path)
+        except OSError:
+            return None
+
+    def _reload(self):
+        self.config = JsonDict(self.json_path)
+        self.config.setdefault("uploads", {})
+        self.mtime = self._mtime()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the cache file lock and reload the latest saved entries."""
+        with open(self.json_path + ".lock", "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._reload()
+            yield
+
+    @staticmethod
+    def key(url, kind):
+        return f"{kind}:{clean_youtube_url(url)}"
+
+    def get(self, url, kind):
+        """Entry dict (file_id, title, caption, ...) or None."""
+        if self._mtime() != self.mtime:
+            self._reload()
+        return self.config["uploads"].get(self.key(url, kind))
+
+    def set(self, url, kind, entry):
+        """Store an entry, dropping the oldest beyond max_entries."""
+        key = self.key(url, kind)
+        with self._locked():
+            uploads = self.config["uploads"]
+            uploads.pop(key, None)
+            uploads[key] = entry
+            while len(uploads) > self.max_entries:
+                uploads.pop(next(iter(uploads)))
+            self.config.save()
+            self.mtime = self._mtime()
+
+
+class FingerprintIndex(UploadCache):
+    """Persisted map of media_fingerprint() to the Telegram document it was uploaded as.
+
+    The same clip arriving through another URL (an embed, a re-upload) is
+    re-sent from it instead of being compressed and uploaded again.
+    """
+
+    @staticmethod
+    def key(fingerprint, kind):
+        return f"{kind}:{fingerprint}"
+
+
+# Bytes hashed from each end of a downloaded file
+FINGERPRINT_SAMPLE_BYTES = 1 * MiB
+
+
+def media_fingerprint(path, duration, width, height):
+    """Cheap content fingerprint of a downloaded file, or None if it can't be read.
+
+    SHA-256 of the first and last FINGERPRINT_SAMPLE_BYTES, plus size,
+    duration and dimensions.
+    """
+    try:
+        size = os.path.getsize(path)
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            digest.update(f.read(FINGERPRINT_SAMPLE_BYTES))
+            if size > FINGERPRINT_SAMPLE_BYTES:
+                f.seek(max(FINGERPRINT_SAMPLE_BYTES, size - FINGERPRINT_SAMPLE_BYTES))
+                digest.update(f.read())
+    except OSError as e:
+        log("DEDUP", f"Could not fingerprint {path}: {e}", level=logging.WARNING)
+        return None
+    return f"{digest.hexdigest()[:32]}:{size}:{duration or 0}:{width or 0}x{height or 0}"
+
+
+# Fair scheduling: job cost is the estimated seconds of work, weight the
+# user's share (admins get ADMIN_JOB_WEIGHT)
+JOB_DEFAULT_COST = 60
+JOB_MIN_COST = 5
+ADMIN_JOB_WEIGHT = 4
+
+
+def connect_job_db(db_path):
+    """Connection to the SQLite job database shared by the frontend and workers."""
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
 
-# Auto-approve admin on startup
-if YTDL_ADMIN_CHAT_ID not in USER_MANAGER.config["approved_users"]:
-    USER_MANAGER.config["approved_users"].append(YTDL_ADMIN_CHAT_ID)
-    USER_MANAGER.config.save()
+
+class JobQueue:
+    """Durable SQLite job queue shared by the frontend and worker processes.
+
+    Jobs move queued -> running -> done/failed. A job left running by a
+    worker that died is put back with requeue().
+
+    With fair=True jobs are served by weighted fair queuing: each job gets
+    a virtual finish tag (user's previous tag or the queue's virtual time,
+    plus cost / weight) and the smallest tag runs first. Users are
+    interleaved however many links they send, and cheap jobs overtake
+    expensive ones, also among one user's own jobs. fair=False is plain FIFO.
+    """
+
+    def __init__(self, db_path, fair=True):
+        self.db_path = db_path
+        self.fair = fair
+        config_dir = os.path.dirname(db_path)
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir)
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " kind TEXT NOT NULL,"
+                " chat_id INTEGER NOT NULL,"
+                " user_id INTEGER NOT NULL,"
+                " url TEXT NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'queued',"
+                " worker TEXT,"
+                " error TEXT,"
+                " created REAL NOT NULL,"
+                " started REAL,"
+                " finished REAL,"
+                " cost REAL NOT NULL DEFAULT 60,"
+                " weight REAL NOT NULL DEFAULT 1,"
+                " vstart REAL NOT NULL DEFAULT 0,"
+                " vfinish REAL NOT NULL DEFAULT 0,"
+                " status_message INTEGER)")
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, default in (("cost", JOB_DEFAULT_COST), ("weight", 1), ("vstart", 0), ("vfinish", 0)):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} REAL NOT NULL DEFAULT {default}")
+            if "status_message" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN status_message INTEGER")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_fair ON jobs (status, vfinish, id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS worker_stats"
+                " (worker TEXT PRIMARY KEY, updated REAL NOT NULL, snapshot TEXT NOT NULL)")
+
+    def _connect(self):
+        return connect_job_db(self.db_path)
+
+    @staticmethod
+    def _virtual_time(conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'vtime'").fetchone()
+        return row["value"] if row else 0.0
+
+    def _order(self):
+        return "vfinish, id" if self.fair else "id"
+
+    def enqueue(self, kind, chat_id, user_id, url, cost=JOB_DEFAULT_COST, weight=1):
+        """Add a job and return its id."""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            last = conn.execute(
+                "SELECT MAX(vfinish) FROM jobs WHERE user_id = ? AND status IN ('queued', 'running')",
+                (user_id,)).fetchone()[0]
+            vstart = max(self._virtual_time(conn), last or 0.0)
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, chat_id, user_id, url, created, cost, weight, vstart, vfinish)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, chat_id, user_id, url, time.time(), cost, weight, vstart, vstart + cost / weight))
+            if self.fair:
+                self._order_user_jobs(conn, user_id)
+            conn.execute("COMMIT")
+            return cursor.lastrowid
+
+    @staticmethod
+    def _order_user_jobs(conn, user_id):
+        """Re-tag a user's queued jobs cheapest first, in the slots they already hold.
+
+        The user's share of the queue stays the same; within it a short
+        job no longer waits behind the user's own long ones.
+        """
+        jobs = conn.execute(
+            "SELECT id, cost, weight, vstart FROM jobs WHERE user_id = ? AND status = 'queued'"
+            " ORDER BY vstart, id", (user_id,)).fetchall()
+        if len(jobs) < 2:
+            return
+        vstart = jobs[0]["vstart"]
+        for job in sorted(jobs, key=lambda job: (job["cost"] / job["weight"], job["id"])):
+            vfinish = vstart + job["cost"] / job["weight"]
+            conn.execute("UPDATE jobs SET vstart = ?, vfinish = ? WHERE id = ?", (vstart, vfinish, job["id"]))
+            vstart = vfinish
+
+    def claim(self, worker):
+        """Atomically take the next queued job for worker, or None."""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE status = 'queued' ORDER BY {self._order()} LIMIT 1").fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ? WHERE id = ?",
+                (str(worker), time.time(), row["id"]))
+            # Virtual time follows the start tag of the job entering service
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('vtime', ?)"
+                " ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)",
+                (row["vstart"],))
+            conn.execute("COMMIT")
+            return dict(row)
+
+    def finish(self, job_id, error=None):
+        """Mark a job done, or failed with an error message."""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                ("failed" if error else "done", error, time.time(), job_id))
+
+    def requeue(self, worker=None):
+        """Put running jobs (of one worker, or all) back in the queue."""
+        with contextlib.closing(self._connect()) as conn:
+            if worker is None:
+                cursor = conn.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running'")
+            else:
+                cursor = conn.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND worker = ?",
+                    (str(worker),))
+            return cursor.rowcount
+
+    def position(self, job_id):
+        """1-based position of a queued job (0 if no longer queued)."""
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute("SELECT status, vfinish FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row["status"] != "queued":
+                return 0
+            if not self.fair:
+                return conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND id <= ?", (job_id,)).fetchone()[0]
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued'"
+                " AND (vfinish < ? OR (vfinish = ? AND id <= ?))",
+                (row["vfinish"], row["vfinish"], job_id)).fetchone()[0]
+
+    def set_status_message(self, job_id, message_id):
+        """Attach the chat message announcing a queued job; False if a worker already took it."""
+        with contextlib.closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status_message = ? WHERE id = ? AND status = 'queued'", (message_id, job_id))
+            return cursor.rowcount == 1
+
+    def depth(self):
+        """Number of queued jobs."""
+        with contextlib.closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def publish_stats(self, worker, snapshot):
+        """Store a worker's Metrics.snapshot() for the frontend's /stats."""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO worker_stats (worker, updated, snapshot) VALUES (?, ?, ?)"
+                " ON CONFLICT(worker) DO UPDATE SET updated = excluded.updated, snapshot = excluded.snapshot",
+                (str(worker), time.time(), json.dumps(snapshot)))
+
+    def worker_stats(self):
+        """{worker: snapshot} as last published by each worker."""
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute("SELECT worker, snapshot FROM worker_stats ORDER BY worker").fetchall()
+        return {row["worker"]: json.loads(row["snapshot"]) for row in rows}
+
+    def clear_stats(self):
+        """Forget the snapshots of workers from an earlier run."""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("DELETE FROM worker_stats")
+
+    def prune(self, max_age):
+        """Delete finished jobs older than max_age seconds."""
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?",
+                (time.time() - max_age,))
+
+
+def load_user_manager():
+    """UserManager for USERS_JSON_PATH with the admin approved."""
+    user_manager = UserManager(USERS_JSON_PATH)
+    if YTDL_ADMIN_CHAT_ID not in user_manager.config["approved_users"]:
+        user_manager.config["approved_users"].append(YTDL_ADMIN_CHAT_ID)
+        user_manager.config.save()
+    return user_manager
+
+
+# State files are read on first use
+USER_MANAGER = LazyObject(load_user_manager)
+PLAYLIST_STATE = LazyObject(lambda: PlaylistState(PLAYLISTS_JSON_PATH))
+UPLOAD_CACHE = LazyObject(lambda: UploadCache(UPLOADS_JSON_PATH))
+FINGERPRINT_INDEX = LazyObject(lambda: FingerprintIndex(FINGERPRINTS_JSON_PATH))
 
 
 async def send_message(chat_id, text, reply_markup=None):
     """Send a message and return it."""
-    print(f"[SEND] to {chat_id}: {text[:100]}{'...' if len(text) > 100 else ''}")
+    log("SEND", f"to {chat_id}: {text[:100]}{'...' if len(text) > 100 else ''}")
     return await BOT.send_message(chat_id, text, reply_markup=reply_markup)
 
 
@@ -321,36 +1168,50 @@ async def clear_status_messages(chat_id):
         try:
             await BOT.delete_message(chat_id, message_id)
         except Exception as e:
-            print(f"Failed to delete message {message_id}: {e}")
+            log("SEND", f"Failed to delete message {message_id}: {e}", level=logging.WARNING)
     STATUS_MESSAGES[chat_id] = []
 
 
+# Resolved TikTok short links (vt/vm/v.tiktok.com -> canonical URL)
+TIKTOK_SHORT_URL_PATTERN = re.compile(r'https?://(vt|vm|v)\.tiktok\.com/')
+TIKTOK_URL_CACHE_SIZE = 1024
+TIKTOK_URL_CACHE_TTL = 6 * 3600
+TIKTOK_URL_CACHE = TTLCache(TIKTOK_URL_CACHE_SIZE, TIKTOK_URL_CACHE_TTL)
+
+
 async def normalize_tiktok_url(url):
     """Fix TikTok URLs: resolve short links and convert /photo/ to /video/.
 
+    Short links are resolved once and cached in TIKTOK_URL_CACHE.
     Returns (normalized_url, is_photo_post).
     """
     is_photo = False
 
     # Resolve TikTok short URLs (vt.tiktok.com, vm.tiktok.com, v.tiktok.com)
-    if re.match(r'https?://(vt|vm|v)\.tiktok\.com/', url):
-        try:
-            session = await get_aiohttp_session()
-            async with session.head(
-                url, allow_redirects=True,
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as response:
-                resolved = str(response.url)
-                print(f"[TIKTOK] Resolved short URL -> {resolved}")
-                url = resolved
-        except Exception as e:
-            print(f"[TIKTOK] Error resolving short URL: {e}")
+    if TIKTOK_SHORT_URL_PATTERN.match(url):
+        resolved = TIKTOK_URL_CACHE.get(url)
+        if resolved is not CACHE_MISS:
+            log("TIKTOK", f"Short URL cached -> {resolved}")
+            url = resolved
+        else:
+            try:
+                session = await get_aiohttp_session()
+                async with session.head(
+                    url, allow_redirects=True,
+                    timeout=aiohttp.ClientTimeout(total=10)
+                ) as response:
+                    resolved = str(response.url)
+                    log("TIKTOK", f"Resolved short URL -> {resolved}")
+                    TIKTOK_URL_CACHE.set(url, resolved)
+                    url = resolved
+            except Exception as e:
+                log("TIKTOK", f"Error resolving short URL: {e}", level=logging.WARNING)
 
     # Convert /photo/ to /video/ - TikTok serves photo posts via /video/ endpoint too
     if 'tiktok.com' in url and '/photo/' in url:
         is_photo = True
         url = url.replace('/photo/', '/video/')
-        print(f"[TIKTOK] Photo post detected, converted -> {url}")
+        log("TIKTOK", f"Photo post detected, converted -> {url}")
 
     return url, is_photo
 
@@ -377,31 +1238,190 @@ async def get_tiktok_photo(url, temp_dir):
         photo_path = os.path.join(temp_dir, "tiktok_photo.jpg")
         with open(photo_path, "wb") as f:
             f.write(content)
-        print(f"[TIKTOK] Downloaded photo: {len(content) / 1024:.0f} KB")
+        log("TIKTOK", f"Downloaded photo: {len(content) / 1024:.0f} KB")
         return photo_path
     except Exception as e:
-        print(f"[TIKTOK] Error fetching photo: {e}")
+        log("TIKTOK", f"Error fetching photo: {e}", level=logging.WARNING)
         return None
 
 
-def merge_image_audio(image_path, audio_path, output_path):
-    """Merge a still image with audio into an MP4 video using ffmpeg."""
+# Multi-media posts: at most this many parallel fetches per post, 10 items per album
+ALBUM_DOWNLOAD_CONCURRENCY = 4
+ALBUM_MAX_ITEMS = 10
+
+# Extensions of photo entries in multi-media posts
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "webp")
+
+# Sites whose posts may carry several media entries (carousels, threads)
+ALBUM_URL_PATTERN = re.compile(r'https?://(www\.)?(instagram\.com|x\.com|twitter\.com)/')
+
+TIKTOK_DATA_PATTERN = re.compile(
+    r'<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">(.*?)</script>',
+    re.DOTALL
+)
+
+
+def extract_tiktok_image_urls(html):
+    """Extract slideshow image URLs from a TikTok page. Returns [] if none found."""
+    match = TIKTOK_DATA_PATTERN.search(html)
+    if not match:
+        return []
+    try:
+        data = json.loads(match.group(1))
+        item = data["__DEFAULT_SCOPE__"]["webapp.video-detail"]["itemInfo"]["itemStruct"]
+        images = item.get("imagePost", {}).get("images", [])
+    except (KeyError, TypeError, ValueError):
+        return []
+
+    urls = []
+    for image in images:
+        url_list = image.get("imageURL", {}).get("urlList", [])
+        if not url_list:
+            continue
+        # Prefer JPEG variants, Telegram does not render HEIC/WebP photos in albums
+        jpeg_urls = [u for u in url_list if ".jpeg" in u or ".jpg" in u]
+        urls.append(jpeg_urls[0] if jpeg_urls else url_list[0])
+    return urls
+
+
+async def download_files(urls, temp_dir, prefix, concurrency=ALBUM_DOWNLOAD_CONCURRENCY):
+    """Download URLs concurrently (bounded by a semaphore), keeping their order.
+
+    Returns a list of file paths; failed downloads are left out.
+    """
+    session = await get_aiohttp_session()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(index, url):
+        path = os.path.join(temp_dir, f"{prefix}_{index:03d}.jpg")
+        async with semaphore:
+            try:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                    if resp.status != 200:
+                        log("ALBUM", f"Item {index} returned HTTP {resp.status}")
+                        return None
+                    content = await resp.read()
+            except Exception as e:
+                log("ALBUM", f"Item {index} failed: {e}", level=logging.WARNING)
+                return None
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    paths = await asyncio.gather(*(fetch(i, u) for i, u in enumerate(urls, 1)))
+    return [path for path in paths if path]
+
+
+async def get_tiktok_photos(url, temp_dir):
+    """Fetch all images of a TikTok photo post.
+
+    Reads the slideshow from the post page and downloads every image
+    concurrently. Falls back to the single oembed thumbnail.
+    Returns a list of file paths (empty on failure).
+    """
+    image_urls = []
+    try:
+        session = await get_aiohttp_session()
+        async with session.get(
+            url, headers={"User-Agent": "Mozilla/5.0"},
+            timeout=aiohttp.ClientTimeout(total=15)
+        ) as resp:
+            if resp.status == 200:
+                image_urls = extract_tiktok_image_urls(await resp.text())
+    except Exception as e:
+        log("TIKTOK", f"Error fetching post page: {e}", level=logging.WARNING)
+
+    if image_urls:
+        paths = await download_files(image_urls, temp_dir, "tiktok_photo")
+        if paths:
+            log("TIKTOK", f"Downloaded {len(paths)}/{len(image_urls)} slideshow images")
+            return paths
+
+    photo_path = await get_tiktok_photo(url, temp_dir)
+    return [photo_path] if photo_path else []
+
+
+# Still-image video settings: a static picture needs very few frames
+STILL_IMAGE_FPS = 1
+STILL_IMAGE_GOP = 300  # frames between keyframes (5 minutes at 1 fps)
+SLIDESHOW_SIZE = (1080, 1920)  # TikTok slideshows are portrait
+# Original audio stream for merging; AAC (m4a) is stream-copied into the MP4
+MERGE_AUDIO_FORMAT = "bestaudio[ext=m4a]/bestaudio/best"
+
+
+def write_concat_list(image_paths, list_path, image_duration):
+    """Write an ffmpeg concat demuxer list showing each image for image_duration seconds."""
+    with open(list_path, "w", encoding="utf-8") as f:
+        for image_path in image_paths:
+            escaped = image_path.replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            f.write(f"duration {image_duration:.3f}\n")
+        # The concat demuxer ignores the last duration unless the file is repeated
+        escaped = image_paths[-1].replace("'", "'\\''")
+        f.write(f"file '{escaped}'\n")
+    return list_path
+
+
+def merge_image_audio(image_paths, audio_path, output_path, duration=None):
+    """Merge still image(s) with audio into an MP4 video using ffmpeg.
+
+    A single image is encoded at STILL_IMAGE_FPS with a long GOP. Several
+    images become a slideshow in the same ffmpeg pass, each shown for an equal
+    share of the audio. AAC audio is stream-copied instead of re-encoded.
+    """
+    if isinstance(image_paths, str):
+        image_paths = [image_paths]
+
+    if len(image_paths) > 1:
+        if not duration:
+            duration = get_audio_duration(audio_path)
+        if not duration:
+            log("TIKTOK", "Unknown audio duration, using first image only")
+            image_paths = image_paths[:1]
+
+    if len(image_paths) > 1:
+        image_duration = duration / len(image_paths)
+        fps = max(STILL_IMAGE_FPS, math.ceil(1 / image_duration))
+        list_path = write_concat_list(
+            image_paths, os.path.splitext(output_path)[0] + "_images.txt", image_duration)
+        width, height = SLIDESHOW_SIZE
+        video_input = ["-f", "concat", "-safe", "0", "-i", list_path]
+        video_filter = (f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps}")
+    else:
+        fps = STILL_IMAGE_FPS
+        video_input = ["-loop", "1", "-framerate", str(fps), "-i", image_paths[0]]
+        # yuv420p needs even dimensions
+        video_filter = "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+
+    if get_audio_codec(audio_path) == "aac":
+        audio_args = ["-c:a", "copy"]
+    else:
+        audio_args = ["-c:a", "aac", "-b:a", "192k"]
+
+    threads, preset = ENCODE_GOVERNOR.acquire(kind="merge")
     command = [
         "ffmpeg", "-y",
-        "-loop", "1",
-        "-i", image_path,
+        *video_input,
         "-i", audio_path,
+        "-vf", video_filter,
         "-c:v", "libx264",
+        "-preset", preset,
+        "-threads", str(threads),
         "-tune", "stillimage",
-        "-c:a", "aac",
-        "-b:a", "192k",
+        "-r", str(fps),
+        "-g", str(STILL_IMAGE_GOP),
+        *audio_args,
         "-pix_fmt", "yuv420p",
         "-shortest",
         output_path
     ]
-    result = subprocess.run(command, capture_output=True, text=True, timeout=300)
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=300)
+    finally:
+        ENCODE_GOVERNOR.release(threads)
     if result.returncode != 0:
-        print(f"[TIKTOK] ffmpeg merge failed: {result.stderr}")
+        log("TIKTOK", f"ffmpeg merge failed: {result.stderr}", level=logging.WARNING)
         return None
     return output_path
 
@@ -416,185 +1436,1123 @@ def clean_youtube_url(url):
     return urllib.parse.urlunparse(parsed._replace(query=clean_query))
 
 
-def is_supported_url(text):
-    """Check if the text looks like a URL that yt-dlp might support."""
-    if not text:
-        return False
-    # Accept any http/https URL - let yt-dlp decide if it's supported
-    return bool(re.match(r'https?://', text.strip()))
+def is_supported_url(text):
+    """Check if the text looks like a URL that yt-dlp might support."""
+    if not text:
+        return False
+    # Accept any http/https URL - let yt-dlp decide if it's supported
+    return bool(re.match(r'https?://', text.strip()))
+
+
+# YouTube playlists and channel tabs (a watch?v=...&list=... link stays a single video)
+PLAYLIST_URL_PATTERN = re.compile(
+    r'https?://(www\.|m\.|music\.)?youtube\.com/'
+    r'(playlist\?|(@[^/?#]+|channel/[^/?#]+|c/[^/?#]+|user/[^/?#]+)/(videos|shorts|streams)\b)'
+)
+
+
+def is_playlist_url(url):
+    """Check if the URL points to a playlist or channel rather than one video."""
+    return bool(PLAYLIST_URL_PATTERN.match(url))
+
+
+# Duration and size seen while fetching titles, reused for disk admission
+MEDIA_PROBE_CACHE = TTLCache(256, 3600)
+# Number of entries the title probe listed, for URLs with more than one
+MEDIA_ENTRY_COUNTS = TTLCache(256, 3600)
+
+
+def parse_probe_number(value):
+    """Number printed by a yt-dlp --print template, or None for NA."""
+    try:
+        return float(value) if value not in ("", "NA", "None") else None
+    except ValueError:
+        return None
+
+
+def get_video_title(url):
+    """Get video title using yt-dlp.
+
+    The same call prints duration and approximate size, which are stored
+    in MEDIA_PROBE_CACHE. Multi-entry posts print both lines per entry;
+    their entry count goes to MEDIA_ENTRY_COUNTS.
+    """
+    try:
+        with METRICS.timer("ytdl_stage_seconds", stage="title"):
+            result = subprocess.run(
+                ["yt-dlp", "--skip-download",
+                 "--print", "%(title)s",
+                 "--print", "%(duration)s\t%(filesize,filesize_approx)s", url],
+                text=True,
+                capture_output=True,
+                timeout=30
+            )
+        if result.returncode != 0:
+            return "Unknown Title"
+        lines = result.stdout.strip().split("\n")
+        if len(lines) > 1 and "\t" in lines[1]:
+            duration, size = lines[1].split("\t", 1)
+            MEDIA_PROBE_CACHE.set(url, (parse_probe_number(duration), parse_probe_number(size)))
+        if len(lines) > 3:
+            MEDIA_ENTRY_COUNTS.set(url, len(lines) // 2)
+        return lines[0].strip()
+    except Exception as e:
+        log("PROBE", f"Error getting video title: {e}", level=logging.WARNING)
+        return "Unknown Title"
+
+
+def get_media_entries(url):
+    """List the entries of a multi-media post using yt-dlp flat extraction.
+
+    Returns (title, entries); entries is empty for single-media URLs.
+    """
+    try:
+        result = subprocess.run(
+            ["yt-dlp", "-J", "--flat-playlist", url],
+            text=True,
+            capture_output=True,
+            timeout=60
+        )
+        if result.returncode == 0 and result.stdout:
+            info = json.loads(result.stdout)
+            if info.get("_type") == "playlist":
+                entries = [entry for entry in info.get("entries") or [] if entry]
+                return info.get("title") or "Unknown Title", entries
+    except Exception as e:
+        log("PROBE", f"Error listing media entries: {e}", level=logging.WARNING)
+    return None, []
+
+
+def get_audio_duration(file_path):
+    """Get audio duration using ffprobe."""
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", file_path],
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+        if result.returncode == 0:
+            return int(float(result.stdout.strip()))
+    except Exception as e:
+        log("PROBE", f"Error getting audio duration: {e}", level=logging.WARNING)
+    return None
+
+
+def get_audio_codec(file_path):
+    """Get the codec name of the first audio stream using ffprobe."""
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a:0",
+             "-show_entries", "stream=codec_name",
+             "-of", "default=noprint_wrappers=1:nokey=1", file_path],
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+        if result.returncode == 0:
+            return result.stdout.strip()
+    except Exception as e:
+        log("PROBE", f"Error getting audio codec: {e}", level=logging.WARNING)
+    return None
+
+
+def get_thumbnail(url, folder):
+    """Download video thumbnail."""
+    try:
+        command = [
+            "yt-dlp",
+            "-o", os.path.join(folder, "_thumbnail.%(ext)s"),
+            "--write-thumbnail",
+            "--skip-download",
+            "--convert-thumbnails", "jpg",
+            url
+        ]
+        subprocess.run(command, capture_output=True, timeout=60)
+
+        # Find thumbnail file
+        for f in os.listdir(folder):
+            if 'thumbnail' in f.lower() and f.endswith('.jpg'):
+                return os.path.join(folder, f)
+    except Exception as e:
+        log("PROBE", f"Error getting thumbnail: {e}", level=logging.WARNING)
+    return None
+
+
+# Admin digest: with an interval set, routine admin events (incoming links,
+# sent files, failures) are batched into one summary message per interval.
+# Approval requests and unexpected errors are always sent at once.
+ADMIN_DIGEST_INTERVAL = 0  # seconds; 0 sends every event immediately
+ADMIN_DIGEST_TOP_URLS = 5
+ADMIN_DIGEST_MAX_FAILURES = 10
+
+
+class AdminDigest:
+    """Buffers admin events and sends them as one summary after ADMIN_DIGEST_INTERVAL.
+
+    In worker mode (db_path) events go to a table of the shared job
+    database: workers only record them, and the frontend, which calls
+    start(), sends one digest for all processes every interval.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self.events = []  # (kind, user_id, url, text)
+        self.started = None
+        self._flush_task = None
+        if db_path:
+            with contextlib.closing(connect_job_db(db_path)) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS digest_events ("
+                    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " kind TEXT NOT NULL,"
+                    " user_id INTEGER,"
+                    " url TEXT,"
+                    " text TEXT NOT NULL,"
+                    " created REAL NOT NULL)")
+
+    def add(self, kind, user_id, text, url=None):
+        """Buffer an event; the first one schedules the next digest."""
+        if self.db_path:
+            with contextlib.closing(connect_job_db(self.db_path)) as conn:
+                conn.execute(
+                    "INSERT INTO digest_events (kind, user_id, url, text, created) VALUES (?, ?, ?, ?, ?)",
+                    (kind, user_id, url, text, time.time()))
+            return
+        if not self.events:
+            self.started = time.time()
+        self.events.append((kind, user_id, url, text))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+        await self.flush()
+
+    def start(self):
+        """Send the shared events every ADMIN_DIGEST_INTERVAL (frontend of worker mode)."""
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+            await self.flush()
+
+    def _take(self):
+        """Remove and return the buffered events."""
+        if not self.db_path:
+            events, self.events = self.events, []
+            return events
+        with contextlib.closing(connect_job_db(self.db_path)) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("SELECT * FROM digest_events ORDER BY id").fetchall()
+            if rows:
+                conn.execute("DELETE FROM digest_events WHERE id <= ?", (rows[-1]["id"],))
+            conn.execute("COMMIT")
+        self.started = rows[0]["created"] if rows else None
+        return [(row["kind"], row["user_id"], row["url"], row["text"]) for row in rows]
+
+    def format(self, events):
+        minutes = (time.time() - self.started) / 60 if self.started else 0
+        users = {user_id for _, user_id, _, _ in events}
+        counts = Counter(kind for kind, _, _, _ in events)
+        lines = [f"Admin digest: {len(events)} events from {len(users)} users in {minutes:.0f} min",
+                 ", ".join(f"{kind}: {count}" for kind, count in counts.most_common())]
+        failures = [(user_id, url, text) for kind, user_id, url, text in events if kind == "failed"]
+        if failures:
+            lines.append("\nFailures:")
+            for user_id, url, text in failures[-ADMIN_DIGEST_MAX_FAILURES:]:
+                lines.append(f"- {user_id}: {text.splitlines()[0]} {url or ''}".rstrip())
+        urls = Counter(url for _, _, url, _ in events if url)
+        if urls:
+            lines.append("\nTop URLs:")
+            lines += [f"- {count}x {url}" for url, count in urls.most_common(ADMIN_DIGEST_TOP_URLS)]
+        return truncate_error("\n".join(lines))
+
+    async def flush(self):
+        """Send buffered events now (no-op when empty)."""
+        events = self._take()
+        if not events:
+            return
+        try:
+            await send_message(YTDL_ADMIN_CHAT_ID, self.format(events))
+        except Exception as e:
+            log("DIGEST", f"Failed to send admin digest: {e}", level=logging.WARNING)
+
+    async def close(self):
+        """Cancel the pending timer and send what is buffered.
+
+        Workers never start() a shared digest, so they leave its events to
+        the frontend.
+        """
+        task, self._flush_task = self._flush_task, None
+        await stop_task(task)
+        if task is not None or not self.db_path:
+            await self.flush()
+
+
+ADMIN_DIGEST = AdminDigest()
+
+
+async def notify_admin(chat_id, text, kind="info", url=None, urgent=False):
+    """Send a message to admin, unless the chat is already the admin chat.
+
+    In digest mode non-urgent events are buffered in ADMIN_DIGEST instead.
+    """
+    if chat_id == YTDL_ADMIN_CHAT_ID:
+        return
+    if urgent or not ADMIN_DIGEST_INTERVAL:
+        await send_message(YTDL_ADMIN_CHAT_ID, text)
+    else:
+        ADMIN_DIGEST.add(kind, chat_id, text, url)
+
+
+def truncate_error(text, max_len=3500):
+    """Truncate error text to fit within Telegram's 4096 char message limit."""
+    if len(text) <= max_len:
+        return text
+    return text[:max_len] + "\n...(truncated)"
+
+
+# Download modes for fragmented (HLS/DASH) sources:
+#   native    - yt-dlp default, fragments fetched one by one
+#   fragments - yt-dlp fetches CONCURRENT_FRAGMENTS fragments in parallel
+#   external  - external downloader with several connections per file
+DOWNLOAD_MODE = "auto"  # "auto" picks per domain from throughput history
+CONCURRENT_FRAGMENTS = 8
+EXTERNAL_DOWNLOADER = "aria2c"
+EXTERNAL_DOWNLOADER_ARGS = "aria2c:-c -x 8 -s 8 -k 1M"  # -c resumes partial files
+DOWNLOAD_EXPLORE_SAMPLES = 3  # measurements per mode before trusting the history
+DOWNLOAD_EXPLORE_RATE = 0.1  # chance to re-measure a non-best mode
+THROUGHPUT_HISTORY_SIZE = 20
+THROUGHPUT_SAVE_INTERVAL = 30  # seconds between writes of new samples to disk
+
+# Hosts that serve the same extractor under several names
+DOMAIN_ALIASES = {
+    "youtu.be": "youtube.com",
+    "music.youtube.com": "youtube.com",
+    "twitter.com": "x.com",
+}
+
+
+def get_domain(url):
+    """Get the extractor domain of a URL (lowercase, without www./m.)."""
+    domain = urllib.parse.urlparse(url).netloc.lower().split(":")[0]
+    for prefix in ("www.", "m."):
+        if domain.startswith(prefix):
+            domain = domain[len(prefix):]
+    return DOMAIN_ALIASES.get(domain, domain)
+
+
+class ThroughputHistory:
+    """Ring buffers of recent measurements persisted to JSON.
+
+    Keys are strings like "youtube.com:video:fragments"; each keeps the last
+    `size` values. New samples are written at most every `save_interval`
+    seconds (and on flush()); worker processes share the file, so a write
+    merges them into the latest saved history under a file lock.
+    """
+
+    def __init__(self, json_path, size=THROUGHPUT_HISTORY_SIZE, save_interval=THROUGHPUT_SAVE_INTERVAL):
+        self.json_path = json_path
+        self.size = size
+        self.save_interval = save_interval
+        config_dir = os.path.dirname(json_path)
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir)
+        self.config = JsonDict(json_path)
+        self.pending = {}  # key -> samples not written yet
+        self.saved = time.monotonic()
+        self._lock = threading.Lock()  # compress_video records from worker threads
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the history file lock."""
+        with open(self.json_path + ".lock", "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def record(self, key, value):
+        """Append a measurement, dropping the oldest beyond `size`."""
+        value = round(value, 3)
+        with self._lock:
+            values = list(self.config.get(key, []))
+            values.append(value)
+            self.config[key] = values[-self.size:]
+            self.pending.setdefault(key, []).append(value)
+            if time.monotonic() - self.saved >= self.save_interval:
+                self._save()
+
+    def flush(self):
+        """Write samples recorded since the last save."""
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self.saved = time.monotonic()
+        if not self.pending:
+            return
+        with self._locked():
+            config = JsonDict(self.json_path)
+            for key, values in self.pending.items():
+                config[key] = (list(config.get(key, [])) + values)[-self.size:]
+            config.save()
+        self.config = config
+        self.pending = {}
+
+    def samples(self, key):
+        """Recorded values for a key, oldest first."""
+        return list(self.config.get(key, []))
+
+    def median(self, key):
+        """Median of the recorded values, or None without samples."""
+        values = sorted(self.config.get(key, []))
+        if not values:
+            return None
+        middle = len(values) // 2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2
+
+
+THROUGHPUT_HISTORY = LazyObject(lambda: ThroughputHistory(THROUGHPUT_JSON_PATH))
+
+
+# Adaptive stage timeouts: expected duration from history times a margin, plus slack
+STAGE_TIMEOUT_MARGIN = 3
+STAGE_TIMEOUT_SLACK = 60  # seconds
+DOWNLOAD_MAX_TIMEOUT = 3 * 3600  # ceiling when nothing is known about the download
+DOWNLOAD_STALL_TIMEOUT = 60  # kill yt-dlp after this long without any progress
+LOCAL_DOMAIN = "local"  # history domain for stages that do not depend on the source
+
+
+def record_stage(domain, stage, elapsed, size=None, media_duration=None):
+    """Record bytes/sec and duration ratio (wall time / media time) of a finished stage."""
+    if elapsed <= 0:
+        return
+    METRICS.observe("ytdl_stage_seconds", elapsed, stage=stage)
+    if stage == "upload" and size:
+        METRICS.observe("ytdl_upload_bytes_per_second", size / elapsed, buckets=THROUGHPUT_BUCKETS)
+    if size:
+        THROUGHPUT_HISTORY.record(f"{domain}:{stage}:bps", size / elapsed)
+    if media_duration:
+        THROUGHPUT_HISTORY.record(f"{domain}:{stage}:ratio", elapsed / media_duration)
+
+
+def expected_stage_duration(domain, stage, size=None, media_duration=None):
+    """Expected seconds for a stage from history, or None if it cannot be estimated."""
+    if media_duration:
+        ratio = THROUGHPUT_HISTORY.median(f"{domain}:{stage}:ratio")
+        if ratio:
+            return ratio * media_duration
+    if size:
+        bps = THROUGHPUT_HISTORY.median(f"{domain}:{stage}:bps")
+        if bps:
+            return size / bps
+    return None
+
+
+def adaptive_timeout(domain, stage, default, size=None, media_duration=None):
+    """Timeout for a stage: expected duration with margins, or `default` without history."""
+    expected = expected_stage_duration(domain, stage, size, media_duration)
+    if expected is None:
+        return default
+    return int(expected * STAGE_TIMEOUT_MARGIN + STAGE_TIMEOUT_SLACK)
+
+
+class DownloadStalledError(subprocess.TimeoutExpired):
+    """Raised when a download makes no progress for too long."""
+
+    def __str__(self):
+        return f"Download stalled (no progress for {self.timeout:.0f}s)"
+
+
+def get_dir_size(path):
+    """Total size of all files under path (0 if it does not exist)."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+# Work directories. YTDL_TEMP_ROOT moves all job files (e.g. to fast NVMe);
+# YTDL_AUDIO_TEMP_ROOT can put audio-only jobs on tmpfs. Default: system temp.
+TEMP_ROOT = os.environ.get("YTDL_TEMP_ROOT") or None
+AUDIO_TEMP_ROOT = os.environ.get("YTDL_AUDIO_TEMP_ROOT") or None
+
+# Disk admission control
+DISK_FREE_MARGIN = 1 * GiB
+DISK_POLL_INTERVAL = 10
+DISK_DEFAULT_RESERVATION = {"video": 1 * GiB, "audio": 100 * MiB, "album": 100 * MiB,  # album: per item
+                            "tiktok_photo": 200 * MiB}
+DISK_RESERVATION_MARGIN = 1.2
+
+
+def make_temp_dir(prefix, audio=False):
+    """Create a job work directory under the configured temp root."""
+    root = (AUDIO_TEMP_ROOT if audio else None) or TEMP_ROOT
+    if root and not os.path.exists(root):
+        os.makedirs(root)
+    return tempfile.mkdtemp(prefix=prefix, dir=root)
+
+
+def estimate_job_bytes(kind, duration=None, size=None, count=1):
+    """Disk space a job may need in its work directory.
+
+    Videos over MAX_VIDEO_SIZE also need room for the compressed copy.
+    Audio needs the downloaded stream plus the MP3 (sized from duration).
+    Albums hold `count` items (size is the first item's), never compressed.
+    TikTok photo posts (photos, audio and the merged video) use the default.
+    """
+    if kind == "tiktok_photo":
+        return DISK_DEFAULT_RESERVATION["tiktok_photo"]
+    if kind == "album":
+        needed = (size or DISK_DEFAULT_RESERVATION["album"]) * count
+    elif kind == "audio":
+        if not duration:
+            return DISK_DEFAULT_RESERVATION["audio"]
+        needed = duration * MAX_AUDIO_BITRATE / 8 * 2
+    else:
+        if not size:
+            return DISK_DEFAULT_RESERVATION["video"]
+        needed = size + (MAX_VIDEO_SIZE if size > MAX_VIDEO_SIZE else 0)
+    return int(needed * DISK_RESERVATION_MARGIN)
+
+
+class DiskBudget:
+    """Reserves work-directory space per job so concurrent jobs cannot fill the disk.
+
+    A job is admitted when the filesystem's free space, minus what running
+    jobs have reserved and DISK_FREE_MARGIN, covers its estimate. Otherwise
+    it waits. A job is always admitted when nothing else holds a
+    reservation on that filesystem, so an oversized job cannot wait forever.
+
+    With db_path the reservations live in a table of the shared job
+    database, so worker processes admit jobs against one budget; each
+    process owns its rows under `owner`. Without it the budget covers this
+    process only.
+    """
+
+    def __init__(self, margin=DISK_FREE_MARGIN, poll_interval=DISK_POLL_INTERVAL, db_path=None, owner=None):
+        self.margin = margin
+        self.poll_interval = poll_interval
+        self.db_path = db_path
+        self.owner = str(owner if owner is not None else os.getpid())
+        self.reserved = {}  # this process's reservations per device
+        self.waiting = 0
+        self._released = None
+        if db_path:
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS disk_reservations ("
+                    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " device TEXT NOT NULL,"
+                    " bytes INTEGER NOT NULL,"
+                    " owner TEXT NOT NULL)")
+            # Rows of a previous run under this owner belong to jobs that died with it
+            self.clear(self.owner)
+
+    def _connect(self):
+        return connect_job_db(self.db_path)
+
+    def clear(self, owner=None):
+        """Drop shared reservations (of one owner, or all)."""
+        if not self.db_path:
+            return 0
+        with contextlib.closing(self._connect()) as conn:
+            if owner is None:
+                return conn.execute("DELETE FROM disk_reservations").rowcount
+            return conn.execute("DELETE FROM disk_reservations WHERE owner = ?", (owner,)).rowcount
+
+    @staticmethod
+    def device(path):
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            return path
+
+    def _available(self, path, reserved):
+        try:
+            free = shutil.disk_usage(path).free
+        except OSError:
+            return None
+        return free - reserved - self.margin
+
+    def available(self, path):
+        """Bytes free for new reservations on path's filesystem."""
+        device = self.device(path)
+        if not self.db_path:
+            return self._available(path, self.reserved.get(device, 0))
+        with contextlib.closing(self._connect()) as conn:
+            return self._available(path, self._db_reserved(conn, device))
+
+    @staticmethod
+    def _db_reserved(conn, device):
+        return conn.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM disk_reservations WHERE device = ?", (str(device),)).fetchone()[0]
+
+    def _try_reserve(self, path, device, nbytes):
+        """Reserve nbytes if they fit; returns (token or None, bytes available)."""
+        if not self.db_path:
+            reserved = self.reserved.get(device, 0)
+            available = self._available(path, reserved)
+            if available is None or available >= nbytes or not reserved:
+                return (device, nbytes, None), available
+            return None, available
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            reserved = self._db_reserved(conn, device)
+            available = self._available(path, reserved)
+            token = None
+            if available is None or available >= nbytes or not reserved:
+                cursor = conn.execute(
+                    "INSERT INTO disk_reservations (device, bytes, owner) VALUES (?, ?, ?)",
+                    (str(device), nbytes, self.owner))
+                token = (device, nbytes, cursor.lastrowid)
+            conn.execute("COMMIT")
+            return token, available
+
+    async def reserve(self, path, nbytes, on_wait=None):
+        """Wait until nbytes can be reserved on path's filesystem; returns a release token."""
+        device = self.device(path)
+        notified = False
+        while True:
+            token, available = self._try_reserve(path, device, nbytes)
+            if token is not None:
+                self.reserved[device] = self.reserved.get(device, 0) + nbytes
+                log("DISK", f"Reserved {nbytes / MiB:.0f} MiB on {path}")
+                return token
+            if not notified:
+                notified = True
+                log("DISK", f"Waiting for {nbytes / MiB:.0f} MiB on {path} ({available / MiB:.0f} MiB available)")
+                if on_wait:
+                    await on_wait()
+            # Re-check on release, or periodically as other processes free space
+            if self._released is None:
+                self._released = asyncio.Event()
+            released = self._released
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(released.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiting -= 1
+
+    def release(self, token):
+        device, nbytes, row_id = token
+        if row_id is not None:
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute("DELETE FROM disk_reservations WHERE id = ?", (row_id,))
+        remaining = self.reserved.get(device, 0) - nbytes
+        if remaining > 0:
+            self.reserved[device] = remaining
+        else:
+            self.reserved.pop(device, None)
+        if self._released is not None:
+            self._released.set()
+            self._released = None
+
+    def snapshot(self):
+        return {"reserved": sum(self.reserved.values()), "waiting": self.waiting}
+
+
+DISK_BUDGET = DiskBudget()
+
+
+async def reserve_disk(chat_id, url, kind, temp_dir, count=1):
+    """Reserve work-directory space for a job, telling the user if it has to wait."""
+    duration, size = MEDIA_PROBE_CACHE.get(url, (None, None))
+
+    async def notify():
+        msg = await send_message(chat_id, "Waiting for free disk space...")
+        add_status_message(chat_id, msg)
+
+    return await DISK_BUDGET.reserve(temp_dir, estimate_job_bytes(kind, duration, size, count), notify)
+
+
+def run_download_process(command, watch_dir, timeout, stall_timeout=DOWNLOAD_STALL_TIMEOUT, poll_interval=1):
+    """Run a download command, killing it when it stops making progress.
+
+    Progress is growth of watch_dir (including .part files) or of the
+    command's output. Raises DownloadStalledError after stall_timeout seconds
+    without progress and subprocess.TimeoutExpired after timeout seconds.
+    Returns a subprocess.CompletedProcess with text stdout/stderr.
+    """
+    with tempfile.TemporaryFile("w+") as out, tempfile.TemporaryFile("w+") as err:
+        process = subprocess.Popen(command, stdout=out, stderr=err, text=True)
+        start = last_progress = time.monotonic()
+        last_size = -1
+        try:
+            while True:
+                try:
+                    returncode = process.wait(timeout=poll_interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+
+                now = time.monotonic()
+                size = get_dir_size(watch_dir) + os.fstat(out.fileno()).st_size
+                if size != last_size:
+                    last_size = size
+                    last_progress = now
+                elif now - last_progress > stall_timeout:
+                    raise DownloadStalledError(command, stall_timeout)
+                if now - start > timeout:
+                    raise subprocess.TimeoutExpired(command, timeout)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+
+        out.seek(0)
+        err.seek(0)
+        return subprocess.CompletedProcess(command, returncode, out.read(), err.read())
+
+
+# Keep .part files and fragment state (.ytdl) so a restarted yt-dlp only
+# fetches what is missing; the native HLS downloader can resume fragments
+RESUME_ARGS = ["--continue", "--part"]
+NATIVE_HLS_ARGS = ["--hls-prefer-native"]
+MAX_STALL_RESTARTS = 20  # restarts allowed while every run makes progress
+
+
+async def run_resumable_download(command, watch_dir, timeout, tag):
+    """Run yt-dlp, restarting it after a stall as long as the stalled run made progress.
+
+    Restarts resume from the .part files and finished fragments in watch_dir,
+    so a network blip costs only the missing bytes and does not use up one of
+    the caller's retries. Raises DownloadStalledError when a run stalls without
+    downloading anything (or after MAX_STALL_RESTARTS restarts).
+    """
+    for restart in range(MAX_STALL_RESTARTS + 1):
+        size_before = get_dir_size(watch_dir)
+        if size_before:
+            log(tag, f"Resuming from {size_before / MiB:.1f} MiB of partial data")
+        try:
+            return await asyncio.to_thread(
+                run_download_process, command, watch_dir=watch_dir, timeout=timeout)
+        except DownloadStalledError:
+            if restart >= MAX_STALL_RESTARTS or get_dir_size(watch_dir) <= size_before:
+                raise
+            log(tag, f"Stalled after progress, restarting ({restart + 1}/{MAX_STALL_RESTARTS})", level=logging.WARNING)
+            METRICS.inc("ytdl_stall_restarts_total")
+
 
+def available_download_modes():
+    """Download modes usable on this host, default first."""
+    modes = ["fragments", "native"]
+    if shutil.which(EXTERNAL_DOWNLOADER):
+        modes.append("external")
+    return modes
 
-def get_video_title(url):
-    """Get video title using yt-dlp."""
-    try:
-        result = subprocess.run(
-            ["yt-dlp", "--get-title", url],
-            text=True,
-            capture_output=True,
-            timeout=30
-        )
-        return result.stdout.strip() if result.returncode == 0 else "Unknown Title"
-    except Exception as e:
-        print(f"Error getting video title: {e}")
-        return "Unknown Title"
 
+def download_mode_args(mode):
+    """yt-dlp arguments for a download mode (including resume options)."""
+    if mode == "fragments":
+        return RESUME_ARGS + NATIVE_HLS_ARGS + ["--concurrent-fragments", str(CONCURRENT_FRAGMENTS)]
+    if mode == "external":
+        return RESUME_ARGS + ["--downloader", EXTERNAL_DOWNLOADER, "--downloader-args", EXTERNAL_DOWNLOADER_ARGS]
+    return RESUME_ARGS + NATIVE_HLS_ARGS
 
-def get_audio_duration(file_path):
-    """Get audio duration using ffprobe."""
-    try:
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-             "-of", "default=noprint_wrappers=1:nokey=1", file_path],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        if result.returncode == 0:
-            return int(float(result.stdout.strip()))
-    except Exception as e:
-        print(f"Error getting audio duration: {e}")
-    return None
 
+def choose_download_mode(url, kind="video"):
+    """Pick the download mode with the best measured throughput for the URL's domain.
 
-def get_thumbnail(url, folder):
-    """Download video thumbnail."""
-    try:
-        command = [
-            "yt-dlp",
-            "-o", os.path.join(folder, "_thumbnail.%(ext)s"),
-            "--write-thumbnail",
-            "--skip-download",
-            "--convert-thumbnails", "jpg",
-            url
-        ]
-        subprocess.run(command, capture_output=True, timeout=60)
+    Every mode is measured DOWNLOAD_EXPLORE_SAMPLES times first; afterwards the
+    best median wins, with an occasional re-measurement of another mode.
+    """
+    if DOWNLOAD_MODE != "auto":
+        return DOWNLOAD_MODE
 
-        # Find thumbnail file
-        for f in os.listdir(folder):
-            if 'thumbnail' in f.lower() and f.endswith('.jpg'):
-                return os.path.join(folder, f)
-    except Exception as e:
-        print(f"Error getting thumbnail: {e}")
-    return None
+    domain = get_domain(url)
+    modes = available_download_modes()
+    keys = {mode: f"{domain}:{kind}:{mode}" for mode in modes}
 
+    for mode in modes:
+        if len(THROUGHPUT_HISTORY.samples(keys[mode])) < DOWNLOAD_EXPLORE_SAMPLES:
+            return mode
 
-async def notify_admin(chat_id, text):
-    """Send a message to admin, unless the chat is already the admin chat."""
-    if chat_id != YTDL_ADMIN_CHAT_ID:
-        await send_message(YTDL_ADMIN_CHAT_ID, text)
+    best = max(modes, key=lambda mode: THROUGHPUT_HISTORY.median(keys[mode]))
+    if len(modes) > 1 and random.random() < DOWNLOAD_EXPLORE_RATE:
+        return random.choice([mode for mode in modes if mode != best])
+    return best
 
 
-def truncate_error(text, max_len=3500):
-    """Truncate error text to fit within Telegram's 4096 char message limit."""
-    if len(text) <= max_len:
-        return text
-    return text[:max_len] + "\n...(truncated)"
+def record_download_throughput(url, kind, mode, path, elapsed, media_duration=None):
+    """Store bytes/sec of a finished download (per mode and per stage) in THROUGHPUT_HISTORY."""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    if size > 0 and elapsed > 0:
+        domain = get_domain(url)
+        THROUGHPUT_HISTORY.record(f"{domain}:{kind}:{mode}", size / elapsed)
+        record_stage(domain, "download", elapsed, size, media_duration)
 
 
-async def download_audio(url, temp_dir, max_retries=10):
+async def download_audio(url, temp_dir, max_retries=10, extra_args=None,
+                         expected_size=None, media_duration=None, keep_source=False,
+                         format_spec="bestaudio/best"):
     """Download YouTube audio only using yt-dlp with robust retry logic.
 
+    extra_args are passed to yt-dlp before the URL (e.g. --playlist-items).
+    expected_size/media_duration (when known) tighten the timeout using the
+    domain's history; stalls are detected from lack of progress either way.
+    keep_source skips the MP3 conversion and keeps the downloaded stream
+    (picked by format_spec) as source.<ext>, for encode_audio_renditions()
+    and merge_image_audio().
     Returns (path, None) on success or (None, error_string) on failure.
     """
-    output_path = os.path.join(temp_dir, 'audio.mp3')
+    output_path = os.path.join(temp_dir, 'source.%(ext)s' if keep_source else 'audio.mp3')
     last_error = "Unknown error"
+    mode = choose_download_mode(url, kind="audio")
+    domain = get_domain(url)
+    timeout = min(DOWNLOAD_MAX_TIMEOUT, adaptive_timeout(
+        domain, "download", DOWNLOAD_MAX_TIMEOUT, expected_size, media_duration))
+    log("AUDIO", f"Download mode: {mode}")
 
     yt_dlp_command = [
         "yt-dlp",
-        "-f", "bestaudio/best",
-        "-x",  # Extract audio
-        "--audio-format", "mp3",
-        "--audio-quality", "0",  # Best quality
+        "-f", format_spec,
+        *([] if keep_source else [
+            "-x",  # Extract audio
+            "--audio-format", "mp3",
+            "--audio-quality", "0",  # Best quality
+        ]),
+        *download_mode_args(mode),
         "-o", output_path,
+        *(extra_args or []),
         url
     ]
 
     for attempt in range(max_retries + 1):
         try:
-            print(f"[AUDIO] Download attempt {attempt + 1}/{max_retries + 1}")
-            result = subprocess.run(
-                yt_dlp_command,
-                capture_output=True,
-                text=True,
-                timeout=300  # 5 minute timeout
-            )
-            if result.returncode == 0 and os.path.exists(output_path):
-                print(f"[AUDIO] Download successful: {output_path}")
-                return output_path, None
+            log("AUDIO", f"Download attempt {attempt + 1}/{max_retries + 1}")
+            attempt_start = time.monotonic()
+            result = await run_resumable_download(yt_dlp_command, temp_dir, timeout, "AUDIO")
+            path = find_source_file(temp_dir) if keep_source else output_path
+            if result.returncode == 0 and path and os.path.exists(path):
+                log("AUDIO", f"Download successful: {path}")
+                record_download_throughput(
+                    url, "audio", mode, path, time.monotonic() - attempt_start, media_duration)
+                return path, None
             last_error = result.stderr.strip() or f"yt-dlp exited with code {result.returncode}"
-            print(f"[AUDIO] Attempt {attempt + 1} failed: {result.stderr}")
+            log("AUDIO", f"Attempt {attempt + 1} failed: {result.stderr}", level=logging.WARNING)
+        except DownloadStalledError as e:
+            last_error = str(e)
+            log("AUDIO", f"Attempt {attempt + 1} stalled", level=logging.WARNING)
         except subprocess.TimeoutExpired:
-            last_error = "Download timed out (5 minutes)"
-            print(f"[AUDIO] Attempt {attempt + 1} timed out")
+            last_error = f"Download timed out ({timeout}s)"
+            log("AUDIO", f"Attempt {attempt + 1} timed out", level=logging.WARNING)
         except Exception as e:
             last_error = str(e)
-            print(f"[AUDIO] Attempt {attempt + 1} error: {e}")
+            log("AUDIO", f"Attempt {attempt + 1} error: {e}", level=logging.WARNING)
 
         if attempt >= max_retries:
             break
 
         # Wait for internet before retry
-        print("[AUDIO] Waiting for internet connection...")
+        log("AUDIO", "Waiting for internet connection...")
         if not await wait_for_internet(max_wait=300, check_interval=10):
-            print("[AUDIO] Internet connection not restored after 5 minutes")
+            log("AUDIO", "Internet connection not restored after 5 minutes", level=logging.WARNING)
             return None, "Internet connection not restored after 5 minutes"
 
-        print(f"[AUDIO] Retrying download (attempt {attempt + 2}/{max_retries + 1})...")
+        log("AUDIO", f"Retrying download (attempt {attempt + 2}/{max_retries + 1})...")
+        METRICS.inc("ytdl_retries_total", stage="download")
 
     return None, last_error
 
 
-async def download_video(url, temp_dir, max_retries=10):
+def find_source_file(temp_dir):
+    """The finished source.<ext> written by download_audio(keep_source=True), or None."""
+    for name in sorted(os.listdir(temp_dir)):
+        if name.startswith("source.") and not name.endswith((".part", ".ytdl")):
+            return os.path.join(temp_dir, name)
+    return None
+
+
+async def download_video(url, temp_dir, max_retries=10, extra_args=None,
+                         expected_size=None, media_duration=None):
     """Download YouTube video using yt-dlp with robust retry logic.
 
+    extra_args are passed to yt-dlp before the URL (e.g. --playlist-items).
+    expected_size/media_duration (when known) tighten the timeout using the
+    domain's history; stalls are detected from lack of progress either way.
     Returns (path, None) on success or (None, error_string) on failure.
     """
     output_path = os.path.join(temp_dir, 'video.mp4')
     last_error = "Unknown error"
+    mode = choose_download_mode(url, kind="video")
+    domain = get_domain(url)
+    timeout = min(DOWNLOAD_MAX_TIMEOUT, adaptive_timeout(
+        domain, "download", DOWNLOAD_MAX_TIMEOUT, expected_size, media_duration))
+    log("VIDEO", f"Download mode: {mode}")
 
     yt_dlp_command = [
         "yt-dlp",
         "-f", "bestvideo[height<=1080]+bestaudio/best[height<=1080]/best",
         "--merge-output-format", "mp4",
+        *download_mode_args(mode),
         "-o", output_path,
+        *(extra_args or []),
         url
     ]
 
     for attempt in range(max_retries + 1):
         try:
-            print(f"[VIDEO] Download attempt {attempt + 1}/{max_retries + 1}")
-            result = subprocess.run(
-                yt_dlp_command,
-                capture_output=True,
-                text=True,
-                timeout=600  # 10 minute timeout
-            )
+            log("VIDEO", f"Download attempt {attempt + 1}/{max_retries + 1}")
+            attempt_start = time.monotonic()
+            result = await run_resumable_download(yt_dlp_command, temp_dir, timeout, "VIDEO")
             if result.returncode == 0 and os.path.exists(output_path):
-                print(f"[VIDEO] Download successful: {output_path}")
+                log("VIDEO", f"Download successful: {output_path}")
+                record_download_throughput(
+                    url, "video", mode, output_path, time.monotonic() - attempt_start, media_duration)
                 return output_path, None
             last_error = result.stderr.strip() or f"yt-dlp exited with code {result.returncode}"
-            print(f"[VIDEO] Attempt {attempt + 1} failed: {result.stderr}")
+            log("VIDEO", f"Attempt {attempt + 1} failed: {result.stderr}", level=logging.WARNING)
+        except DownloadStalledError as e:
+            last_error = str(e)
+            log("VIDEO", f"Attempt {attempt + 1} stalled", level=logging.WARNING)
         except subprocess.TimeoutExpired:
-            last_error = "Download timed out (10 minutes)"
-            print(f"[VIDEO] Attempt {attempt + 1} timed out")
+            last_error = f"Download timed out ({timeout}s)"
+            log("VIDEO", f"Attempt {attempt + 1} timed out", level=logging.WARNING)
         except Exception as e:
             last_error = str(e)
-            print(f"[VIDEO] Attempt {attempt + 1} error: {e}")
+            log("VIDEO", f"Attempt {attempt + 1} error: {e}", level=logging.WARNING)
 
         if attempt >= max_retries:
             break
 
         # Wait for internet before retry
-        print("[VIDEO] Waiting for internet connection...")
+        log("VIDEO", "Waiting for internet connection...")
         if not await wait_for_internet(max_wait=300, check_interval=10):
-            print("[VIDEO] Internet connection not restored after 5 minutes")
+            log("VIDEO", "Internet connection not restored after 5 minutes", level=logging.WARNING)
             return None, "Internet connection not restored after 5 minutes"
 
-        print(f"[VIDEO] Retrying download (attempt {attempt + 2}/{max_retries + 1})...")
+        log("VIDEO", f"Retrying download (attempt {attempt + 2}/{max_retries + 1})...")
+        METRICS.inc("ytdl_retries_total", stage="download")
 
     return None, last_error
 
 
+class EncodeGovernor:
+    """Shares CPU cores between concurrent ffmpeg encodes.
+
+    Every encode asks for a slot before starting ffmpeg and gets back a
+    -threads value and an x264 preset picked from queue depth and how long
+    the encode is allowed to take. A running ffmpeg keeps the -threads it
+    started with, so a new encode gets its share of the cores only as far
+    as they are not already held by running ones (always at least one).
+    """
+
+    PRESETS = ("medium", "fast", "veryfast")  # slowest (best quality) first
+    # Rough x264 throughput per thread as a multiple of realtime at 1080p.
+    # Only used for explicit deadlines; without one "fast" is the floor.
+    PRESET_SPEED = {"medium": 0.15, "fast": 0.25, "veryfast": 0.5}
+    DEADLINE_MARGIN = 0.5
+
+    def __init__(self, cpu_count=None):
+        self.cpu_count = cpu_count or os.cpu_count() or 1
+        self.active = 0
+        self.threads_in_use = 0
+        self.decisions = {preset: 0 for preset in self.PRESETS}
+        self.last_decision = None
+        self._lock = threading.Lock()
+
+    def choose(self, depth, video_length=None, deadline=None, in_use=0):
+        """Return (threads, preset) for an encode when `depth` encodes are running.
+
+        in_use is the number of threads the other running encodes hold.
+        """
+        depth = max(1, depth)
+        threads = max(1, min(self.cpu_count // depth, self.cpu_count - in_use))
+
+        # Queue depth caps quality: one encode may use medium, two share at fast
+        if depth >= 3:
+            candidates = self.PRESETS[2:]
+        elif depth == 2:
+            candidates = self.PRESETS[1:]
+        else:
+            candidates = self.PRESETS
+
+        if not (video_length and deadline):
+            # No deadline known: keep the "fast" default unless load forces faster
+            return threads, candidates[0] if depth > 1 else "fast"
+
+        # Pick the slowest preset expected to finish within half the deadline
+        required_speed = video_length / (deadline * self.DEADLINE_MARGIN)
+        for preset in candidates:
+            if self.PRESET_SPEED[preset] * threads >= required_speed:
+                return threads, preset
+        return threads, candidates[-1]
+
+    def acquire(self, video_length=None, deadline=None, kind="encode"):
+        """Register a running encode and return its (threads, preset); pass threads to release()."""
+        with self._lock:
+            self.active += 1
+            depth = self.active
+            threads, preset = self.choose(depth, video_length, deadline, self.threads_in_use)
+            self.threads_in_use += threads
+            self.decisions[preset] += 1
+            self.last_decision = {
+                "kind": kind,
+                "threads": threads,
+                "preset": preset,
+                "depth": depth,
+            }
+        METRICS.inc("ytdl_encode_decisions_total", preset=preset, kind=kind)
+        log("ENCODE", f"{kind}: {threads} threads, preset {preset} ({depth} running, {self.cpu_count} CPUs)")
+        return threads, preset
+
+    def release(self, threads):
+        """Mark an encode that was given `threads` as finished."""
+        with self._lock:
+            self.active = max(0, self.active - 1)
+            self.threads_in_use = max(0, self.threads_in_use - threads)
+
+    def snapshot(self):
+        """Current state for metrics."""
+        with self._lock:
+            return {
+                "cpu_count": self.cpu_count,
+                "active": self.active,
+                "threads": self.threads_in_use,
+                "decisions": dict(self.decisions),
+                "last_decision": dict(self.last_decision) if self.last_decision else None,
+            }
+
+
+ENCODE_GOVERNOR = EncodeGovernor()
+
+
+# Audio quality ladder: the "Audio" button sends one best-quality MP3; these
+# renditions are offered as extra buttons. The first request for a URL
+# downloads the source stream once and encodes every rendition in a single
+# ffmpeg run (one decode, one encoder per output). All of them are cached,
+# so choosing another quality of the same URL later skips the download.
+AUDIO_RENDITIONS = {
+    "voice": {"label": "Voice", "ext": "ogg",
+              "args": ["-c:a", "libopus", "-b:a", "32k", "-ac", "1", "-application", "voip"]},
+    "64": {"label": "64k", "ext": "mp3", "args": ["-c:a", "libmp3lame", "-b:a", "64k"]},
+    "128": {"label": "128k", "ext": "mp3", "args": ["-c:a", "libmp3lame", "-b:a", "128k"]},
+    "320": {"label": "320k", "ext": "mp3", "args": ["-c:a", "libmp3lame", "-b:a", "320k"]},
+}
+AUDIO_RENDITION_KIND = "audio_"  # job kind prefix: "audio_128" sends the 128k rendition
+AUDIO_RENDITION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio_cache")
+AUDIO_RENDITION_TTL = 7 * 24 * 3600  # entries unused this long are removed
+AUDIO_RENDITION_CACHE_BYTES = 2 * GiB
+AUDIO_RENDITION_TIMEOUT = 600
+AUDIO_RENDITION_THUMBNAIL = "thumbnail.jpg"
+
+
+def encode_audio_renditions(source_path, out_dir, renditions=None, timeout=AUDIO_RENDITION_TIMEOUT):
+    """Encode source_path to every rendition with one ffmpeg run.
+
+    The audio stream is decoded once and fed to one encoder per output.
+    Returns {rendition: path} for the outputs that were written ({} on failure).
+    """
+    renditions = renditions or AUDIO_RENDITIONS
+    outputs = {name: os.path.join(out_dir, f"{name}.{spec['ext']}") for name, spec in renditions.items()}
+    command = ["ffmpeg", "-y", "-i", source_path]
+    for name, spec in renditions.items():
+        command += ["-map", "0:a:0", "-map_metadata", "0", *spec["args"], outputs[name]]
+
+    threads, _ = ENCODE_GOVERNOR.acquire(kind="audio ladder")
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        log("ENCODE", f"Audio ladder timed out after {timeout}s", level=logging.WARNING)
+        return {}
+    finally:
+        ENCODE_GOVERNOR.release(threads)
+    if result.returncode != 0:
+        log("ENCODE", f"Audio ladder failed: {result.stderr}", level=logging.WARNING)
+        return {}
+    return {name: path for name, path in outputs.items()
+            if os.path.exists(path) and os.path.getsize(path) > 0}
+
+
+class AudioRenditionCache:
+    """Encoded audio renditions on disk, one directory per URL.
+
+    A directory holds the <rendition>.<ext> files, the thumbnail and
+    meta.json (title, duration). Entries unused for `ttl` seconds are
+    removed on store(), then the least recently used ones until the cache
+    fits in max_bytes.
+    """
+
+    def __init__(self, root, ttl=AUDIO_RENDITION_TTL, max_bytes=AUDIO_RENDITION_CACHE_BYTES):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def entry_dir(self, url):
+        digest = hashlib.sha1(clean_youtube_url(url).encode()).hexdigest()[:16]
+        return os.path.join(self.root, digest)
+
+    def get(self, url, rendition):
+        """Metadata of a cached rendition with its "path" and "thumbnail", or None."""
+        entry = self.entry_dir(url)
+        path = os.path.join(entry, f"{rendition}.{AUDIO_RENDITIONS[rendition]['ext']}")
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(path):
+            return None
+        os.utime(entry)  # mark as recently used
+        thumbnail = os.path.join(entry, AUDIO_RENDITION_THUMBNAIL)
+        return dict(meta, path=path, thumbnail=thumbnail if os.path.exists(thumbnail) else None)
+
+    def store(self, url, renditions, meta, thumbnail=None):
+        """Move encoded renditions ({rendition: path}) and the thumbnail into url's entry."""
+        entry = self.entry_dir(url)
+        os.makedirs(entry, exist_ok=True)
+        for name, path in renditions.items():
+            shutil.move(path, os.path.join(entry, f"{name}.{AUDIO_RENDITIONS[name]['ext']}"))
+        if thumbnail:
+            shutil.move(thumbnail, os.path.join(entry, AUDIO_RENDITION_THUMBNAIL))
+        # meta.json last: get() only sees complete entries
+        tmp_path = os.path.join(entry, "meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(entry, "meta.json"))
+        self.prune(keep=entry)
+
+    def prune(self, keep=None, now=None):
+        """Drop expired entries, then the least recently used while over max_bytes."""
+        now = now or time.time()
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                entries.append((os.path.getmtime(path), get_dir_size(path), path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if path == keep:
+                continue
+            if now - mtime > self.ttl or total > self.max_bytes:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+AUDIO_RENDITION_CACHE = AudioRenditionCache(AUDIO_RENDITION_DIR)
+
+
 def get_new_video_info(video_path):
     """Calculate target resolution, bitrates, and FPS based on video properties.
 
@@ -696,8 +2654,13 @@ def get_new_video_info(video_path):
     return new_video_bitrate, new_audio_bitrate, new_width, new_height, new_fps, video_fps, video_length
 
 
-def compress_video(video_path, chat_id=None):
-    """Compress video using ffmpeg with software encoding (libx264)."""
+def compress_video(video_path, chat_id=None, deadline=None):
+    """Compress video using ffmpeg with software encoding (libx264).
+
+    `deadline` is the number of seconds the encode may take. Given, it drives
+    the preset chosen by ENCODE_GOVERNOR; otherwise the encode runs at "fast"
+    (or faster under load) within the compression timeout.
+    """
     ext = os.path.splitext(video_path)[1]
     compressed_path = video_path.replace(ext, "_compressed.mp4")
 
@@ -706,51 +2669,63 @@ def compress_video(video_path, chat_id=None):
     fps_info = ""
     if new_fps != original_fps:
         fps_info = f", fps: {original_fps:.1f}->{new_fps:.1f}"
-    print(f"Compressing to {new_width}x{new_height}, "
-          f"video: {new_video_bitrate/KiB:.0f}kbps, audio: {new_audio_bitrate/KiB:.0f}kbps{fps_info}")
-
-    # Timeout: 10x video length (minimum 60 seconds)
-    compression_timeout = max(60, int(video_length * 10))
-
-    for attempt in range(5):
-        # Build video filter (scale + optional fps reduction)
-        vf_filters = [f"scale={new_width}:{new_height}"]
-        if new_fps != original_fps:
-            vf_filters.append(f"fps={new_fps}")
-        vf_string = ",".join(vf_filters)
-
-        command = [
-            "ffmpeg", "-y",
-            "-i", video_path,
-            "-vf", vf_string,
-            "-c:v", "libx264",
-            "-preset", "fast",
-            "-b:v", str(int(new_video_bitrate)),
-            "-c:a", "aac",
-            "-b:a", str(int(new_audio_bitrate)),
-            compressed_path
-        ]
-
-        print(f"Compression attempt {attempt + 1}/5")
-        try:
-            result = subprocess.run(command, capture_output=True, text=True, timeout=compression_timeout)
-        except subprocess.TimeoutExpired:
-            print(f"ffmpeg timed out after {compression_timeout}s")
-            return None, None, None
-
-        if result.returncode != 0:
-            print(f"ffmpeg failed: {result.stderr}")
-            return None, None, None
-
-        compressed_size = os.path.getsize(compressed_path)
-        print(f"Compressed size: {compressed_size / MiB:.1f} MiB")
+    log("COMPRESS", f"Compressing to {new_width}x{new_height}, "
+        f"video: {new_video_bitrate/KiB:.0f}kbps, audio: {new_audio_bitrate/KiB:.0f}kbps{fps_info}")
 
-        if compressed_size <= MAX_VIDEO_SIZE:
-            return compressed_path, new_width, new_height
+    # Timeout: 10x video length (minimum 60 seconds), raised by encode history.
+    # The history is learned from encodes that often had every core; one
+    # started under load may get a single thread, so it never lowers the limit.
+    default_timeout = max(60, int(video_length * 10))
+    compression_timeout = max(default_timeout, adaptive_timeout(
+        LOCAL_DOMAIN, "compress", default_timeout, media_duration=video_length))
 
-        # Reduce bitrate and retry
-        print(f"Still too large, reducing bitrate by 10%")
-        new_video_bitrate = int(new_video_bitrate * 0.9)
+    threads, preset = ENCODE_GOVERNOR.acquire(video_length, deadline, kind="compress")
+    try:
+        for attempt in range(5):
+            # Build video filter (scale + optional fps reduction)
+            vf_filters = [f"scale={new_width}:{new_height}"]
+            if new_fps != original_fps:
+                vf_filters.append(f"fps={new_fps}")
+            vf_string = ",".join(vf_filters)
+
+            command = [
+                "ffmpeg", "-y",
+                "-i", video_path,
+                "-vf", vf_string,
+                "-c:v", "libx264",
+                "-preset", preset,
+                "-threads", str(threads),
+                "-b:v", str(int(new_video_bitrate)),
+                "-c:a", "aac",
+                "-b:a", str(int(new_audio_bitrate)),
+                compressed_path
+            ]
+
+            log("COMPRESS", f"Compression attempt {attempt + 1}/5")
+            attempt_start = time.monotonic()
+            try:
+                result = subprocess.run(command, capture_output=True, text=True, timeout=compression_timeout)
+            except subprocess.TimeoutExpired:
+                log("COMPRESS", f"ffmpeg timed out after {compression_timeout}s", level=logging.WARNING)
+                return None, None, None
+
+            if result.returncode != 0:
+                log("COMPRESS", f"ffmpeg failed: {result.stderr}", level=logging.WARNING)
+                return None, None, None
+
+            compressed_size = os.path.getsize(compressed_path)
+            log("COMPRESS", f"Compressed size: {compressed_size / MiB:.1f} MiB")
+            record_stage(LOCAL_DOMAIN, "compress", time.monotonic() - attempt_start,
+                         media_duration=video_length)
+
+            if compressed_size <= MAX_VIDEO_SIZE:
+                return compressed_path, new_width, new_height
+
+            # Reduce bitrate and retry
+            log("COMPRESS", "Still too large, reducing bitrate by 10%")
+            new_video_bitrate = int(new_video_bitrate * 0.9)
+    finally:
+        ENCODE_GOVERNOR.release(threads)
 
     return None, None, None
 
@@ -772,7 +2747,7 @@ async def wait_for_internet(max_wait=300, check_interval=10):
         if await check_internet():
             return True
         elapsed = int(time.time() - start)
-        print(f"[NET] Waiting for internet... ({elapsed}s)")
+        log("NET", f"Waiting for internet... ({elapsed}s)")
         await asyncio.sleep(check_interval)
     return False
 
@@ -804,7 +2779,7 @@ class UploadProgressCallback:
 
         # Print progress update
         retry_info = f" (retry {self.retry_attempt}/{self.max_retries})" if self.retry_attempt > 0 else ""
-        print(f"[UPLOAD] {percent:.1f}% ({mib_per_min:.1f} MiB/min){retry_info} - {elapsed/60:.1f} min elapsed")
+        log("UPLOAD", f"{percent:.1f}% ({mib_per_min:.1f} MiB/min){retry_info} - {elapsed/60:.1f} min elapsed")
 
         try:
             # Build message with optional retry info
@@ -827,7 +2802,7 @@ class UploadFailedError(Exception):
 
 
 class ConsoleProgressCallback:
-    """Simple progress callback for console output (prints every 10 seconds)."""
+    """Simple progress callback for console output (logs every 10 seconds)."""
 
     def __init__(self, file_size):
         self.file_size = file_size
@@ -846,7 +2821,83 @@ class ConsoleProgressCallback:
         elapsed = now - self.start_time
         mib_per_min = (current / MiB) / (elapsed / 60) if elapsed > 0 else 0
 
-        print(f"[UPLOAD] {percent:.1f}% ({mib_per_min:.1f} MiB/min) - {elapsed/60:.1f} min elapsed")
+        log("UPLOAD", f"{percent:.1f}% ({mib_per_min:.1f} MiB/min) - {elapsed/60:.1f} min elapsed")
+
+
+# Upload parts. Telegram takes up to 512 KiB per part and wants
+# SaveBigFilePart (no MD5) for files over 10 MiB.
+UPLOAD_PART_SIZE = 512 * KiB
+UPLOAD_BIG_FILE_SIZE = 10 * MiB
+
+
+class MmapUpload:
+    """Uploads a file to Telegram in parts sliced from an mmap of it.
+
+    Parts are memoryview slices of the mapping: no read() buffers, and the
+    only copy is the bytes() Telethon's request serializer requires, one
+    part at a time. Each part's pages are dropped from the process once it
+    is sent, so RSS stays flat whatever the file size and number of
+    parallel uploads. Parts Telegram confirmed are remembered, so calling
+    upload() again after a failure sends only the missing ones under the
+    same file id.
+    """
+
+    def __init__(self, path, part_size=None):
+        self.path = path
+        self.file_size = os.path.getsize(path)
+        if not self.file_size:
+            raise ValueError(f"Cannot upload empty file {path}")
+        self.part_size = part_size = part_size or UPLOAD_PART_SIZE
+        self.part_count = (self.file_size + part_size - 1) // part_size
+        self.is_big = self.file_size > UPLOAD_BIG_FILE_SIZE
+        self.file_id = random.randrange(-2 ** 63, 2 ** 63)
+        self.done = set()
+        self.md5 = None
+
+    def part_bounds(self, index):
+        start = index * self.part_size
+        return start, min(start + self.part_size, self.file_size)
+
+    def sent_bytes(self):
+        return sum(end - start for start, end in map(self.part_bounds, self.done))
+
+    async def upload(self, client, progress_callback=None):
+        """Send the missing parts through client and return the InputFile handle for send_file()."""
+        from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+        from telethon.tl.types import InputFileBig
+        from telethon.tl.custom import InputSizedFile
+
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                if not self.is_big and self.md5 is None:
+                    self.md5 = hashlib.md5(view)
+                for index in range(self.part_count):
+                    if index in self.done:
+                        continue
+                    start, end = self.part_bounds(index)
+                    with view[start:end] as part:
+                        if self.is_big:
+                            request = SaveBigFilePartRequest(self.file_id, index, self.part_count, bytes(part))
+                        else:
+                            request = SaveFilePartRequest(self.file_id, index, bytes(part))
+                    if not await client(request):
+                        raise RuntimeError(f"Failed to upload file part {index}")
+                    self.done.add(index)
+                    if hasattr(mapped, "madvise"):
+                        # madvise wants a page-aligned start; a shared page just refaults
+                        aligned = start - start % mmap.PAGESIZE
+                        mapped.madvise(mmap.MADV_DONTNEED, aligned, end - aligned)
+                    if progress_callback:
+                        result = progress_callback(self.sent_bytes(), self.file_size)
+                        if asyncio.iscoroutine(result):
+                            await result
+
+        name = os.path.basename(self.path)
+        if self.is_big:
+            return InputFileBig(self.file_id, self.part_count, name)
+        return InputSizedFile(self.file_id, self.part_count, name, md5=self.md5, size=self.file_size)
 
 
 async def send_media_telethon(
@@ -854,7 +2905,7 @@ async def send_media_telethon(
     media_type,  # "video" or "audio"
     width=None, height=None,  # video only
     title=None,  # audio only
-    status_message_id=None, file_size=None, max_retries=10
+    status_message_id=None, file_size=None, max_retries=10, source_url=None, fingerprint=None
 ):
     """Send video or audio using Telethon for large files with retry logic.
 
@@ -862,7 +2913,12 @@ async def send_media_telethon(
         media_type: "video" or "audio"
         width, height: Required for video
         title: Required for audio
+        source_url: Record the upload in UPLOAD_CACHE under this URL
+        fingerprint: Record the upload in FINGERPRINT_INDEX under this media_fingerprint()
     """
+    from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeFilename, DocumentAttributeAudio
+    from telethon.errors import FilePartMissingError
+
     # Build attributes based on media type
     if media_type == "video":
         media_attributes = DocumentAttributeVideo(
@@ -883,58 +2939,70 @@ async def send_media_telethon(
         file_attributes = DocumentAttributeFilename(file_name=os.path.basename(file_path))
         attributes = [media_attributes, file_attributes]
     else:
-        # For audio, use title as filename (with .mp3 extension) so it displays correctly
+        # For audio, use title as filename (with the file's extension) so it displays correctly
         safe_title = (title or "audio").replace("/", "-").replace("\\", "-")
-        file_attributes = DocumentAttributeFilename(file_name=f"{safe_title}.mp3")
+        extension = os.path.splitext(file_path)[1] or ".mp3"
+        file_attributes = DocumentAttributeFilename(file_name=f"{safe_title}{extension}")
         attributes = [media_attributes, file_attributes]
 
+    # Parts sent before a failure are kept, a retry only sends the rest
+    upload = MmapUpload(file_path)
     for attempt in range(max_retries + 1):
         try:
             if not TELETHON_CLIENT.is_connected():
                 await TELETHON_CLIENT.connect()
 
+            upload_start = time.monotonic()
             if status_message_id and file_size:
                 callback = UploadProgressCallback(chat_id, status_message_id, file_size, media_type, retry_attempt=attempt, max_retries=max_retries)
             else:
                 callback = ConsoleProgressCallback(file_size or os.path.getsize(file_path))
 
-            await TELETHON_CLIENT.send_file(
+            input_file = await upload.upload(TELETHON_CLIENT, callback)
+            sent = await TELETHON_CLIENT.send_file(
                 entity=chat_id,
-                file=file_path,
+                file=input_file,
                 attributes=attributes,
                 caption=caption,
-                thumb=thumbnail,
-                progress_callback=callback
+                thumb=thumbnail
             )
-            print()  # New line after progress
-            return  # Success
+            record_stage(LOCAL_DOMAIN, "upload", time.monotonic() - upload_start,
+                         size=file_size or os.path.getsize(file_path))
+            if source_url:
+                bot_file_id = await get_bot_file_id(chat_id, sent.id, media_type)
+                await asyncio.to_thread(record_upload, source_url, media_type, sent, title, caption, duration,
+                                        fingerprint, bot_file_id)
+            return sent  # Success
 
         except Exception as e:
-            print(f"\n[UPLOAD] Error on attempt {attempt + 1}/{max_retries + 1}: {type(e).__name__}: {e}")
+            log("UPLOAD", f"Error on attempt {attempt + 1}/{max_retries + 1}: {type(e).__name__}: {e}", level=logging.WARNING)
+            if isinstance(e, FilePartMissingError):
+                upload.done.discard(e.which)
 
             if attempt >= max_retries:
                 raise UploadFailedError(f"Upload failed after {max_retries + 1} attempts: {e}")
 
             # Disconnect Telethon client
-            print("[UPLOAD] Disconnecting Telethon...")
+            log("UPLOAD", "Disconnecting Telethon...")
             try:
                 await TELETHON_CLIENT.disconnect()
             except Exception:
                 pass
 
             # Wait for internet before retry
-            print("[UPLOAD] Waiting for internet connection...")
+            log("UPLOAD", "Waiting for internet connection...")
             if not await wait_for_internet(max_wait=300, check_interval=10):
                 raise UploadFailedError(f"Internet connection not restored after 5 minutes")
 
             # Reconnect Telethon client
-            print("[UPLOAD] Reconnecting Telethon...")
+            log("UPLOAD", "Reconnecting Telethon...")
             try:
                 await TELETHON_CLIENT.connect()
             except Exception as conn_err:
-                print(f"[UPLOAD] Reconnect failed: {conn_err}, will retry on next attempt")
+                log("UPLOAD", f"Reconnect failed: {conn_err}, will retry on next attempt", level=logging.WARNING)
 
-            print(f"[UPLOAD] Retrying upload (attempt {attempt + 2}/{max_retries + 1})...")
+            log("UPLOAD", f"Retrying upload (attempt {attempt + 2}/{max_retries + 1})...")
+            METRICS.inc("ytdl_retries_total", stage="upload")
 
             # Update user message immediately with retry info
             if status_message_id and file_size:
@@ -948,37 +3016,153 @@ async def send_media_telethon(
                     pass
 
 
-async def send_video_telethon(chat_id, video_path, caption, width, height, duration, thumbnail, status_message_id=None, file_size=None, max_retries=10):
+async def send_video_telethon(chat_id, video_path, caption, width, height, duration, thumbnail, status_message_id=None, file_size=None, max_retries=10, source_url=None, fingerprint=None):
     """Send video using Telethon. Wrapper for send_media_telethon()."""
-    await send_media_telethon(
+    return await send_media_telethon(
         chat_id, video_path, caption, duration, thumbnail,
         media_type="video",
         width=width, height=height,
-        status_message_id=status_message_id, file_size=file_size, max_retries=max_retries
+        status_message_id=status_message_id, file_size=file_size, max_retries=max_retries,
+        source_url=source_url, fingerprint=fingerprint
     )
 
 
-async def send_audio_telethon(chat_id, audio_path, caption, title, duration, thumbnail, status_message_id=None, file_size=None, max_retries=10):
+async def send_audio_telethon(chat_id, audio_path, caption, title, duration, thumbnail, status_message_id=None, file_size=None, max_retries=10, source_url=None):
     """Send audio using Telethon. Wrapper for send_media_telethon()."""
-    await send_media_telethon(
+    return await send_media_telethon(
         chat_id, audio_path, caption, duration, thumbnail,
         media_type="audio",
         title=title,
-        status_message_id=status_message_id, file_size=file_size, max_retries=max_retries
+        status_message_id=status_message_id, file_size=file_size, max_retries=max_retries,
+        source_url=source_url
     )
 
 
+# Telethon's packed file ids carry no file_reference, which the Bot API
+# needs to send cached media. Uploads are forwarded here (then deleted) to
+# learn their Bot API file_id for inline answers.
+FILE_ID_CHAT_ID = YTDL_ADMIN_CHAT_ID
+
+
+async def get_bot_file_id(chat_id, message_id, media_type):
+    """Bot API file_id of a message the bot sent with Telethon, or None."""
+    try:
+        forwarded = await BOT.forward_message(FILE_ID_CHAT_ID, chat_id, message_id, disable_notification=True)
+        media = getattr(forwarded, media_type, None) or getattr(forwarded, "document", None)
+        await BOT.delete_message(FILE_ID_CHAT_ID, forwarded.message_id)
+    except Exception as e:
+        log("UPLOAD", f"Could not get the file_id of message {message_id}: {e}", level=logging.WARNING)
+        return None
+    return media.file_id if media else None
+
+
+def record_upload(url, media_type, message, title, caption, duration=None, fingerprint=None, bot_file_id=None):
+    """Remember the uploaded document for inline answers and dedup.
+
+    file_id is Telethon's packed id, used to re-send with Telethon;
+    bot_file_id (from get_bot_file_id) is what inline answers send.
+    """
+    try:
+        from telethon.utils import pack_bot_file_id
+        file_id = pack_bot_file_id(getattr(message, "document", None))
+        if not file_id:
+            return
+        entry = {
+            "file_id": file_id,
+            "bot_file_id": bot_file_id,
+            "title": title or (caption or "").split("\n", 1)[0] or url,
+            "caption": caption,
+            "duration": duration,
+            "uploaded": Time.dotted(),
+        }
+        UPLOAD_CACHE.set(url, media_type, entry)
+        if fingerprint:
+            FINGERPRINT_INDEX.set(fingerprint, media_type, dict(entry, url=url))
+    except Exception as e:
+        log("UPLOAD", f"Could not cache upload of {url}: {e}", level=logging.WARNING)
+
+
+async def resend_duplicate(chat_id, url, media_type, fingerprint, caption):
+    """Re-send the document already uploaded for fingerprint; False if there is none or it failed."""
+    entry = FINGERPRINT_INDEX.get(fingerprint, media_type)
+    if not entry:
+        return False
+    log("DEDUP", f"{url} matches the upload of {entry.get('url')}, re-sending it")
+    try:
+        if not TELETHON_CLIENT.is_connected():
+            await TELETHON_CLIENT.connect()
+        await TELETHON_CLIENT.send_file(entity=chat_id, file=entry["file_id"], caption=caption)
+    except Exception as e:
+        log("DEDUP", f"Re-sending cached upload failed, uploading again: {type(e).__name__}: {e}",
+            level=logging.WARNING)
+        return False
+    METRICS.inc("ytdl_duplicate_uploads_skipped_total", kind=media_type)
+    # The new URL gets inline answers from the same document
+    cached = dict(entry, caption=caption)
+    cached.pop("url", None)
+    await asyncio.to_thread(UPLOAD_CACHE.set, url, media_type, cached)
+    return True
+
+
+async def send_album_telethon(chat_id, file_paths, caption=None, max_retries=10):
+    """Send files as Telegram albums using Telethon with retry logic.
+
+    Each album is a single send_file() call with a list of up to
+    ALBUM_MAX_ITEMS files; the caption goes on the first album.
+    """
+    for start in range(0, len(file_paths), ALBUM_MAX_ITEMS):
+        chunk = file_paths[start:start + ALBUM_MAX_ITEMS]
+        chunk_caption = caption if start == 0 else None
+
+        for attempt in range(max_retries + 1):
+            try:
+                if not TELETHON_CLIENT.is_connected():
+                    await TELETHON_CLIENT.connect()
+
+                await TELETHON_CLIENT.send_file(
+                    entity=chat_id,
+                    file=chunk,
+                    caption=chunk_caption,
+                    supports_streaming=True
+                )
+                log("ALBUM", f"Sent {len(chunk)} items")
+                break
+
+            except Exception as e:
+                log("ALBUM", f"Error on attempt {attempt + 1}/{max_retries + 1}: {type(e).__name__}: {e}", level=logging.WARNING)
+
+                if attempt >= max_retries:
+                    raise UploadFailedError(f"Album upload failed after {max_retries + 1} attempts: {e}")
+
+                try:
+                    await TELETHON_CLIENT.disconnect()
+                except Exception:
+                    pass
+
+                log("ALBUM", "Waiting for internet connection...")
+                if not await wait_for_internet(max_wait=300, check_interval=10):
+                    raise UploadFailedError("Internet connection not restored after 5 minutes")
+
+                try:
+                    await TELETHON_CLIENT.connect()
+                except Exception as conn_err:
+                    log("ALBUM", f"Reconnect failed: {conn_err}, will retry on next attempt", level=logging.WARNING)
+                METRICS.inc("ytdl_retries_total", stage="upload")
+
+
 @BOT.message_handler(commands=['help'])
 async def handle_help(message):
     """Handle /help command."""
     chat_id = message.chat.id
     user_id = message.from_user.id
 
-    text = "Send a video link to download video or audio."
+    text = ("Send a video link to download video or audio.\n"
+            "Inline: type @<bot> <link> in any chat to share a video that was downloaded before.")
 
     # Show admin commands
     if user_id == YTDL_ADMIN_CHAT_ID:
-        text += "\n\nAdmin commands:\n/revoke <user_id> - revoke user access"
+        text += ("\n\nAdmin commands:\n/revoke <user_id> - revoke user access"
+                 "\n/stats - stage latency and failure summary")
 
     await send_message(chat_id, text)
 
@@ -1020,6 +3204,16 @@ async def handle_revoke(message):
         await send_message(chat_id, f"User {target_user_id} was not in approved list.")
 
 
+@BOT.message_handler(commands=['stats'])
+async def handle_stats(message):
+    """Handle /stats command - admin only."""
+    chat_id = message.chat.id
+    if message.from_user.id != YTDL_ADMIN_CHAT_ID:
+        await send_message(chat_id, "Admin only command.")
+        return
+    await send_message(chat_id, format_stats())
+
+
 @BOT.message_handler(commands=['start'])
 async def handle_start(message):
     """Handle /start command."""
@@ -1046,19 +3240,21 @@ async def handle_message(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
     text = message.text.strip() if message.text else ""
-    print(f"[RECV] from {user_id}: {text[:100]}{'...' if len(text) > 100 else ''}")
+    log("RECV", f"from {user_id}: {text[:100]}{'...' if len(text) > 100 else ''}")
 
     # Check if it's a URL
     if not is_supported_url(text):
         await send_message(chat_id, "Please send a valid URL.")
         return
 
-    # Forward to admin for monitoring
-    if chat_id != YTDL_ADMIN_CHAT_ID:
+    # Forward to admin for monitoring (counted in the digest in digest mode)
+    if chat_id != YTDL_ADMIN_CHAT_ID and ADMIN_DIGEST_INTERVAL:
+        ADMIN_DIGEST.add("request", user_id, text, text)
+    elif chat_id != YTDL_ADMIN_CHAT_ID:
         try:
             await BOT.forward_message(YTDL_ADMIN_CHAT_ID, chat_id, message.message_id)
         except Exception as e:
-            print(f"Failed to forward message to admin: {e}")
+            log("BOT", f"Failed to forward message to admin: {e}", level=logging.WARNING)
 
     # Check user status
     if USER_MANAGER.is_denied(user_id):
@@ -1078,12 +3274,12 @@ async def handle_message(message):
     if is_tiktok_photo:
         # TikTok photo post: merge image + audio into video
         if USER_MANAGER.is_approved(user_id):
-            await process_tiktok_photo(chat_id, user_id, url)
+            await dispatch_job("tiktok_photo", chat_id, user_id, url)
         else:
             await request_approval_with_format(chat_id, user_id, message.from_user, url, audio_only=True)
     elif is_audio_only:
         if USER_MANAGER.is_approved(user_id):
-            await process_audio_download(chat_id, user_id, url)
+            await dispatch_job("audio", chat_id, user_id, url)
         else:
             await request_approval_with_format(chat_id, user_id, message.from_user, url, audio_only=True)
     elif USER_MANAGER.is_approved(user_id):
@@ -1111,7 +3307,14 @@ async def show_format_choice(chat_id, user_id, url, approved=True):
     audio_btn = telebot.types.InlineKeyboardButton(
         "Audio (MP3)", callback_data=f"{prefix}_audio")
     markup.row(video_btn, audio_btn)
-
+    if approved and not is_playlist_url(url):
+        # Other audio qualities, all encoded from one download
+        markup.row(*[telebot.types.InlineKeyboardButton(
+            spec["label"], callback_data=f"dl_{AUDIO_RENDITION_KIND}{name}")
+            for name, spec in AUDIO_RENDITIONS.items()])
+
+    if approved:
+        prefetch_media_probe(url)
     msg = await send_message(chat_id, "Choose format:", reply_markup=markup)
     add_status_message(chat_id, msg)
 
@@ -1124,14 +3327,17 @@ async def show_format_choice(chat_id, user_id, url, approved=True):
     }
 
 
-@BOT.callback_query_handler(func=lambda call: call.data in ('dl_video', 'dl_audio'))
+FORMAT_CALLBACKS = ('dl_video', 'dl_audio', *(f"dl_{AUDIO_RENDITION_KIND}{name}" for name in AUDIO_RENDITIONS))
+
+
+@BOT.callback_query_handler(func=lambda call: call.data in FORMAT_CALLBACKS)
 async def handle_format_choice(call):
-    """Handle Video/Audio format choice for approved users."""
-    format_type = call.data.split('_')[1]  # 'video' or 'audio'
+    """Handle Video/Audio/audio quality choice for approved users."""
+    kind = call.data[len('dl_'):]  # 'video', 'audio' or 'audio_<rendition>'
     message_id = call.message.message_id
     chat_id = call.message.chat.id
     user_id = call.from_user.id
-    print(f"[CALLBACK] from {user_id}: {call.data}")
+    log("CALLBACK", f"from {user_id}: {call.data}")
 
     # Get stored URL by message_id
     pending_data = PENDING_CHOICES.pop(message_id, None)
@@ -1147,15 +3353,12 @@ async def handle_format_choice(call):
         if chat_id in STATUS_MESSAGES and call.message.message_id in STATUS_MESSAGES[chat_id]:
             STATUS_MESSAGES[chat_id].remove(call.message.message_id)
     except Exception as e:
-        print(f"Failed to delete format choice message: {e}")
+        log("BOT", f"Failed to delete format choice message: {e}", level=logging.WARNING)
 
     await BOT.answer_callback_query(call.id)
 
     # Process download
-    if format_type == 'video':
-        await process_download(chat_id, user_id, url)
-    else:
-        await process_audio_download(chat_id, user_id, url)
+    await dispatch_job(kind, chat_id, user_id, url)
 
 
 @BOT.callback_query_handler(func=lambda call: call.data in ('req_video', 'req_audio'))
@@ -1180,7 +3383,7 @@ async def handle_format_choice_unapproved(call):
         if chat_id in STATUS_MESSAGES and call.message.message_id in STATUS_MESSAGES[chat_id]:
             STATUS_MESSAGES[chat_id].remove(call.message.message_id)
     except Exception as e:
-        print(f"Failed to delete format choice message: {e}")
+        log("BOT", f"Failed to delete format choice message: {e}", level=logging.WARNING)
 
     await BOT.answer_callback_query(call.id)
 
@@ -1226,7 +3429,7 @@ async def request_approval_with_format(chat_id, user_id, user, url, audio_only=F
                            "Your request has been sent to the admin for approval. "
                            "You will be notified once approved.")
     except Exception as e:
-        print(f"Error sending approval request: {e}")
+        log("APPROVAL", f"Error sending approval request: {e}", level=logging.WARNING)
         await send_message(chat_id,
                            "Error processing your request. Please try again later.")
 
@@ -1248,11 +3451,11 @@ async def handle_approval_callback(call):
                                    "Your access has been approved! Processing your request...")
                 # Process with the format they chose
                 if pending.get("audio_only", False):
-                    await process_audio_download(user_id, user_id, pending["requested_url"])
+                    await dispatch_job("audio", user_id, user_id, pending["requested_url"])
                 else:
-                    await process_download(user_id, user_id, pending["requested_url"])
+                    await dispatch_job("video", user_id, user_id, pending["requested_url"])
             except Exception as e:
-                print(f"Error processing approved user request: {e}")
+                log("APPROVAL", f"Error processing approved user request: {e}", level=logging.WARNING)
     else:
         pending = USER_MANAGER.deny_user(user_id)
         result_text = f"User {user_id} has been DENIED."
@@ -1262,7 +3465,7 @@ async def handle_approval_callback(call):
                 await send_message(user_id,
                                    "Sorry, your access request has been denied.")
             except Exception as e:
-                print(f"Error notifying denied user: {e}")
+                log("APPROVAL", f"Error notifying denied user: {e}", level=logging.WARNING)
 
     # Update admin message
     try:
@@ -1274,36 +3477,132 @@ async def handle_approval_callback(call):
         )
         await BOT.answer_callback_query(call.id, result_text)
     except Exception as e:
-        print(f"Error updating admin message: {e}")
+        log("APPROVAL", f"Error updating admin message: {e}", level=logging.WARNING)
+
+
+# Inline mode (@bot <url>, enable with BotFather /setinline)
+INLINE_CACHE_TIME = 300  # seconds Telegram may reuse an answer with cached media
+INLINE_PENDING_TTL = 600  # an uncached URL is downloaded at most once per window
+INLINE_PENDING = TTLCache(1024, INLINE_PENDING_TTL)
+# Telegram sends a query per keystroke: a download starts only once the
+# user has stopped typing for this long
+INLINE_DEBOUNCE = 1.5
+INLINE_LATEST = {}  # user_id -> id of the user's latest inline query
+INLINE_HOST_PATTERN = re.compile(r'(?:[a-z0-9-]+\.)+[a-z]{2,}$')
+
+
+def is_complete_url(text):
+    """Whether text looks like a whole media URL rather than one still being typed."""
+    parsed = urllib.parse.urlparse(text)
+    host = (parsed.hostname or "").lower()
+    return (parsed.scheme in ("http", "https") and bool(INLINE_HOST_PATTERN.fullmatch(host))
+            and (parsed.path.strip("/") != "" or parsed.query != ""))
+
+
+def inline_pending_key(url):
+    """Normalized URL for INLINE_PENDING: no tracking parameters, www., fragment or trailing slash."""
+    parsed = urllib.parse.urlparse(clean_youtube_url(url))
+    host = (parsed.hostname or "").lower().removeprefix("www.")
+    return urllib.parse.urlunparse(parsed._replace(
+        scheme="https", netloc=host, path=parsed.path.rstrip("/"), fragment=""))
+
+
+def inline_results(url):
+    """Inline results for the cached video/audio uploads of url.
+
+    Only uploads with a Bot API file_id can be sent; older entries only
+    have Telethon's packed id.
+    """
+    results = []
+    video = UPLOAD_CACHE.get(url, "video")
+    if video and video.get("bot_file_id"):
+        results.append(telebot.types.InlineQueryResultCachedVideo(
+            "video", video["bot_file_id"], video["title"], caption=video.get("caption")))
+    audio = UPLOAD_CACHE.get(url, "audio")
+    if audio and audio.get("bot_file_id"):
+        results.append(telebot.types.InlineQueryResultCachedAudio(
+            "audio", audio["bot_file_id"], caption=audio.get("caption")))
+    return results
+
+
+@BOT.inline_handler(func=lambda query: True)
+async def handle_inline_query(query):
+    """Answer with the cached upload of a URL, or start downloading it for next time."""
+    text = (query.query or "").strip()
+    user_id = query.from_user.id
+    if not is_supported_url(text):
+        await BOT.answer_inline_query(query.id, [], cache_time=INLINE_CACHE_TIME)
+        return
+    if not USER_MANAGER.is_approved(user_id):
+        await BOT.answer_inline_query(query.id, [], cache_time=0, is_personal=True,
+                                      switch_pm_text="Request access", switch_pm_parameter="start")
+        return
+
+    url, is_tiktok_photo = await normalize_tiktok_url(text)
+    results = inline_results(url)
+    if results:
+        log("INLINE", f"Cache hit for user {user_id}: {url}")
+        await BOT.answer_inline_query(query.id, results, cache_time=INLINE_CACHE_TIME)
+        return
+
+    if not is_complete_url(url):
+        await BOT.answer_inline_query(query.id, [], cache_time=0, is_personal=True)
+        return
+    # Wait for the user to stop typing; a newer query supersedes this one
+    INLINE_LATEST[user_id] = query.id
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    if INLINE_LATEST.get(user_id) != query.id:
+        return
+    INLINE_LATEST.pop(user_id, None)
+
+    key = inline_pending_key(url)
+    if INLINE_PENDING.get(key) is CACHE_MISS:
+        # Download in the background; the file also arrives in the user's chat with the bot
+        log("INLINE", f"Cache miss for user {user_id}, downloading: {url}")
+        INLINE_PENDING.set(key, True)
+        task = asyncio.create_task(dispatch_job("tiktok_photo" if is_tiktok_photo else "video", user_id, user_id, url))
+        BACKGROUND_TASKS.add(task)
+        task.add_done_callback(BACKGROUND_TASKS.discard)
+    placeholder = telebot.types.InlineQueryResultArticle(
+        "processing", "Downloading, try again in a minute",
+        telebot.types.InputTextMessageContent(clean_youtube_url(url)),
+        description="Not cached yet. It will also be sent to your chat with the bot.")
+    await BOT.answer_inline_query(query.id, [placeholder], cache_time=0, is_personal=True)
 
 
 async def process_tiktok_photo(chat_id, user_id, url):
     """Download TikTok photo post: fetch image + audio, merge into MP4 video."""
-    print(f"[TIKTOK] Starting photo post download for user {user_id}")
-    temp_dir = tempfile.mkdtemp(prefix="ytdl_tiktok_")
+    log("TIKTOK", f"Starting photo post download for user {user_id}")
+    temp_dir = make_temp_dir("ytdl_tiktok_")
+    reservation = None
 
     try:
+        reservation = await reserve_disk(chat_id, url, "tiktok_photo", temp_dir)
         msg = await send_message(chat_id, "Downloading TikTok photo post...")
         add_status_message(chat_id, msg)
 
-        # Download audio and fetch photo in parallel
-        print("[TIKTOK] Downloading audio and photo...")
-        audio_task = download_audio(url, temp_dir)
-        photo_task = get_tiktok_photo(url, temp_dir)
-        audio_result, photo_path = await asyncio.gather(audio_task, photo_task)
+        # Download audio and fetch photo in parallel. The original stream is
+        # kept so AAC audio is copied into the video instead of re-encoded.
+        log_stage("download")
+        log("TIKTOK", "Downloading audio and photo...", level=logging.DEBUG)
+        audio_task = download_audio(url, temp_dir, keep_source=True, format_spec=MERGE_AUDIO_FORMAT)
+        photo_task = get_tiktok_photos(url, temp_dir)
+        audio_result, photo_paths = await asyncio.gather(audio_task, photo_task)
         audio_path, audio_error = audio_result
 
         if not audio_path:
             error_detail = truncate_error(audio_error or "Unknown error")
             await send_message(chat_id, f"Failed to download audio.\n\n{error_detail}")
-            await notify_admin(chat_id, f"Audio download failed for user {user_id}:\n{url}\n\n{error_detail}")
+            await notify_admin(chat_id, f"Audio download failed for user {user_id}:\n{url}\n\n{error_detail}", kind="failed", url=url)
             await clear_status_messages(chat_id)
             return
 
-        if not photo_path:
+        if not photo_paths:
             # Fallback: send audio only if photo fetch failed
-            print("[TIKTOK] Photo fetch failed, falling back to audio only")
+            log("TIKTOK", "Photo fetch failed, falling back to audio only", level=logging.WARNING)
             await clear_status_messages(chat_id)
+            DISK_BUDGET.release(reservation)
+            reservation = None  # the audio job reserves its own space
             await process_audio_download(chat_id, user_id, url)
             return
 
@@ -1311,50 +3610,55 @@ async def process_tiktok_photo(chat_id, user_id, url):
         msg = await send_message(chat_id, "Merging photo and audio...")
         add_status_message(chat_id, msg)
         video_path = os.path.join(temp_dir, "tiktok_video.mp4")
-        print("[TIKTOK] Merging image + audio...")
-        result = await asyncio.to_thread(merge_image_audio, photo_path, audio_path, video_path)
+        log_stage("merge")
+        log("TIKTOK", "Merging image + audio...", level=logging.DEBUG)
+        result = await asyncio.to_thread(merge_image_audio, photo_paths, audio_path, video_path)
         if not result:
-            print("[TIKTOK] Merge failed, falling back to audio only")
+            log("TIKTOK", "Merge failed, falling back to audio only", level=logging.WARNING)
             await clear_status_messages(chat_id)
+            DISK_BUDGET.release(reservation)
+            reservation = None
             await process_audio_download(chat_id, user_id, url)
             return
 
         file_size = os.path.getsize(video_path)
-        print(f"[TIKTOK] Merged video: {file_size / MiB:.1f} MiB")
+        log("TIKTOK", f"Merged video: {file_size / MiB:.1f} MiB")
 
+        log_stage("probe")
         # Get video info
         title = await asyncio.to_thread(get_video_title, url)
         duration = await asyncio.to_thread(get_audio_duration, audio_path)
         width, height = await asyncio.to_thread(Video.get_resolution, video_path)
 
         # Upload
+        log_stage("upload")
         msg = await send_message(chat_id, f"Uploading video ({file_size / MiB:.0f} MiB)...")
         add_status_message(chat_id, msg)
 
+        # Slideshows are sent only as the merged video, which keeps the sound
         caption = f"{title}\n\nSource: {clean_youtube_url(url)}"
         await send_video_telethon(
             chat_id, video_path, caption, width, height, duration,
-            photo_path,  # use the photo as thumbnail too
-            status_message_id=msg.message_id, file_size=file_size
+            photo_paths[0],  # use the first photo as thumbnail too
+            status_message_id=msg.message_id, file_size=file_size, source_url=url
         )
-        print("[TIKTOK] Upload complete")
+        log("TIKTOK", "Upload complete")
 
         await clear_status_messages(chat_id)
-        print(f"[TIKTOK] Done for user {user_id}")
+        log("TIKTOK", f"Done for user {user_id}")
 
-        await notify_admin(chat_id, f"TikTok photo video sent to user {user_id}: {title}")
+        await notify_admin(chat_id, f"TikTok photo video sent to user {user_id}: {title}", kind="sent", url=url)
 
     except UploadFailedError as e:
-        print(f"Upload failed: {e}")
+        log("TIKTOK", f"Upload failed: {e}", level=logging.ERROR)
         await send_message(chat_id, f"Upload failed after multiple retries. Please try again later.\n\nError: {e}")
-        await notify_admin(chat_id, f"Upload failed for user {user_id}:\n{url}\n\n{e}")
+        await notify_admin(chat_id, f"Upload failed for user {user_id}:\n{url}\n\n{e}", kind="failed", url=url)
 
     except Exception as e:
-        print(f"Error processing TikTok photo: {e}")
-        traceback.print_exc()
+        log("TIKTOK", f"Error processing TikTok photo: {e}", level=logging.ERROR, exc_info=True)
         tb = truncate_error(traceback.format_exc())
         await send_message(chat_id, f"Error:\n{tb}")
-        await notify_admin(chat_id, f"Error for user {user_id}:\n{url}\n\n{tb}")
+        await notify_admin(chat_id, f"Error for user {user_id}:\n{url}\n\n{tb}", kind="error", url=url, urgent=True)
 
     finally:
         STATUS_MESSAGES.pop(chat_id, None)
@@ -1362,35 +3666,48 @@ async def process_tiktok_photo(chat_id, user_id, url):
             if os.path.exists(temp_dir):
                 shutil.rmtree(temp_dir)
         except Exception as e:
-            print(f"Error cleaning up temp dir: {e}")
+            log("TIKTOK", f"Error cleaning up temp dir: {e}", level=logging.WARNING)
+        if reservation:
+            DISK_BUDGET.release(reservation)
 
 
 async def process_audio_download(chat_id, user_id, url):
-    """Download and send audio only."""
-    print(f"[AUDIO] Starting download for user {user_id}")
-    url, _ = await normalize_tiktok_url(url)
-    temp_dir = tempfile.mkdtemp(prefix="ytdl_")
+    """Download and send audio only. Expects a URL from normalize_tiktok_url."""
+    log("AUDIO", f"Starting download for user {user_id}")
+
+    if is_playlist_url(url) and await process_playlist_download(chat_id, user_id, url, audio_only=True):
+        return
+
+    temp_dir = make_temp_dir("ytdl_", audio=True)
+    spotify_task = None
+    reservation = None
 
     try:
-        print("[AUDIO] Getting title...")
+        log_stage("title")
+        log("AUDIO", "Getting title...", level=logging.DEBUG)
         title = await asyncio.to_thread(get_video_title, url)
-        print(f"[AUDIO] Title: {title}")
+        log("AUDIO", f"Title: {title}")
+        # Look up Spotify while the audio downloads
+        spotify_task = asyncio.create_task(search_spotify(title))
+        reservation = await reserve_disk(chat_id, url, "audio", temp_dir)
         msg = await send_message(chat_id, f"Downloading audio: {title}\nPlease wait...")
         add_status_message(chat_id, msg)
 
         # Download audio
-        print("[AUDIO] Starting yt-dlp download...")
+        log_stage("download")
+        log("AUDIO", "Starting yt-dlp download...", level=logging.DEBUG)
         audio_path, dl_error = await download_audio(url, temp_dir)
         if not audio_path:
             error_detail = truncate_error(dl_error or "Unknown error")
             await send_message(chat_id, f"Failed to download audio.\n\n{error_detail}")
-            await notify_admin(chat_id, f"Audio download failed for user {user_id}:\n{url}\n\n{error_detail}")
+            await notify_admin(chat_id, f"Audio download failed for user {user_id}:\n{url}\n\n{error_detail}", kind="failed", url=url)
+            METRICS.inc("ytdl_job_failures_total", kind="audio", error="DownloadFailed")
             await clear_status_messages(chat_id)
             return
-        print("[AUDIO] Download complete")
+        log("AUDIO", "Download complete")
 
         file_size = os.path.getsize(audio_path)
-        print(f"[AUDIO] Downloaded size: {file_size / MiB:.1f} MiB")
+        log("AUDIO", f"Downloaded size: {file_size / MiB:.1f} MiB")
 
         if file_size > MAX_VIDEO_SIZE:
             await send_message(chat_id,
@@ -1404,151 +3721,291 @@ async def process_audio_download(chat_id, user_id, url):
         add_status_message(chat_id, msg)
 
         # Get thumbnail
-        print("[AUDIO] Getting thumbnail...")
+        log_stage("probe")
+        log("AUDIO", "Getting thumbnail...", level=logging.DEBUG)
         thumbnail_path = await asyncio.to_thread(get_thumbnail, url, temp_dir)
-        print(f"[AUDIO] Thumbnail: {thumbnail_path}")
+        log("AUDIO", f"Thumbnail: {thumbnail_path}")
+
+        # Get audio duration
+        log("AUDIO", "Getting duration...", level=logging.DEBUG)
+        duration = await asyncio.to_thread(get_audio_duration, audio_path)
+        log("AUDIO", f"Duration: {duration}s")
+
+        # Collect Spotify link (started before the download)
+        log("AUDIO", "Waiting for Spotify lookup...", level=logging.DEBUG)
+        spotify_info = await spotify_task
+        log("AUDIO", f"Spotify: {spotify_info}")
+
+        # Upload to Telegram
+        log_stage("upload")
+        log("AUDIO", "Starting upload...", level=logging.DEBUG)
+        msg = await send_message(chat_id, f"Uploading audio ({file_size / MiB:.0f} MiB)...")
+        add_status_message(chat_id, msg)
+
+        # Build caption
+        caption = f"Source: {clean_youtube_url(url)}"
+        if spotify_info:
+            caption += f"\n\nSpotify {spotify_info['artist']} - {spotify_info['name']}: {spotify_info['url']}"
+
+        # Use Telethon for upload
+        await send_audio_telethon(
+            chat_id,
+            audio_path,
+            caption,
+            title,
+            duration,
+            thumbnail_path,
+            status_message_id=msg.message_id,
+            file_size=file_size,
+            source_url=url
+        )
+        log("AUDIO", "Upload complete")
+
+        # Clear status messages on success
+        await clear_status_messages(chat_id)
+        log("AUDIO", f"Done for user {user_id}")
+
+        # Notify admin
+        await notify_admin(chat_id, f"Audio sent to user {user_id}: {title}", kind="sent", url=url)
+
+    except UploadFailedError as e:
+        METRICS.inc("ytdl_job_failures_total", kind="audio", error="UploadFailedError")
+        error_msg = f"Upload failed: {str(e)}"
+        log("AUDIO", error_msg, level=logging.ERROR)
+
+        await send_message(chat_id,
+                           f"Upload failed after multiple retries. Please try again later.\n\nError: {e}")
+        await notify_admin(chat_id, f"Upload failed for user {user_id}:\n{url}\n\n{error_msg}", kind="failed", url=url)
+
+    except Exception as e:
+        METRICS.inc("ytdl_job_failures_total", kind="audio", error=type(e).__name__)
+        error_msg = f"Error processing audio: {str(e)}"
+        log("AUDIO", error_msg, level=logging.ERROR, exc_info=True)
+        tb = truncate_error(traceback.format_exc())
+        await send_message(chat_id, f"Error:\n{tb}")
+        await notify_admin(chat_id, f"Error for user {user_id}:\n{url}\n\n{tb}", kind="error", url=url, urgent=True)
+
+    finally:
+        if spotify_task and not spotify_task.done():
+            spotify_task.cancel()
+        STATUS_MESSAGES.pop(chat_id, None)
+        try:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+        except Exception as e:
+            log("AUDIO", f"Error cleaning up temp dir: {e}", level=logging.WARNING)
+        if reservation:
+            DISK_BUDGET.release(reservation)
+
+
+async def process_audio_rendition(chat_id, user_id, url, rendition):
+    """Send one AUDIO_RENDITIONS quality of url's audio.
+
+    A cached rendition is uploaded straight away. Otherwise the source audio
+    is downloaded once and encoded to every rendition, which are all cached.
+    """
+    kind = f"{AUDIO_RENDITION_KIND}{rendition}"
+    label = AUDIO_RENDITIONS[rendition]["label"]
+    log("AUDIO", f"Starting {label} audio for user {user_id}")
+
+    temp_dir = None
+    reservation = None
+
+    try:
+        cached = await asyncio.to_thread(AUDIO_RENDITION_CACHE.get, url, rendition)
+        if cached:
+            log("AUDIO", f"Rendition cache hit ({label}): {url}")
+        else:
+            log_stage("title")
+            title = await asyncio.to_thread(get_video_title, url)
+            temp_dir = make_temp_dir("ytdl_", audio=True)
+            reservation = await reserve_disk(chat_id, url, "audio", temp_dir)
+            msg = await send_message(chat_id, f"Downloading audio: {title}\nPlease wait...")
+            add_status_message(chat_id, msg)
+
+            log_stage("download")
+            source_path, dl_error = await download_audio(url, temp_dir, keep_source=True)
+            if not source_path:
+                error_detail = truncate_error(dl_error or "Unknown error")
+                await send_message(chat_id, f"Failed to download audio.\n\n{error_detail}")
+                await notify_admin(chat_id, f"Audio download failed for user {user_id}:\n{url}\n\n{error_detail}", kind="failed", url=url)
+                METRICS.inc("ytdl_job_failures_total", kind=kind, error="DownloadFailed")
+                await clear_status_messages(chat_id)
+                return
 
-        # Get audio duration
-        print("[AUDIO] Getting duration...")
-        duration = await asyncio.to_thread(get_audio_duration, audio_path)
-        print(f"[AUDIO] Duration: {duration}s")
+            log_stage("encode")
+            msg = await send_message(chat_id, "Encoding audio...")
+            add_status_message(chat_id, msg)
+            renditions = await asyncio.to_thread(encode_audio_renditions, source_path, temp_dir)
+            if rendition not in renditions:
+                await send_message(chat_id, "Failed to encode audio.")
+                METRICS.inc("ytdl_job_failures_total", kind=kind, error="EncodeFailed")
+                await clear_status_messages(chat_id)
+                return
+            log("AUDIO", f"Encoded {len(renditions)} renditions")
 
-        # Search for Spotify link
-        print("[AUDIO] Searching Spotify...")
-        spotify_info = await search_spotify(title)
-        print(f"[AUDIO] Spotify: {spotify_info}")
+            log_stage("probe")
+            duration = await asyncio.to_thread(get_audio_duration, source_path)
+            thumbnail_path = await asyncio.to_thread(get_thumbnail, url, temp_dir)
+            await asyncio.to_thread(AUDIO_RENDITION_CACHE.store, url, renditions,
+                                    {"title": title, "duration": duration}, thumbnail_path)
+            cached = await asyncio.to_thread(AUDIO_RENDITION_CACHE.get, url, rendition)
 
-        # Upload to Telegram
-        print("[AUDIO] Starting upload...")
-        msg = await send_message(chat_id, f"Uploading audio ({file_size / MiB:.0f} MiB)...")
+        spotify_info = await search_spotify(cached["title"])
+        file_size = os.path.getsize(cached["path"])
+
+        log_stage("upload")
+        msg = await send_message(chat_id, f"Uploading audio ({label}, {file_size / MiB:.1f} MiB)...")
         add_status_message(chat_id, msg)
 
-        # Build caption
         caption = f"Source: {clean_youtube_url(url)}"
         if spotify_info:
             caption += f"\n\nSpotify {spotify_info['artist']} - {spotify_info['name']}: {spotify_info['url']}"
 
-        # Use Telethon for upload
         await send_audio_telethon(
             chat_id,
-            audio_path,
+            cached["path"],
             caption,
-            title,
-            duration,
-            thumbnail_path,
+            cached["title"],
+            cached["duration"],
+            cached["thumbnail"],
             status_message_id=msg.message_id,
             file_size=file_size
         )
-        print("[AUDIO] Upload complete")
-
-        # Clear status messages on success
+        log("AUDIO", "Upload complete")
         await clear_status_messages(chat_id)
-        print(f"[AUDIO] Done for user {user_id}")
-
-        # Notify admin
-        await notify_admin(chat_id, f"Audio sent to user {user_id}: {title}")
+        await notify_admin(chat_id, f"Audio ({label}) sent to user {user_id}: {cached['title']}", kind="sent", url=url)
 
     except UploadFailedError as e:
-        error_msg = f"Upload failed: {str(e)}"
-        print(error_msg)
-
+        METRICS.inc("ytdl_job_failures_total", kind=kind, error="UploadFailedError")
+        log("AUDIO", f"Upload failed: {e}", level=logging.ERROR)
         await send_message(chat_id,
                            f"Upload failed after multiple retries. Please try again later.\n\nError: {e}")
-        await notify_admin(chat_id, f"Upload failed for user {user_id}:\n{url}\n\n{error_msg}")
+        await notify_admin(chat_id, f"Upload failed for user {user_id}:\n{url}\n\n{e}", kind="failed", url=url)
 
     except Exception as e:
-        error_msg = f"Error processing audio: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        METRICS.inc("ytdl_job_failures_total", kind=kind, error=type(e).__name__)
+        log("AUDIO", f"Error processing audio: {e}", level=logging.ERROR, exc_info=True)
         tb = truncate_error(traceback.format_exc())
         await send_message(chat_id, f"Error:\n{tb}")
-        await notify_admin(chat_id, f"Error for user {user_id}:\n{url}\n\n{tb}")
+        await notify_admin(chat_id, f"Error for user {user_id}:\n{url}\n\n{tb}", kind="error", url=url, urgent=True)
 
     finally:
         STATUS_MESSAGES.pop(chat_id, None)
-        try:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-        except Exception as e:
-            print(f"Error cleaning up temp dir: {e}")
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        if reservation:
+            DISK_BUDGET.release(reservation)
 
 
 async def process_download(chat_id, user_id, url):
-    """Main video download and processing function."""
-    print(f"[VIDEO] Starting download for user {user_id}")
-    url, _ = await normalize_tiktok_url(url)
-    temp_dir = tempfile.mkdtemp(prefix="ytdl_")
+    """Main video download and processing function.
+
+    Expects a URL already passed through normalize_tiktok_url.
+    """
+    log("VIDEO", f"Starting download for user {user_id}")
+
+    if is_playlist_url(url) and await process_playlist_download(chat_id, user_id, url):
+        return
+
+    log_stage("title")
+    log("VIDEO", "Getting title...", level=logging.DEBUG)
+    title = await asyncio.to_thread(get_video_title, url)
+    log("VIDEO", f"Title: {title}")
+
+    # Carousels and threads go through the album pipeline. The title probe
+    # already listed their entries, so single posts cost no extra yt-dlp run.
+    count = MEDIA_ENTRY_COUNTS.get(url, 1) if ALBUM_URL_PATTERN.match(url) else 1
+    if count > 1:
+        await process_album_download(chat_id, user_id, url, title, count)
+        return
+
+    temp_dir = make_temp_dir("ytdl_")
+    reservation = None
 
     try:
-        print("[VIDEO] Getting title...")
-        title = await asyncio.to_thread(get_video_title, url)
-        print(f"[VIDEO] Title: {title}")
+        reservation = await reserve_disk(chat_id, url, "video", temp_dir)
         msg = await send_message(chat_id, f"Downloading video: {title}\nPlease wait...")
         add_status_message(chat_id, msg)
 
         # Download video
-        print("[VIDEO] Starting yt-dlp download...")
-        video_path, dl_error = await download_video(url, temp_dir)
+        log_stage("download")
+        log("VIDEO", "Starting yt-dlp download...", level=logging.DEBUG)
+        duration, size = MEDIA_PROBE_CACHE.get(url, (None, None))
+        video_path, dl_error = await download_video(url, temp_dir, expected_size=size, media_duration=duration)
         if not video_path:
             error_detail = truncate_error(dl_error or "Unknown error")
             await send_message(chat_id, f"Failed to download video.\n\n{error_detail}")
-            await notify_admin(chat_id, f"Video download failed for user {user_id}:\n{url}\n\n{error_detail}")
+            await notify_admin(chat_id, f"Video download failed for user {user_id}:\n{url}\n\n{error_detail}", kind="failed", url=url)
+            METRICS.inc("ytdl_job_failures_total", kind="video", error="DownloadFailed")
             await clear_status_messages(chat_id)
             return
-        print("[VIDEO] Download complete")
+        log("VIDEO", "Download complete")
 
-        # Check file size and compress if needed
         file_size = os.path.getsize(video_path)
-        print(f"[VIDEO] Downloaded size: {file_size / MiB:.1f} MiB")
+        log("VIDEO", f"Downloaded size: {file_size / MiB:.1f} MiB")
+
+        # Get video dimensions and duration
+        msg = await send_message(chat_id, "Processing video...")
+        add_status_message(chat_id, msg)
+        log_stage("probe")
+        log("VIDEO", "Getting resolution...", level=logging.DEBUG)
+        try:
+            width, height = await asyncio.to_thread(Video.get_resolution, video_path)
+        except Exception:
+            width, height = 1920, 1080
+        log("VIDEO", f"Resolution: {width}x{height}")
+
+        log("VIDEO", "Getting duration...", level=logging.DEBUG)
+        try:
+            duration = int(await asyncio.to_thread(Video.get_length, video_path))
+        except Exception:
+            duration = None
+        log("VIDEO", f"Duration: {duration}s")
+
+        caption = f"{title}\n\nSource: {clean_youtube_url(url)}"
+
+        # Same clip already uploaded from another URL: send that instead
+        fingerprint = await asyncio.to_thread(media_fingerprint, video_path, duration, width, height)
+        if fingerprint and await resend_duplicate(chat_id, url, "video", fingerprint, caption):
+            await clear_status_messages(chat_id)
+            log("VIDEO", f"Done for user {user_id} (duplicate)")
+            await notify_admin(chat_id, f"Video sent to user {user_id} (duplicate): {title}", kind="sent", url=url)
+            return
 
+        # Compress if needed
         if file_size > MAX_VIDEO_SIZE:
             msg = await send_message(chat_id,
                 f"Video is too large ({file_size / GiB:.1f} GB). Compressing...")
             add_status_message(chat_id, msg)
 
-            print("[VIDEO] Starting compression...")
+            log_stage("compress")
+            log("VIDEO", "Starting compression...", level=logging.DEBUG)
             compressed_path, new_width, new_height = await asyncio.to_thread(compress_video, video_path)
             if not compressed_path:
                 await send_message(chat_id,
                     "Failed to compress video. It may be too long.")
+                METRICS.inc("ytdl_job_failures_total", kind="video", error="CompressFailed")
                 await clear_status_messages(chat_id)
                 return
 
             video_path = compressed_path
             width, height = new_width, new_height
             file_size = os.path.getsize(video_path)
-            print(f"[VIDEO] Compression complete: {file_size / MiB:.1f} MiB")
-        else:
-            # Get video dimensions
-            msg = await send_message(chat_id, "Processing video...")
-            add_status_message(chat_id, msg)
-            print("[VIDEO] Getting resolution...")
-            try:
-                width, height = await asyncio.to_thread(Video.get_resolution, video_path)
-            except Exception:
-                width, height = 1920, 1080
-            print(f"[VIDEO] Resolution: {width}x{height}")
-
-        # Get video duration
-        print("[VIDEO] Getting duration...")
-        try:
-            duration = int(await asyncio.to_thread(Video.get_length, video_path))
-        except Exception:
-            duration = None
-        print(f"[VIDEO] Duration: {duration}s")
+            log("VIDEO", f"Compression complete: {file_size / MiB:.1f} MiB")
+            log_stage("probe")
 
         # Get thumbnail
-        print("[VIDEO] Getting thumbnail...")
+        log("VIDEO", "Getting thumbnail...", level=logging.DEBUG)
         thumbnail_path = await asyncio.to_thread(get_thumbnail, url, temp_dir)
-        print(f"[VIDEO] Thumbnail: {thumbnail_path}")
+        log("VIDEO", f"Thumbnail: {thumbnail_path}")
 
         # Upload to Telegram
-        print("[VIDEO] Starting upload...")
+        log_stage("upload")
+        log("VIDEO", "Starting upload...", level=logging.DEBUG)
         msg = await send_message(chat_id, f"Uploading video ({file_size / MiB:.0f} MiB)...")
         add_status_message(chat_id, msg)
 
-        caption = f"{title}\n\nSource: {clean_youtube_url(url)}"
-
         # Use Telethon for upload
         await send_video_telethon(
             chat_id,
@@ -1559,32 +4016,35 @@ async def process_download(chat_id, user_id, url):
             duration,
             thumbnail_path,
             status_message_id=msg.message_id,
-            file_size=file_size
+            file_size=file_size,
+            source_url=url,
+            fingerprint=fingerprint
         )
-        print("[VIDEO] Upload complete")
+        log("VIDEO", "Upload complete")
 
         # Clear status messages on success
         await clear_status_messages(chat_id)
-        print(f"[VIDEO] Done for user {user_id}")
+        log("VIDEO", f"Done for user {user_id}")
 
         # Notify admin
-        await notify_admin(chat_id, f"Video sent to user {user_id}: {title}")
+        await notify_admin(chat_id, f"Video sent to user {user_id}: {title}", kind="sent", url=url)
 
     except UploadFailedError as e:
+        METRICS.inc("ytdl_job_failures_total", kind="video", error="UploadFailedError")
         error_msg = f"Upload failed: {str(e)}"
-        print(error_msg)
+        log("VIDEO", error_msg, level=logging.ERROR)
 
         await send_message(chat_id,
                            f"Upload failed after multiple retries. Please try again later.\n\nError: {e}")
-        await notify_admin(chat_id, f"Upload failed for user {user_id}:\n{url}\n\n{error_msg}")
+        await notify_admin(chat_id, f"Upload failed for user {user_id}:\n{url}\n\n{error_msg}", kind="failed", url=url)
 
     except Exception as e:
+        METRICS.inc("ytdl_job_failures_total", kind="video", error=type(e).__name__)
         error_msg = f"Error processing video: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        log("VIDEO", error_msg, level=logging.ERROR, exc_info=True)
         tb = truncate_error(traceback.format_exc())
         await send_message(chat_id, f"Error:\n{tb}")
-        await notify_admin(chat_id, f"Error for user {user_id}:\n{url}\n\n{tb}")
+        await notify_admin(chat_id, f"Error for user {user_id}:\n{url}\n\n{tb}", kind="error", url=url, urgent=True)
 
     finally:
         STATUS_MESSAGES.pop(chat_id, None)
@@ -1592,7 +4052,536 @@ async def process_download(chat_id, user_id, url):
             if os.path.exists(temp_dir):
                 shutil.rmtree(temp_dir)
         except Exception as e:
-            print(f"Error cleaning up temp dir: {e}")
+            log("VIDEO", f"Error cleaning up temp dir: {e}", level=logging.WARNING)
+        if reservation:
+            DISK_BUDGET.release(reservation)
+
+
+def get_album_entries(url):
+    """Full yt-dlp metadata of every entry of a multi-media post ([] on failure)."""
+    try:
+        result = subprocess.run(
+            ["yt-dlp", "-J", url],
+            text=True,
+            capture_output=True,
+            timeout=60
+        )
+        if result.returncode == 0 and result.stdout:
+            info = json.loads(result.stdout)
+            if info.get("_type") == "playlist":
+                return list(info.get("entries") or [])
+    except Exception as e:
+        log("ALBUM", f"Error listing album entries: {e}", level=logging.WARNING)
+    return []
+
+
+def album_photo_url(entry):
+    """Image URL of a photo entry of a multi-media post, or None for video entries.
+
+    Photos have no video stream; the image is the entry's own URL or its
+    largest thumbnail.
+    """
+    if not entry or entry.get("duration"):
+        return None
+    if any(f.get("vcodec") not in (None, "none") for f in entry.get("formats") or []):
+        return None
+    if entry.get("ext") in IMAGE_EXTENSIONS and entry.get("url"):
+        return entry["url"]
+    thumbnails = [t for t in entry.get("thumbnails") or [] if t.get("url")]
+    if not thumbnails:
+        return None
+    best = max(thumbnails, key=lambda t: ((t.get("width") or 0) * (t.get("height") or 0), t.get("preference") or 0))
+    return best["url"]
+
+
+async def download_album(url, count, temp_dir, concurrency=ALBUM_DOWNLOAD_CONCURRENCY):
+    """Download entries 1..count of a multi-media post concurrently.
+
+    Photo entries are fetched directly from their image URL (yt-dlp has no
+    format to download for them), videos with yt-dlp --playlist-items.
+    Returns file paths in entry order; failed entries are left out.
+    """
+    entries = await asyncio.to_thread(get_album_entries, url)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(index):
+        entry_dir = os.path.join(temp_dir, f"entry_{index:03d}")
+        os.makedirs(entry_dir, exist_ok=True)
+        photo_url = album_photo_url(entries[index - 1]) if index <= len(entries) else None
+        async with semaphore:
+            if photo_url:
+                paths = await download_files([photo_url], entry_dir, "photo", concurrency=1)
+                path, error = (paths[0], None) if paths else (None, "image fetch failed")
+            else:
+                path, error = await download_video(
+                    url, entry_dir, max_retries=2, extra_args=["--playlist-items", str(index)])
+        if not path:
+            log("ALBUM", f"Entry {index} failed: {error}", level=logging.WARNING)
+        return path
+
+    paths = await asyncio.gather(*(fetch(i) for i in range(1, count + 1)))
+    return [path for path in paths if path]
+
+
+async def process_album_download(chat_id, user_id, url, title, count):
+    """Download every entry of a carousel/thread and send them as albums."""
+    log("ALBUM", f"Starting download of {count} items for user {user_id}")
+    temp_dir = make_temp_dir("ytdl_album_")
+    reservation = None
+
+    try:
+        reservation = await reserve_disk(chat_id, url, "album", temp_dir, count=count)
+        msg = await send_message(chat_id, f"Downloading {count} items: {title}\nPlease wait...")
+        add_status_message(chat_id, msg)
+
+        log_stage("download")
+        paths = await download_album(url, count, temp_dir)
+        # No compression in album mode, oversized entries are skipped
+        paths = [path for path in paths if os.path.getsize(path) <= MAX_VIDEO_SIZE]
+        if not paths:
+            await send_message(chat_id, "Failed to download any items of this post.")
+            await notify_admin(chat_id, f"Album download failed for user {user_id}:\n{url}", kind="failed", url=url)
+            METRICS.inc("ytdl_job_failures_total", kind="album", error="DownloadFailed")
+            await clear_status_messages(chat_id)
+            return
+        log("ALBUM", f"Downloaded {len(paths)}/{count} items")
+
+        log_stage("upload")
+        msg = await send_message(chat_id, f"Uploading {len(paths)} items...")
+        add_status_message(chat_id, msg)
+
+        caption = f"{title}\n\nSource: {clean_youtube_url(url)}"
+        upload_start = time.monotonic()
+        await send_album_telethon(chat_id, paths, caption)
+        record_stage(LOCAL_DOMAIN, "upload", time.monotonic() - upload_start,
+                     size=sum(os.path.getsize(path) for path in paths))
+        log("ALBUM", "Upload complete")
+
+        await clear_status_messages(chat_id)
+        await notify_admin(chat_id, f"Album ({len(paths)} items) sent to user {user_id}: {title}", kind="sent", url=url)
+
+    except UploadFailedError as e:
+        METRICS.inc("ytdl_job_failures_total", kind="album", error="UploadFailedError")
+        log("ALBUM", f"Upload failed: {e}", level=logging.ERROR)
+        await send_message(chat_id, f"Upload failed after multiple retries. Please try again later.\n\nError: {e}")
+        await notify_admin(chat_id, f"Upload failed for user {user_id}:\n{url}\n\n{e}", kind="failed", url=url)
+
+    except Exception as e:
+        METRICS.inc("ytdl_job_failures_total", kind="album", error=type(e).__name__)
+        log("ALBUM", f"Error processing album: {e}", level=logging.ERROR, exc_info=True)
+        tb = truncate_error(traceback.format_exc())
+        await send_message(chat_id, f"Error:\n{tb}")
+        await notify_admin(chat_id, f"Error for user {user_id}:\n{url}\n\n{tb}", kind="error", url=url, urgent=True)
+
+    finally:
+        STATUS_MESSAGES.pop(chat_id, None)
+        try:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+        except Exception as e:
+            log("ALBUM", f"Error cleaning up temp dir: {e}", level=logging.WARNING)
+        if reservation:
+            DISK_BUDGET.release(reservation)
+
+
+# Playlist mode: entries downloaded ahead of the upload cursor, progress edit interval
+PLAYLIST_CONCURRENCY = 3
+PLAYLIST_PROGRESS_INTERVAL = 10  # seconds
+
+# Keep references to fire-and-forget tasks so they are not garbage collected
+BACKGROUND_TASKS = set()
+
+
+def format_playlist_progress(title, done, total, failed, current=None):
+    """Build the aggregate playlist progress text (current: line about the entry in progress)."""
+    text = f"Playlist: {title}\n{done}/{total} sent"
+    if failed:
+        text += f", {len(failed)} failed"
+    if current:
+        text += f"\n{current}"
+    return text
+
+
+async def upload_playlist_entry(chat_id, path, entry_title, entry_url, audio_only, search_title=None):
+    """Upload one downloaded playlist entry (compressing videos if needed)."""
+    caption = f"{entry_title}\n\nSource: {clean_youtube_url(entry_url)}"
+    if audio_only:
+        spotify_info = await search_spotify(search_title, clean=False) if search_title else None
+        if spotify_info:
+            caption += f"\n\nSpotify {spotify_info['artist']} - {spotify_info['name']}: {spotify_info['url']}"
+        duration = await asyncio.to_thread(get_audio_duration, path)
+        await send_audio_telethon(chat_id, path, caption, entry_title, duration, None)
+        return
+
+    if os.path.getsize(path) > MAX_VIDEO_SIZE:
+        path, width, height = await asyncio.to_thread(compress_video, path)
+        if not path:
+            raise RuntimeError("compression failed")
+    else:
+        width, height = await asyncio.to_thread(Video.get_resolution, path)
+    duration = int(await asyncio.to_thread(Video.get_length, path))
+    await send_video_telethon(chat_id, path, caption, width, height, duration, None)
+
+
+async def process_playlist_download(chat_id, user_id, url, audio_only=False):
+    """Download a playlist/channel with parallel workers and upload in order.
+
+    Entries are enumerated once with flat extraction and downloaded from
+    their own URLs, up to PLAYLIST_CONCURRENCY ahead of the upload cursor;
+    uploads follow playlist order. The progress message is refreshed every
+    PLAYLIST_PROGRESS_INTERVAL, also while a long entry is in progress. Progress is persisted in PLAYLIST_STATE so an interrupted job
+    resumes from the first entry not yet sent.
+    Returns False if the URL has no entries (caller falls back to one video).
+    """
+    title, entries = await asyncio.to_thread(get_media_entries, url)
+    if not entries:
+        return False
+
+    total = len(entries)
+    job = PLAYLIST_STATE.start(chat_id, user_id, url, title, total, audio_only)
+    done = set(job["done"])
+    pending = [i for i in range(1, total + 1) if i not in done]
+    failed = []
+    log("PLAYLIST", f"{title}: {total} entries, {len(done)} already sent")
+
+    entry_titles = [entry.get("title") or f"{title} #{index}" for index, entry in enumerate(entries, 1)]
+    search_titles = clean_titles_for_search(entry_titles) if audio_only else [None] * total
+
+    temp_dir = make_temp_dir("ytdl_playlist_", audio=audio_only)
+    download = download_audio if audio_only else download_video
+    tasks = {}
+
+    current = {}  # entry the upload cursor waits for: index, stage, since
+    progress_task = None
+
+    async def fetch(index):
+        entry_dir = os.path.join(temp_dir, f"entry_{index:04d}")
+        os.makedirs(entry_dir, exist_ok=True)
+        entry_url = entries[index - 1].get("url")
+        if entry_url:
+            return await download(entry_url, entry_dir, max_retries=2)
+        # No URL in the flat listing: select the entry from the playlist instead
+        return await download(url, entry_dir, max_retries=2, extra_args=["--playlist-items", str(index)])
+
+    def progress_text():
+        line = None
+        if current:
+            elapsed = int(time.monotonic() - current["since"])
+            line = (f"{current['stage']} #{current['index']}: {entry_titles[current['index'] - 1]}"
+                    f" ({elapsed // 60}:{elapsed % 60:02d})")
+        return format_playlist_progress(title, len(done), total, failed, line)
+
+    async def report_progress(message_id):
+        shown = None
+        while True:
+            await asyncio.sleep(PLAYLIST_PROGRESS_INTERVAL)
+            text = progress_text()
+            if text == shown:
+                continue
+            shown = text
+            try:
+                await BOT.edit_message_text(text, chat_id, message_id)
+            except Exception:
+                pass
+
+    try:
+        msg = await send_message(chat_id, format_playlist_progress(title, len(done), total, failed))
+        progress_task = asyncio.create_task(report_progress(msg.message_id))
+
+        for position, index in enumerate(pending):
+            # Keep a bounded window of downloads running ahead of the upload
+            for ahead in pending[position:position + PLAYLIST_CONCURRENCY]:
+                if ahead not in tasks:
+                    tasks[ahead] = asyncio.create_task(fetch(ahead))
+
+            current.update(index=index, stage="Downloading", since=time.monotonic())
+            path, error = await tasks.pop(index)
+            entry_title = entry_titles[index - 1]
+            entry_url = entries[index - 1].get("url") or url
+
+            if path:
+                current.update(stage="Uploading", since=time.monotonic())
+                try:
+                    await upload_playlist_entry(chat_id, path, entry_title, entry_url, audio_only,
+                                                search_title=search_titles[index - 1])
+                    done.add(index)
+                    PLAYLIST_STATE.mark_done(chat_id, url, audio_only, index)
+                except Exception as e:
+                    log("PLAYLIST", f"Upload of entry {index} failed: {e}", level=logging.WARNING)
+                    failed.append(index)
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            else:
+                log("PLAYLIST", f"Entry {index} failed: {error}", level=logging.WARNING)
+                failed.append(index)
+            current.clear()
+
+        PLAYLIST_STATE.finish(chat_id, url, audio_only)
+        summary = format_playlist_progress(title, len(done), total, failed)
+        if failed:
+            summary += "\nFailed entries: " + ", ".join(map(str, failed))
+        await send_message(chat_id, summary)
+        await notify_admin(chat_id, f"Playlist sent to user {user_id}: {title} ({len(done)}/{total})", kind="sent", url=url)
+
+    except Exception as e:
+        log("PLAYLIST", f"Error processing playlist: {e}", level=logging.ERROR, exc_info=True)
+        tb = truncate_error(traceback.format_exc())
+        await send_message(chat_id, f"Playlist interrupted, send the link again to resume.\n\n{tb}")
+        await notify_admin(chat_id, f"Playlist error for user {user_id}:\n{url}\n\n{tb}", kind="error", url=url, urgent=True)
+
+    finally:
+        await stop_task(progress_task)
+        for task in tasks.values():
+            task.cancel()
+        try:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+        except Exception as e:
+            log("PLAYLIST", f"Error cleaning up temp dir: {e}", level=logging.WARNING)
+
+    return True
+
+
+def resume_playlists():
+    """Restart playlist jobs interrupted by a previous shutdown."""
+    for job in PLAYLIST_STATE.unfinished():
+        if not USER_MANAGER.is_approved(job["user_id"]):
+            PLAYLIST_STATE.finish(job["chat_id"], job["url"], job.get("audio_only", False))
+            continue
+        log("PLAYLIST", f"Resuming {job['url']} for chat {job['chat_id']}")
+        if JOB_QUEUE is not None:
+            kind = "audio" if job.get("audio_only", False) else "video"
+            JOB_QUEUE.enqueue(kind, job["chat_id"], job["user_id"], job["url"])
+            continue
+        task = asyncio.create_task(process_playlist_download(
+            job["chat_id"], job["user_id"], job["url"], job.get("audio_only", False)))
+        BACKGROUND_TASKS.add(task)
+        task.add_done_callback(BACKGROUND_TASKS.discard)
+
+
+# Worker mode: the frontend enqueues jobs in JOB_QUEUE and WORKER_COUNT
+# worker processes (each with its own Telethon session) run them.
+# WORKER_COUNT = 0 runs every job inside the bot process.
+WORKER_COUNT = 0
+WORKER_POLL_INTERVAL = 1
+WORKER_RESTART_DELAY = 5
+# Workers publish their metrics to the job database this often for /stats
+WORKER_STATS_INTERVAL = 15
+JOB_RETENTION = 7 * 24 * 3600
+JOB_QUEUE = None
+
+
+# Fallback work rates for cost estimates when a stage has no history yet
+JOB_COST_FALLBACK_BPS = 2 * MiB
+JOB_COST_FALLBACK_RATIO = 0.2
+
+
+def estimate_job_cost(url, kind, duration=None, size=None):
+    """Estimated seconds of worker time for a job, from stage history.
+
+    Sums download, compression (videos over MAX_VIDEO_SIZE) and upload.
+    """
+    stages = [(get_domain(url), "download"), (LOCAL_DOMAIN, "upload")]
+    if kind == "video" and size and size > MAX_VIDEO_SIZE:
+        stages.append((LOCAL_DOMAIN, "compress"))
+
+    cost = 0
+    for domain, stage in stages:
+        expected = expected_stage_duration(domain, stage, size, duration)
+        if expected is None:
+            if size:
+                expected = size / JOB_COST_FALLBACK_BPS
+            elif duration:
+                expected = duration * JOB_COST_FALLBACK_RATIO
+            else:
+                return JOB_DEFAULT_COST
+        cost += expected
+    return max(JOB_MIN_COST, cost)
+
+
+def job_weight(user_id):
+    """Fair-share weight of a user's jobs."""
+    return ADMIN_JOB_WEIGHT if user_id == YTDL_ADMIN_CHAT_ID else 1
+
+
+def get_job_handler(kind):
+    """Coroutine function that runs a job of the given kind."""
+    if kind.startswith(AUDIO_RENDITION_KIND):
+        rendition = kind[len(AUDIO_RENDITION_KIND):]
+        return lambda chat_id, user_id, url: process_audio_rendition(chat_id, user_id, url, rendition)
+    return {
+        "video": process_download,
+        "audio": process_audio_download,
+        "tiktok_photo": process_tiktok_photo,
+    }[kind]
+
+
+LOCAL_JOB_IDS = itertools.count(1)
+
+
+async def run_job(kind, chat_id, user_id, url, job_id=None):
+    """Run a job in this process, tracking it in METRICS and tagging its log records with job_id."""
+    if job_id is None:
+        job_id = f"L{next(LOCAL_JOB_IDS)}"
+    with job_context(job_id, kind) as job:
+        log("JOB", f"Started {kind} for user {user_id}: {url}", user=user_id, url=url, kind=kind)
+        METRICS.inc("ytdl_jobs_total", kind=kind)
+        METRICS.add_gauge("ytdl_active_jobs", 1)
+        try:
+            with METRICS.timer("ytdl_stage_seconds", stage="job"):
+                await get_job_handler(kind)(chat_id, user_id, url)
+        finally:
+            METRICS.add_gauge("ytdl_active_jobs", -1)
+            log_stage(None)
+            elapsed = time.monotonic() - job.started
+            log("JOB", f"Finished {kind} in {elapsed:.1f}s", job_seconds=round(elapsed, 3))
+
+
+# Title probes started while the user picks a format (worker mode): url -> task
+MEDIA_PROBE_TASKS = {}
+
+
+def prefetch_media_probe(url):
+    """Start the title probe for a URL so dispatch_job can cost its job.
+
+    The probe (get_video_title, one yt-dlp --print run) fills
+    MEDIA_PROBE_CACHE while the format choice is on screen. Playlists are
+    not probed: listing a whole channel is not cheap.
+    """
+    if JOB_QUEUE is None or is_playlist_url(url) or url in MEDIA_PROBE_TASKS:
+        return
+    if MEDIA_PROBE_CACHE.get(url) is not CACHE_MISS:
+        return
+    task = asyncio.create_task(asyncio.to_thread(get_video_title, url))
+    MEDIA_PROBE_TASKS[url] = task
+    task.add_done_callback(lambda _: MEDIA_PROBE_TASKS.pop(url, None))
+
+
+async def probe_job_media(url):
+    """Duration and size of a URL for its job cost: cached, prefetched or probed once."""
+    cached = MEDIA_PROBE_CACHE.get(url)
+    if cached is not CACHE_MISS:
+        return cached
+    if not is_playlist_url(url):
+        task = MEDIA_PROBE_TASKS.get(url)
+        await (task if task else asyncio.to_thread(get_video_title, url))
+    return MEDIA_PROBE_CACHE.get(url, (None, None))
+
+
+async def dispatch_job(kind, chat_id, user_id, url):
+    """Run a download job in-process, or queue it for the worker processes."""
+    if JOB_QUEUE is None:
+        await run_job(kind, chat_id, user_id, url)
+        return
+    duration, size = await probe_job_media(url)
+    cost = estimate_job_cost(url, kind, duration, size)
+    job_id = JOB_QUEUE.enqueue(kind, chat_id, user_id, url, cost=cost, weight=job_weight(user_id))
+    position = JOB_QUEUE.position(job_id)
+    log("QUEUE", f"Job {job_id} ({kind}, ~{cost:.0f}s) for user {user_id}, position {position}")
+    if position > 1:
+        msg = await send_message(chat_id, f"Queued, position {position}. Please wait...")
+        # The worker that claims the job deletes the message; if one already has, do it here
+        if not JOB_QUEUE.set_status_message(job_id, msg.message_id):
+            await delete_queued_message(chat_id, msg.message_id)
+
+
+async def delete_queued_message(chat_id, message_id):
+    """Delete the "Queued, position N" message of a job that has started."""
+    try:
+        await BOT.delete_message(chat_id, message_id)
+    except Exception as e:
+        log("QUEUE", f"Failed to delete message {message_id}: {e}", level=logging.WARNING)
+
+
+def worker_session_path(worker_id):
+    """Telethon session file for a worker process."""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), f'ytdl_session_worker{worker_id}')
+
+
+def worker_log_path(log_path, worker_id):
+    """Log file of a worker process: each rotates its own file next to log_path."""
+    root, ext = os.path.splitext(log_path)
+    return f"{root}.worker{worker_id}{ext}"
+
+
+async def run_worker(worker_id, max_jobs=None):
+    """Worker process main loop: claim jobs from the queue and run them."""
+    global TELETHON_CLIENT, DISK_BUDGET, ADMIN_DIGEST
+    log(f"WORKER {worker_id}", "Starting")
+    queue = JobQueue(JOBS_DB_PATH)
+    DISK_BUDGET = DiskBudget(db_path=JOBS_DB_PATH, owner=f"worker{worker_id}")
+    ADMIN_DIGEST = AdminDigest(JOBS_DB_PATH)  # the frontend sends the digest
+    requeued = queue.requeue(worker_id)
+    if requeued:
+        log(f"WORKER {worker_id}", f"Requeued {requeued} interrupted job(s)")
+
+    TELETHON_CLIENT = make_telethon_client(worker_session_path(worker_id))
+    await start_telethon_with_retry()
+    metrics_runner = await start_metrics_server(METRICS_PORT + 1 + worker_id) if METRICS_PORT else None
+    lag_monitor = start_loop_lag_monitor()
+    stats_publisher = asyncio.create_task(publish_worker_stats(queue, worker_id))
+
+    handled = 0
+    try:
+        while max_jobs is None or handled < max_jobs:
+            job = queue.claim(worker_id)
+            if job is None:
+                await asyncio.sleep(WORKER_POLL_INTERVAL)
+                continue
+            log(f"WORKER {worker_id}", f"Job {job['id']} ({job['kind']}): {job['url']}")
+            if job.get("status_message"):
+                await delete_queued_message(job["chat_id"], job["status_message"])
+            error = None
+            try:
+                await run_job(job["kind"], job["chat_id"], job["user_id"], job["url"], job_id=job["id"])
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                log(f"WORKER {worker_id}", f"Job {job['id']} failed: {error}", level=logging.ERROR, exc_info=True)
+            queue.finish(job["id"], error)
+            queue.publish_stats(worker_id, METRICS.snapshot())
+            handled += 1
+    finally:
+        await stop_task(stats_publisher)
+        queue.publish_stats(worker_id, METRICS.snapshot())
+        await stop_task(lag_monitor)
+        await ADMIN_DIGEST.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if is_initialized(THROUGHPUT_HISTORY):
+            THROUGHPUT_HISTORY.flush()
+        await TELETHON_CLIENT.disconnect()
+        await close_aiohttp_session()
+
+
+async def publish_worker_stats(queue, worker_id):
+    """Publish this worker's metrics every WORKER_STATS_INTERVAL seconds."""
+    while True:
+        await asyncio.to_thread(queue.publish_stats, worker_id, METRICS.snapshot())
+        await asyncio.sleep(WORKER_STATS_INTERVAL)
+
+
+async def supervise_workers(count):
+    """Keep count worker processes running, restarting any that exit."""
+    processes = {}
+    try:
+        while True:
+            for worker_id in range(count):
+                process = processes.get(worker_id)
+                if process is not None and process.returncode is None:
+                    continue
+                if process is not None:
+                    log(f"WORKER {worker_id}", f"Exited with code {process.returncode}, restarting")
+                digest_args = ["--admin-digest", str(ADMIN_DIGEST_INTERVAL)] if ADMIN_DIGEST_INTERVAL else []
+                log_args = ["--log-level", LOG_CONSOLE_LEVEL, "--log-file", LOG_PATH or ""]
+                metrics_args = ["--metrics-port", str(METRICS_PORT or 0)]
+                processes[worker_id] = await asyncio.create_subprocess_exec(
+                    sys.executable, os.path.abspath(__file__), "--worker", str(worker_id),
+                    *digest_args, *log_args, *metrics_args)
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+    finally:
+        for process in processes.values():
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
 
 
 async def start_telethon_with_retry(max_retries=10):
@@ -1600,10 +4589,10 @@ async def start_telethon_with_retry(max_retries=10):
     for attempt in range(max_retries + 1):
         try:
             await TELETHON_CLIENT.start(bot_token=YTDL_TELEGRAM_TOKEN)
-            print("Telethon client started")
+            log("TELETHON", "Client started")
             return
         except Exception as e:
-            print(f"[TELETHON] Connection failed on attempt {attempt + 1}/{max_retries + 1}: {type(e).__name__}: {e}")
+            log("TELETHON", f"Connection failed on attempt {attempt + 1}/{max_retries + 1}: {type(e).__name__}: {e}", level=logging.WARNING)
 
             if attempt >= max_retries:
                 raise Exception(f"Failed to connect to Telegram after {max_retries + 1} attempts")
@@ -1614,27 +4603,339 @@ async def start_telethon_with_retry(max_retries=10):
             except Exception:
                 pass
 
-            print("[TELETHON] Waiting for internet...")
+            log("TELETHON", "Waiting for internet...")
             if not await wait_for_internet(max_wait=300, check_interval=10):
                 raise Exception("Internet connection not restored after 5 minutes")
 
-            print(f"[TELETHON] Retrying connection (attempt {attempt + 2}/{max_retries + 1})...")
+            log("TELETHON", f"Retrying connection (attempt {attempt + 2}/{max_retries + 1})...")
 
 
-async def main():
-    print(f"YouTube Download Bot v{__version__} starting...")
-    print(f"Admin chat ID: {YTDL_ADMIN_CHAT_ID}")
-    print(f"Max video size: {MAX_VIDEO_SIZE / GiB:.0f} GB")
+# Webhook ingestion (used when YTDL_WEBHOOK_URL is set, polling otherwise)
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_QUEUE_SIZE = 100
+WEBHOOK_MAX_CONNECTIONS = 8  # parallel deliveries Telegram may open
+# Updates handled at once. Without worker processes a handler runs the whole
+# download job, so this is well above the number of jobs expected in flight.
+WEBHOOK_MAX_HANDLERS = 64
+WEBHOOK_ENQUEUE_TIMEOUT = 5
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookIngress:
+    """aiohttp endpoint that feeds Telegram webhook updates to the bot handlers.
+
+    Updates go into a bounded intake queue. A dispatcher hands each one to
+    its own task, as polling does, with at most `max_handlers` running, so
+    a long handler does not hold up the ones after it. When the handlers
+    are all busy and the queue stays full for WEBHOOK_ENQUEUE_TIMEOUT the
+    request is answered with 503, so Telegram backs off and redelivers it
+    later. Requests without the registered secret token are refused with 403.
+    """
+
+    def __init__(self, bot, secret_token, queue_size=WEBHOOK_QUEUE_SIZE,
+                 max_handlers=WEBHOOK_MAX_HANDLERS, enqueue_timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+        if not secret_token:
+            raise ValueError("A webhook secret token is required")
+        self.bot = bot
+        self.secret_token = secret_token
+        self.queue_size = queue_size
+        self.max_handlers = max_handlers
+        self.enqueue_timeout = enqueue_timeout
+        self.queue = None
+        self.dispatcher = None
+        self.handlers = set()
+        self.runner = None
+
+    def make_app(self):
+        """Build the aiohttp application serving WEBHOOK_PATH."""
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        app.on_startup.append(self._start_dispatcher)
+        app.on_cleanup.append(self._stop_dispatcher)
+        return app
+
+    async def handle(self, request):
+        token = request.headers.get(WEBHOOK_SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            return web.Response(status=403)
+        try:
+            update = telebot.types.Update.de_json(await request.text())
+        except Exception as e:
+            log("WEBHOOK", f"Bad update: {e}", level=logging.WARNING)
+            return web.Response(status=400)
+        try:
+            await asyncio.wait_for(self.queue.put(update), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            log("WEBHOOK", f"Queue full, rejecting update {update.update_id}", level=logging.WARNING)
+            return web.Response(status=503)
+        return web.Response()
+
+    async def dispatch(self):
+        slots = asyncio.Semaphore(self.max_handlers)
+        while True:
+            # Take an update only when a handler slot is free, so a backlog stays in the queue
+            await slots.acquire()
+            update = await self.queue.get()
+            task = asyncio.create_task(self.process(update, slots))
+            self.handlers.add(task)
+            task.add_done_callback(self.handlers.discard)
+
+    async def process(self, update, slots):
+        try:
+            await self.bot.process_new_updates([update])
+        except Exception as e:
+            log("WEBHOOK", f"Error handling update {update.update_id}: {e}", level=logging.ERROR, exc_info=True)
+        finally:
+            slots.release()
+            self.queue.task_done()
+
+    async def _start_dispatcher(self, app):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.dispatcher = asyncio.create_task(self.dispatch())
+        METRICS.gauge_fn("ytdl_webhook_queue_depth", self.queue.qsize)
+        METRICS.gauge_fn("ytdl_webhook_handlers", lambda: len(self.handlers))
+
+    async def _stop_dispatcher(self, app):
+        await stop_task(self.dispatcher)
+        self.dispatcher = None
+        for task in list(self.handlers):
+            await stop_task(task)
+
+    async def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        log("WEBHOOK", f"Listening on {host}:{port}{WEBHOOK_PATH}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def run_webhook(webhook_url):
+    """Serve updates via webhook until cancelled; raises if setup fails."""
+    if not YTDL_WEBHOOK_SECRET:
+        # Without it anyone reaching the port could post forged updates
+        raise RuntimeError("YTDL_WEBHOOK_SECRET is not set")
+    ingress = WebhookIngress(BOT, YTDL_WEBHOOK_SECRET)
+    await ingress.start()
+    try:
+        if not await BOT.set_webhook(url=webhook_url, secret_token=YTDL_WEBHOOK_SECRET,
+                                     max_connections=WEBHOOK_MAX_CONNECTIONS):
+            raise RuntimeError("set_webhook was rejected")
+        log("WEBHOOK", f"Registered {webhook_url}")
+        await asyncio.Event().wait()
+    finally:
+        await ingress.stop()
+
+
+METRICS.gauge_fn("ytdl_job_queue_depth", lambda: JOB_QUEUE.depth() if JOB_QUEUE else 0)
+METRICS.gauge_fn("ytdl_encode_active", lambda: ENCODE_GOVERNOR.snapshot()["active"])
+METRICS.gauge_fn("ytdl_encode_threads", lambda: ENCODE_GOVERNOR.snapshot()["threads"])
+METRICS.gauge_fn("ytdl_disk_reserved_bytes", lambda: DISK_BUDGET.snapshot()["reserved"])
+METRICS.gauge_fn("ytdl_disk_waiting_jobs", lambda: DISK_BUDGET.snapshot()["waiting"])
+
+
+async def handle_metrics_request(request):
+    return web.Response(text=METRICS.render(), content_type="text/plain")
+
+
+async def start_metrics_server(port, host=METRICS_HOST):
+    """Serve METRICS on http://host:port/metrics; returns the runner or None."""
+    runner = web.AppRunner(web.Application())
+    runner.app.router.add_get("/metrics", handle_metrics_request)
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        log("METRICS", f"Could not listen on {host}:{port}: {e}", level=logging.WARNING)
+        await runner.cleanup()
+        return None
+    log("METRICS", f"Serving http://{host}:{port}/metrics")
+    return runner
+
+
+LOOP_LAG_INTERVAL = 0.25  # seconds between event-loop heartbeats (None disables the monitor)
+LOOP_LAG_THRESHOLD = 1.0  # loop stuck this long -> log the blocking stack
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
-    # Start Telethon client with bot token
-    await start_telethon_with_retry()
-    print("Telethon client ready")
 
-    # Start bot polling
+class LoopLagMonitor:
+    """Measures event-loop scheduling lag and reports code that blocks the loop.
+
+    A task on the loop sleeps `interval` seconds at a time and records how
+    late it wakes up (ytdl_loop_lag_seconds). A watchdog thread checks that
+    heartbeat; once the loop has been stuck for `threshold` seconds it logs
+    the loop thread's stack, i.e. the blocking call, once per stall.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = None
+        self.loop = None
+        self.loop_thread = None
+        self.last_dump = None
+        self._stop = threading.Event()
+
+    def blocked_for(self, now=None):
+        """Seconds the loop is overdue for its next heartbeat."""
+        if self.heartbeat is None:
+            return 0.0
+        return max(0.0, (now or time.monotonic()) - self.heartbeat - self.interval)
+
+    def dump_stack(self, blocked):
+        frame = sys._current_frames().get(self.loop_thread)
+        try:
+            task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            task = None
+        stack = "".join(traceback.format_stack(frame)) if frame else "  (no frame)\n"
+        self.last_dump = (f"Event loop blocked for {blocked:.1f}s"
+                          f" in task {task.get_name() if task else '?'}:\n{stack}")
+        log("LAG", self.last_dump.rstrip(), level=logging.WARNING, blocked=round(blocked, 3))
+        METRICS.inc("ytdl_loop_stalls_total")
+
+    def _watch(self):
+        dumped = None
+        while not self._stop.wait(min(self.interval, self.threshold / 2)):
+            beat = self.heartbeat
+            blocked = self.blocked_for()
+            if blocked >= self.threshold and beat != dumped:
+                dumped = beat
+                self.dump_stack(blocked)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stop.clear()
+        watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                start = self.heartbeat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, time.monotonic() - start - self.interval)
+                METRICS.observe("ytdl_loop_lag_seconds", lag, buckets=LAG_BUCKETS)
+        finally:
+            self._stop.set()
+            watchdog.join()
+
+
+def start_loop_lag_monitor():
+    """Run a LoopLagMonitor on the current loop; returns its task or None when disabled."""
+    if not LOOP_LAG_INTERVAL:
+        return None
+    return asyncio.create_task(LoopLagMonitor().run())
+
+
+async def stop_task(task):
+    """Cancel a background task (None is ignored) and wait for it to finish."""
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def collect_stats():
+    """Metrics for /stats: this process's, plus every worker's in worker mode.
+
+    Returns (metrics, workers); workers is the number of worker snapshots
+    merged in.
+    """
+    if JOB_QUEUE is None:
+        return METRICS, 0
+    snapshots = JOB_QUEUE.worker_stats()
+    metrics = Metrics()
+    for snapshot in (METRICS.snapshot(), *snapshots.values()):
+        metrics.merge(snapshot)
+    return metrics, len(snapshots)
+
+
+def format_stats():
+    """Admin /stats summary: p50/p95 per stage, retries, failures and gauges."""
+    metrics, workers = collect_stats()
+    lines = []
+    if JOB_QUEUE is not None:
+        ports = f" (own metrics on ports {METRICS_PORT + 1}-{METRICS_PORT + workers})" if METRICS_PORT and workers else ""
+        lines.append(f"Workers reporting: {workers}{ports}")
+    lines.append("Stage latency (recent):")
+    stages = metrics.percentiles("ytdl_stage_seconds")
+    if not stages:
+        lines.append("  no data yet")
+    for stage, (count, pcts) in sorted(stages.items()):
+        lines.append(f"  {stage}: p50 {pcts[50]:.1f}s, p95 {pcts[95]:.1f}s (n={count})")
+    uploads = metrics.percentiles("ytdl_upload_bytes_per_second").get("ytdl_upload_bytes_per_second")
+    if uploads:
+        lines.append(f"Upload speed: p50 {uploads[1][50] / MiB:.1f} MiB/s")
+    lag = metrics.percentiles("ytdl_loop_lag_seconds", pcts=(50, 99)).get("ytdl_loop_lag_seconds")
+    if lag:
+        stalls = sum(metrics.counters.get("ytdl_loop_stalls_total", {}).values())
+        lines.append(f"Event-loop lag: p50 {lag[1][50] * 1000:.0f}ms, p99 {lag[1][99] * 1000:.0f}ms, "
+                     f"stalls: {stalls:g}")
+    for title, name in (("Retries", "ytdl_retries_total"), ("Failures", "ytdl_job_failures_total")):
+        series = metrics.counters.get(name, {})
+        if series:
+            lines.append(f"{title}:")
+            for key, value in sorted(series.items()):
+                lines.append(f"  {', '.join(v for _, v in key)}: {value:g}")
+    active = sum(metrics.gauges.get("ytdl_active_jobs", {}).values())
+    queued = JOB_QUEUE.depth() if JOB_QUEUE else 0
+    lines.append(f"Active jobs: {active:g}, queued: {queued}")
+    return "\n".join(lines)
+
+
+async def main(workers=WORKER_COUNT):
+    global JOB_QUEUE, ADMIN_DIGEST
+    log("BOT", f"YouTube Download Bot v{__version__} starting...")
+    log("BOT", f"Admin chat ID: {YTDL_ADMIN_CHAT_ID}")
+    log("BOT", f"Max video size: {MAX_VIDEO_SIZE / GiB:.0f} GB")
+
+    supervisor = None
+    if workers:
+        # Frontend only: workers own downloads, uploads and Telethon sessions
+        JOB_QUEUE = JobQueue(JOBS_DB_PATH)
+        JOB_QUEUE.requeue()
+        JOB_QUEUE.prune(JOB_RETENTION)
+        DiskBudget(db_path=JOBS_DB_PATH).clear()  # reservations of workers from the last run
+        JOB_QUEUE.clear_stats()
+        # One digest for the frontend and all workers
+        ADMIN_DIGEST = AdminDigest(JOBS_DB_PATH)
+        if ADMIN_DIGEST_INTERVAL:
+            ADMIN_DIGEST.start()
+        supervisor = asyncio.create_task(supervise_workers(workers))
+        log("BOT", f"Worker mode: {workers} worker process(es)")
+    else:
+        # Start Telethon client with bot token
+        await start_telethon_with_retry()
+        log("BOT", "Telethon client ready")
+
+    resume_playlists()
+    metrics_runner = await start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+    lag_monitor = start_loop_lag_monitor()
+
     try:
+        if YTDL_WEBHOOK_URL:
+            try:
+                await run_webhook(YTDL_WEBHOOK_URL)
+            except Exception as e:
+                log("WEBHOOK", f"Failed ({e}), falling back to polling", level=logging.WARNING)
+                await BOT.delete_webhook()
+        # Start bot polling
         await BOT.polling(non_stop=True)
     finally:
-        await TELETHON_CLIENT.disconnect()
+        await stop_task(supervisor)
+        await stop_task(lag_monitor)
+        await ADMIN_DIGEST.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if is_initialized(THROUGHPUT_HISTORY):
+            THROUGHPUT_HISTORY.flush()
+        if is_initialized(TELETHON_CLIENT):
+            await TELETHON_CLIENT.disconnect()
         await close_aiohttp_session()
 
 
@@ -1879,6 +5180,7 @@ async def test_upload_only(cache_dir):
 async def test_full(url):
     """Full test mode: download, process, and upload video in one shot."""
     print(f"YouTube Download Bot v{__version__} FULL TEST MODE (VIDEO)")
+    url, _ = await normalize_tiktok_url(url)
     print(f"Testing URL: {url}")
 
     telethon_started = False
@@ -1900,6 +5202,7 @@ async def test_full(url):
 async def test_audio(url):
     """Full test mode: download, process, and upload audio in one shot."""
     print(f"YouTube Download Bot v{__version__} FULL TEST MODE (AUDIO)")
+    url, _ = await normalize_tiktok_url(url)
     print(f"Testing URL: {url}")
 
     telethon_started = False
@@ -1936,8 +5239,34 @@ Test mode examples:
 
   The split pipeline keeps files in download_cache/ so you can retry
   uploads without re-downloading from YouTube.
+
+Worker mode (frontend + N download/upload worker processes):
+    python3 ytdl_bot.py --workers 4
+
+Admin digest (one summary every 10 minutes instead of a message per event):
+    python3 ytdl_bot.py --admin-digest 600
+
+Logging (console shows INFO and up; logs/ytdl_bot.log gets everything as JSON lines):
+    python3 ytdl_bot.py --log-level DEBUG
+    python3 ytdl_bot.py --log-file ''          # console only
+
+Metrics (Prometheus text on 127.0.0.1:PORT/metrics, workers use PORT+1+N):
+    python3 ytdl_bot.py --metrics-port 9464
+    python3 ytdl_bot.py --metrics-port 0       # disabled
         """
     )
+    parser.add_argument('--workers', metavar='N', type=int, default=WORKER_COUNT,
+                        help='Run jobs in N worker processes fed by a SQLite queue')
+    parser.add_argument('--worker', metavar='ID', type=int,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--admin-digest', metavar='SECONDS', type=float, default=ADMIN_DIGEST_INTERVAL,
+                        help='Batch routine admin notifications into one digest per SECONDS')
+    parser.add_argument('--log-level', default=LOG_CONSOLE_LEVEL, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Console log verbosity (default: %(default)s)')
+    parser.add_argument('--log-file', metavar='PATH', default=LOG_PATH,
+                        help="Rotating JSON log file, '' to disable (default: %(default)s)")
+    parser.add_argument('--metrics-port', metavar='PORT', type=int, default=METRICS_PORT or 0,
+                        help='Serve Prometheus metrics on PORT, 0 to disable (default: %(default)s)')
     parser.add_argument('--test-video', metavar='URL',
                         help='Full test: download, process, and upload video')
     parser.add_argument('--test-audio', metavar='URL',
@@ -1949,16 +5278,29 @@ Test mode examples:
     parser.add_argument('--test-upload', metavar='PATH',
                         help='Upload only: upload cached video to Telegram (PATH is cache dir)')
     args = parser.parse_args()
-
-    if args.test_audio:
-        asyncio.run(test_audio(args.test_audio))
-    elif args.test_download:
-        asyncio.run(test_download_only(args.test_download))
-    elif args.test_process:
-        asyncio.run(test_process_only(args.test_process))
-    elif args.test_upload:
-        asyncio.run(test_upload_only(args.test_upload))
-    elif args.test_video:
-        asyncio.run(test_full(args.test_video))
+    ADMIN_DIGEST_INTERVAL = args.admin_digest
+    LOG_CONSOLE_LEVEL = args.log_level
+    LOG_PATH = args.log_file or None
+    METRICS_PORT = args.metrics_port or None
+    if LOG_PATH and args.worker is not None:
+        setup_logging(LOG_CONSOLE_LEVEL, worker_log_path(LOG_PATH, args.worker))
     else:
-        asyncio.run(main())
+        setup_logging(LOG_CONSOLE_LEVEL, LOG_PATH)
+
+    try:
+        if args.test_audio:
+            asyncio.run(test_audio(args.test_audio))
+        elif args.test_download:
+            asyncio.run(test_download_only(args.test_download))
+        elif args.test_process:
+            asyncio.run(test_process_only(args.test_process))
+        elif args.test_upload:
+            asyncio.run(test_upload_only(args.test_upload))
+        elif args.test_video:
+            asyncio.run(test_full(args.test_video))
+        elif args.worker is not None:
+            asyncio.run(run_worker(args.worker))
+        else:
+            asyncio.run(main(args.workers))
+    finally:
+        stop_logging()
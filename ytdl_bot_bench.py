@@ -0,0 +1,591 @@
+#! python3
+# -*- coding: utf-8 -*-
+"""
+Offline end-to-end benchmark for ytdl_bot.
+
+yt-dlp, ffmpeg and ffprobe are replaced by fake executables (this module
+run under their names) that write real files of configurable size and
+duration at a configurable rate. The Telegram bot API and Telethon are
+replaced by in-process fakes; the Telethon fake reads the uploaded file at a
+configurable bandwidth. Simulated users send links through handle_message
+and pick a format through handle_format_choice, so jobs run the same code
+path as in production.
+
+    python3 ytdl_bot_bench.py --users 8 --jobs 4 --size 50 --download-rate 20 --upload-rate 10
+
+--upload-bench instead measures the Telethon part uploader alone: peak RSS
+and CPU seconds per GiB, for MmapUpload against a read()-per-part baseline.
+
+    python3 ytdl_bot_bench.py --upload-bench --size 512 --upload-parallel 4
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import inspect
+import tempfile
+import contextlib
+from types import SimpleNamespace
+from unittest.mock import patch
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+# Fake tools read their settings from the environment, so they work as subprocesses
+BENCH_ENV_PREFIX = "YTDL_BENCH_"
+BENCH_DEFAULTS = {
+    "SIZE": 20 * MiB,          # downloaded video size (bytes)
+    "DURATION": 300,           # media duration (seconds)
+    "DOWNLOAD_BPS": 20 * MiB,  # yt-dlp download rate (0 = unlimited)
+    "ENCODE_SPEED": 20,        # ffmpeg speed as a multiple of realtime
+    "PROBE_DELAY": 0.2,        # seconds per metadata/thumbnail call
+}
+FAKE_TOOLS = ("yt-dlp", "ffmpeg", "ffprobe")
+AUDIO_BITRATE = 320 * 1000
+WRITE_CHUNK = 256 * 1024
+BENCH_USER_ID_BASE = 10_000_000
+
+# Enough container header for tools and humans to recognise the files
+MP4_HEADER = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom"
+MP3_HEADER = b"ID3\x04\x00\x00\x00\x00\x00\x00"
+JPEG_STUB = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xd9"
+
+
+# ---------------------------------------------------------------------------
+# Fake yt-dlp / ffmpeg / ffprobe
+# ---------------------------------------------------------------------------
+
+def bench_settings():
+    """Fake tool settings from the environment (BENCH_DEFAULTS when unset)."""
+    return {key: float(os.environ.get(BENCH_ENV_PREFIX + key, default))
+            for key, default in BENCH_DEFAULTS.items()}
+
+
+def write_synthetic_file(path, nbytes, rate=0, header=b"", resume=False):
+    """Write nbytes to path in chunks, no faster than rate bytes/sec.
+
+    With resume, an existing file is extended instead of rewritten.
+    """
+    nbytes = int(nbytes)
+    mode = "ab" if resume and os.path.exists(path) else "wb"
+    block = (header + bytes(range(256)) * (WRITE_CHUNK // 256 + 1))[:WRITE_CHUNK]
+    with open(path, mode) as f:
+        written = f.tell()
+        start = time.monotonic()
+        resumed_at = written
+        while written < nbytes:
+            chunk = block[:min(WRITE_CHUNK, nbytes - written)]
+            f.write(chunk)
+            f.flush()
+            written += len(chunk)
+            if rate:
+                ahead = (written - resumed_at) / rate - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def fake_yt_dlp(args, settings):
+    url = args[-1]
+    name = url.rstrip("/").rsplit("=", 1)[-1].rsplit("/", 1)[-1]
+    title = f"Bench {name}"
+    if "--print" in args:
+        time.sleep(settings["PROBE_DELAY"])
+        print(title)
+        print(f"{settings['DURATION']:g}\t{settings['SIZE']:g}")
+        return 0
+    if "-J" in args:
+        time.sleep(settings["PROBE_DELAY"])
+        print(json.dumps({"title": title, "duration": settings["DURATION"], "filesize": settings["SIZE"]}))
+        return 0
+
+    output = args[args.index("-o") + 1]
+    if "--write-thumbnail" in args:
+        time.sleep(settings["PROBE_DELAY"])
+        write_synthetic_file(output.replace("%(ext)s", "jpg"), len(JPEG_STUB), header=JPEG_STUB)
+        return 0
+
+    # Each link gets its own content, so duplicate detection doesn't skip uploads
+    if "-x" in args:
+        nbytes, header = settings["DURATION"] * AUDIO_BITRATE / 8, MP3_HEADER + name.encode()
+    else:
+        nbytes, header = settings["SIZE"], MP4_HEADER + name.encode()
+    part = output + ".part"
+    write_synthetic_file(part, nbytes, settings["DOWNLOAD_BPS"], header, resume="--continue" in args)
+    os.replace(part, output)
+    return 0
+
+
+def fake_ffprobe(args, settings):
+    path = args[-1]
+    query = " ".join(args)
+    duration = settings["DURATION"]
+    if "json" in query:
+        video_bitrate = int(settings["SIZE"] * 8 / duration)
+        print(json.dumps({
+            "streams": [
+                {"codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080,
+                 "bit_rate": str(video_bitrate), "r_frame_rate": "30/1", "duration": str(duration)},
+                {"codec_type": "audio", "codec_name": "aac", "bit_rate": "128000", "duration": str(duration)},
+            ],
+            "format": {"duration": str(duration), "size": str(os.path.getsize(path))},
+        }))
+    elif "codec_name" in query:
+        print("mp3" if path.endswith(".mp3") else "aac")
+    elif "width" in query:
+        print("1920x1080" if "s=x" in query else "1920\n1080")
+    else:
+        print(f"{duration:g}")
+    return 0
+
+
+def fake_ffmpeg(args, settings):
+    output = args[-1]
+    duration = settings["DURATION"]
+    bitrate = sum(int(args[i + 1]) for i, arg in enumerate(args[:-1]) if arg in ("-b:v", "-b:a"))
+    nbytes = bitrate * duration / 8 if bitrate else settings["SIZE"]
+    encode_time = duration / settings["ENCODE_SPEED"] if settings["ENCODE_SPEED"] else 0
+    write_synthetic_file(output, nbytes, nbytes / encode_time if encode_time else 0, MP4_HEADER)
+    return 0
+
+
+def fake_tool_main(name, args):
+    """Entry point of the fake executables; returns the exit code."""
+    handler = {"yt-dlp": fake_yt_dlp, "ffmpeg": fake_ffmpeg, "ffprobe": fake_ffprobe}[name]
+    try:
+        return handler(args, bench_settings())
+    except Exception as e:
+        print(f"{name}: {type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+
+
+def install_fake_tools(bin_dir):
+    """Write yt-dlp/ffmpeg/ffprobe wrappers into bin_dir; prepend it to PATH to use them."""
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in FAKE_TOOLS:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(f"#!{sys.executable}\n"
+                    "import sys\n"
+                    f"sys.path.insert(0, {module_dir!r})\n"
+                    "from ytdl_bot_bench import fake_tool_main\n"
+                    f"sys.exit(fake_tool_main({name!r}, sys.argv[1:]))\n")
+        os.chmod(path, 0o755)
+    return bin_dir
+
+
+# ---------------------------------------------------------------------------
+# Fake Telegram
+# ---------------------------------------------------------------------------
+
+class FakeBot:
+    """Stands in for AsyncTeleBot; every call takes `latency` seconds."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.sent = []
+        self._next_id = 0
+
+    async def _call(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self._call()
+        self._next_id += 1
+        msg = SimpleNamespace(message_id=self._next_id, chat=SimpleNamespace(id=chat_id),
+                              text=text, reply_markup=reply_markup)
+        self.sent.append(msg)
+        return msg
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        await self._call()
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call()
+
+    async def forward_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._call()
+        self._next_id += 1
+        return SimpleNamespace(message_id=self._next_id, chat=SimpleNamespace(id=chat_id), document=None)
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        await self._call()
+
+
+class FakeTelethonClient:
+    """Stands in for TelegramClient at `bandwidth` bytes/sec per upload.
+
+    File parts arrive as upload requests (client(request)) and send_file()
+    then gets their InputFile handle; plain paths (albums) are read here.
+    """
+
+    def __init__(self, bandwidth=10 * MiB, latency=0.1, chunk_size=512 * 1024):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.connected = False
+        self.uploads = []  # (entity, bytes, seconds)
+        self.parts = {}  # file_id -> [first part time, bytes received]
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.connected = True
+
+    async def start(self, *args, **kwargs):
+        self.connected = True
+        return self
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def __call__(self, request):
+        bytes(request)  # serialize like the real client
+        received = self.parts.get(request.file_id)
+        if received is None:
+            received = self.parts[request.file_id] = [time.monotonic(), 0]
+            await asyncio.sleep(self.latency)
+        received[1] += len(request.bytes)
+        await self.pace(received[0], received[1])
+        return True
+
+    async def pace(self, start, done):
+        if self.bandwidth:
+            ahead = done / self.bandwidth - (time.monotonic() - start)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+    async def send_file(self, entity, file, progress_callback=None, **kwargs):
+        if hasattr(file, "parts"):  # InputFile handle from uploaded parts
+            start, total = self.parts.pop(file.id)
+            self.uploads.append((entity, total, time.monotonic() - start))
+            return SimpleNamespace(id=len(self.uploads))
+        paths = file if isinstance(file, list) else [file]
+        total = sum(os.path.getsize(path) for path in paths)
+        start = time.monotonic()
+        await asyncio.sleep(self.latency)
+        done = 0
+        for path in paths:
+            with open(path, "rb") as f:
+                while True:
+                    chunk = await asyncio.to_thread(f.read, self.chunk_size)
+                    if not chunk:
+                        break
+                    done += len(chunk)
+                    await self.pace(start, done)
+                    if progress_callback:
+                        result = progress_callback(done, total)
+                        if inspect.isawaitable(result):
+                            await result
+        self.uploads.append((entity, total, time.monotonic() - start))
+        return SimpleNamespace(id=len(self.uploads))
+
+
+# ---------------------------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------------------------
+
+def percentile(values, pct):
+    """Nearest-rank percentile, as used by Metrics.percentiles."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(pct / 100 * len(values)))] if values else 0.0
+
+
+async def simulate_user(bot, client, user_id, jobs, audio_ratio, rng, results):
+    """Send `jobs` links one after another, choosing video or audio for each."""
+    import ytdl_bot
+    user = SimpleNamespace(id=user_id, username=f"bench{user_id}", first_name="Bench", last_name=None)
+    chat = SimpleNamespace(id=user_id)
+    for n in range(jobs):
+        url = f"https://www.youtube.com/watch?v=bench{user_id}n{n}"
+        kind = "audio" if rng.random() < audio_ratio else "video"
+        uploads_before = sum(1 for entity, _, _ in client.uploads if entity == user_id)
+        start = time.monotonic()
+        await ytdl_bot.handle_message(SimpleNamespace(message_id=n, chat=chat, from_user=user, text=url))
+        choice_id = next(mid for mid, data in list(ytdl_bot.PENDING_CHOICES.items()) if data["url"] == url)
+        call = SimpleNamespace(id=f"{user_id}:{n}", data=f"dl_{kind}", from_user=user,
+                               message=SimpleNamespace(message_id=choice_id, chat=chat))
+        await ytdl_bot.handle_format_choice(call)
+        uploaded = sum(1 for entity, _, _ in client.uploads if entity == user_id) > uploads_before
+        results.append({"kind": kind, "user": user_id, "seconds": time.monotonic() - start, "ok": uploaded})
+
+
+@contextlib.contextmanager
+def bench_environment(bot=None, client=None, approved_users=(), size=20 * MiB, duration=300,
+                      download_bps=20 * MiB, encode_speed=20, probe_delay=0.2,
+                      max_video_size=None, metrics=None, verbose=False):
+    """Point ytdl_bot at the fake tools, throwaway state and the given fakes.
+
+    bot/client replace BOT and TELETHON_CLIENT when given. Yields the temp root.
+    """
+    import ytdl_bot
+    from ytdl_bot import (Metrics, DiskBudget, TTLCache, UserManager, PlaylistState, ThroughputHistory,
+                          UploadCache, FingerprintIndex, AudioRenditionCache)
+
+    with tempfile.TemporaryDirectory(prefix="ytdl_bench_") as root, contextlib.ExitStack() as stack:
+        bin_dir = os.path.join(root, "bin")
+        os.makedirs(bin_dir)
+        install_fake_tools(bin_dir)
+        config_dir = os.path.join(root, "configs")
+        user_manager = UserManager(os.path.join(config_dir, "users.json"))
+        user_manager.config["approved_users"] = list(approved_users)
+        stack.enter_context(patch.dict(os.environ, {
+            "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+            BENCH_ENV_PREFIX + "SIZE": str(size),
+            BENCH_ENV_PREFIX + "DURATION": str(duration),
+            BENCH_ENV_PREFIX + "DOWNLOAD_BPS": str(download_bps),
+            BENCH_ENV_PREFIX + "ENCODE_SPEED": str(encode_speed),
+            BENCH_ENV_PREFIX + "PROBE_DELAY": str(probe_delay),
+        }))
+        overrides = {
+            "USER_MANAGER": user_manager,
+            "PLAYLIST_STATE": PlaylistState(os.path.join(config_dir, "playlists.json")),
+            "UPLOAD_CACHE": UploadCache(os.path.join(config_dir, "uploads.json")),
+            "FINGERPRINT_INDEX": FingerprintIndex(os.path.join(config_dir, "fingerprints.json")),
+            "AUDIO_RENDITION_CACHE": AudioRenditionCache(os.path.join(root, "audio_cache")),
+            "THROUGHPUT_HISTORY": ThroughputHistory(os.path.join(config_dir, "throughput.json")),
+            "METRICS": metrics or Metrics(),
+            "DISK_BUDGET": DiskBudget(),
+            "MEDIA_PROBE_CACHE": TTLCache(1024, 3600),
+            "MEDIA_ENTRY_COUNTS": TTLCache(1024, 3600),
+            "PENDING_CHOICES": {},
+            "STATUS_MESSAGES": {},
+            "TEMP_ROOT": os.path.join(root, "work"),
+            "AUDIO_TEMP_ROOT": None,
+            "SPOTIFY_ENABLED": False,
+            "JOB_QUEUE": None,
+        }
+        if bot is not None:
+            overrides["BOT"] = bot
+        if client is not None:
+            overrides["TELETHON_CLIENT"] = client
+        if max_video_size:
+            overrides["MAX_VIDEO_SIZE"] = max_video_size
+        for name, value in overrides.items():
+            stack.enter_context(patch.object(ytdl_bot, name, value))
+        if verbose:
+            ytdl_bot.setup_logging("INFO", None)
+            stack.callback(ytdl_bot.stop_logging)
+        else:
+            stack.enter_context(patch.object(ytdl_bot.LOG, "disabled", True))
+        yield root
+
+
+async def run_benchmark(users=4, jobs_per_user=2, size=20 * MiB, duration=300,
+                        download_bps=20 * MiB, upload_bps=10 * MiB, encode_speed=20,
+                        probe_delay=0.2, api_latency=0.05, audio_ratio=0.25,
+                        max_video_size=None, seed=0, verbose=False):
+    """Run the simulated load and return a result dict (see format_report)."""
+    import ytdl_bot
+    from ytdl_bot import Metrics
+
+    rng = random.Random(seed)
+    bot = FakeBot(api_latency)
+    client = FakeTelethonClient(upload_bps)
+    metrics = Metrics(sample_size=max(ytdl_bot.METRICS_SAMPLE_SIZE, users * jobs_per_user * 2))
+    user_ids = [BENCH_USER_ID_BASE + i for i in range(users)]
+    results = []
+
+    with bench_environment(bot, client, user_ids, size=size, duration=duration,
+                           download_bps=download_bps, encode_speed=encode_speed,
+                           probe_delay=probe_delay, max_video_size=max_video_size,
+                           metrics=metrics, verbose=verbose):
+        start = time.monotonic()
+        await asyncio.gather(*(simulate_user(bot, client, user_id, jobs_per_user, audio_ratio, rng, results)
+                               for user_id in user_ids))
+        elapsed = time.monotonic() - start
+
+    pcts = (50, 95, 99)
+    latencies = [r["seconds"] for r in results]
+    return {
+        "users": users,
+        "jobs": len(results),
+        "failed": sum(1 for r in results if not r["ok"]),
+        "elapsed": elapsed,
+        "jobs_per_min": len(results) / elapsed * 60 if elapsed else 0.0,
+        "latency": {pct: percentile(latencies, pct) for pct in pcts},
+        "stages": metrics.percentiles("ytdl_stage_seconds", pcts=pcts),
+        "uploaded_bytes": sum(total for _, total, _ in client.uploads),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Upload memory/CPU benchmark
+# ---------------------------------------------------------------------------
+
+UPLOAD_METHODS = ("read", "mmap")
+RSS_SAMPLE_INTERVAL = 0.002
+
+
+def current_rss():
+    """Resident set size of this process in bytes (0 where /proc is unavailable)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler:
+    """Samples current_rss() from a thread; peak is the highest value seen."""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.baseline = self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+class NullTelethonClient:
+    """Serializes each upload request like TelegramClient and drops it."""
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+
+    async def __call__(self, request):
+        self.bytes += len(request.bytes)
+        self.requests += 1
+        bytes(request)
+        await asyncio.sleep(0)  # let parallel uploads interleave
+        return True
+
+
+async def read_upload(client, path, part_size=None):
+    """Baseline: Telethon's upload_file loop, one read() buffer per part."""
+    import ytdl_bot
+    from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+
+    part_size = part_size or ytdl_bot.UPLOAD_PART_SIZE
+    file_size = os.path.getsize(path)
+    part_count = (file_size + part_size - 1) // part_size
+    is_big = file_size > ytdl_bot.UPLOAD_BIG_FILE_SIZE
+    file_id = random.randrange(-2 ** 63, 2 ** 63)
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for index in range(part_count):
+            part = f.read(part_size)
+            if is_big:
+                await client(SaveBigFilePartRequest(file_id, index, part_count, part))
+            else:
+                md5.update(part)
+                await client(SaveFilePartRequest(file_id, index, part))
+
+
+async def mmap_upload(client, path, part_size=None):
+    import ytdl_bot
+    await ytdl_bot.MmapUpload(path, part_size).upload(client)
+
+
+async def run_upload_benchmark(size=256 * MiB, parallel=4, methods=UPLOAD_METHODS, part_size=None):
+    """Upload `parallel` files of `size` bytes with each method; return one result dict per method."""
+    import gc
+    uploaders = {"read": read_upload, "mmap": mmap_upload}
+    results = []
+    with tempfile.TemporaryDirectory(prefix="ytdl_upload_bench_") as root:
+        paths = [os.path.join(root, f"upload_{i}.bin") for i in range(parallel)]
+        for path in paths:
+            write_synthetic_file(path, size)
+        for method in methods:
+            gc.collect()
+            client = NullTelethonClient()
+            cpu_start, start = time.process_time(), time.monotonic()
+            with RssSampler() as rss:
+                await asyncio.gather(*(uploaders[method](client, path, part_size) for path in paths))
+            cpu, elapsed = time.process_time() - cpu_start, time.monotonic() - start
+            gib = client.bytes / GiB
+            results.append({
+                "method": method,
+                "files": parallel,
+                "uploaded_bytes": client.bytes,
+                "parts": client.requests,
+                "elapsed": elapsed,
+                "cpu_seconds": cpu,
+                "cpu_per_gib": cpu / gib if gib else 0.0,
+                "peak_rss_delta": max(0, rss.peak - rss.baseline),
+            })
+    return results
+
+
+def format_upload_report(results):
+    lines = [f"{'method':<8}{'files':>6}{'GiB':>8}{'parts':>8}{'CPU s/GiB':>11}{'peak RSS +MiB':>15}{'MiB/s':>9}"]
+    for r in results:
+        rate = r["uploaded_bytes"] / MiB / r["elapsed"] if r["elapsed"] else 0.0
+        lines.append(f"{r['method']:<8}{r['files']:>6}{r['uploaded_bytes'] / GiB:>8.2f}{r['parts']:>8}"
+                     f"{r['cpu_per_gib']:>11.3f}{r['peak_rss_delta'] / MiB:>15.1f}{rate:>9.0f}")
+    return "\n".join(lines)
+
+
+def format_report(result):
+    upload_rate = result["uploaded_bytes"] / MiB / result["elapsed"] if result["elapsed"] else 0.0
+    lines = [
+        f"Users: {result['users']}, jobs: {result['jobs']} ({result['failed']} failed) "
+        f"in {result['elapsed']:.1f}s",
+        f"Throughput: {result['jobs_per_min']:.1f} jobs/min, {upload_rate:.1f} MiB/s uploaded",
+        "",
+        f"{'stage':<12}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}",
+    ]
+    rows = [("end-to-end", result["jobs"], result["latency"])]
+    rows += [(stage, count, values) for stage, (count, values) in sorted(result["stages"].items())]
+    for stage, count, values in rows:
+        lines.append(f"{stage:<12}{count:>6}" + "".join(f"{values[pct]:>9.2f}s" for pct in (50, 95, 99)))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Offline ytdl_bot benchmark with fake yt-dlp, ffmpeg and Telegram')
+    parser.add_argument('--users', type=int, default=4, help='Concurrent simulated users')
+    parser.add_argument('--jobs', type=int, default=2, help='Links sent by each user, one after another')
+    parser.add_argument('--size', type=float, default=20, help='Video size in MiB')
+    parser.add_argument('--duration', type=float, default=300, help='Media duration in seconds')
+    parser.add_argument('--download-rate', type=float, default=20, help='Download rate per job in MiB/s (0 = unlimited)')
+    parser.add_argument('--upload-rate', type=float, default=10, help='Upload bandwidth per job in MiB/s (0 = unlimited)')
+    parser.add_argument('--encode-speed', type=float, default=20, help='ffmpeg speed as a multiple of realtime')
+    parser.add_argument('--probe-delay', type=float, default=0.2, help='Seconds per yt-dlp metadata call')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='Seconds per bot API call')
+    parser.add_argument('--audio-ratio', type=float, default=0.25, help='Share of jobs choosing audio')
+    parser.add_argument('--max-video-size', type=float, metavar='MiB',
+                        help='Lower the upload limit to force compression')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='Show the bot log')
+    parser.add_argument('--upload-bench', action='store_true',
+                        help='Only measure RSS and CPU per GiB of the part uploader (--size is per file)')
+    parser.add_argument('--upload-parallel', type=int, default=4, help='Files uploaded at once by --upload-bench')
+    args = parser.parse_args()
+
+    if args.upload_bench:
+        print(format_upload_report(asyncio.run(run_upload_benchmark(
+            size=int(args.size * MiB), parallel=args.upload_parallel))))
+        sys.exit(0)
+
+    result = asyncio.run(run_benchmark(
+        users=args.users, jobs_per_user=args.jobs, size=int(args.size * MiB), duration=args.duration,
+        download_bps=int(args.download_rate * MiB), upload_bps=int(args.upload_rate * MiB),
+        encode_speed=args.encode_speed, probe_delay=args.probe_delay, api_latency=args.api_latency,
+        audio_ratio=args.audio_ratio,
+        max_video_size=int(args.max_video_size * MiB) if args.max_video_size else None,
+        seed=args.seed, verbose=args.verbose))
+    print(format_report(result))
@@ -0,0 +1,413 @@
+#! python3
+# -*- coding: utf-8 -*-
+"""
+Load generator for ytdl_bot's update handlers.
+
+Replays a recorded or synthetic stream of Telegram updates (messages and
+callback queries) into the bot through BOT.process_new_updates, the same
+entry point used by polling and the webhook, so handle_message,
+handle_format_choice and handle_approval_callback run as in production.
+Bot API calls go to a local fake Bot API server; downloads and uploads use
+the fakes from ytdl_bot_bench, so no network is needed.
+
+Reports event-loop lag, time to first reply and the growth of
+PENDING_CHOICES, STATUS_MESSAGES and the UserManager state.
+
+    python3 ytdl_bot_loadgen.py --sessions 200 --rate 20 --new-user-ratio 0.2
+    python3 ytdl_bot_loadgen.py --replay updates.jsonl --speed 2
+
+A recorded stream is JSON lines of {"at": seconds, "update": <Update>}.
+A callback query is sent to the most recent message in its chat that
+offers its callback_data, since message ids differ between runs.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import itertools
+from collections import deque
+from unittest.mock import patch
+
+from aiohttp import web
+
+from ytdl_bot_bench import MiB, BENCH_USER_ID_BASE, FakeTelethonClient, bench_environment, percentile
+
+LOADGEN_NEW_USER_BASE = 20_000_000
+LAG_SAMPLE_INTERVAL = 0.02  # seconds between event-loop lag samples
+STATE_SAMPLE_INTERVAL = 0.5  # seconds between state size samples
+BUTTON_TIMEOUT = 60  # seconds a callback waits for its button to appear
+DRAIN_TIMEOUT = 300  # seconds to let handlers finish after the last update
+
+
+# ---------------------------------------------------------------------------
+# Fake Bot API server
+# ---------------------------------------------------------------------------
+
+class FakeBotApi:
+    """Minimal local Telegram Bot API: stores sent messages and their buttons.
+
+    on_reply(kind, key) is called for the first reply signals the load
+    generator tracks: ("chat", chat_id) for sendMessage and
+    ("callback", callback_query_id) for answerCallbackQuery.
+    """
+
+    def __init__(self, latency=0.0, on_reply=None):
+        self.latency = latency
+        self.on_reply = on_reply
+        self.messages = {}  # (chat_id, message_id) -> message dict
+        self.calls = {}     # method -> count
+        self._message_ids = itertools.count(1)
+        self._changed = None
+        self.runner = None
+        self.url = None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Serve on host:port (0 = any free port); returns the API_URL template."""
+        self._changed = asyncio.Condition()
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}/bot{{0}}/{{1}}"
+        return self.url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def _new_message(self, chat_id, text, reply_markup=None):
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"},
+                   "from": {"id": 1, "is_bot": True, "first_name": "ytdl"},
+                   "text": text}
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+        self.messages[(chat_id, message["message_id"])] = message
+        return message
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        params.update(request.query)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result = True
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        reply_markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        if method == "sendMessage":
+            result = self._new_message(chat_id, params.get("text", ""), reply_markup)
+            self._reply("chat", chat_id)
+        elif method == "forwardMessage":
+            result = self._new_message(chat_id, "")
+        elif method == "editMessageText":
+            message = self.messages.get((chat_id, int(params.get("message_id", 0))))
+            if message:
+                message["text"] = params.get("text", "")
+                if reply_markup:
+                    message["reply_markup"] = reply_markup
+                else:
+                    message.pop("reply_markup", None)
+                result = message
+        elif method == "deleteMessage":
+            self.messages.pop((chat_id, int(params.get("message_id", 0))), None)
+        elif method == "answerCallbackQuery":
+            self._reply("callback", params.get("callback_query_id"))
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "ytdl", "username": "ytdl_bot"}
+
+        async with self._changed:
+            self._changed.notify_all()
+        return web.json_response({"ok": True, "result": result})
+
+    def _reply(self, kind, key):
+        if self.on_reply:
+            self.on_reply(kind, key)
+
+    def find_button(self, chat_id, data):
+        """Most recent message in chat_id with a button sending `data`, or None."""
+        for (chat, _), message in sorted(self.messages.items(), key=lambda item: -item[0][1]):
+            if chat != chat_id:
+                continue
+            for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+                if any(button.get("callback_data") == data for button in row):
+                    return message
+        return None
+
+    async def wait_for_button(self, chat_id, data, timeout=BUTTON_TIMEOUT):
+        async with self._changed:
+            await asyncio.wait_for(
+                self._changed.wait_for(lambda: self.find_button(chat_id, data)), timeout)
+            return self.find_button(chat_id, data)
+
+
+# ---------------------------------------------------------------------------
+# Update streams
+# ---------------------------------------------------------------------------
+
+def user_json(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+
+
+def message_update(user_id, text):
+    return {"message": {"message_id": 0, "date": int(time.time()), "text": text,
+                        "chat": {"id": user_id, "type": "private"}, "from": user_json(user_id)}}
+
+
+def callback_update(user_id, chat_id, data):
+    """Callback query; its message is filled in from the fake server at send time."""
+    return {"callback_query": {"id": "", "from": user_json(user_id), "chat_instance": str(chat_id),
+                               "data": data, "message": {"chat": {"id": chat_id}}}}
+
+
+def synthetic_updates(sessions=50, rate=5.0, new_user_ratio=0.2, audio_ratio=0.25,
+                      think=1.0, admin_id=None, seed=0):
+    """Poisson arrivals of `rate` sessions/sec: link, format choice, and admin approval for new users."""
+    rng = random.Random(seed)
+    entries = []
+    at = 0.0
+    for n in range(sessions):
+        at += rng.expovariate(rate)
+        new_user = admin_id is not None and rng.random() < new_user_ratio
+        user_id = (LOADGEN_NEW_USER_BASE if new_user else BENCH_USER_ID_BASE) + n
+        kind = "audio" if rng.random() < audio_ratio else "video"
+        entries.append({"at": at, "update": message_update(user_id, f"https://www.youtube.com/watch?v=load{n}")})
+        entries.append({"at": at + think,
+                        "update": callback_update(user_id, user_id, f"{'req' if new_user else 'dl'}_{kind}")})
+        if new_user:
+            entries.append({"at": at + 2 * think,
+                            "update": callback_update(admin_id, admin_id, f"approve_{user_id}")})
+    return sorted(entries, key=lambda entry: entry["at"])
+
+
+def load_updates(path, rate=None):
+    """Recorded stream from JSON lines; bare updates are spaced 1/rate seconds apart."""
+    entries = []
+    with open(path) as f:
+        for n, line in enumerate(line for line in f if line.strip()):
+            record = json.loads(line)
+            if "update" not in record:
+                record = {"at": n / (rate or 1.0), "update": record}
+            entries.append(record)
+    return sorted(entries, key=lambda entry: entry["at"])
+
+
+def initially_approved(entries):
+    """Every sender starts approved, except users an approve_/deny_ callback decides on."""
+    senders, decided = set(), set()
+    for entry in entries:
+        update = entry["update"]
+        if "message" in update:
+            senders.add(update["message"]["from"]["id"])
+        data = update.get("callback_query", {}).get("data", "")
+        if data.startswith(("approve_", "deny_")):
+            decided.add(int(data.split("_", 1)[1]))
+    return sorted(senders - decided)
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+def deep_sizeof(obj, seen=None):
+    """Approximate bytes held by a container and everything it references."""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def state_sizes():
+    """(entries, bytes) of the handler state that grows with traffic."""
+    import ytdl_bot
+    status_entries = sum(len(ids) for ids in ytdl_bot.STATUS_MESSAGES.values())
+    users = ytdl_bot.USER_MANAGER.config
+    user_entries = sum(len(users.get(key, ())) for key in ("approved_users", "denied_users", "pending_requests"))
+    return {
+        "PENDING_CHOICES": (len(ytdl_bot.PENDING_CHOICES), deep_sizeof(ytdl_bot.PENDING_CHOICES)),
+        "STATUS_MESSAGES": (status_entries, deep_sizeof(ytdl_bot.STATUS_MESSAGES)),
+        "UserManager": (user_entries, deep_sizeof(dict(users))),
+    }
+
+
+async def sample_loop_lag(samples, interval=LAG_SAMPLE_INTERVAL):
+    """Append how late each interval-long sleep wakes up."""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.monotonic() - start - interval))
+
+
+async def sample_state(samples, interval=STATE_SAMPLE_INTERVAL):
+    while True:
+        samples.append(state_sizes())
+        await asyncio.sleep(interval)
+
+
+class LoadGenerator:
+    """Injects timed updates and measures time to first reply per update type."""
+
+    def __init__(self, bot, api, speed=1.0):
+        self.bot = bot
+        self.api = api
+        self.speed = speed
+        self.update_ids = itertools.count(1)
+        self.waiting = {}  # ("chat", chat_id) / ("callback", id) -> deque of (sent_at, update type)
+        self.first_reply = {"message": [], "callback_query": []}
+        self.handlers = set()
+        self.sent = 0
+        self.skipped = 0
+        api.on_reply = self.on_reply
+
+    def on_reply(self, kind, key):
+        pending = self.waiting.get((kind, key))
+        if pending:
+            sent_at, update_type = pending.popleft()
+            self.first_reply[update_type].append(time.monotonic() - sent_at)
+
+    async def send(self, entry, start):
+        delay = start + entry["at"] / self.speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = json.loads(json.dumps(entry["update"]))
+        update["update_id"] = next(self.update_ids)
+        if "callback_query" in update:
+            call = update["callback_query"]
+            chat_id = (call.get("message") or {}).get("chat", {}).get("id", call["from"]["id"])
+            try:
+                call["message"] = await self.api.wait_for_button(chat_id, call["data"])
+            except asyncio.TimeoutError:
+                self.skipped += 1
+                return
+            call["id"] = str(update["update_id"])
+            key, update_type = ("callback", call["id"]), "callback_query"
+        else:
+            update["message"]["message_id"] = update["update_id"]
+            key, update_type = ("chat", update["message"]["chat"]["id"]), "message"
+
+        import telebot
+        self.waiting.setdefault(key, deque()).append((time.monotonic(), update_type))
+        self.sent += 1
+        # Handlers run as their own task, as with polling and the webhook dispatcher
+        task = asyncio.create_task(self.bot.process_new_updates([telebot.types.Update.de_json(update)]))
+        self.handlers.add(task)
+        task.add_done_callback(self.handlers.discard)
+
+    async def run(self, entries, drain_timeout=DRAIN_TIMEOUT):
+        start = time.monotonic()
+        await asyncio.gather(*(self.send(entry, start) for entry in entries))
+        injected = time.monotonic() - start
+        if self.handlers:
+            done, pending = await asyncio.wait(set(self.handlers), timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+        return injected
+
+
+async def run_loadgen(entries, speed=1.0, api_latency=0.0, upload_bps=50 * MiB,
+                      size=5 * MiB, duration=60, download_bps=0, probe_delay=0.1,
+                      drain_timeout=DRAIN_TIMEOUT, verbose=False):
+    """Replay entries into the bot and return a result dict (see format_report)."""
+    import telebot
+    import ytdl_bot
+
+    api = FakeBotApi(api_latency)
+    url = await api.start()
+    generator = LoadGenerator(ytdl_bot.BOT, api, speed)
+    lag, states = [], []
+    try:
+        with bench_environment(client=FakeTelethonClient(upload_bps, latency=0),
+                               approved_users=initially_approved(entries), size=size, duration=duration,
+                               download_bps=download_bps, probe_delay=probe_delay, verbose=verbose), \
+                patch.object(telebot.asyncio_helper, "API_URL", url):
+            samplers = [asyncio.create_task(sample_loop_lag(lag)), asyncio.create_task(sample_state(states))]
+            start = time.monotonic()
+            try:
+                injected = await generator.run(entries, drain_timeout)
+            finally:
+                for task in samplers:
+                    task.cancel()
+                await asyncio.gather(*samplers, return_exceptions=True)
+            elapsed = time.monotonic() - start
+            states.append(state_sizes())
+    finally:
+        await api.stop()
+        session = telebot.asyncio_helper.session_manager.session
+        if session and not session.closed:
+            await session.close()
+
+    pcts = (50, 95, 99)
+    return {
+        "updates": generator.sent,
+        "skipped": generator.skipped,
+        "injected": injected,
+        "elapsed": elapsed,
+        "api_calls": dict(api.calls),
+        "loop_lag": {**{pct: percentile(lag, pct) for pct in pcts}, "max": max(lag, default=0.0)},
+        "first_reply": {kind: (len(values), {pct: percentile(values, pct) for pct in pcts})
+                        for kind, values in generator.first_reply.items()},
+        "state": {name: (states[0][name], max(s[name] for s in states), states[-1][name])
+                  for name in states[0]},
+    }
+
+
+def format_report(result):
+    lag = result["loop_lag"]
+    lines = [
+        f"Updates: {result['updates']} sent ({result['skipped']} callbacks without a button) "
+        f"over {result['injected']:.1f}s, all handlers done after {result['elapsed']:.1f}s",
+        f"Event-loop lag: p50 {lag[50] * 1000:.1f}ms, p95 {lag[95] * 1000:.1f}ms, "
+        f"p99 {lag[99] * 1000:.1f}ms, max {lag['max'] * 1000:.1f}ms",
+        "",
+        f"{'first reply':<16}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}",
+    ]
+    for kind, (count, values) in result["first_reply"].items():
+        lines.append(f"{kind:<16}{count:>6}" + "".join(f"{values[pct]:>9.3f}s" for pct in (50, 95, 99)))
+    lines += ["", f"{'state':<16}{'start':>16}{'peak':>16}{'end':>16}"]
+    for name, snapshots in result["state"].items():
+        lines.append(f"{name:<16}" + "".join(f"{f'{n} / {size / 1024:.1f}K':>16}" for n, size in snapshots))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay Telegram updates into ytdl_bot against a fake Bot API')
+    parser.add_argument('--replay', metavar='PATH', help='Recorded updates (JSON lines) instead of a synthetic stream')
+    parser.add_argument('--sessions', type=int, default=50, help='Synthetic sessions (link + format choice)')
+    parser.add_argument('--rate', type=float, default=5, help='Sessions/sec (synthetic) or updates/sec (bare recorded updates)')
+    parser.add_argument('--speed', type=float, default=1, help='Replay speed multiplier')
+    parser.add_argument('--new-user-ratio', type=float, default=0.2, help='Share of sessions needing admin approval')
+    parser.add_argument('--audio-ratio', type=float, default=0.25, help='Share of sessions choosing audio')
+    parser.add_argument('--think', type=float, default=1, help='Seconds before a user presses a button')
+    parser.add_argument('--api-latency', type=float, default=0, help='Seconds per fake Bot API call')
+    parser.add_argument('--size', type=float, default=5, help='Video size in MiB')
+    parser.add_argument('--duration', type=float, default=60, help='Media duration in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='Show the bot log')
+    args = parser.parse_args()
+
+    if args.replay:
+        stream = load_updates(args.replay, args.rate)
+    else:
+        from ytdl_bot import YTDL_ADMIN_CHAT_ID
+        stream = synthetic_updates(args.sessions, args.rate, args.new_user_ratio, args.audio_ratio,
+                                   args.think, YTDL_ADMIN_CHAT_ID, args.seed)
+    print(format_report(asyncio.run(run_loadgen(
+        stream, speed=args.speed, api_latency=args.api_latency, size=int(args.size * MiB),
+        duration=args.duration, verbose=args.verbose))))
@@ -23,6 +23,24 @@ import os
 # Fixtures and Helpers
 # ---------------------------------------------------------------------------
 
+@pytest.fixture(autouse=True)
+def clear_spotify_cache():
+    """Keep cached Spotify lookups from leaking between tests."""
+    from ytdl_bot import SPOTIFY_CACHE
+    SPOTIFY_CACHE.clear()
+    yield
+    SPOTIFY_CACHE.clear()
+
+
+@pytest.fixture(autouse=True)
+def throughput_history(tmp_path):
+    """Keep recorded stage timings out of configs/ytdl_throughput.json."""
+    from ytdl_bot import ThroughputHistory
+    history = ThroughputHistory(str(tmp_path / "throughput.json"))
+    with patch("ytdl_bot.THROUGHPUT_HISTORY", history):
+        yield history
+
+
 @pytest.fixture
 def mock_telethon_client():
     """Mock Telethon client for upload tests."""
@@ -283,7 +301,7 @@ class TestDownloadVideoRetry:
             output_file.write_bytes(b"video content")
             return Mock(returncode=0, stdout="", stderr="")
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             from ytdl_bot import download_video
             result = await download_video("https://youtube.com/watch?v=test", str(tmp_path))
 
@@ -303,7 +321,7 @@ class TestDownloadVideoRetry:
             output_file.write_bytes(b"video content")
             return Mock(returncode=0, stdout="", stderr="")
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = True
 
@@ -317,7 +335,7 @@ class TestDownloadVideoRetry:
     @pytest.mark.asyncio
     async def test_download_video_all_retries_fail(self, tmp_path):
         """Test that download returns None after all retries exhausted."""
-        with patch('subprocess.run', return_value=Mock(returncode=1, stderr="Error")):
+        with patch('ytdl_bot.run_download_process', return_value=Mock(returncode=1, stderr="Error")):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = True
 
@@ -340,7 +358,7 @@ class TestDownloadVideoRetry:
             output_file.write_bytes(b"video content")
             return Mock(returncode=0)
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = True
 
@@ -364,7 +382,7 @@ class TestDownloadVideoRetry:
             output_file.write_bytes(b"video content")
             return Mock(returncode=0)
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = True
 
@@ -376,7 +394,7 @@ class TestDownloadVideoRetry:
     @pytest.mark.asyncio
     async def test_download_video_fails_when_internet_not_restored(self, tmp_path):
         """Test that download fails when internet doesn't come back."""
-        with patch('subprocess.run', return_value=Mock(returncode=1, stderr="Network error")):
+        with patch('ytdl_bot.run_download_process', return_value=Mock(returncode=1, stderr="Network error")):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = False  # Internet never comes back
 
@@ -399,7 +417,7 @@ class TestDownloadVideoRetry:
             output_file.write_bytes(b"video content")
             return Mock(returncode=0)
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = True
 
@@ -426,7 +444,7 @@ class TestDownloadAudioRetry:
             output_file.write_bytes(b"audio content")
             return Mock(returncode=0)
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             from ytdl_bot import download_audio
             result = await download_audio("https://youtube.com/watch?v=test", str(tmp_path))
 
@@ -446,7 +464,7 @@ class TestDownloadAudioRetry:
             output_file.write_bytes(b"audio content")
             return Mock(returncode=0)
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = True
 
@@ -460,7 +478,7 @@ class TestDownloadAudioRetry:
     @pytest.mark.asyncio
     async def test_download_audio_all_retries_fail(self, tmp_path):
         """Test that audio download returns None after all retries exhausted."""
-        with patch('subprocess.run', return_value=Mock(returncode=1, stderr="Error")):
+        with patch('ytdl_bot.run_download_process', return_value=Mock(returncode=1, stderr="Error")):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = True
 
@@ -472,7 +490,7 @@ class TestDownloadAudioRetry:
     @pytest.mark.asyncio
     async def test_download_audio_fails_when_internet_not_restored(self, tmp_path):
         """Test that audio download fails when internet doesn't come back."""
-        with patch('subprocess.run', return_value=Mock(returncode=1, stderr="Network error")):
+        with patch('ytdl_bot.run_download_process', return_value=Mock(returncode=1, stderr="Network error")):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = False
 
@@ -495,7 +513,7 @@ class TestDownloadAudioRetry:
             output_file.write_bytes(b"audio content")
             return Mock(returncode=0)
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
                 mock_wait.return_value = True
 
@@ -1442,7 +1460,7 @@ class TestEdgeCases:
             output_file.write_bytes(b"video content")
             return Mock(returncode=0)
 
-        with patch('subprocess.run', side_effect=mock_run):
+        with patch('ytdl_bot.run_download_process', side_effect=mock_run):
             from ytdl_bot import download_video
             result = await download_video("https://youtube.com/watch?v=test", str(tmp_path))
 
@@ -2031,9 +2049,9 @@ class TestAudioUploadComprehensive:
                 )
 
                 mock_telethon_client.send_file.assert_called_once()
-                call_kwargs = mock_telethon_client.send_file.call_args[1]
-                assert 'progress_callback' in call_kwargs
-                assert callable(call_kwargs['progress_callback'])
+                # Progress comes from the part uploader and reaches the status message
+                mock_bot.edit_message_text.assert_called()
+                assert "Uploading audio" in mock_bot.edit_message_text.call_args[0][0]
 
     @pytest.mark.asyncio
     async def test_audio_upload_status_message_updates(self, mock_telethon_client, temp_audio_file):
@@ -2105,26 +2123,28 @@ class TestUploadMidTransferFailures:
         file_path.write_bytes(b"fake video content" * 1000)
         return str(file_path)
 
-    @pytest.mark.asyncio
-    async def test_upload_fails_at_10_percent(self, mock_telethon_client, temp_file):
-        """Test upload failure at 10% progress."""
-        call_count = 0
-        progress_at_failure = None
-
-        async def mock_send_file(*args, **kwargs):
-            nonlocal call_count, progress_at_failure
-            call_count += 1
-            progress_callback = kwargs.get('progress_callback')
-            if progress_callback and call_count == 1:
-                # Simulate 10% progress before failure
-                await progress_callback(10, 100)
-                progress_at_failure = 10
-                raise Exception("Connection lost at 10%")
-            return Mock()
+    @pytest.fixture(autouse=True)
+    def small_parts(self):
+        """1 KiB parts: the 18 KB test file uploads in 18 parts."""
+        with patch('ytdl_bot.UPLOAD_PART_SIZE', 1024):
+            yield
+
+    def fail_parts_at(self, client, failure_points):
+        """Make the part upload at each of failure_points percent fail once; returns part calls."""
+        pending = list(failure_points)
+        part_calls = []
+
+        async def save_part(request):
+            part_calls.append(request.file_part)
+            if pending and (request.file_part + 1) * 100 / 18 >= pending[0]:
+                raise Exception(f"Connection lost at {pending.pop(0)}%")
+            return True
 
-        mock_telethon_client.send_file = mock_send_file
+        client.side_effect = save_part
+        return part_calls
 
-        with patch('ytdl_bot.TELETHON_CLIENT', mock_telethon_client):
+    async def upload(self, client, **kwargs):
+        with patch('ytdl_bot.TELETHON_CLIENT', client):
             with patch('ytdl_bot.BOT') as mock_bot:
                 mock_bot.edit_message_text = AsyncMock()
 
@@ -2135,230 +2155,79 @@ class TestUploadMidTransferFailures:
 
                     await send_video_telethon(
                         chat_id=12345,
-                        video_path=temp_file,
                         caption="Test",
                         width=1920,
                         height=1080,
                         duration=60,
                         thumbnail=None,
                         status_message_id=1,
-                        file_size=100
+                        file_size=100,
+                        **kwargs
                     )
+                    return mock_wait
 
-                    assert call_count == 2
-                    assert progress_at_failure == 10
+    @pytest.mark.asyncio
+    async def test_upload_fails_at_10_percent(self, mock_telethon_client, temp_file):
+        """Test upload failure at 10% progress."""
+        part_calls = self.fail_parts_at(mock_telethon_client, [10])
+        mock_wait = await self.upload(mock_telethon_client, video_path=temp_file)
+
+        assert mock_wait.call_count == 1
+        assert part_calls.count(1) == 2  # failed part sent again
+        mock_telethon_client.send_file.assert_called_once()
 
     @pytest.mark.asyncio
     async def test_upload_fails_at_50_percent(self, mock_telethon_client, temp_file):
         """Test upload failure at 50% progress."""
-        call_count = 0
-
-        async def mock_send_file(*args, **kwargs):
-            nonlocal call_count
-            call_count += 1
-            progress_callback = kwargs.get('progress_callback')
-            if progress_callback and call_count == 1:
-                # Simulate 50% progress before failure
-                await progress_callback(50, 100)
-                raise Exception("Connection lost at 50%")
-            return Mock()
-
-        mock_telethon_client.send_file = mock_send_file
-
-        with patch('ytdl_bot.TELETHON_CLIENT', mock_telethon_client):
-            with patch('ytdl_bot.BOT') as mock_bot:
-                mock_bot.edit_message_text = AsyncMock()
+        part_calls = self.fail_parts_at(mock_telethon_client, [50])
+        await self.upload(mock_telethon_client, video_path=temp_file)
 
-                with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
-                    mock_wait.return_value = True
-
-                    from ytdl_bot import send_video_telethon
-
-                    await send_video_telethon(
-                        chat_id=12345,
-                        video_path=temp_file,
-                        caption="Test",
-                        width=1920,
-                        height=1080,
-                        duration=60,
-                        thumbnail=None,
-                        status_message_id=1,
-                        file_size=100
-                    )
-
-                    assert call_count == 2
+        assert len(part_calls) == 18 + 1
+        mock_telethon_client.send_file.assert_called_once()
 
     @pytest.mark.asyncio
     async def test_upload_fails_at_90_percent(self, mock_telethon_client, temp_file):
         """Test upload failure at 90% progress (near completion)."""
-        call_count = 0
-
-        async def mock_send_file(*args, **kwargs):
-            nonlocal call_count
-            call_count += 1
-            progress_callback = kwargs.get('progress_callback')
-            if progress_callback and call_count == 1:
-                # Simulate 90% progress before failure
-                await progress_callback(90, 100)
-                raise Exception("Connection lost at 90%")
-            return Mock()
+        part_calls = self.fail_parts_at(mock_telethon_client, [90])
+        await self.upload(mock_telethon_client, video_path=temp_file)
 
-        mock_telethon_client.send_file = mock_send_file
-
-        with patch('ytdl_bot.TELETHON_CLIENT', mock_telethon_client):
-            with patch('ytdl_bot.BOT') as mock_bot:
-                mock_bot.edit_message_text = AsyncMock()
-
-                with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
-                    mock_wait.return_value = True
-
-                    from ytdl_bot import send_video_telethon
-
-                    await send_video_telethon(
-                        chat_id=12345,
-                        video_path=temp_file,
-                        caption="Test",
-                        width=1920,
-                        height=1080,
-                        duration=60,
-                        thumbnail=None,
-                        status_message_id=1,
-                        file_size=100
-                    )
-
-                    assert call_count == 2
+        assert len(part_calls) == 18 + 1
+        mock_telethon_client.send_file.assert_called_once()
 
     @pytest.mark.asyncio
     async def test_upload_fails_multiple_times_at_different_points(self, mock_telethon_client, temp_file):
         """Test upload fails at different progress points across retries."""
-        call_count = 0
         failure_points = [10, 50, 90]  # Fail at 10%, 50%, 90% then succeed
+        part_calls = self.fail_parts_at(mock_telethon_client, failure_points)
+        mock_wait = await self.upload(mock_telethon_client, video_path=temp_file, max_retries=10)
 
-        async def mock_send_file(*args, **kwargs):
-            nonlocal call_count
-            call_count += 1
-            progress_callback = kwargs.get('progress_callback')
-            if progress_callback and call_count <= len(failure_points):
-                # Simulate progress before failure
-                await progress_callback(failure_points[call_count - 1], 100)
-                raise Exception(f"Connection lost at {failure_points[call_count - 1]}%")
-            return Mock()
-
-        mock_telethon_client.send_file = mock_send_file
-
-        with patch('ytdl_bot.TELETHON_CLIENT', mock_telethon_client):
-            with patch('ytdl_bot.BOT') as mock_bot:
-                mock_bot.edit_message_text = AsyncMock()
-
-                with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
-                    mock_wait.return_value = True
-
-                    from ytdl_bot import send_video_telethon
-
-                    await send_video_telethon(
-                        chat_id=12345,
-                        video_path=temp_file,
-                        caption="Test",
-                        width=1920,
-                        height=1080,
-                        duration=60,
-                        thumbnail=None,
-                        status_message_id=1,
-                        file_size=100,
-                        max_retries=10
-                    )
-
-                    assert call_count == len(failure_points) + 1
+        assert mock_wait.call_count == len(failure_points)
+        assert len(part_calls) == 18 + len(failure_points)
+        mock_telethon_client.send_file.assert_called_once()
 
     @pytest.mark.asyncio
     async def test_upload_progress_callback_during_retry(self, mock_telethon_client, temp_file):
         """Test progress callback is properly created during retry with correct retry_attempt."""
-        call_count = 0
-        callbacks_created = []
-
-        original_send_file = mock_telethon_client.send_file
-
-        async def mock_send_file(*args, **kwargs):
-            nonlocal call_count
-            call_count += 1
-            progress_callback = kwargs.get('progress_callback')
-            if progress_callback:
-                callbacks_created.append(progress_callback)
-            if call_count < 3:
-                raise Exception("Retry needed")
-            return Mock()
-
-        mock_telethon_client.send_file = mock_send_file
-
-        with patch('ytdl_bot.TELETHON_CLIENT', mock_telethon_client):
-            with patch('ytdl_bot.BOT') as mock_bot:
-                mock_bot.edit_message_text = AsyncMock()
-
-                with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
-                    mock_wait.return_value = True
-
-                    from ytdl_bot import send_video_telethon
-
-                    await send_video_telethon(
-                        chat_id=12345,
-                        video_path=temp_file,
-                        caption="Test",
-                        width=1920,
-                        height=1080,
-                        duration=60,
-                        thumbnail=None,
-                        status_message_id=1,
-                        file_size=100
-                    )
-
-                    assert len(callbacks_created) == 3
-                    # Each callback should have increasing retry_attempt
-                    for i, callback in enumerate(callbacks_created):
-                        assert callback.retry_attempt == i
-
-    @pytest.mark.asyncio
-    async def test_upload_restarts_from_zero_on_retry(self, mock_telethon_client, temp_file):
-        """Test that upload restarts from 0% on retry (not resume)."""
-        call_count = 0
-        progress_starts = []
-
-        async def mock_send_file(*args, **kwargs):
-            nonlocal call_count
-            call_count += 1
-            progress_callback = kwargs.get('progress_callback')
-            if progress_callback:
-                # Record the starting progress of each attempt
-                progress_starts.append(0)  # Telethon always starts from 0
-                if call_count == 1:
-                    await progress_callback(50, 100)  # Progress to 50%
-                    raise Exception("Connection lost")
-            return Mock()
-
-        mock_telethon_client.send_file = mock_send_file
-
-        with patch('ytdl_bot.TELETHON_CLIENT', mock_telethon_client):
-            with patch('ytdl_bot.BOT') as mock_bot:
-                mock_bot.edit_message_text = AsyncMock()
-
-                with patch('ytdl_bot.wait_for_internet', new_callable=AsyncMock) as mock_wait:
-                    mock_wait.return_value = True
-
-                    from ytdl_bot import send_video_telethon
-
-                    await send_video_telethon(
-                        chat_id=12345,
-                        video_path=temp_file,
-                        caption="Test",
-                        width=1920,
-                        height=1080,
-                        duration=60,
-                        thumbnail=None,
-                        status_message_id=1,
-                        file_size=100
-                    )
-
-                    # Both attempts start from 0
-                    assert all(p == 0 for p in progress_starts)
+        self.fail_parts_at(mock_telethon_client, [10, 50])
+        from ytdl_bot import UploadProgressCallback
+        with patch('ytdl_bot.UploadProgressCallback', wraps=UploadProgressCallback) as spy:
+            await self.upload(mock_telethon_client, video_path=temp_file)
+
+        # Each callback should have increasing retry_attempt
+        assert [call.kwargs['retry_attempt'] for call in spy.call_args_list] == [0, 1, 2]
+
+    @pytest.mark.asyncio
+    async def test_upload_resumes_missing_parts_on_retry(self, mock_telethon_client, temp_file):
+        """Test that a retry sends only the parts Telegram has not confirmed."""
+        part_calls = self.fail_parts_at(mock_telethon_client, [50])
+        await self.upload(mock_telethon_client, video_path=temp_file)
+
+        failed = part_calls[len(part_calls) // 2]
+        first, retry = part_calls[:part_calls.index(failed) + 1], part_calls[part_calls.index(failed) + 1:]
+        assert first == list(range(failed + 1))
+        assert retry == list(range(failed, 18))  # resumes at the failed part
+        file_ids = {call.args[0].file_id for call in mock_telethon_client.call_args_list}
+        assert len(file_ids) == 1
 
 
 # ---------------------------------------------------------------------------
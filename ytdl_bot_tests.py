@@ -23,6 +23,24 @@ from unittest.mock import Mock, AsyncMock, patch, MagicMock
 # Helpers
 # ---------------------------------------------------------------------------
 
+@pytest.fixture(autouse=True)
+def clear_spotify_cache():
+    """Keep cached Spotify lookups from leaking between tests."""
+    from ytdl_bot import SPOTIFY_CACHE
+    SPOTIFY_CACHE.clear()
+    yield
+    SPOTIFY_CACHE.clear()
+
+
+@pytest.fixture(autouse=True)
+def throughput_history(tmp_path):
+    """Keep recorded stage timings out of configs/ytdl_throughput.json."""
+    from ytdl_bot import ThroughputHistory
+    history = ThroughputHistory(str(tmp_path / "throughput.json"))
+    with patch("ytdl_bot.THROUGHPUT_HISTORY", history):
+        yield history
+
+
 class AsyncContextManager:
     """Helper to mock aiohttp response context managers."""
 
@@ -593,7 +611,7 @@ class TestCommit08_AudioFormatFallback:
                 f.write(b"fake audio")
             return Mock(returncode=0, stderr="")
 
-        with patch("ytdl_bot.subprocess.run", side_effect=mock_run), \
+        with patch("ytdl_bot.run_download_process", side_effect=mock_run), \
              patch("ytdl_bot.os.path.exists", return_value=True):
             from ytdl_bot import download_audio
             path, error = await download_audio("https://example.com", str(tmp_path), max_retries=0)
@@ -840,7 +858,7 @@ class TestCommit10_ErrorReporting:
         def mock_run(cmd, **kwargs):
             return Mock(returncode=0, stderr="")
 
-        with patch("ytdl_bot.subprocess.run", side_effect=mock_run), \
+        with patch("ytdl_bot.run_download_process", side_effect=mock_run), \
              patch("ytdl_bot.os.path.exists", return_value=True):
             from ytdl_bot import download_audio
             path, error = await download_audio("https://example.com", str(tmp_path), max_retries=0)
@@ -851,7 +869,7 @@ class TestCommit10_ErrorReporting:
         def mock_run(cmd, **kwargs):
             return Mock(returncode=1, stderr="ERROR: not found")
 
-        with patch("ytdl_bot.subprocess.run", side_effect=mock_run):
+        with patch("ytdl_bot.run_download_process", side_effect=mock_run):
             from ytdl_bot import download_audio
             path, error = await download_audio("https://example.com", "/tmp", max_retries=0)
             assert path is None
@@ -868,7 +886,7 @@ class TestCommit10_ErrorReporting:
         def mock_run(cmd, **kwargs):
             return Mock(returncode=0, stderr="")
 
-        with patch("ytdl_bot.subprocess.run", side_effect=mock_run), \
+        with patch("ytdl_bot.run_download_process", side_effect=mock_run), \
              patch("ytdl_bot.os.path.exists", return_value=True):
             from ytdl_bot import download_video
             path, error = await download_video("https://example.com", str(tmp_path), max_retries=0)
@@ -879,7 +897,7 @@ class TestCommit10_ErrorReporting:
         def mock_run(cmd, **kwargs):
             return Mock(returncode=1, stderr="ERROR: video not available")
 
-        with patch("ytdl_bot.subprocess.run", side_effect=mock_run):
+        with patch("ytdl_bot.run_download_process", side_effect=mock_run):
             from ytdl_bot import download_video
             path, error = await download_video("https://example.com", "/tmp", max_retries=0)
             assert path is None
@@ -1336,6 +1354,22 @@ class TestCompressVideo:
         path, w, h = compress_video("/tmp/video.mp4")
         assert path is None
 
+    @patch("ytdl_bot.get_new_video_info")
+    @patch("ytdl_bot.subprocess.run")
+    @patch("ytdl_bot.os.path.getsize")
+    def test_compress_timeout_never_below_ten_times_length(self, mock_getsize, mock_run, mock_info,
+                                                            throughput_history):
+        mock_info.return_value = (1000000, 128000, 1280, 720, 30.0, 30.0, 120)
+        mock_run.return_value = Mock(returncode=0)
+        mock_getsize.return_value = 100 * 1024 * 1024
+        # Fast solo encodes in the history would give 3 * 0.1 * 120 + 60 = 96s
+        for _ in range(5):
+            throughput_history.record("local:compress:ratio", 0.1)
+
+        from ytdl_bot import compress_video
+        compress_video("/tmp/video.mp4")
+        assert mock_run.call_args[1]["timeout"] == 1200
+
     @patch("ytdl_bot.get_new_video_info")
     @patch("ytdl_bot.subprocess.run")
     @patch("ytdl_bot.os.path.getsize")
@@ -2009,7 +2043,7 @@ class TestProcessTikTokPhoto:
         with patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
              patch("ytdl_bot.add_status_message"), \
              patch("ytdl_bot.download_audio", new_callable=AsyncMock, return_value=(str(tmp_path / "a.mp3"), None)), \
-             patch("ytdl_bot.get_tiktok_photo", new_callable=AsyncMock, return_value=str(tmp_path / "p.jpg")), \
+             patch("ytdl_bot.get_tiktok_photos", new_callable=AsyncMock, return_value=[str(tmp_path / "p.jpg")]), \
              patch("ytdl_bot.asyncio.to_thread") as mock_to_thread, \
              patch("ytdl_bot.merge_image_audio", return_value=str(tmp_path / "v.mp4")), \
              patch("ytdl_bot.os.path.getsize", return_value=5 * 1024 * 1024), \
@@ -2038,7 +2072,7 @@ class TestProcessTikTokPhoto:
         with patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
              patch("ytdl_bot.add_status_message"), \
              patch("ytdl_bot.download_audio", new_callable=AsyncMock, return_value=(None, "dl error")), \
-             patch("ytdl_bot.get_tiktok_photo", new_callable=AsyncMock, return_value=None), \
+             patch("ytdl_bot.get_tiktok_photos", new_callable=AsyncMock, return_value=[]), \
              patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
              patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
              patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
@@ -2053,7 +2087,7 @@ class TestProcessTikTokPhoto:
         with patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
              patch("ytdl_bot.add_status_message"), \
              patch("ytdl_bot.download_audio", new_callable=AsyncMock, return_value=(str(tmp_path / "a.mp3"), None)), \
-             patch("ytdl_bot.get_tiktok_photo", new_callable=AsyncMock, return_value=None), \
+             patch("ytdl_bot.get_tiktok_photos", new_callable=AsyncMock, return_value=[]), \
              patch("ytdl_bot.process_audio_download", new_callable=AsyncMock) as mock_audio, \
              patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
              patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
@@ -2069,7 +2103,7 @@ class TestProcessTikTokPhoto:
         with patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
              patch("ytdl_bot.add_status_message"), \
              patch("ytdl_bot.download_audio", new_callable=AsyncMock, return_value=(str(tmp_path / "a.mp3"), None)), \
-             patch("ytdl_bot.get_tiktok_photo", new_callable=AsyncMock, return_value=str(tmp_path / "p.jpg")), \
+             patch("ytdl_bot.get_tiktok_photos", new_callable=AsyncMock, return_value=[str(tmp_path / "p.jpg")]), \
              patch("ytdl_bot.asyncio.to_thread", new_callable=AsyncMock, return_value=None), \
              patch("ytdl_bot.process_audio_download", new_callable=AsyncMock) as mock_audio, \
              patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
@@ -2087,7 +2121,7 @@ class TestProcessTikTokPhoto:
         with patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
              patch("ytdl_bot.add_status_message"), \
              patch("ytdl_bot.download_audio", new_callable=AsyncMock, return_value=(str(tmp_path / "a.mp3"), None)), \
-             patch("ytdl_bot.get_tiktok_photo", new_callable=AsyncMock, return_value=str(tmp_path / "p.jpg")), \
+             patch("ytdl_bot.get_tiktok_photos", new_callable=AsyncMock, return_value=[str(tmp_path / "p.jpg")]), \
              patch("ytdl_bot.asyncio.to_thread") as mock_tt, \
              patch("ytdl_bot.os.path.getsize", return_value=5*1024*1024), \
              patch("ytdl_bot.send_video_telethon", new_callable=AsyncMock, side_effect=UploadFailedError("fail")), \
@@ -2107,7 +2141,7 @@ class TestProcessTikTokPhoto:
         with patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
              patch("ytdl_bot.add_status_message"), \
              patch("ytdl_bot.download_audio", new_callable=AsyncMock, side_effect=Exception("boom")), \
-             patch("ytdl_bot.get_tiktok_photo", new_callable=AsyncMock, side_effect=Exception("boom")), \
+             patch("ytdl_bot.get_tiktok_photos", new_callable=AsyncMock, side_effect=Exception("boom")), \
              patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
              patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
              patch("ytdl_bot.shutil.rmtree"), \
@@ -2116,6 +2150,59 @@ class TestProcessTikTokPhoto:
             from ytdl_bot import process_tiktok_photo
             await process_tiktok_photo(100, 100, "https://tiktok.com/@u/video/1")
 
+    @pytest.mark.asyncio
+    async def test_aac_source_is_copied_into_merged_video(self, tmp_path):
+        """The original AAC stream is downloaded (no -x) and stream-copied by the merge."""
+        # One ADTS frame header: AAC-LC, 44.1 kHz, stereo
+        aac = bytes([0xFF, 0xF1, 0x50, 0x80, 0x02, 0x1F, 0xFC]) + b"\x00" * 9
+        photo = tmp_path / "photo.jpg"
+        photo.write_bytes(b"\xff\xd8\xff\xd9")
+        work = tmp_path / "work"
+        work.mkdir()
+        downloads, encodes = [], []
+
+        def fake_download(command, watch_dir, timeout, **kwargs):
+            downloads.append(command)
+            (work / "source.m4a").write_bytes(aac)
+            return Mock(returncode=0, stderr="")
+
+        def fake_tools(command, **kwargs):
+            if command[0] == "ffprobe":  # codec query: sniff the ADTS sync word
+                with open(command[-1], "rb") as f:
+                    header = f.read(2)
+                codec = "aac" if header[0] == 0xFF and header[1] & 0xF0 == 0xF0 else "mp3"
+                return Mock(returncode=0, stdout=codec + "\n")
+            encodes.append(command)
+            with open(command[-1], "wb") as f:
+                f.write(b"merged")
+            return Mock(returncode=0, stdout="", stderr="")
+
+        mock_video = Mock()
+        mock_video.get_resolution.return_value = (1080, 1920)
+        with patch("ytdl_bot.tempfile.mkdtemp", return_value=str(work)), \
+             patch("ytdl_bot.run_download_process", side_effect=fake_download), \
+             patch("ytdl_bot.record_download_throughput"), \
+             patch("ytdl_bot.get_tiktok_photos", new_callable=AsyncMock, return_value=[str(photo)]), \
+             patch("ytdl_bot.subprocess.run", side_effect=fake_tools), \
+             patch("ytdl_bot.get_video_title", return_value="Slideshow"), \
+             patch("ytdl_bot.get_audio_duration", return_value=12), \
+             patch("ytdl_bot.Video", mock_video), \
+             patch("ytdl_bot.send_video_telethon", new_callable=AsyncMock) as mock_upload, \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_tiktok_photo, MERGE_AUDIO_FORMAT
+            await process_tiktok_photo(100, 100, "https://tiktok.com/@u/photo/1")
+
+        command = downloads[0]
+        assert "-x" not in command
+        assert command[command.index("-f") + 1] == MERGE_AUDIO_FORMAT
+        merge = encodes[0]
+        assert merge[merge.index("-i", merge.index(str(photo))) + 1] == str(work / "source.m4a")
+        assert merge[merge.index("-c:a") + 1] == "copy"
+        mock_upload.assert_called_once()
+
 
 # ---------------------------------------------------------------------------
 # TestProcessAudioDownload
@@ -2245,7 +2332,7 @@ class TestProcessDownload:
              patch("ytdl_bot.shutil.rmtree"), \
              patch("ytdl_bot.os.path.exists", return_value=True), \
              patch("ytdl_bot.STATUS_MESSAGES", {}):
-            mock_tt.side_effect = ["Title", (1920, 1080), 120, "/thumb.jpg"]
+            mock_tt.side_effect = ["Title", (1920, 1080), 120, None, "/thumb.jpg"]
             from ytdl_bot import process_download
             await process_download(100, 100, "https://yt.com/v")
 
@@ -2290,8 +2377,10 @@ class TestProcessDownload:
              patch("ytdl_bot.STATUS_MESSAGES", {}):
             mock_tt.side_effect = [
                 "Title",                                     # get_video_title
-                ("/tmp/compressed.mp4", 1280, 720),          # compress_video
+                (1920, 1080),                                # Video.get_resolution
                 120,                                         # Video.get_length
+                None,                                        # media_fingerprint
+                ("/tmp/compressed.mp4", 1280, 720),          # compress_video
                 "/thumb.jpg",                                # get_thumbnail
             ]
             from ytdl_bot import process_download
@@ -2310,7 +2399,8 @@ class TestProcessDownload:
              patch("ytdl_bot.shutil.rmtree"), \
              patch("ytdl_bot.os.path.exists", return_value=True), \
              patch("ytdl_bot.STATUS_MESSAGES", {}):
-            mock_tt.side_effect = ["Title", (None, None, None)]  # compress_video returns failure
+            mock_tt.side_effect = ["Title", (1920, 1080), 120, None,
+                                   (None, None, None)]  # compress_video returns failure
             from ytdl_bot import process_download
             await process_download(100, 100, "https://yt.com/v")
 
@@ -2330,7 +2420,7 @@ class TestProcessDownload:
              patch("ytdl_bot.shutil.rmtree"), \
              patch("ytdl_bot.os.path.exists", return_value=True), \
              patch("ytdl_bot.STATUS_MESSAGES", {}):
-            mock_tt.side_effect = ["Title", (1920, 1080), 120, "/thumb.jpg"]
+            mock_tt.side_effect = ["Title", (1920, 1080), 120, None, "/thumb.jpg"]
             from ytdl_bot import process_download
             await process_download(100, 100, "https://yt.com/v")
 
@@ -2385,7 +2475,8 @@ class TestProcessDownload:
 
             mock_tt.side_effect = ["Title", Exception("probe failed")]
             # We need a more nuanced side effect here. Let's just handle the sequence.
-            # The sequence is: get_video_title, Video.get_resolution (raises), Video.get_length, get_thumbnail
+            # The sequence is: get_video_title, Video.get_resolution (raises), Video.get_length,
+            # media_fingerprint, get_thumbnail
             call_idx = [0]
             results = ["Title"]
 
@@ -2397,7 +2488,7 @@ class TestProcessDownload:
                     raise Exception("probe failed")  # Video.get_resolution
                 if call_idx[0] == 3:
                     return 120  # Video.get_length
-                return None  # get_thumbnail
+                return None  # media_fingerprint, get_thumbnail
 
             mock_tt.side_effect = tt_side_effect
             from ytdl_bot import process_download
@@ -2416,7 +2507,7 @@ class TestDownloadTimeoutPaths:
 
     @pytest.mark.asyncio
     async def test_download_audio_timeout(self):
-        with patch("ytdl_bot.subprocess.run", side_effect=subprocess.TimeoutExpired("yt-dlp", 300)):
+        with patch("ytdl_bot.run_download_process", side_effect=subprocess.TimeoutExpired("yt-dlp", 300)):
             from ytdl_bot import download_audio
             path, error = await download_audio("https://example.com", "/tmp", max_retries=0)
             assert path is None
@@ -2424,7 +2515,7 @@ class TestDownloadTimeoutPaths:
 
     @pytest.mark.asyncio
     async def test_download_audio_generic_exception(self):
-        with patch("ytdl_bot.subprocess.run", side_effect=OSError("disk full")):
+        with patch("ytdl_bot.run_download_process", side_effect=OSError("disk full")):
             from ytdl_bot import download_audio
             path, error = await download_audio("https://example.com", "/tmp", max_retries=0)
             assert path is None
@@ -2432,7 +2523,7 @@ class TestDownloadTimeoutPaths:
 
     @pytest.mark.asyncio
     async def test_download_video_timeout(self):
-        with patch("ytdl_bot.subprocess.run", side_effect=subprocess.TimeoutExpired("yt-dlp", 600)):
+        with patch("ytdl_bot.run_download_process", side_effect=subprocess.TimeoutExpired("yt-dlp", 600)):
             from ytdl_bot import download_video
             path, error = await download_video("https://example.com", "/tmp", max_retries=0)
             assert path is None
@@ -2440,7 +2531,7 @@ class TestDownloadTimeoutPaths:
 
     @pytest.mark.asyncio
     async def test_download_video_generic_exception(self):
-        with patch("ytdl_bot.subprocess.run", side_effect=OSError("disk full")):
+        with patch("ytdl_bot.run_download_process", side_effect=OSError("disk full")):
             from ytdl_bot import download_video
             path, error = await download_video("https://example.com", "/tmp", max_retries=0)
             assert path is None
@@ -2518,6 +2609,20 @@ class TestStartTelethonWithRetry:
 class TestMain:
     """main() function."""
 
+    @pytest.fixture(autouse=True)
+    def playlist_state(self, tmp_path):
+        """main() resumes playlists at startup; keep it off configs/ytdl_playlists.json."""
+        from ytdl_bot import PlaylistState
+        state = PlaylistState(str(tmp_path / "playlists.json"))
+        with patch("ytdl_bot.PLAYLIST_STATE", state):
+            yield state
+
+    @pytest.fixture(autouse=True)
+    def no_metrics_server(self):
+        """main() would otherwise bind the real METRICS_PORT."""
+        with patch("ytdl_bot.METRICS_PORT", None):
+            yield
+
     @pytest.mark.asyncio
     async def test_main_runs_polling(self):
         mock_bot = AsyncMock()
@@ -2546,6 +2651,22 @@ class TestMain:
             mock_client.disconnect.assert_called()
             mock_close.assert_called()
 
+    @pytest.mark.asyncio
+    async def test_main_resumes_playlists_from_state(self, playlist_state):
+        playlist_state.start(100, 100, "https://yt.com/playlist?list=PL1", "PL", 3)
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.TELETHON_CLIENT", AsyncMock()), \
+             patch("ytdl_bot.start_telethon_with_retry", new_callable=AsyncMock), \
+             patch("ytdl_bot.USER_MANAGER") as mock_users, \
+             patch("ytdl_bot.process_playlist_download", new_callable=AsyncMock) as mock_playlist, \
+             patch("ytdl_bot.close_aiohttp_session", new_callable=AsyncMock):
+            mock_users.is_approved.return_value = True
+            from ytdl_bot import main
+            await main()
+            await asyncio.sleep(0)
+        mock_playlist.assert_called_once_with(100, 100, "https://yt.com/playlist?list=PL1", False)
+
 
 # ---------------------------------------------------------------------------
 # TestCLIModes
@@ -2805,3 +2926,2903 @@ class TestGetAudioDurationReturnCode:
         mock_run.return_value = Mock(returncode=1, stdout="")
         from ytdl_bot import get_audio_duration
         assert get_audio_duration("/tmp/audio.mp3") is None
+
+
+# ---------------------------------------------------------------------------
+# TestEncodeGovernor
+# ---------------------------------------------------------------------------
+
+class TestEncodeGovernor:
+    """EncodeGovernor thread/preset decisions and ffmpeg wiring."""
+
+    def test_single_encode_gets_all_cores(self):
+        from ytdl_bot import EncodeGovernor
+        gov = EncodeGovernor(cpu_count=8)
+        threads, preset = gov.choose(1)
+        assert threads == 8
+        assert preset == "fast"
+
+    def test_cores_split_between_encodes(self):
+        from ytdl_bot import EncodeGovernor
+        gov = EncodeGovernor(cpu_count=8)
+        assert gov.choose(2)[0] == 4
+        assert gov.choose(3)[0] == 2
+        assert gov.choose(16)[0] == 1
+
+    def test_queue_depth_forces_faster_preset(self):
+        from ytdl_bot import EncodeGovernor
+        gov = EncodeGovernor(cpu_count=8)
+        assert gov.choose(2)[1] == "fast"
+        assert gov.choose(3)[1] == "veryfast"
+        # Even with a generous deadline, 3 encodes never get medium
+        assert gov.choose(3, video_length=60, deadline=6000)[1] == "veryfast"
+
+    def test_generous_deadline_allows_medium(self):
+        from ytdl_bot import EncodeGovernor
+        gov = EncodeGovernor(cpu_count=8)
+        assert gov.choose(1, video_length=600, deadline=6000)[1] == "medium"
+
+    def test_tight_deadline_picks_veryfast(self):
+        from ytdl_bot import EncodeGovernor
+        gov = EncodeGovernor(cpu_count=1)
+        assert gov.choose(1, video_length=600, deadline=600)[1] == "veryfast"
+
+    def test_acquire_release_tracks_active(self):
+        from ytdl_bot import EncodeGovernor
+        gov = EncodeGovernor(cpu_count=4)
+        assert gov.acquire() == (4, "fast")
+        assert gov.acquire() == (1, "fast")  # the first encode still holds all 4 cores
+        assert gov.snapshot()["active"] == 2
+        assert gov.snapshot()["threads"] == 5
+        gov.release(4)
+        gov.release(1)
+        gov.release(1)  # never goes negative
+        snap = gov.snapshot()
+        assert snap["active"] == 0 and snap["threads"] == 0
+        assert snap["decisions"]["fast"] == 2
+        assert snap["last_decision"]["depth"] == 2
+
+    def test_running_encodes_threads_are_counted(self):
+        from ytdl_bot import EncodeGovernor
+        gov = EncodeGovernor(cpu_count=8)
+        assert gov.choose(2, in_use=2)[0] == 4  # share of 8 over 2 encodes
+        assert gov.choose(2, in_use=6)[0] == 2  # only 2 cores left
+        first, _ = gov.acquire()
+        second, _ = gov.acquire()
+        gov.release(first)
+        third, _ = gov.acquire()
+        assert (first, second, third) == (8, 1, 4)
+        assert gov.snapshot()["threads"] == second + third <= 8
+
+    def test_decisions_exported_as_metrics(self):
+        from ytdl_bot import EncodeGovernor, Metrics
+        metrics = Metrics()
+        gov = EncodeGovernor(cpu_count=4)
+        with patch("ytdl_bot.METRICS", metrics):
+            gov.acquire(kind="compress")
+            gov.acquire(video_length=600, deadline=600, kind="compress")
+        assert metrics.counters["ytdl_encode_decisions_total"] == {
+            (("kind", "compress"), ("preset", "fast")): 1,
+            (("kind", "compress"), ("preset", "veryfast")): 1}
+        import ytdl_bot
+        with patch("ytdl_bot.ENCODE_GOVERNOR", gov):
+            assert "ytdl_encode_threads 5" in ytdl_bot.METRICS.render()
+
+    @patch("ytdl_bot.get_new_video_info")
+    @patch("ytdl_bot.subprocess.run")
+    @patch("ytdl_bot.os.path.getsize")
+    def test_compress_passes_threads_and_preset(self, mock_getsize, mock_run, mock_info):
+        from ytdl_bot import EncodeGovernor
+        mock_info.return_value = (1000000, 128000, 1280, 720, 30.0, 30.0, 120)
+        mock_run.return_value = Mock(returncode=0)
+        mock_getsize.return_value = 100 * 1024 * 1024
+        gov = EncodeGovernor(cpu_count=6)
+        with patch("ytdl_bot.ENCODE_GOVERNOR", gov):
+            from ytdl_bot import compress_video
+            compress_video("/tmp/video.mp4")
+        cmd = mock_run.call_args[0][0]
+        assert cmd[cmd.index("-threads") + 1] == "6"
+        # The default deadline (10x the video length) keeps "fast" as the floor
+        assert cmd[cmd.index("-preset") + 1] == "fast"
+        assert gov.active == 0 and gov.threads_in_use == 0
+
+    @patch("ytdl_bot.get_new_video_info")
+    @patch("ytdl_bot.subprocess.run")
+    def test_compress_releases_slot_on_timeout(self, mock_run, mock_info):
+        from ytdl_bot import EncodeGovernor
+        mock_info.return_value = (1000000, 128000, 1280, 720, 30.0, 30.0, 120)
+        mock_run.side_effect = subprocess.TimeoutExpired(cmd="ffmpeg", timeout=60)
+        gov = EncodeGovernor(cpu_count=2)
+        with patch("ytdl_bot.ENCODE_GOVERNOR", gov):
+            from ytdl_bot import compress_video
+            assert compress_video("/tmp/video.mp4") == (None, None, None)
+        assert gov.active == 0
+
+    @patch("ytdl_bot.subprocess.run")
+    def test_merge_image_audio_uses_governor(self, mock_run):
+        from ytdl_bot import EncodeGovernor
+        mock_run.return_value = Mock(returncode=0)
+        gov = EncodeGovernor(cpu_count=3)
+        with patch("ytdl_bot.ENCODE_GOVERNOR", gov):
+            from ytdl_bot import merge_image_audio
+            merge_image_audio("/img.jpg", "/audio.mp3", "/out.mp4")
+        cmd = mock_run.call_args[0][0]
+        assert cmd[cmd.index("-threads") + 1] == "3"
+        assert gov.active == 0
+
+
+# ---------------------------------------------------------------------------
+# TestStillImageMerge
+# ---------------------------------------------------------------------------
+
+class TestStillImageMerge:
+    """Low frame rate still-image encode, AAC copy and multi-image slideshows."""
+
+    @staticmethod
+    def _ffmpeg_cmd(mock_run):
+        return [c[0][0] for c in mock_run.call_args_list if c[0][0][0] == "ffmpeg"][-1]
+
+    @patch("ytdl_bot.subprocess.run")
+    def test_single_image_low_fps_long_gop(self, mock_run):
+        mock_run.return_value = Mock(returncode=0, stdout="mp3\n")
+        from ytdl_bot import merge_image_audio, STILL_IMAGE_FPS, STILL_IMAGE_GOP
+        assert merge_image_audio("/img.jpg", "/a.mp3", "/out.mp4") == "/out.mp4"
+        cmd = self._ffmpeg_cmd(mock_run)
+        assert cmd[cmd.index("-framerate") + 1] == str(STILL_IMAGE_FPS)
+        assert cmd[cmd.index("-r") + 1] == str(STILL_IMAGE_FPS)
+        assert cmd[cmd.index("-g") + 1] == str(STILL_IMAGE_GOP)
+        assert cmd[cmd.index("-c:a") + 1] == "aac"
+
+    @patch("ytdl_bot.subprocess.run")
+    def test_aac_audio_is_stream_copied(self, mock_run):
+        mock_run.return_value = Mock(returncode=0, stdout="aac\n")
+        from ytdl_bot import merge_image_audio
+        merge_image_audio("/img.jpg", "/a.m4a", "/out.mp4")
+        cmd = self._ffmpeg_cmd(mock_run)
+        assert cmd[cmd.index("-c:a") + 1] == "copy"
+        assert "-b:a" not in cmd
+
+    @patch("ytdl_bot.subprocess.run")
+    def test_slideshow_uses_concat_list(self, mock_run, tmp_path):
+        mock_run.return_value = Mock(returncode=0, stdout="mp3\n")
+        images = [str(tmp_path / f"{i}.jpg") for i in range(3)]
+        out = str(tmp_path / "out.mp4")
+        from ytdl_bot import merge_image_audio
+        assert merge_image_audio(images, "/a.mp3", out, duration=9) == out
+        cmd = self._ffmpeg_cmd(mock_run)
+        assert cmd[cmd.index("-f") + 1] == "concat"
+        list_path = cmd[cmd.index("-f") + 5]
+        with open(list_path) as f:
+            lines = f.read().splitlines()
+        assert lines.count("duration 3.000") == 3
+        # Last image repeated so its duration is honoured
+        assert lines[-1] == f"file '{images[-1]}'"
+        assert "pad=" in cmd[cmd.index("-vf") + 1]
+
+    @patch("ytdl_bot.subprocess.run")
+    def test_slideshow_short_images_raise_fps(self, mock_run, tmp_path):
+        mock_run.return_value = Mock(returncode=0, stdout="aac\n")
+        images = [str(tmp_path / f"{i}.jpg") for i in range(8)]
+        from ytdl_bot import merge_image_audio
+        merge_image_audio(images, "/a.m4a", str(tmp_path / "out.mp4"), duration=2)
+        cmd = self._ffmpeg_cmd(mock_run)
+        assert cmd[cmd.index("-r") + 1] == "4"
+
+    @patch("ytdl_bot.get_audio_duration", return_value=None)
+    @patch("ytdl_bot.subprocess.run")
+    def test_slideshow_unknown_duration_falls_back_to_first_image(self, mock_run, _):
+        mock_run.return_value = Mock(returncode=0, stdout="")
+        from ytdl_bot import merge_image_audio
+        merge_image_audio(["/1.jpg", "/2.jpg"], "/a.mp3", "/out.mp4")
+        cmd = self._ffmpeg_cmd(mock_run)
+        assert "-loop" in cmd
+        assert "/1.jpg" in cmd
+        assert "/2.jpg" not in cmd
+
+    @patch("ytdl_bot.subprocess.run")
+    def test_get_audio_codec(self, mock_run):
+        mock_run.return_value = Mock(returncode=0, stdout="aac\n")
+        from ytdl_bot import get_audio_codec
+        assert get_audio_codec("/a.m4a") == "aac"
+        mock_run.return_value = Mock(returncode=1, stdout="")
+        assert get_audio_codec("/a.m4a") is None
+
+
+# ---------------------------------------------------------------------------
+# TestAlbumBatching
+# ---------------------------------------------------------------------------
+
+def make_tiktok_page(image_url_lists):
+    """Build a TikTok post page with an embedded slideshow."""
+    data = {"__DEFAULT_SCOPE__": {"webapp.video-detail": {"itemInfo": {"itemStruct": {
+        "imagePost": {"images": [{"imageURL": {"urlList": urls}} for urls in image_url_lists]}
+    }}}}}
+    return ('<html><script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">'
+            + json.dumps(data) + '</script></html>')
+
+
+class TestAlbumBatching:
+    """Multi-entry extraction, concurrent fetches and album uploads."""
+
+    def test_extract_tiktok_image_urls_prefers_jpeg(self):
+        from ytdl_bot import extract_tiktok_image_urls
+        html = make_tiktok_page([
+            ["https://p/1.heic", "https://p/1.jpeg"],
+            ["https://p/2.webp"],
+            [],
+        ])
+        assert extract_tiktok_image_urls(html) == ["https://p/1.jpeg", "https://p/2.webp"]
+
+    def test_extract_tiktok_image_urls_no_data(self):
+        from ytdl_bot import extract_tiktok_image_urls
+        assert extract_tiktok_image_urls("<html></html>") == []
+        bad = '<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">{}</script>'
+        assert extract_tiktok_image_urls(bad) == []
+
+    @pytest.mark.asyncio
+    async def test_download_files_bounded_and_ordered(self, tmp_path):
+        running = [0]
+        peak = [0]
+
+        class SlowResponse:
+            status = 200
+
+            def __init__(self, url):
+                self.url = url
+
+            async def __aenter__(self):
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+                await asyncio.sleep(0.01)
+                running[0] -= 1
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+            async def read(self):
+                return self.url.encode()
+
+        mock_session = Mock()
+        mock_session.get = lambda url, **kw: SlowResponse(url)
+        urls = [f"https://p/{i}" for i in range(6)]
+
+        with patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=mock_session):
+            from ytdl_bot import download_files
+            paths = await download_files(urls, str(tmp_path), "img", concurrency=2)
+
+        assert peak[0] <= 2
+        assert [open(p, "rb").read().decode() for p in paths] == urls
+
+    @pytest.mark.asyncio
+    async def test_get_tiktok_photos_from_page(self, tmp_path):
+        page_resp = make_mock_response(status=200)
+        page_resp.text = AsyncMock(return_value=make_tiktok_page([["https://p/1.jpg"], ["https://p/2.jpg"]]))
+        mock_session = AsyncMock()
+        mock_session.get = lambda *a, **kw: AsyncContextManager(page_resp)
+
+        with patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=mock_session), \
+             patch("ytdl_bot.download_files", new_callable=AsyncMock, return_value=["/a.jpg", "/b.jpg"]) as mock_dl, \
+             patch("ytdl_bot.get_tiktok_photo", new_callable=AsyncMock) as mock_single:
+            from ytdl_bot import get_tiktok_photos
+            paths = await get_tiktok_photos("https://tiktok.com/@u/video/1", str(tmp_path))
+        assert paths == ["/a.jpg", "/b.jpg"]
+        assert mock_dl.call_args[0][0] == ["https://p/1.jpg", "https://p/2.jpg"]
+        mock_single.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_get_tiktok_photos_falls_back_to_oembed(self, tmp_path):
+        page_resp = make_mock_response(status=403)
+        mock_session = AsyncMock()
+        mock_session.get = lambda *a, **kw: AsyncContextManager(page_resp)
+
+        with patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=mock_session), \
+             patch("ytdl_bot.get_tiktok_photo", new_callable=AsyncMock, return_value="/thumb.jpg"):
+            from ytdl_bot import get_tiktok_photos
+            assert await get_tiktok_photos("https://tiktok.com/@u/video/1", str(tmp_path)) == ["/thumb.jpg"]
+
+    @patch("ytdl_bot.subprocess.run")
+    def test_get_media_entries_playlist(self, mock_run):
+        mock_run.return_value = Mock(returncode=0, stdout=json.dumps({
+            "_type": "playlist", "title": "Carousel", "entries": [{"id": "1"}, None, {"id": "2"}]
+        }))
+        from ytdl_bot import get_media_entries
+        title, entries = get_media_entries("https://instagram.com/p/abc")
+        assert title == "Carousel"
+        assert [e["id"] for e in entries] == ["1", "2"]
+        assert "--flat-playlist" in mock_run.call_args[0][0]
+
+    @patch("ytdl_bot.subprocess.run")
+    def test_get_media_entries_single_video(self, mock_run):
+        mock_run.return_value = Mock(returncode=0, stdout=json.dumps({"_type": "video", "title": "x"}))
+        from ytdl_bot import get_media_entries
+        assert get_media_entries("https://x.com/u/status/1") == (None, [])
+
+    @pytest.mark.asyncio
+    async def test_download_album_uses_playlist_items(self, tmp_path):
+        async def fake_download(url, entry_dir, max_retries=10, extra_args=None):
+            index = int(extra_args[1])
+            if index == 2:
+                return None, "failed"
+            return os.path.join(entry_dir, "video.mp4"), None
+
+        with patch("ytdl_bot.get_album_entries", return_value=[]), \
+             patch("ytdl_bot.download_video", side_effect=fake_download):
+            from ytdl_bot import download_album
+            paths = await download_album("https://x.com/u/status/1", 3, str(tmp_path))
+        assert [os.path.basename(os.path.dirname(p)) for p in paths] == ["entry_001", "entry_003"]
+
+    def test_album_photo_url(self):
+        from ytdl_bot import album_photo_url
+        video = {"duration": 12, "thumbnails": [{"url": "https://cdn/v.jpg"}]}
+        streams = {"formats": [{"vcodec": "avc1"}], "thumbnails": [{"url": "https://cdn/v.jpg"}]}
+        direct = {"ext": "jpg", "url": "https://cdn/direct.jpg"}
+        thumbs = {"thumbnails": [{"url": "https://cdn/small.jpg", "width": 320, "height": 320},
+                                 {"url": "https://cdn/big.jpg", "width": 1080, "height": 1350}]}
+        assert album_photo_url(video) is None
+        assert album_photo_url(streams) is None
+        assert album_photo_url(None) is None
+        assert album_photo_url(direct) == "https://cdn/direct.jpg"
+        assert album_photo_url(thumbs) == "https://cdn/big.jpg"
+
+    @pytest.mark.asyncio
+    async def test_download_album_fetches_photo_entries_directly(self, tmp_path):
+        entries = [{"ext": "jpg", "url": "https://cdn/1.jpg"},
+                   {"duration": 5, "formats": [{"vcodec": "avc1"}]},
+                   {"thumbnails": [{"url": "https://cdn/3.jpg", "width": 1080, "height": 1080}]}]
+        fetched = []
+
+        async def fake_files(urls, entry_dir, prefix, concurrency=4):
+            fetched.extend(urls)
+            return [os.path.join(entry_dir, f"{prefix}_001.jpg")]
+
+        async def fake_download(url, entry_dir, max_retries=10, extra_args=None):
+            return os.path.join(entry_dir, "video.mp4"), None
+
+        with patch("ytdl_bot.get_album_entries", return_value=entries), \
+             patch("ytdl_bot.download_files", side_effect=fake_files), \
+             patch("ytdl_bot.download_video", side_effect=fake_download) as mock_video:
+            from ytdl_bot import download_album
+            paths = await download_album("https://instagram.com/p/abc", 3, str(tmp_path))
+        assert fetched == ["https://cdn/1.jpg", "https://cdn/3.jpg"]
+        assert mock_video.call_count == 1
+        assert mock_video.call_args[1]["extra_args"] == ["--playlist-items", "2"]
+        assert [os.path.basename(p) for p in paths] == ["photo_001.jpg", "video.mp4", "photo_001.jpg"]
+
+    @pytest.mark.asyncio
+    async def test_send_album_single_call_per_ten_items(self):
+        client = AsyncMock()
+        client.is_connected = Mock(return_value=True)
+        files = [f"/f{i}.jpg" for i in range(12)]
+        with patch("ytdl_bot.TELETHON_CLIENT", client):
+            from ytdl_bot import send_album_telethon
+            await send_album_telethon(100, files, "caption")
+        assert client.send_file.call_count == 2
+        first, second = client.send_file.call_args_list
+        assert first.kwargs["file"] == files[:10]
+        assert first.kwargs["caption"] == "caption"
+        assert second.kwargs["file"] == files[10:]
+        assert second.kwargs["caption"] is None
+
+    @pytest.mark.asyncio
+    async def test_send_album_retries_then_fails(self):
+        client = AsyncMock()
+        client.is_connected = Mock(return_value=True)
+        client.send_file = AsyncMock(side_effect=ConnectionError("down"))
+        with patch("ytdl_bot.TELETHON_CLIENT", client), \
+             patch("ytdl_bot.wait_for_internet", new_callable=AsyncMock, return_value=True):
+            from ytdl_bot import send_album_telethon, UploadFailedError
+            with pytest.raises(UploadFailedError):
+                await send_album_telethon(100, ["/a.jpg"], max_retries=1)
+        assert client.send_file.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_process_download_routes_carousel_to_album(self):
+        from ytdl_bot import TTLCache
+        # The title probe prints title and duration/size lines for every entry
+        probe = Mock(returncode=0, stdout="Post\n5\tNA\nPost\n6\tNA\nPost\nNA\tNA\n")
+        with patch("ytdl_bot.normalize_tiktok_url", new_callable=AsyncMock,
+                   return_value=("https://www.instagram.com/p/abc/", False)), \
+             patch("ytdl_bot.MEDIA_PROBE_CACHE", TTLCache()), \
+             patch("ytdl_bot.MEDIA_ENTRY_COUNTS", TTLCache()), \
+             patch("ytdl_bot.subprocess.run", return_value=probe) as mock_run, \
+             patch("ytdl_bot.process_album_download", new_callable=AsyncMock) as mock_album, \
+             patch("ytdl_bot.download_video", new_callable=AsyncMock) as mock_dl:
+            from ytdl_bot import process_download
+            await process_download(100, 100, "https://www.instagram.com/p/abc/")
+        mock_album.assert_called_once_with(100, 100, "https://www.instagram.com/p/abc/", "Post", 3)
+        mock_dl.assert_not_called()
+        mock_run.assert_called_once()  # no separate entry listing
+
+    @pytest.mark.asyncio
+    async def test_single_post_costs_no_extra_probe(self, tmp_path):
+        from ytdl_bot import TTLCache
+        probe = Mock(returncode=0, stdout="Clip\n12\t1000\n")
+        with patch("ytdl_bot.MEDIA_PROBE_CACHE", TTLCache()), \
+             patch("ytdl_bot.MEDIA_ENTRY_COUNTS", TTLCache()), \
+             patch("ytdl_bot.subprocess.run", return_value=probe) as mock_run, \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.download_video", new_callable=AsyncMock, return_value=(None, "fail")) as mock_dl, \
+             patch("ytdl_bot.process_album_download", new_callable=AsyncMock) as mock_album, \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_download
+            await process_download(100, 100, "https://x.com/u/status/1")
+        mock_album.assert_not_called()
+        mock_dl.assert_called_once()
+        assert [call.args[0][0] for call in mock_run.call_args_list] == ["yt-dlp"]
+        assert "-J" not in mock_run.call_args[0][0]
+
+    @pytest.mark.asyncio
+    async def test_process_album_download_sends_album(self, tmp_path):
+        files = []
+        for i in range(2):
+            f = tmp_path / f"{i}.mp4"
+            f.write_bytes(b"x" * 10)
+            files.append(str(f))
+        with patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path / "work")), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.add_status_message"), \
+             patch("ytdl_bot.download_album", new_callable=AsyncMock, return_value=files), \
+             patch("ytdl_bot.send_album_telethon", new_callable=AsyncMock) as mock_send, \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_album_download
+            await process_album_download(100, 100, "https://x.com/u/status/1", "Thread", 2)
+        mock_send.assert_called_once()
+        assert mock_send.call_args[0][1] == files
+        assert "Thread" in mock_send.call_args[0][2]
+
+    @pytest.mark.asyncio
+    async def test_process_album_download_reserves_disk_and_counts_failures(self, tmp_path):
+        from ytdl_bot import DiskBudget, Metrics, TTLCache, DISK_DEFAULT_RESERVATION, DISK_RESERVATION_MARGIN
+        budget, metrics = DiskBudget(), Metrics()
+        reserved = []
+
+        async def fake_album(url, count, temp_dir):
+            reserved.append(budget.snapshot()["reserved"])
+            return []
+
+        with patch("ytdl_bot.DISK_BUDGET", budget), \
+             patch("ytdl_bot.METRICS", metrics), \
+             patch("ytdl_bot.MEDIA_PROBE_CACHE", TTLCache()), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path / "work")), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.download_album", side_effect=fake_album), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_album_download
+            await process_album_download(100, 100, "https://x.com/u/status/1", "Thread", 3)
+        assert reserved == [int(3 * DISK_DEFAULT_RESERVATION["album"] * DISK_RESERVATION_MARGIN)]
+        assert budget.snapshot()["reserved"] == 0
+        assert metrics.counters["ytdl_job_failures_total"] == {
+            (("error", "DownloadFailed"), ("kind", "album")): 1}
+
+    @pytest.mark.asyncio
+    async def test_tiktok_slideshow_sends_only_merged_video(self, tmp_path):
+        photos = [str(tmp_path / "1.jpg"), str(tmp_path / "2.jpg")]
+        with patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.add_status_message"), \
+             patch("ytdl_bot.download_audio", new_callable=AsyncMock, return_value=(str(tmp_path / "a.mp3"), None)), \
+             patch("ytdl_bot.get_tiktok_photos", new_callable=AsyncMock, return_value=photos), \
+             patch("ytdl_bot.asyncio.to_thread") as mock_tt, \
+             patch("ytdl_bot.os.path.getsize", return_value=1024), \
+             patch("ytdl_bot.send_video_telethon", new_callable=AsyncMock) as mock_video, \
+             patch("ytdl_bot.send_album_telethon", new_callable=AsyncMock) as mock_album, \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
+             patch("ytdl_bot.shutil.rmtree"), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            mock_tt.side_effect = [str(tmp_path / "v.mp4"), "Title", 10, (1080, 1920)]
+            from ytdl_bot import process_tiktok_photo
+            await process_tiktok_photo(100, 100, "https://tiktok.com/@u/video/1")
+        assert mock_tt.call_args_list[0][0][1] == photos
+        mock_video.assert_called_once()
+        mock_album.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# TestPlaylistMode
+# ---------------------------------------------------------------------------
+
+class TestPlaylistMode:
+    """Playlist detection, ordered parallel downloads and resumable state."""
+
+    def test_is_playlist_url(self):
+        from ytdl_bot import is_playlist_url
+        assert is_playlist_url("https://www.youtube.com/playlist?list=PL123")
+        assert is_playlist_url("https://youtube.com/@somechannel/videos")
+        assert is_playlist_url("https://www.youtube.com/channel/UC123/shorts")
+        assert not is_playlist_url("https://www.youtube.com/watch?v=abc&list=PL123")
+        assert not is_playlist_url("https://www.youtube.com/@somechannel")
+        assert not is_playlist_url("https://vimeo.com/123")
+
+    def test_playlist_state_roundtrip(self, tmp_path):
+        from ytdl_bot import PlaylistState
+        path = str(tmp_path / "cfg" / "playlists.json")
+        state = PlaylistState(path)
+        job = state.start(1, 2, "https://yt/pl", "PL", 5)
+        assert job["done"] == []
+        state.mark_done(1, "https://yt/pl", False, 2)
+        state.mark_done(1, "https://yt/pl", False, 2)
+
+        reloaded = PlaylistState(path)
+        assert reloaded.start(1, 2, "https://yt/pl", "PL", 5)["done"] == [2]
+        # Audio and video jobs for the same URL are separate
+        assert reloaded.start(1, 2, "https://yt/pl", "PL", 5, audio_only=True)["done"] == []
+        reloaded.finish(1, "https://yt/pl", False)
+        assert len(reloaded.unfinished()) == 1
+
+    @pytest.mark.asyncio
+    async def test_downloads_parallel_uploads_in_order(self, tmp_path):
+        from ytdl_bot import PlaylistState
+        state = PlaylistState(str(tmp_path / "playlists.json"))
+        entries = [{"title": f"E{i}", "url": f"https://yt/{i}"} for i in range(1, 6)]
+        running = [0]
+        peak = [0]
+        uploaded = []
+
+        async def fake_download(url, entry_dir, max_retries=10, extra_args=None):
+            # Entries are downloaded from their own URLs, not re-extracted from the playlist
+            assert extra_args is None
+            index = int(url.rsplit("/", 1)[1])
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            # Later entries finish first
+            await asyncio.sleep(0.01 * (6 - index))
+            running[0] -= 1
+            if index == 4:
+                return None, "gone"
+            path = os.path.join(entry_dir, "video.mp4")
+            open(path, "wb").close()
+            return path, None
+
+        async def fake_upload(chat_id, path, entry_title, entry_url, audio_only, search_title=None):
+            uploaded.append(entry_title)
+
+        with patch("ytdl_bot.get_media_entries", return_value=("PL", entries)), \
+             patch("ytdl_bot.PLAYLIST_STATE", state), \
+             patch("ytdl_bot.PLAYLIST_CONCURRENCY", 2), \
+             patch("ytdl_bot.download_video", side_effect=fake_download), \
+             patch("ytdl_bot.upload_playlist_entry", side_effect=fake_upload), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path / "work")), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)) as mock_send, \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock):
+            from ytdl_bot import process_playlist_download
+            assert await process_playlist_download(100, 100, "https://yt/pl") is True
+
+        assert uploaded == ["E1", "E2", "E3", "E5"]
+        assert peak[0] <= 2
+        assert state.unfinished() == []
+        assert "Failed entries: 4" in mock_send.call_args_list[-1][0][1]
+
+    @pytest.mark.asyncio
+    async def test_progress_refreshes_during_long_entry(self, tmp_path):
+        from ytdl_bot import PlaylistState
+        state = PlaylistState(str(tmp_path / "playlists.json"))
+        release = asyncio.Event()
+
+        async def slow_download(url, entry_dir, max_retries=10, extra_args=None):
+            await release.wait()
+            return None, "gone"
+
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.get_media_entries", return_value=("PL", [{"title": "Long", "url": "https://yt/1"}])), \
+             patch("ytdl_bot.PLAYLIST_STATE", state), \
+             patch("ytdl_bot.PLAYLIST_PROGRESS_INTERVAL", 0.01), \
+             patch("ytdl_bot.download_video", side_effect=slow_download), \
+             patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path / "work")), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=7)), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock):
+            from ytdl_bot import process_playlist_download
+            job = asyncio.create_task(process_playlist_download(100, 100, "https://yt/pl"))
+            await asyncio.sleep(0.05)
+            assert mock_bot.edit_message_text.called
+            text, chat_id, message_id = mock_bot.edit_message_text.call_args[0]
+            assert "Downloading #1: Long" in text
+            assert (chat_id, message_id) == (100, 7)
+            release.set()
+            await job
+
+    @pytest.mark.asyncio
+    async def test_resume_skips_sent_entries(self, tmp_path):
+        from ytdl_bot import PlaylistState
+        state = PlaylistState(str(tmp_path / "playlists.json"))
+        state.start(100, 100, "https://yt/pl", "PL", 3)
+        state.mark_done(100, "https://yt/pl", False, 1)
+        state.mark_done(100, "https://yt/pl", False, 2)
+        requested = []
+
+        async def fake_download(url, entry_dir, max_retries=10, extra_args=None):
+            requested.append(int(extra_args[1]))
+            return os.path.join(entry_dir, "video.mp4"), None
+
+        with patch("ytdl_bot.get_media_entries", return_value=("PL", [{}, {}, {}])), \
+             patch("ytdl_bot.PLAYLIST_STATE", state), \
+             patch("ytdl_bot.download_video", side_effect=fake_download), \
+             patch("ytdl_bot.upload_playlist_entry", new_callable=AsyncMock), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path / "work")), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock):
+            from ytdl_bot import process_playlist_download
+            await process_playlist_download(100, 100, "https://yt/pl")
+        assert requested == [3]
+
+    @pytest.mark.asyncio
+    async def test_interrupted_job_stays_resumable(self, tmp_path):
+        from ytdl_bot import PlaylistState
+        state = PlaylistState(str(tmp_path / "playlists.json"))
+
+        with patch("ytdl_bot.get_media_entries", return_value=("PL", [{}, {}])), \
+             patch("ytdl_bot.PLAYLIST_STATE", state), \
+             patch("ytdl_bot.download_audio", new_callable=AsyncMock, side_effect=RuntimeError("boom")), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path / "work")), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock):
+            from ytdl_bot import process_playlist_download
+            await process_playlist_download(100, 100, "https://yt/pl", audio_only=True)
+        assert len(state.unfinished()) == 1
+
+    @pytest.mark.asyncio
+    async def test_no_entries_falls_back(self):
+        with patch("ytdl_bot.get_media_entries", return_value=(None, [])):
+            from ytdl_bot import process_playlist_download
+            assert await process_playlist_download(100, 100, "https://yt/pl") is False
+
+    @pytest.mark.asyncio
+    async def test_resume_playlists_only_for_approved_users(self, tmp_path):
+        from ytdl_bot import PlaylistState
+        state = PlaylistState(str(tmp_path / "playlists.json"))
+        state.start(1, 1, "https://yt/a", "A", 2)
+        state.start(2, 2, "https://yt/b", "B", 2)
+        um = Mock()
+        um.is_approved = lambda user_id: user_id == 1
+
+        with patch("ytdl_bot.PLAYLIST_STATE", state), \
+             patch("ytdl_bot.USER_MANAGER", um), \
+             patch("ytdl_bot.process_playlist_download", new_callable=AsyncMock) as mock_pl:
+            from ytdl_bot import resume_playlists, BACKGROUND_TASKS
+            resume_playlists()
+            await asyncio.gather(*BACKGROUND_TASKS)
+        mock_pl.assert_called_once_with(1, 1, "https://yt/a", False)
+        assert [job["url"] for job in state.unfinished()] == ["https://yt/a"]
+
+
+# ---------------------------------------------------------------------------
+# TestDownloadModes
+# ---------------------------------------------------------------------------
+
+class TestDownloadModes:
+    """Concurrent-fragment / external downloader selection from throughput history."""
+
+    def test_get_domain(self):
+        from ytdl_bot import get_domain
+        assert get_domain("https://www.youtube.com/watch?v=1") == "youtube.com"
+        assert get_domain("https://youtu.be/1") == "youtube.com"
+        assert get_domain("https://m.twitter.com/u/status/1") == "x.com"
+        assert get_domain("https://www.Instagram.com:443/p/1") == "instagram.com"
+
+    def test_history_ring_buffer_and_median(self, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        path = str(tmp_path / "t.json")
+        history = ThroughputHistory(path, size=3, save_interval=0)
+        for value in (1, 2, 3, 10):
+            history.record("k", value)
+        assert history.samples("k") == [2, 3, 10]
+        assert history.median("k") == 3
+        history.record("k", 4)
+        assert ThroughputHistory(path, size=3).median("k") == 4
+        assert history.median("missing") is None
+
+    def test_history_saves_are_debounced_and_merged(self, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        path = str(tmp_path / "t.json")
+        first = ThroughputHistory(path, size=3)
+        second = ThroughputHistory(path, size=3)
+        first.record("k", 1)
+        second.record("k", 2)
+        assert not os.path.exists(path)
+        assert first.samples("k") == [1]
+        first.flush()
+        second.flush()
+        assert ThroughputHistory(path).samples("k") == [1, 2]
+        assert second.samples("k") == [1, 2]
+
+    def test_mode_args(self):
+        from ytdl_bot import download_mode_args, CONCURRENT_FRAGMENTS
+        assert "--concurrent-fragments" not in download_mode_args("native")
+        fragments = download_mode_args("fragments")
+        assert fragments[fragments.index("--concurrent-fragments") + 1] == str(CONCURRENT_FRAGMENTS)
+        external = download_mode_args("external")
+        assert external[external.index("--downloader") + 1] == "aria2c"
+
+    def test_fixed_mode_overrides_history(self):
+        with patch("ytdl_bot.DOWNLOAD_MODE", "native"):
+            from ytdl_bot import choose_download_mode
+            assert choose_download_mode("https://x.com/a") == "native"
+
+    def test_explores_until_enough_samples(self, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        history = ThroughputHistory(str(tmp_path / "t.json"))
+        with patch("ytdl_bot.THROUGHPUT_HISTORY", history), \
+             patch("ytdl_bot.shutil.which", return_value=None):
+            from ytdl_bot import choose_download_mode, DOWNLOAD_EXPLORE_SAMPLES
+            assert choose_download_mode("https://x.com/a") == "fragments"
+            for _ in range(DOWNLOAD_EXPLORE_SAMPLES):
+                history.record("x.com:video:fragments", 100)
+            assert choose_download_mode("https://x.com/a") == "native"
+            # Other domains and kinds are tracked separately
+            assert choose_download_mode("https://x.com/a", kind="audio") == "fragments"
+
+    def test_exploits_best_median(self, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        history = ThroughputHistory(str(tmp_path / "t.json"))
+        for value in (100, 120, 110):
+            history.record("youtube.com:video:fragments", value)
+            history.record("youtube.com:video:native", value / 4)
+            history.record("youtube.com:video:external", value * 2)
+        with patch("ytdl_bot.THROUGHPUT_HISTORY", history), \
+             patch("ytdl_bot.shutil.which", return_value="/usr/bin/aria2c"), \
+             patch("ytdl_bot.random.random", return_value=0.99):
+            from ytdl_bot import choose_download_mode
+            assert choose_download_mode("https://youtu.be/a") == "external"
+        with patch("ytdl_bot.THROUGHPUT_HISTORY", history), \
+             patch("ytdl_bot.shutil.which", return_value=None), \
+             patch("ytdl_bot.random.random", return_value=0.99):
+            assert choose_download_mode("https://youtu.be/a") == "fragments"
+
+    @pytest.mark.asyncio
+    async def test_download_video_passes_mode_and_records(self, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        history = ThroughputHistory(str(tmp_path / "t.json"))
+        commands = []
+
+        def mock_run(cmd, **kwargs):
+            commands.append(cmd)
+            (tmp_path / "video.mp4").write_bytes(b"x" * 4096)
+            return Mock(returncode=0, stderr="")
+
+        with patch("ytdl_bot.run_download_process", side_effect=mock_run), \
+             patch("ytdl_bot.THROUGHPUT_HISTORY", history), \
+             patch("ytdl_bot.DOWNLOAD_MODE", "fragments"):
+            from ytdl_bot import download_video
+            path, error = await download_video("https://x.com/u/status/1", str(tmp_path), max_retries=0)
+
+        assert error is None
+        assert "--concurrent-fragments" in commands[0]
+        assert commands[0][-1] == "https://x.com/u/status/1"
+        assert len(history.samples("x.com:video:fragments")) == 1
+
+
+# ---------------------------------------------------------------------------
+# TestAdaptiveTimeouts
+# ---------------------------------------------------------------------------
+
+class TestAdaptiveTimeouts:
+    """Per-domain/per-stage history, derived timeouts and stall detection."""
+
+    def test_record_stage_bps_and_ratio(self, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        history = ThroughputHistory(str(tmp_path / "t.json"))
+        with patch("ytdl_bot.THROUGHPUT_HISTORY", history):
+            from ytdl_bot import record_stage
+            record_stage("youtube.com", "download", 10, size=1000, media_duration=20)
+            record_stage("youtube.com", "download", 0, size=1000)  # ignored
+        assert history.samples("youtube.com:download:bps") == [100]
+        assert history.samples("youtube.com:download:ratio") == [0.5]
+
+    def test_adaptive_timeout_without_history_uses_default(self, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        with patch("ytdl_bot.THROUGHPUT_HISTORY", ThroughputHistory(str(tmp_path / "t.json"))):
+            from ytdl_bot import adaptive_timeout
+            assert adaptive_timeout("tiktok.com", "download", 600, size=10, media_duration=10) == 600
+
+    def test_adaptive_timeout_from_ratio_and_bps(self, tmp_path):
+        from ytdl_bot import ThroughputHistory, STAGE_TIMEOUT_MARGIN, STAGE_TIMEOUT_SLACK
+        history = ThroughputHistory(str(tmp_path / "t.json"))
+        history.record("local:compress:ratio", 2)
+        history.record("x.com:download:bps", 1000)
+        with patch("ytdl_bot.THROUGHPUT_HISTORY", history):
+            from ytdl_bot import adaptive_timeout
+            assert adaptive_timeout("local", "compress", 9999, media_duration=100) == \
+                200 * STAGE_TIMEOUT_MARGIN + STAGE_TIMEOUT_SLACK
+            assert adaptive_timeout("x.com", "download", 9999, size=50000) == \
+                50 * STAGE_TIMEOUT_MARGIN + STAGE_TIMEOUT_SLACK
+
+    def test_get_dir_size(self, tmp_path):
+        from ytdl_bot import get_dir_size
+        (tmp_path / "a").write_bytes(b"x" * 10)
+        (tmp_path / "sub").mkdir()
+        (tmp_path / "sub" / "b.part").write_bytes(b"x" * 5)
+        assert get_dir_size(str(tmp_path)) == 15
+        assert get_dir_size(str(tmp_path / "missing")) == 0
+
+    def test_run_download_process_success(self, tmp_path):
+        import sys
+        from ytdl_bot import run_download_process
+        result = run_download_process(
+            [sys.executable, "-c", "print('done')"], str(tmp_path), timeout=10, poll_interval=0.05)
+        assert result.returncode == 0
+        assert result.stdout.strip() == "done"
+
+    def test_run_download_process_kills_stalled(self, tmp_path):
+        import sys
+        from ytdl_bot import run_download_process, DownloadStalledError
+        with pytest.raises(DownloadStalledError) as exc:
+            run_download_process([sys.executable, "-c", "import time; time.sleep(30)"],
+                                 str(tmp_path), timeout=30, stall_timeout=0.3, poll_interval=0.05)
+        assert "stalled" in str(exc.value)
+
+    def test_run_download_process_growing_output_is_not_stalled(self, tmp_path):
+        import sys
+        from ytdl_bot import run_download_process
+        part = str(tmp_path / "out.part")
+        script = ("import time\n"
+                  "for i in range(8):\n"
+                  f"    open({part!r}, 'a').write('x' * 100)\n"
+                  "    time.sleep(0.1)\n")
+        result = run_download_process([sys.executable, "-c", script], str(tmp_path),
+                                      timeout=30, stall_timeout=0.5, poll_interval=0.05)
+        assert result.returncode == 0
+
+    def test_run_download_process_hard_timeout(self, tmp_path):
+        import sys
+        from ytdl_bot import run_download_process, DownloadStalledError
+        script = "import time\nwhile True:\n    print('x', flush=True)\n    time.sleep(0.05)\n"
+        with pytest.raises(subprocess.TimeoutExpired) as exc:
+            run_download_process([sys.executable, "-c", script], str(tmp_path),
+                                 timeout=0.4, stall_timeout=5, poll_interval=0.05)
+        assert not isinstance(exc.value, DownloadStalledError)
+
+    @pytest.mark.asyncio
+    async def test_download_reports_stall(self):
+        from ytdl_bot import DownloadStalledError
+        with patch("ytdl_bot.run_download_process", side_effect=DownloadStalledError("yt-dlp", 60)):
+            from ytdl_bot import download_video
+            path, error = await download_video("https://tiktok.com/@u/video/1", "/tmp", max_retries=0)
+        assert path is None
+        assert "stalled" in error
+
+    @pytest.mark.asyncio
+    async def test_download_timeout_derived_from_history(self, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        history = ThroughputHistory(str(tmp_path / "t.json"))
+        history.record("tiktok.com:download:bps", 1024 * 1024)
+        calls = []
+
+        def mock_run(cmd, **kwargs):
+            calls.append(kwargs)
+            return Mock(returncode=1, stderr="err")
+
+        with patch("ytdl_bot.THROUGHPUT_HISTORY", history), \
+             patch("ytdl_bot.run_download_process", side_effect=mock_run):
+            from ytdl_bot import download_video, DOWNLOAD_MAX_TIMEOUT
+            await download_video("https://tiktok.com/@u/video/1", str(tmp_path), max_retries=0,
+                                 expected_size=10 * 1024 * 1024)
+            await download_video("https://youtube.com/watch?v=1", str(tmp_path), max_retries=0)
+        assert calls[0]["timeout"] < 120
+        assert calls[1]["timeout"] == DOWNLOAD_MAX_TIMEOUT
+
+    @patch("ytdl_bot.get_new_video_info")
+    @patch("ytdl_bot.subprocess.run")
+    @patch("ytdl_bot.os.path.getsize")
+    def test_compress_uses_and_records_history(self, mock_getsize, mock_run, mock_info, tmp_path):
+        from ytdl_bot import ThroughputHistory
+        history = ThroughputHistory(str(tmp_path / "t.json"))
+        history.record("local:compress:ratio", 5)
+        mock_info.return_value = (1000000, 128000, 1280, 720, 30.0, 30.0, 600)
+        mock_run.return_value = Mock(returncode=0)
+        mock_getsize.return_value = 100 * 1024 * 1024
+        with patch("ytdl_bot.THROUGHPUT_HISTORY", history):
+            from ytdl_bot import compress_video
+            compress_video("/tmp/video.mp4")
+        # Slow encodes in the history raise the limit above 10x the length
+        assert mock_run.call_args.kwargs["timeout"] == 3000 * 3 + 60
+        assert len(history.samples("local:compress:ratio")) == 2
+
+
+# ---------------------------------------------------------------------------
+# TestResumableDownloads
+# ---------------------------------------------------------------------------
+
+class TestResumableDownloads:
+    """Stall restarts that resume from .part files instead of starting over."""
+
+    def test_every_mode_keeps_partial_files(self):
+        from ytdl_bot import download_mode_args, EXTERNAL_DOWNLOADER_ARGS
+        for mode in ("native", "fragments", "external"):
+            args = download_mode_args(mode)
+            assert "--continue" in args
+            assert "--part" in args
+        assert "--hls-prefer-native" in download_mode_args("fragments")
+        assert "-c" in EXTERNAL_DOWNLOADER_ARGS.split(":", 1)[1].split()
+
+    @pytest.mark.asyncio
+    async def test_stall_with_progress_restarts_without_using_a_retry(self, tmp_path):
+        from ytdl_bot import DownloadStalledError
+        part = tmp_path / "video.mp4.part"
+        calls = []
+
+        def mock_run(cmd, **kwargs):
+            calls.append(cmd)
+            if len(calls) < 3:
+                # Each run appends some bytes, then the network drops
+                with open(part, "ab") as f:
+                    f.write(b"x" * 100)
+                raise DownloadStalledError(cmd, 60)
+            assert part.stat().st_size == 200  # partial data kept between runs
+            part.rename(tmp_path / "video.mp4")
+            return Mock(returncode=0, stderr="")
+
+        with patch("ytdl_bot.run_download_process", side_effect=mock_run), \
+             patch("ytdl_bot.wait_for_internet", new_callable=AsyncMock) as mock_wait:
+            from ytdl_bot import download_video
+            path, error = await download_video("https://x.com/u/status/1", str(tmp_path), max_retries=0)
+        assert error is None
+        assert len(calls) == 3
+        assert calls[0] == calls[2]  # same output name, so yt-dlp resumes
+        mock_wait.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_stall_without_progress_counts_as_failed_attempt(self, tmp_path):
+        from ytdl_bot import DownloadStalledError
+        with patch("ytdl_bot.run_download_process", side_effect=DownloadStalledError("yt-dlp", 60)) as mock_run:
+            from ytdl_bot import download_audio
+            path, error = await download_audio("https://x.com/u/status/1", str(tmp_path), max_retries=0)
+        assert path is None
+        assert "stalled" in error
+        assert mock_run.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_restarts_are_capped(self, tmp_path):
+        from ytdl_bot import DownloadStalledError
+
+        def mock_run(cmd, **kwargs):
+            with open(tmp_path / "video.mp4.part", "ab") as f:
+                f.write(b"x")
+            raise DownloadStalledError(cmd, 60)
+
+        with patch("ytdl_bot.run_download_process", side_effect=mock_run) as mock_rdp, \
+             patch("ytdl_bot.MAX_STALL_RESTARTS", 2):
+            from ytdl_bot import run_resumable_download
+            with pytest.raises(DownloadStalledError):
+                await run_resumable_download(["yt-dlp"], str(tmp_path), 60, "VIDEO")
+        assert mock_rdp.call_count == 3
+
+
+# ---------------------------------------------------------------------------
+# TestSpotifyCache
+# ---------------------------------------------------------------------------
+
+class TestSpotifyCache:
+    """TTLCache, cached Spotify search and single-flight token refresh."""
+
+    TRACK_DATA = {
+        "tracks": {"items": [{
+            "external_urls": {"spotify": "https://open.spotify.com/track/1"},
+            "artists": [{"name": "Artist"}],
+            "name": "Song"
+        }]}
+    }
+
+    def _session(self, resp):
+        session = AsyncMock()
+        session.get = MagicMock(side_effect=lambda *a, **kw: AsyncContextManager(resp))
+        return session
+
+    def test_ttl_cache_expires_entries(self):
+        from ytdl_bot import TTLCache, CACHE_MISS
+        cache = TTLCache(max_size=4, ttl=10)
+        with patch("ytdl_bot.time.monotonic", return_value=100):
+            cache.set("a", 1)
+            cache.set("b", None, ttl=2)
+        with patch("ytdl_bot.time.monotonic", return_value=105):
+            assert cache.get("a") == 1
+            assert cache.get("b") is CACHE_MISS
+        with patch("ytdl_bot.time.monotonic", return_value=111):
+            assert cache.get("a") is CACHE_MISS
+        assert len(cache) == 0
+
+    def test_ttl_cache_evicts_least_recently_used(self):
+        from ytdl_bot import TTLCache, CACHE_MISS
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is CACHE_MISS
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+    @pytest.mark.asyncio
+    async def test_search_is_cached_by_cleaned_title(self):
+        session = self._session(make_mock_response(status=200, json_data=self.TRACK_DATA))
+        token = AsyncMock(return_value="token")
+        with patch("ytdl_bot.SPOTIFY_ENABLED", True), \
+             patch("ytdl_bot.get_spotify_token", token), \
+             patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=session):
+            from ytdl_bot import search_spotify
+            first = await search_spotify("Song (Official Video)")
+            second = await search_spotify("song [HD]")
+        assert first == second
+        assert first["name"] == "Song"
+        assert session.get.call_count == 1
+        # A cache hit answers without a token (no refresh round-trip)
+        assert token.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_empty_result_is_cached_with_negative_ttl(self):
+        session = self._session(make_mock_response(status=200, json_data={"tracks": {"items": []}}))
+        with patch("ytdl_bot.SPOTIFY_ENABLED", True), \
+             patch("ytdl_bot.get_spotify_token", new_callable=AsyncMock, return_value="token"), \
+             patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=session), \
+             patch("ytdl_bot.SPOTIFY_NEGATIVE_TTL", 0):
+            from ytdl_bot import search_spotify, SPOTIFY_CACHE
+            assert await search_spotify("Missing") is None
+            assert await search_spotify("Missing") is None
+        # A zero negative TTL expires immediately, so both calls hit the API
+        assert session.get.call_count == 2
+
+        with patch("ytdl_bot.SPOTIFY_ENABLED", True), \
+             patch("ytdl_bot.get_spotify_token", new_callable=AsyncMock, return_value="token"), \
+             patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=session):
+            assert await search_spotify("Missing") is None
+            assert await search_spotify("Missing") is None
+        assert session.get.call_count == 3
+        assert "missing" in SPOTIFY_CACHE._data
+
+    @pytest.mark.asyncio
+    async def test_api_errors_are_not_cached(self):
+        session = self._session(make_mock_response(status=500))
+        with patch("ytdl_bot.SPOTIFY_ENABLED", True), \
+             patch("ytdl_bot.get_spotify_token", new_callable=AsyncMock, return_value="token"), \
+             patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=session):
+            from ytdl_bot import search_spotify
+            await search_spotify("Flaky")
+            await search_spotify("Flaky")
+        assert session.get.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_token_refresh_is_single_flight(self):
+        import time
+        calls = []
+
+        async def slow_refresh():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            import ytdl_bot
+            ytdl_bot.SPOTIFY_TOKEN["token"] = "fresh"
+            ytdl_bot.SPOTIFY_TOKEN["expires"] = time.time() + 3600
+            return "fresh"
+
+        with patch("ytdl_bot.SPOTIFY_TOKEN", {"token": None, "expires": 0}), \
+             patch("ytdl_bot.SPOTIFY_TOKEN_LOCK", asyncio.Lock()), \
+             patch("ytdl_bot._refresh_spotify_token", side_effect=slow_refresh):
+            from ytdl_bot import get_spotify_token
+            tokens = await asyncio.gather(*(get_spotify_token() for _ in range(5)))
+        assert tokens == ["fresh"] * 5
+        assert len(calls) == 1
+
+    @pytest.mark.asyncio
+    async def test_audio_lookup_starts_before_download(self, tmp_path):
+        audio_file = tmp_path / "audio.mp3"
+        audio_file.write_bytes(b"x" * 1024)
+        events = []
+
+        async def fake_search(title):
+            events.append("spotify")
+            return None
+
+        async def fake_download(url, temp_dir, **kwargs):
+            await asyncio.sleep(0)
+            events.append("download")
+            return str(audio_file), None
+
+        with patch("ytdl_bot.normalize_tiktok_url", new_callable=AsyncMock, return_value=("https://yt.com/v", False)), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.add_status_message"), \
+             patch("ytdl_bot.asyncio.to_thread", new_callable=AsyncMock, side_effect=["Title", None, 180]), \
+             patch("ytdl_bot.download_audio", side_effect=fake_download), \
+             patch("ytdl_bot.search_spotify", side_effect=fake_search), \
+             patch("ytdl_bot.send_audio_telethon", new_callable=AsyncMock), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.shutil.rmtree"), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_audio_download
+            await process_audio_download(100, 100, "https://yt.com/v")
+        assert events == ["spotify", "download"]
+
+
+# ---------------------------------------------------------------------------
+# TestTitleCleaner
+# ---------------------------------------------------------------------------
+
+class TestTitleCleaner:
+    """Single-pass clean_title_for_search, batch API and micro-benchmark."""
+
+    TITLES = [
+        "Artist - Song (Official Music Video)",
+        "Artist - Song [Lyric Video] (HD)",
+        "【MV】 Artist - Song [4K] | Label Records",
+        "Artist - Song (Visualizer) [Audio]",
+        "Just a normal title",
+    ]
+
+    @staticmethod
+    def multi_pass_clean(title):
+        """Reference implementation: one re.sub pass per pattern."""
+        import re
+        from ytdl_bot import TITLE_NOISE_PATTERNS
+        for pattern in TITLE_NOISE_PATTERNS:
+            title = re.sub(pattern, '', title, flags=re.IGNORECASE)
+        return ' '.join(title.split())
+
+    def test_matches_multi_pass_reference(self):
+        from ytdl_bot import clean_title_for_search
+        for title in self.TITLES:
+            assert clean_title_for_search(title) == self.multi_pass_clean(title)
+
+    def test_batch_matches_single(self):
+        from ytdl_bot import clean_title_for_search, clean_titles_for_search
+        assert clean_titles_for_search(self.TITLES) == [clean_title_for_search(t) for t in self.TITLES]
+        assert clean_titles_for_search([]) == []
+
+    def test_single_pass_is_faster(self):
+        import timeit
+        from ytdl_bot import clean_titles_for_search
+        titles = self.TITLES * 200
+        single = min(timeit.repeat(lambda: clean_titles_for_search(titles), number=3, repeat=5))
+        multi = min(timeit.repeat(lambda: [self.multi_pass_clean(t) for t in titles], number=3, repeat=5))
+        assert single < multi
+
+    @pytest.mark.asyncio
+    async def test_audio_playlist_uses_cleaned_titles(self, tmp_path):
+        from ytdl_bot import PlaylistState
+        state = PlaylistState(str(tmp_path / "playlists.json"))
+        entries = [{"title": "Song A (Official Video)"}, {"title": "Song B [HD]"}]
+        searched = []
+
+        async def fake_download(url, entry_dir, max_retries=10, extra_args=None):
+            path = os.path.join(entry_dir, "audio.mp3")
+            open(path, "wb").close()
+            return path, None
+
+        async def fake_search(title, clean=True):
+            searched.append((title, clean))
+            return None
+
+        with patch("ytdl_bot.get_media_entries", return_value=("PL", entries)), \
+             patch("ytdl_bot.PLAYLIST_STATE", state), \
+             patch("ytdl_bot.download_audio", side_effect=fake_download), \
+             patch("ytdl_bot.search_spotify", side_effect=fake_search), \
+             patch("ytdl_bot.get_audio_duration", return_value=60), \
+             patch("ytdl_bot.send_audio_telethon", new_callable=AsyncMock) as mock_send_audio, \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path / "work")), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock):
+            from ytdl_bot import process_playlist_download
+            assert await process_playlist_download(100, 100, "https://yt/pl", audio_only=True) is True
+
+        assert searched == [("Song A", False), ("Song B", False)]
+        assert mock_send_audio.call_args_list[0][0][3] == "Song A (Official Video)"
+
+
+# ---------------------------------------------------------------------------
+# TestTikTokUrlCache
+# ---------------------------------------------------------------------------
+
+class TestTikTokUrlCache:
+    """Cached short-link resolution and the tuned shared session."""
+
+    @pytest.mark.asyncio
+    async def test_short_link_resolved_once(self):
+        mock_resp = make_mock_response(url="https://www.tiktok.com/@user/photo/42")
+        mock_session = AsyncMock()
+        mock_session.head = MagicMock(side_effect=lambda *a, **kw: AsyncContextManager(mock_resp))
+
+        from ytdl_bot import TTLCache
+        with patch("ytdl_bot.TIKTOK_URL_CACHE", TTLCache()), \
+             patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=mock_session):
+            from ytdl_bot import normalize_tiktok_url
+            first = await normalize_tiktok_url("https://vt.tiktok.com/cached/")
+            second = await normalize_tiktok_url("https://vt.tiktok.com/cached/")
+        assert first == second == ("https://www.tiktok.com/@user/video/42", True)
+        assert mock_session.head.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_resolution_not_cached(self):
+        from ytdl_bot import TTLCache
+        cache = TTLCache()
+        mock_session = AsyncMock()
+        mock_session.head = MagicMock(side_effect=Exception("Network error"))
+        with patch("ytdl_bot.TIKTOK_URL_CACHE", cache), \
+             patch("ytdl_bot.get_aiohttp_session", new_callable=AsyncMock, return_value=mock_session):
+            from ytdl_bot import normalize_tiktok_url
+            await normalize_tiktok_url("https://vm.tiktok.com/flaky/")
+        assert len(cache) == 0
+
+    @pytest.mark.asyncio
+    async def test_process_download_does_not_renormalize(self):
+        from ytdl_bot import TTLCache
+        counts = TTLCache()
+        counts.set("https://www.instagram.com/p/abc/", 2)
+        with patch("ytdl_bot.normalize_tiktok_url", new_callable=AsyncMock) as mock_norm, \
+             patch("ytdl_bot.get_video_title", return_value="Post"), \
+             patch("ytdl_bot.MEDIA_ENTRY_COUNTS", counts), \
+             patch("ytdl_bot.process_album_download", new_callable=AsyncMock):
+            from ytdl_bot import process_download
+            await process_download(100, 100, "https://www.instagram.com/p/abc/")
+        mock_norm.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_session_uses_tuned_connector(self):
+        import ytdl_bot
+        with patch("ytdl_bot._AIOHTTP_SESSION", None):
+            session = await ytdl_bot.get_aiohttp_session()
+            try:
+                assert session.connector.limit == ytdl_bot.HTTP_CONNECTION_LIMIT
+                assert session.connector.limit_per_host == ytdl_bot.HTTP_CONNECTION_LIMIT_PER_HOST
+            finally:
+                await session.close()
+
+
+# ---------------------------------------------------------------------------
+# TestWebhookIngress
+# ---------------------------------------------------------------------------
+
+def make_fake_update(update_id, text="https://youtube.com/watch?v=abc", chat_id=100):
+    """Build a Telegram Update payload as the Bot API would post it."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+        },
+    }
+
+
+class TestWebhookIngress:
+    """Webhook app fed by a fake Telegram sender, plus polling fallback."""
+
+    @pytest.mark.asyncio
+    async def test_updates_reach_handlers(self):
+        from aiohttp.test_utils import TestServer, TestClient
+        from ytdl_bot import WebhookIngress, WEBHOOK_PATH
+        bot = Mock()
+        handled = []
+        bot.process_new_updates = AsyncMock(side_effect=lambda updates: handled.extend(updates))
+        ingress = WebhookIngress(bot, secret_token="s3cret", max_handlers=2)
+
+        async with TestClient(TestServer(ingress.make_app())) as client:
+            for update_id in (1, 2, 3):
+                resp = await client.post(WEBHOOK_PATH, json=make_fake_update(update_id),
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+                assert resp.status == 200
+            await ingress.queue.join()
+
+        assert sorted(u.update_id for u in handled) == [1, 2, 3]
+        assert handled[0].message.text == "https://youtube.com/watch?v=abc"
+
+    @pytest.mark.asyncio
+    async def test_rejects_wrong_secret_and_bad_payload(self):
+        from aiohttp.test_utils import TestServer, TestClient
+        from ytdl_bot import WebhookIngress, WEBHOOK_PATH
+        bot = Mock(process_new_updates=AsyncMock())
+        ingress = WebhookIngress(bot, secret_token="s3cret")
+
+        async with TestClient(TestServer(ingress.make_app())) as client:
+            resp = await client.post(WEBHOOK_PATH, json=make_fake_update(1))
+            assert resp.status == 403
+            resp = await client.post(WEBHOOK_PATH, json=make_fake_update(1),
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": "guess"})
+            assert resp.status == 403
+            resp = await client.post(WEBHOOK_PATH, data="not json",
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+            assert resp.status == 400
+        bot.process_new_updates.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_blocked_handler_does_not_stop_later_updates(self):
+        from aiohttp.test_utils import TestServer, TestClient
+        from ytdl_bot import WebhookIngress, WEBHOOK_PATH
+        release = asyncio.Event()
+        handled = []
+
+        async def handler(updates):
+            # Update 1 stands for a download job running inside its handler
+            if updates[0].update_id == 1:
+                await release.wait()
+            handled.extend(u.update_id for u in updates)
+
+        bot = Mock(process_new_updates=AsyncMock(side_effect=handler))
+        ingress = WebhookIngress(bot, "s3cret", queue_size=2, enqueue_timeout=0.05)
+
+        async with TestClient(TestServer(ingress.make_app())) as client:
+            for update_id in range(1, 6):
+                resp = await client.post(WEBHOOK_PATH, json=make_fake_update(update_id),
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+                assert resp.status == 200
+            for _ in range(50):
+                if len(handled) == 4:
+                    break
+                await asyncio.sleep(0.01)
+            assert handled == [2, 3, 4, 5]
+            release.set()
+            await ingress.queue.join()
+        assert handled == [2, 3, 4, 5, 1]
+
+    @pytest.mark.asyncio
+    async def test_full_queue_applies_backpressure(self):
+        from aiohttp.test_utils import TestServer, TestClient
+        from ytdl_bot import WebhookIngress, WEBHOOK_PATH
+        release = asyncio.Event()
+
+        async def slow_handler(updates):
+            await release.wait()
+
+        bot = Mock(process_new_updates=AsyncMock(side_effect=slow_handler))
+        ingress = WebhookIngress(bot, "s3cret", queue_size=1, max_handlers=1, enqueue_timeout=0.05)
+
+        async with TestClient(TestServer(ingress.make_app())) as client:
+            statuses = []
+            for update_id in (1, 2, 3):
+                resp = await client.post(WEBHOOK_PATH, json=make_fake_update(update_id),
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+                statuses.append(resp.status)
+                await asyncio.sleep(0.01)
+            release.set()
+            await ingress.queue.join()
+
+        # One update is being handled, one waits in the queue, one is refused
+        assert statuses == [200, 200, 503]
+        assert bot.process_new_updates.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_webhook_requires_secret(self):
+        from ytdl_bot import WebhookIngress, run_webhook
+        with pytest.raises(ValueError):
+            WebhookIngress(Mock(), None)
+        with patch("ytdl_bot.YTDL_WEBHOOK_SECRET", None), \
+             patch("ytdl_bot.WebhookIngress") as mock_ingress, \
+             patch("ytdl_bot.BOT") as mock_bot:
+            with pytest.raises(RuntimeError):
+                await run_webhook("https://bot.example.com/telegram/webhook")
+        mock_ingress.assert_not_called()
+        mock_bot.set_webhook.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_main_falls_back_to_polling(self):
+        with patch("ytdl_bot.YTDL_WEBHOOK_URL", "https://bot.example.com/telegram/webhook"), \
+             patch("ytdl_bot.start_telethon_with_retry", new_callable=AsyncMock), \
+             patch("ytdl_bot.resume_playlists"), \
+             patch("ytdl_bot.METRICS_PORT", None), \
+             patch("ytdl_bot.run_webhook", new_callable=AsyncMock, side_effect=OSError("port in use")), \
+             patch("ytdl_bot.BOT") as mock_bot, \
+             patch("ytdl_bot.TELETHON_CLIENT") as mock_client, \
+             patch("ytdl_bot.close_aiohttp_session", new_callable=AsyncMock):
+            mock_bot.delete_webhook = AsyncMock()
+            mock_bot.polling = AsyncMock()
+            mock_client.disconnect = AsyncMock()
+            from ytdl_bot import main
+            await main()
+        mock_bot.delete_webhook.assert_called_once()
+        mock_bot.polling.assert_called_once_with(non_stop=True)
+
+    @pytest.mark.asyncio
+    async def test_main_uses_polling_without_webhook_url(self):
+        with patch("ytdl_bot.YTDL_WEBHOOK_URL", None), \
+             patch("ytdl_bot.start_telethon_with_retry", new_callable=AsyncMock), \
+             patch("ytdl_bot.resume_playlists"), \
+             patch("ytdl_bot.METRICS_PORT", None), \
+             patch("ytdl_bot.run_webhook", new_callable=AsyncMock) as mock_webhook, \
+             patch("ytdl_bot.BOT") as mock_bot, \
+             patch("ytdl_bot.TELETHON_CLIENT") as mock_client, \
+             patch("ytdl_bot.close_aiohttp_session", new_callable=AsyncMock):
+            mock_bot.polling = AsyncMock()
+            mock_client.disconnect = AsyncMock()
+            from ytdl_bot import main
+            await main()
+        mock_webhook.assert_not_called()
+        mock_bot.polling.assert_called_once_with(non_stop=True)
+
+
+# ---------------------------------------------------------------------------
+# TestWorkerMode
+# ---------------------------------------------------------------------------
+
+class TestWorkerMode:
+    """SQLite JobQueue, dispatch to workers and the worker loop."""
+
+    def test_queue_lifecycle(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "cfg" / "jobs.sqlite3"))
+        first = queue.enqueue("video", 1, 1, "https://a")
+        second = queue.enqueue("audio", 2, 2, "https://b")
+        assert queue.position(second) == 2
+
+        job = queue.claim("w0")
+        assert job["id"] == first and job["kind"] == "video"
+        assert queue.position(first) == 0
+        assert queue.position(second) == 1
+
+        queue.finish(first)
+        assert queue.claim("w1")["id"] == second
+        assert queue.claim("w1") is None
+
+    def test_requeue_returns_interrupted_jobs(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        queue.enqueue("video", 1, 1, "https://a")
+        queue.enqueue("video", 2, 2, "https://b")
+        queue.claim("w0")
+        queue.claim("w1")
+        assert queue.requeue("w0") == 1
+        assert queue.claim("w2")["url"] == "https://a"
+        assert queue.requeue() == 2
+
+    def test_prune_removes_old_finished_jobs(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        job_id = queue.enqueue("video", 1, 1, "https://a")
+        queue.claim("w0")
+        queue.finish(job_id, "boom")
+        queue.prune(-1)
+        queue.enqueue("video", 1, 1, "https://b")
+        assert queue.claim("w0")["url"] == "https://b"
+
+    def test_concurrent_claims_never_share_a_job(self, tmp_path):
+        from concurrent.futures import ThreadPoolExecutor
+        from ytdl_bot import JobQueue
+        path = str(tmp_path / "jobs.sqlite3")
+        queue = JobQueue(path)
+        for i in range(40):
+            queue.enqueue("video", i, i, f"https://v/{i}")
+
+        def drain(worker):
+            own = JobQueue(path)
+            claimed = []
+            while (job := own.claim(worker)) is not None:
+                claimed.append(job["id"])
+            return claimed
+
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(drain, ["w0", "w1", "w2", "w3"]))
+        ids = [job_id for claimed in results for job_id in claimed]
+        assert sorted(ids) == list(range(1, 41))
+
+    @pytest.mark.asyncio
+    async def test_dispatch_runs_in_process_without_queue(self):
+        with patch("ytdl_bot.JOB_QUEUE", None), \
+             patch("ytdl_bot.process_audio_download", new_callable=AsyncMock) as mock_audio:
+            from ytdl_bot import dispatch_job
+            await dispatch_job("audio", 1, 2, "https://a")
+        mock_audio.assert_called_once_with(1, 2, "https://a")
+
+    @pytest.mark.asyncio
+    async def test_dispatch_enqueues_in_worker_mode(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        with patch("ytdl_bot.JOB_QUEUE", queue), \
+             patch("ytdl_bot.process_download", new_callable=AsyncMock) as mock_video, \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)) as mock_send, \
+             patch("ytdl_bot.STATUS_MESSAGES", {}) as status_messages:
+            from ytdl_bot import dispatch_job
+            await dispatch_job("video", 1, 1, "https://a")
+            await dispatch_job("video", 2, 2, "https://b")
+        mock_video.assert_not_called()
+        # Only the second job has to wait behind another one
+        assert mock_send.call_count == 1
+        assert "position 2" in mock_send.call_args[0][1]
+        assert queue.claim("w0")["url"] == "https://a"
+        # The queued message travels with the job to the worker, not the frontend's map
+        assert queue.claim("w0")["status_message"] == 1
+        assert status_messages == {}
+
+    @pytest.mark.asyncio
+    async def test_queued_message_deleted_when_job_already_claimed(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        queue.enqueue("video", 1, 1, "https://a")
+        job_id = queue.enqueue("video", 2, 2, "https://b")
+        queue.claim("w0")
+        queue.claim("w1")
+        assert queue.set_status_message(job_id, 5) is False
+
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.JOB_QUEUE", Mock(enqueue=Mock(return_value=job_id), position=Mock(return_value=2),
+                                              set_status_message=queue.set_status_message)), \
+             patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=5)):
+            from ytdl_bot import dispatch_job
+            await dispatch_job("video", 2, 2, "https://b")
+        mock_bot.delete_message.assert_called_once_with(2, 5)
+
+    @pytest.mark.asyncio
+    async def test_supervisor_passes_metrics_port_to_workers(self):
+        process = Mock(returncode=None, terminate=Mock(), wait=AsyncMock())
+        with patch("ytdl_bot.METRICS_PORT", None), \
+             patch("ytdl_bot.asyncio.create_subprocess_exec", new_callable=AsyncMock,
+                   return_value=process) as mock_exec, \
+             patch("ytdl_bot.asyncio.sleep", new_callable=AsyncMock, side_effect=asyncio.CancelledError):
+            from ytdl_bot import supervise_workers
+            with pytest.raises(asyncio.CancelledError):
+                await supervise_workers(1)
+        args = mock_exec.call_args[0]
+        assert args[args.index("--metrics-port") + 1] == "0"
+        process.terminate.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_worker_runs_claimed_jobs(self, tmp_path):
+        from ytdl_bot import JobQueue
+        path = str(tmp_path / "jobs.sqlite3")
+        queue = JobQueue(path)
+        ok_id = queue.enqueue("video", 1, 1, "https://ok")
+        bad_id = queue.enqueue("audio", 2, 2, "https://bad")
+        queue.set_status_message(bad_id, 55)
+        client = AsyncMock()
+        mock_bot = AsyncMock()
+
+        with patch("ytdl_bot.JOBS_DB_PATH", path), \
+             patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.METRICS_PORT", None), \
+             patch("ytdl_bot.DISK_BUDGET"), \
+             patch("ytdl_bot.ADMIN_DIGEST"), \
+             patch("ytdl_bot.make_telethon_client", return_value=client) as mock_client_cls, \
+             patch("ytdl_bot.start_telethon_with_retry", new_callable=AsyncMock), \
+             patch("ytdl_bot.close_aiohttp_session", new_callable=AsyncMock), \
+             patch("ytdl_bot.process_download", new_callable=AsyncMock) as mock_video, \
+             patch("ytdl_bot.process_audio_download", new_callable=AsyncMock, side_effect=RuntimeError("boom")):
+            from ytdl_bot import run_worker
+            await run_worker(3, max_jobs=2)
+
+        mock_video.assert_called_once_with(1, 1, "https://ok")
+        assert mock_client_cls.call_args[0][0].endswith("ytdl_session_worker3")
+        client.disconnect.assert_called_once()
+        # The claiming worker removes the frontend's "Queued, position N" message
+        mock_bot.delete_message.assert_called_once_with(2, 55)
+        import sqlite3
+        rows = dict(sqlite3.connect(path).execute("SELECT id, status FROM jobs").fetchall())
+        assert rows == {ok_id: "done", bad_id: "failed"}
+        # Published for the frontend's /stats
+        assert "3" in queue.worker_stats()
+
+    def test_resume_playlists_enqueues_in_worker_mode(self, tmp_path):
+        from ytdl_bot import JobQueue, PlaylistState
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        state = PlaylistState(str(tmp_path / "playlists.json"))
+        state.start(100, 100, "https://yt/pl", "PL", 3, audio_only=True)
+        with patch("ytdl_bot.JOB_QUEUE", queue), \
+             patch("ytdl_bot.PLAYLIST_STATE", state), \
+             patch("ytdl_bot.USER_MANAGER") as mock_users, \
+             patch("ytdl_bot.process_playlist_download") as mock_playlist:
+            mock_users.is_approved.return_value = True
+            from ytdl_bot import resume_playlists
+            resume_playlists()
+        mock_playlist.assert_not_called()
+        job = queue.claim("w0")
+        assert (job["kind"], job["url"]) == ("audio", "https://yt/pl")
+
+    def test_playlist_state_sees_other_process_changes(self, tmp_path):
+        from ytdl_bot import PlaylistState
+        path = str(tmp_path / "playlists.json")
+        first = PlaylistState(path)
+        second = PlaylistState(path)
+        first.start(1, 1, "https://a", "A", 2)
+        second.start(2, 2, "https://b", "B", 2)
+        first.mark_done(1, "https://a", False, 1)
+        urls = sorted(job["url"] for job in PlaylistState(path).unfinished())
+        assert urls == ["https://a", "https://b"]
+
+
+# ---------------------------------------------------------------------------
+# TestFairScheduling
+# ---------------------------------------------------------------------------
+
+def simulate_queue(db_path, arrivals, workers, fair):
+    """Discrete-event simulation of worker processes draining a JobQueue.
+
+    arrivals: list of (time, user_id, cost). Returns {job index: latency}.
+    """
+    import heapq
+    from ytdl_bot import JobQueue
+    queue = JobQueue(db_path, fair=fair)
+    pending = sorted(enumerate(arrivals), key=lambda item: item[1][0])
+    arrival_time = {}
+    job_index = {}
+    running = []  # heap of (finish time, worker, job index)
+    idle = list(range(workers))
+    latencies = {}
+    now = 0.0
+
+    while pending or running or len(latencies) < len(arrivals):
+        while pending and pending[0][1][0] <= now:
+            index, (at, user_id, cost) = pending.pop(0)
+            job_id = queue.enqueue("video", user_id, user_id, f"https://sim/{index}", cost=cost)
+            arrival_time[job_id] = at
+            job_index[job_id] = index
+        while idle:
+            job = queue.claim(idle[0])
+            if job is None:
+                break
+            heapq.heappush(running, (now + job["cost"], idle.pop(0), job["id"]))
+        next_arrival = pending[0][1][0] if pending else float("inf")
+        next_finish = running[0][0] if running else float("inf")
+        if next_finish <= next_arrival:
+            now, worker, job_id = heapq.heappop(running)
+            queue.finish(job_id)
+            latencies[job_index[job_id]] = now - arrival_time[job_id]
+            idle.append(worker)
+        else:
+            now = next_arrival
+    return latencies
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class TestFairScheduling:
+    """Weighted fair queuing in JobQueue, cost probe and a tail-latency simulation."""
+
+    def test_users_are_interleaved(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        for i in range(5):
+            queue.enqueue("video", 1, 1, f"https://spam/{i}", cost=60)
+        queue.enqueue("video", 2, 2, "https://other", cost=60)
+        order = [queue.claim("w")["user_id"] for _ in range(6)]
+        assert order.index(2) <= 1
+
+    def test_cheap_job_overtakes_giant_one(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        queue.enqueue("video", 1, 1, "https://giant", cost=6 * 3600)
+        small = queue.enqueue("video", 2, 2, "https://small", cost=30)
+        assert queue.position(small) == 1
+        assert queue.claim("w")["url"] == "https://small"
+
+    def test_fifo_mode_keeps_arrival_order(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"), fair=False)
+        queue.enqueue("video", 1, 1, "https://giant", cost=6 * 3600)
+        queue.enqueue("video", 2, 2, "https://small", cost=30)
+        assert queue.claim("w")["url"] == "https://giant"
+
+    def test_weight_gives_larger_share(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        for i in range(8):
+            queue.enqueue("video", 1, 1, f"https://user/{i}", cost=60)
+            queue.enqueue("video", 9, 9, f"https://admin/{i}", cost=60, weight=4)
+        first = [queue.claim("w")["user_id"] for _ in range(8)]
+        assert first.count(9) >= 6
+
+    def test_estimate_uses_history_and_fallbacks(self):
+        from ytdl_bot import estimate_job_cost, JOB_DEFAULT_COST, JOB_MIN_COST
+        with patch("ytdl_bot.expected_stage_duration", return_value=None):
+            assert estimate_job_cost("https://yt.com/v", "video") == JOB_DEFAULT_COST
+            assert estimate_job_cost("https://yt.com/v", "audio", duration=600) == pytest.approx(240)
+        with patch("ytdl_bot.expected_stage_duration", return_value=1):
+            assert estimate_job_cost("https://yt.com/v", "video", 10, 10) == JOB_MIN_COST
+            assert estimate_job_cost("https://yt.com/v", "video", 10, 3 * 1024 ** 3) == JOB_MIN_COST
+
+    @pytest.mark.asyncio
+    async def test_dispatch_costs_jobs_from_one_title_probe(self, tmp_path):
+        from ytdl_bot import JobQueue, TTLCache, estimate_job_cost, dispatch_job, JOB_DEFAULT_COST
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        cache = TTLCache()
+        cache.set("https://yt.com/v", (600, 100 * 1024 ** 2))
+
+        def probe(url):
+            cache.set(url, (30, None))
+            return "Clip"
+
+        with patch("ytdl_bot.JOB_QUEUE", queue), \
+             patch("ytdl_bot.MEDIA_PROBE_CACHE", cache), \
+             patch("ytdl_bot.get_video_title", side_effect=probe) as mock_probe, \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)):
+            await dispatch_job("video", 1, 1, "https://yt.com/v")
+            await dispatch_job("video", 2, 2, "https://yt.com/clip")
+            await dispatch_job("video", 3, 3, "https://youtube.com/playlist?list=PL1")
+        mock_probe.assert_called_once_with("https://yt.com/clip")
+        costs = {job["url"]: job["cost"] for job in (queue.claim("w0") for _ in range(3))}
+        assert costs == {
+            "https://yt.com/v": pytest.approx(estimate_job_cost("https://yt.com/v", "video", 600, 100 * 1024 ** 2)),
+            "https://yt.com/clip": pytest.approx(estimate_job_cost("https://yt.com/clip", "video", 30, None)),
+            "https://youtube.com/playlist?list=PL1": JOB_DEFAULT_COST,
+        }
+
+    @pytest.mark.asyncio
+    async def test_format_choice_prefetches_probe_for_dispatch(self, tmp_path):
+        from ytdl_bot import JobQueue, TTLCache, show_format_choice, dispatch_job, MEDIA_PROBE_TASKS
+        cache = TTLCache()
+
+        def probe(url):
+            cache.set(url, (30, None))
+            return "Clip"
+
+        with patch("ytdl_bot.JOB_QUEUE", JobQueue(str(tmp_path / "jobs.sqlite3"))), \
+             patch("ytdl_bot.MEDIA_PROBE_CACHE", cache), \
+             patch("ytdl_bot.get_video_title", side_effect=probe) as mock_probe, \
+             patch("ytdl_bot.PENDING_CHOICES", {}), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)):
+            await show_format_choice(1, 1, "https://yt.com/clip")
+            assert "https://yt.com/clip" in MEDIA_PROBE_TASKS
+            await dispatch_job("video", 1, 1, "https://yt.com/clip")
+        mock_probe.assert_called_once_with("https://yt.com/clip")
+        assert MEDIA_PROBE_TASKS == {}
+
+    def test_users_short_job_overtakes_their_long_one(self, tmp_path):
+        from ytdl_bot import JobQueue
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        queue.enqueue("video", 1, 1, "long-a", cost=3600)
+        queue.enqueue("video", 1, 1, "long-b", cost=3600)
+        queue.enqueue("video", 1, 1, "short", cost=30)
+        queue.enqueue("video", 2, 2, "other", cost=600)
+        order = [queue.claim("w0")["url"] for _ in range(4)]
+        assert order[0] == "short"
+        assert order.index("other") < order.index("long-b")
+        assert order.index("long-a") < order.index("long-b")
+
+    def test_simulated_tail_latency(self, tmp_path):
+        """Mixed workload: one user floods 20 long jobs, another sends a 6h
+        video, eight users send short clips over the next hour."""
+        import random
+        rng = random.Random(7)
+        arrivals = [(0, 1, 600)] * 20 + [(0, 2, 6 * 3600)]
+        light = list(range(len(arrivals), len(arrivals) + 40))
+        arrivals += [(rng.uniform(0, 3600), 10 + i % 8, rng.uniform(20, 90)) for i in range(40)]
+
+        results = {}
+        for fair in (False, True):
+            latencies = simulate_queue(str(tmp_path / f"sim_{fair}.sqlite3"), arrivals, workers=2, fair=fair)
+            results[fair] = [latencies[i] for i in light]
+            print(f"\n[SIM] {'fair' if fair else 'fifo'}: short-job p50 {percentile(results[fair], 50):.0f}s, "
+                  f"p95 {percentile(results[fair], 95):.0f}s")
+
+        # Short jobs still wait for a busy worker, but no longer behind the backlog
+        assert percentile(results[True], 50) * 5 < percentile(results[False], 50)
+        assert percentile(results[True], 95) * 5 < percentile(results[False], 95)
+
+
+# ---------------------------------------------------------------------------
+# TestDiskAdmission
+# ---------------------------------------------------------------------------
+
+class TestDiskAdmission:
+    """Disk budget reservations, job size estimates and temp roots."""
+
+    @staticmethod
+    def usage(free):
+        return Mock(total=100 * 1024 ** 3, used=0, free=free)
+
+    def test_temp_roots(self, tmp_path):
+        from ytdl_bot import make_temp_dir
+        with patch("ytdl_bot.TEMP_ROOT", str(tmp_path / "nvme")), \
+             patch("ytdl_bot.AUDIO_TEMP_ROOT", str(tmp_path / "ram")):
+            video_dir = make_temp_dir("ytdl_")
+            audio_dir = make_temp_dir("ytdl_", audio=True)
+        assert os.path.dirname(video_dir) == str(tmp_path / "nvme")
+        assert os.path.dirname(audio_dir) == str(tmp_path / "ram")
+        with patch("ytdl_bot.TEMP_ROOT", str(tmp_path / "nvme")), \
+             patch("ytdl_bot.AUDIO_TEMP_ROOT", None):
+            assert os.path.dirname(make_temp_dir("ytdl_", audio=True)) == str(tmp_path / "nvme")
+
+    def test_estimate_job_bytes(self):
+        from ytdl_bot import estimate_job_bytes, DISK_DEFAULT_RESERVATION, MAX_VIDEO_SIZE
+        GiB = 1024 ** 3
+        assert estimate_job_bytes("video") == DISK_DEFAULT_RESERVATION["video"]
+        assert estimate_job_bytes("audio", size=GiB) == DISK_DEFAULT_RESERVATION["audio"]
+        assert estimate_job_bytes("video", size=GiB) == int(GiB * 1.2)
+        # Oversized videos also need room for the compressed copy
+        assert estimate_job_bytes("video", size=3 * GiB) == int((3 * GiB + MAX_VIDEO_SIZE) * 1.2)
+        assert estimate_job_bytes("audio", duration=600) == int(600 * 320 * 1024 / 8 * 2 * 1.2)
+
+    @pytest.mark.asyncio
+    async def test_waits_until_space_is_released(self, tmp_path):
+        from ytdl_bot import DiskBudget
+        GiB = 1024 ** 3
+        budget = DiskBudget(margin=GiB, poll_interval=5)
+        waited = AsyncMock()
+        with patch("ytdl_bot.shutil.disk_usage", return_value=self.usage(5 * GiB)):
+            first = await budget.reserve(str(tmp_path), 3 * GiB)
+            second = asyncio.create_task(budget.reserve(str(tmp_path), 2 * GiB, waited))
+            await asyncio.sleep(0.01)
+            assert not second.done()
+            assert budget.snapshot() == {"reserved": 3 * GiB, "waiting": 1}
+            budget.release(first)
+            await asyncio.wait_for(second, 1)
+        waited.assert_called_once()
+        assert budget.snapshot()["reserved"] == 2 * GiB
+        budget.release(second.result())
+        assert budget.snapshot()["reserved"] == 0
+
+    @pytest.mark.asyncio
+    async def test_oversized_job_admitted_when_alone(self, tmp_path):
+        from ytdl_bot import DiskBudget
+        budget = DiskBudget(margin=0)
+        with patch("ytdl_bot.shutil.disk_usage", return_value=self.usage(10)):
+            token = await asyncio.wait_for(budget.reserve(str(tmp_path), 1000), 1)
+        assert budget.snapshot()["reserved"] == 1000
+        budget.release(token)
+
+    @pytest.mark.asyncio
+    async def test_rechecks_free_space_periodically(self, tmp_path):
+        from ytdl_bot import DiskBudget
+        budget = DiskBudget(margin=0, poll_interval=0.01)
+        budget.reserved[budget.device(str(tmp_path))] = 1
+        with patch("ytdl_bot.shutil.disk_usage",
+                   side_effect=[self.usage(100), self.usage(100), self.usage(10 ** 6)]):
+            await asyncio.wait_for(budget.reserve(str(tmp_path), 500), 1)
+
+    @pytest.mark.asyncio
+    async def test_budget_is_shared_through_job_db(self, tmp_path):
+        from ytdl_bot import DiskBudget
+        GiB = 1024 ** 3
+        db_path = str(tmp_path / "jobs.sqlite3")
+        first = DiskBudget(margin=GiB, poll_interval=0.01, db_path=db_path, owner="worker0")
+        second = DiskBudget(margin=GiB, poll_interval=0.01, db_path=db_path, owner="worker1")
+        with patch("ytdl_bot.shutil.disk_usage", return_value=self.usage(5 * GiB)):
+            token = await first.reserve(str(tmp_path), 3 * GiB)
+            # worker1 sees worker0's reservation and has to wait
+            assert second.available(str(tmp_path)) == GiB
+            waiting = asyncio.create_task(second.reserve(str(tmp_path), 2 * GiB))
+            await asyncio.sleep(0.05)
+            assert not waiting.done()
+            first.release(token)
+            await asyncio.wait_for(waiting, 1)
+        assert first.snapshot()["reserved"] == 0
+        assert second.snapshot()["reserved"] == 2 * GiB
+
+        # A restarted worker drops the rows its previous run left behind
+        DiskBudget(margin=GiB, db_path=db_path, owner="worker1")
+        with patch("ytdl_bot.shutil.disk_usage", return_value=self.usage(5 * GiB)):
+            assert first.available(str(tmp_path)) == 4 * GiB
+
+    @pytest.mark.asyncio
+    async def test_tiktok_photo_reserves_and_releases(self, tmp_path):
+        from ytdl_bot import DiskBudget, DISK_DEFAULT_RESERVATION
+        budget = DiskBudget()
+        seen = []
+
+        async def fake_photos(url, temp_dir):
+            seen.append(budget.snapshot()["reserved"])
+            return None
+
+        with patch("ytdl_bot.DISK_BUDGET", budget), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
+             patch("ytdl_bot.download_audio", new_callable=AsyncMock, return_value=(None, "fail")), \
+             patch("ytdl_bot.get_tiktok_photos", side_effect=fake_photos), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_tiktok_photo
+            await process_tiktok_photo(100, 100, "https://tiktok.com/@u/photo/1")
+        assert seen == [DISK_DEFAULT_RESERVATION["tiktok_photo"]]
+        assert budget.snapshot()["reserved"] == 0
+
+    def test_title_fetch_records_probe(self):
+        from ytdl_bot import TTLCache
+        cache = TTLCache()
+        with patch("ytdl_bot.MEDIA_PROBE_CACHE", cache), \
+             patch("ytdl_bot.subprocess.run", return_value=Mock(returncode=0, stdout="Clip\n212.5\tNA\n")):
+            from ytdl_bot import get_video_title
+            assert get_video_title("https://yt.com/v") == "Clip"
+        assert cache.get("https://yt.com/v") == (212.5, None)
+
+    @pytest.mark.asyncio
+    async def test_process_download_reserves_and_releases(self, tmp_path):
+        from ytdl_bot import DiskBudget, TTLCache
+        budget = DiskBudget()
+        seen = []
+
+        async def fake_download(url, temp_dir, **kwargs):
+            seen.append(budget.snapshot()["reserved"])
+            return None, "fail"
+
+        with patch("ytdl_bot.DISK_BUDGET", budget), \
+             patch("ytdl_bot.MEDIA_PROBE_CACHE", TTLCache()), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
+             patch("ytdl_bot.get_video_title", return_value="Title"), \
+             patch("ytdl_bot.download_video", side_effect=fake_download), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_download, DISK_DEFAULT_RESERVATION
+            await process_download(100, 100, "https://yt.com/v")
+        assert seen == [DISK_DEFAULT_RESERVATION["video"]]
+        assert budget.snapshot()["reserved"] == 0
+
+
+# ---------------------------------------------------------------------------
+# TestMetrics
+# ---------------------------------------------------------------------------
+
+class TestMetrics:
+    """Metrics registry, Prometheus rendering, /metrics endpoint and /stats."""
+
+    def test_histogram_render(self):
+        from ytdl_bot import Metrics
+        metrics = Metrics()
+        metrics.observe("stage_seconds", 0.7, buckets=(1, 10), stage="title")
+        metrics.observe("stage_seconds", 5, buckets=(1, 10), stage="title")
+        metrics.observe("stage_seconds", 50, buckets=(1, 10), stage="title")
+        text = metrics.render()
+        assert "# TYPE stage_seconds histogram" in text
+        assert 'stage_seconds_bucket{stage="title",le="1"} 1' in text
+        assert 'stage_seconds_bucket{stage="title",le="10"} 2' in text
+        assert 'stage_seconds_bucket{stage="title",le="+Inf"} 3' in text
+        assert 'stage_seconds_sum{stage="title"} 55.7' in text
+        assert 'stage_seconds_count{stage="title"} 3' in text
+
+    def test_counters_and_gauges(self):
+        from ytdl_bot import Metrics
+        metrics = Metrics()
+        metrics.inc("retries_total", stage="upload")
+        metrics.inc("retries_total", stage="upload")
+        metrics.add_gauge("active", 2)
+        metrics.add_gauge("active", -1)
+        metrics.gauge_fn("depth", lambda: 7)
+        metrics.gauge_fn("broken", lambda: 1 / 0)
+        text = metrics.render()
+        assert 'retries_total{stage="upload"} 2' in text
+        assert "active 1" in text
+        assert "depth 7" in text
+        assert "broken" not in text
+
+    def test_percentiles_and_timer(self):
+        from ytdl_bot import Metrics
+        metrics = Metrics(sample_size=100)
+        for value in range(1, 101):
+            metrics.observe("stage_seconds", value, stage="download")
+        with patch("ytdl_bot.time.monotonic", side_effect=[10.0, 12.5]):
+            with metrics.timer("stage_seconds", stage="title"):
+                pass
+        result = metrics.percentiles("stage_seconds")
+        count, pcts = result["download"]
+        assert count == 100
+        assert pcts[50] == 51 and pcts[95] == 96
+        assert result["title"][1][50] == 2.5
+
+    def test_record_stage_feeds_metrics(self):
+        from ytdl_bot import Metrics, record_stage
+        metrics = Metrics()
+        with patch("ytdl_bot.METRICS", metrics), patch("ytdl_bot.THROUGHPUT_HISTORY"):
+            record_stage("local", "upload", 4, size=8 * 1024 * 1024)
+        assert metrics.percentiles("ytdl_stage_seconds")["upload"][1][50] == 4
+        upload = metrics.percentiles("ytdl_upload_bytes_per_second")["ytdl_upload_bytes_per_second"]
+        assert upload[1][50] == 2 * 1024 * 1024
+
+    @pytest.mark.asyncio
+    async def test_run_job_tracks_active_jobs(self):
+        from ytdl_bot import Metrics
+        metrics = Metrics()
+        seen = []
+
+        async def fake_process(chat_id, user_id, url):
+            seen.append(sum(metrics.gauges["ytdl_active_jobs"].values()))
+
+        with patch("ytdl_bot.METRICS", metrics), \
+             patch("ytdl_bot.process_download", side_effect=fake_process):
+            from ytdl_bot import run_job
+            await run_job("video", 1, 1, "https://a")
+        assert seen == [1]
+        assert sum(metrics.gauges["ytdl_active_jobs"].values()) == 0
+        assert metrics.counters["ytdl_jobs_total"] == {(("kind", "video"),): 1}
+        assert "job" in metrics.percentiles("ytdl_stage_seconds")
+
+    @pytest.mark.asyncio
+    async def test_download_failure_counted(self, tmp_path):
+        from ytdl_bot import Metrics
+        metrics = Metrics()
+        with patch("ytdl_bot.METRICS", metrics), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(tmp_path)), \
+             patch("ytdl_bot.get_video_title", return_value="Title"), \
+             patch("ytdl_bot.download_video", new_callable=AsyncMock, return_value=(None, "gone")), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_download
+            await process_download(100, 100, "https://yt.com/failing")
+        assert 'ytdl_job_failures_total{error="DownloadFailed",kind="video"} 1' in metrics.render()
+
+    @pytest.mark.asyncio
+    async def test_metrics_endpoint(self):
+        from aiohttp.test_utils import TestServer, TestClient
+        from aiohttp import web
+        from ytdl_bot import Metrics, handle_metrics_request
+        metrics = Metrics()
+        metrics.inc("ytdl_retries_total", stage="download")
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics_request)
+        with patch("ytdl_bot.METRICS", metrics):
+            async with TestClient(TestServer(app)) as client:
+                resp = await client.get("/metrics")
+                assert resp.status == 200
+                assert 'ytdl_retries_total{stage="download"} 1' in await resp.text()
+
+    @pytest.mark.asyncio
+    async def test_stats_command_admin_only(self):
+        from ytdl_bot import Metrics, YTDL_ADMIN_CHAT_ID
+        metrics = Metrics()
+        metrics.observe("ytdl_stage_seconds", 3, stage="download")
+        metrics.inc("ytdl_job_failures_total", kind="audio", error="UploadFailedError")
+        with patch("ytdl_bot.METRICS", metrics), \
+             patch("ytdl_bot.JOB_QUEUE", None), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock) as mock_send:
+            from ytdl_bot import handle_stats
+            await handle_stats(Mock(chat=Mock(id=5), from_user=Mock(id=5)))
+            assert mock_send.call_args[0][1] == "Admin only command."
+            await handle_stats(Mock(chat=Mock(id=1), from_user=Mock(id=YTDL_ADMIN_CHAT_ID)))
+        text = mock_send.call_args[0][1]
+        assert "download: p50 3.0s, p95 3.0s (n=1)" in text
+        assert "UploadFailedError, audio: 1" in text
+
+    def test_stats_merge_worker_snapshots(self, tmp_path):
+        from ytdl_bot import Metrics, JobQueue, format_stats
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+        for worker_id, seconds in ((0, 2), (1, 4)):
+            worker = Metrics()
+            worker.observe("ytdl_stage_seconds", seconds, stage="download")
+            worker.inc("ytdl_job_failures_total", kind="video", error="DownloadFailed")
+            worker.add_gauge("ytdl_active_jobs", 1)
+            queue.publish_stats(worker_id, worker.snapshot())
+        queue.enqueue("video", 1, 1, "https://yt.com/v")
+        # The frontend itself runs no jobs in worker mode
+        with patch("ytdl_bot.METRICS", Metrics()), \
+             patch("ytdl_bot.JOB_QUEUE", queue), \
+             patch("ytdl_bot.METRICS_PORT", 9464):
+            text = format_stats()
+        assert "Workers reporting: 2 (own metrics on ports 9465-9466)" in text
+        assert "download: p50 4.0s, p95 4.0s (n=2)" in text
+        assert "DownloadFailed, video: 2" in text
+        assert "Active jobs: 2, queued: 1" in text
+        queue.clear_stats()
+        assert queue.worker_stats() == {}
+
+
+# ---------------------------------------------------------------------------
+# Offline benchmark harness
+# ---------------------------------------------------------------------------
+
+class TestBenchmark:
+
+    def test_fake_yt_dlp_writes_configured_size(self, tmp_path):
+        from ytdl_bot_bench import fake_yt_dlp, BENCH_DEFAULTS
+        settings = dict(BENCH_DEFAULTS, SIZE=300000, DOWNLOAD_BPS=0, PROBE_DELAY=0)
+        output = str(tmp_path / "video.mp4")
+        assert fake_yt_dlp(["-f", "best", "--continue", "-o", output, "https://yt.com/watch?v=x"], settings) == 0
+        assert os.path.getsize(output) == 300000
+        assert not os.path.exists(output + ".part")
+
+    def test_fake_ffmpeg_sizes_output_from_bitrate(self, tmp_path):
+        from ytdl_bot_bench import fake_ffmpeg, BENCH_DEFAULTS
+        settings = dict(BENCH_DEFAULTS, DURATION=10, ENCODE_SPEED=0)
+        output = str(tmp_path / "out.mp4")
+        fake_ffmpeg(["-y", "-i", "in.mp4", "-b:v", "72000", "-b:a", "8000", output], settings)
+        assert os.path.getsize(output) == 100000
+
+    @pytest.mark.asyncio
+    async def test_fake_telethon_respects_bandwidth(self, tmp_path):
+        from ytdl_bot_bench import FakeTelethonClient
+        path = tmp_path / "file.bin"
+        path.write_bytes(b"x" * 200000)
+        progress = []
+        client = FakeTelethonClient(bandwidth=1000000, latency=0, chunk_size=50000)
+        await client.send_file(7, str(path), progress_callback=lambda current, total: progress.append(current))
+        entity, size, seconds = client.uploads[0]
+        assert (entity, size) == (7, 200000)
+        assert seconds >= 0.19
+        assert progress[-1] == 200000
+
+    @pytest.mark.asyncio
+    async def test_run_benchmark_end_to_end(self):
+        from ytdl_bot_bench import run_benchmark, format_report
+        result = await run_benchmark(users=2, jobs_per_user=1, size=1024 * 1024, duration=10,
+                                     download_bps=0, upload_bps=0, probe_delay=0, api_latency=0,
+                                     audio_ratio=0.5, seed=1)
+        assert result["jobs"] == 2
+        assert result["failed"] == 0
+        assert {"title", "download", "upload", "job"} <= set(result["stages"])
+        assert "jobs/min" in format_report(result)
+
+
+# ---------------------------------------------------------------------------
+# Update-stream load generator
+# ---------------------------------------------------------------------------
+
+class TestLoadGenerator:
+
+    def test_synthetic_stream_sessions(self):
+        from ytdl_bot_loadgen import synthetic_updates, initially_approved, LOADGEN_NEW_USER_BASE
+        entries = synthetic_updates(sessions=20, rate=10, new_user_ratio=0.5, admin_id=1, seed=3)
+        messages = [e for e in entries if "message" in e["update"]]
+        approvals = [e for e in entries if e["update"].get("callback_query", {}).get("data", "").startswith("approve_")]
+        assert len(messages) == 20
+        assert approvals and len(entries) == 40 + len(approvals)
+        assert [e["at"] for e in entries] == sorted(e["at"] for e in entries)
+        approved = initially_approved(entries)
+        assert all(user_id < LOADGEN_NEW_USER_BASE for user_id in approved)
+        assert len(approved) == 20 - len(approvals)
+
+    def test_load_updates_spaces_bare_updates(self, tmp_path):
+        from ytdl_bot_loadgen import load_updates, message_update
+        path = tmp_path / "updates.jsonl"
+        path.write_text("\n".join(json.dumps(message_update(5, f"https://x.com/{n}")) for n in range(3)))
+        entries = load_updates(str(path), rate=2)
+        assert [e["at"] for e in entries] == [0, 0.5, 1.0]
+
+    @pytest.mark.asyncio
+    async def test_fake_bot_api_tracks_buttons(self):
+        import aiohttp
+        from ytdl_bot_loadgen import FakeBotApi
+        replies = []
+        api = FakeBotApi(on_reply=lambda kind, key: replies.append((kind, key)))
+        url = await api.start()
+        markup = json.dumps({"inline_keyboard": [[{"text": "Video", "callback_data": "dl_video"}]]})
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url.format("T", "sendMessage"),
+                                        data={"chat_id": "7", "text": "Choose format:", "reply_markup": markup}) as resp:
+                    message = (await resp.json())["result"]
+                assert (await api.wait_for_button(7, "dl_video", timeout=1))["message_id"] == message["message_id"]
+                await session.post(url.format("T", "deleteMessage"),
+                                   data={"chat_id": "7", "message_id": str(message["message_id"])})
+            assert api.find_button(7, "dl_video") is None
+            assert replies == [("chat", 7)]
+        finally:
+            await api.stop()
+
+    @pytest.mark.asyncio
+    async def test_run_loadgen_end_to_end(self):
+        from ytdl_bot_loadgen import run_loadgen, synthetic_updates, format_report
+        from ytdl_bot import YTDL_ADMIN_CHAT_ID
+        entries = synthetic_updates(sessions=3, rate=50, new_user_ratio=0.5, think=0.05,
+                                    admin_id=YTDL_ADMIN_CHAT_ID, seed=2)
+        result = await run_loadgen(entries, size=256 * 1024, duration=5, probe_delay=0, drain_timeout=60)
+        assert result["skipped"] == 0
+        assert result["updates"] == len(entries)
+        assert result["first_reply"]["message"][0] == 3
+        assert result["state"]["PENDING_CHOICES"][2][0] == 0
+        assert "Event-loop lag" in format_report(result)
+
+
+# ---------------------------------------------------------------------------
+# Event-loop lag monitor
+# ---------------------------------------------------------------------------
+
+class TestLoopLagMonitor:
+
+    @pytest.mark.asyncio
+    async def test_blocking_call_is_measured_and_dumped(self):
+        import time
+        from ytdl_bot import Metrics, LoopLagMonitor
+        metrics = Metrics()
+        monitor = LoopLagMonitor(interval=0.01, threshold=0.1)
+        with patch("ytdl_bot.METRICS", metrics):
+            task = asyncio.create_task(monitor.run())
+            await asyncio.sleep(0.05)
+            time.sleep(0.4)  # blocks the loop
+            await asyncio.sleep(0.05)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        samples = metrics.histograms["ytdl_loop_lag_seconds"][()]["samples"]
+        assert max(samples) >= 0.3
+        assert metrics.counters["ytdl_loop_stalls_total"][()] == 1
+        assert "time.sleep(0.4)" in monitor.last_dump
+        assert monitor._stop.is_set()  # watchdog stopped
+
+    def test_blocked_for(self):
+        from ytdl_bot import LoopLagMonitor
+        monitor = LoopLagMonitor(interval=0.25)
+        assert monitor.blocked_for(now=10) == 0.0
+        monitor.heartbeat = 10
+        assert monitor.blocked_for(now=10.2) == 0.0
+        assert monitor.blocked_for(now=12.25) == pytest.approx(2.0)
+
+    @pytest.mark.asyncio
+    async def test_disabled(self):
+        with patch("ytdl_bot.LOOP_LAG_INTERVAL", None):
+            from ytdl_bot import start_loop_lag_monitor
+            assert start_loop_lag_monitor() is None
+
+    def test_stats_show_loop_lag(self):
+        from ytdl_bot import Metrics, format_stats, LAG_BUCKETS
+        metrics = Metrics()
+        for lag in (0.001, 0.002, 0.5):
+            metrics.observe("ytdl_loop_lag_seconds", lag, buckets=LAG_BUCKETS)
+        metrics.inc("ytdl_loop_stalls_total")
+        with patch("ytdl_bot.METRICS", metrics), patch("ytdl_bot.JOB_QUEUE", None):
+            assert "Event-loop lag: p50 2ms, p99 500ms, stalls: 1" in format_stats()
+
+
+# ---------------------------------------------------------------------------
+# Lazy startup
+# ---------------------------------------------------------------------------
+
+class TestLazyStartup:
+
+    def test_lazy_object_builds_once_on_first_use(self):
+        from ytdl_bot import LazyObject, is_initialized
+        factory = Mock(return_value=Mock(value=1))
+        lazy = LazyObject(factory)
+        assert not is_initialized(lazy)
+        factory.assert_not_called()
+        assert lazy.value == 1
+        lazy.value = 2
+        assert lazy.value == 2
+        factory.assert_called_once()
+        assert is_initialized(lazy)
+        assert is_initialized(Mock())
+
+    def test_import_has_no_side_effects(self):
+        import sys
+        code = ("import sys, ytdl_bot as b; "
+                "print('telethon' in sys.modules, b.is_initialized(b.TELETHON_CLIENT), "
+                "b.is_initialized(b.USER_MANAGER), b.is_initialized(b.PLAYLIST_STATE), "
+                "b.is_initialized(b.THROUGHPUT_HISTORY))")
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert result.stdout.split() == ["False"] * 5, result.stderr
+
+    def test_load_user_manager_approves_admin(self, tmp_path):
+        with patch("ytdl_bot.USERS_JSON_PATH", str(tmp_path / "users.json")):
+            from ytdl_bot import load_user_manager, YTDL_ADMIN_CHAT_ID
+            user_manager = load_user_manager()
+        assert user_manager.is_approved(YTDL_ADMIN_CHAT_ID)
+        assert YTDL_ADMIN_CHAT_ID in json.loads((tmp_path / "users.json").read_text())["approved_users"]
+
+
+# ---------------------------------------------------------------------------
+# Admin digest
+# ---------------------------------------------------------------------------
+
+class TestAdminDigest:
+
+    @pytest.mark.asyncio
+    async def test_digest_mode_batches_routine_events(self):
+        from ytdl_bot import AdminDigest
+        digest = AdminDigest()
+        with patch("ytdl_bot.YTDL_ADMIN_CHAT_ID", 1000), \
+             patch("ytdl_bot.ADMIN_DIGEST_INTERVAL", 0.05), \
+             patch("ytdl_bot.ADMIN_DIGEST", digest), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock) as mock_send:
+            from ytdl_bot import notify_admin
+            await notify_admin(5, "Video sent to user 5: A", kind="sent", url="https://a")
+            await notify_admin(6, "Video sent to user 6: A", kind="sent", url="https://a")
+            await notify_admin(6, "Upload failed for user 6:\nhttps://b\n\nboom", kind="failed", url="https://b")
+            mock_send.assert_not_called()
+            await notify_admin(7, "Error for user 7: traceback", kind="error", urgent=True)
+            mock_send.assert_called_once_with(1000, "Error for user 7: traceback")
+            await asyncio.sleep(0.15)
+        assert mock_send.call_count == 2
+        text = mock_send.call_args[0][1]
+        assert text.startswith("Admin digest: 3 events from 2 users")
+        assert "sent: 2, failed: 1" in text
+        assert "- 6: Upload failed for user 6: https://b" in text
+        assert "- 2x https://a" in text
+        assert digest.events == []
+
+    @pytest.mark.asyncio
+    async def test_digest_mode_replaces_forwarding(self):
+        from ytdl_bot import AdminDigest
+        digest = AdminDigest()
+        mock_um = Mock(is_denied=Mock(return_value=False), is_pending=Mock(return_value=False),
+                       is_approved=Mock(return_value=True))
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.USER_MANAGER", mock_um), \
+             patch("ytdl_bot.YTDL_ADMIN_CHAT_ID", 9999), \
+             patch("ytdl_bot.ADMIN_DIGEST_INTERVAL", 60), \
+             patch("ytdl_bot.ADMIN_DIGEST", digest), \
+             patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock) as mock_send, \
+             patch("ytdl_bot.normalize_tiktok_url", new_callable=AsyncMock, return_value=("https://youtube.com/v", False)), \
+             patch("ytdl_bot.show_format_choice", new_callable=AsyncMock):
+            from ytdl_bot import handle_message
+            await handle_message(make_mock_message(chat_id=100, text="https://youtube.com/v"))
+            mock_bot.forward_message.assert_not_called()
+            assert [event[:3] for event in digest.events] == [("request", 100, "https://youtube.com/v")]
+            await digest.close()
+            mock_send.assert_called_once()
+            assert "request: 1" in mock_send.call_args[0][1]
+
+    @pytest.mark.asyncio
+    async def test_worker_mode_sends_one_digest_from_frontend(self, tmp_path):
+        from ytdl_bot import AdminDigest
+        db_path = str(tmp_path / "jobs.sqlite3")
+        frontend, workers = AdminDigest(db_path), [AdminDigest(db_path), AdminDigest(db_path)]
+        with patch("ytdl_bot.YTDL_ADMIN_CHAT_ID", 1000), \
+             patch("ytdl_bot.ADMIN_DIGEST_INTERVAL", 0.05), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock) as mock_send:
+            frontend.start()
+            frontend.add("request", 5, "https://a", "https://a")
+            workers[0].add("sent", 5, "Video sent to user 5: A", "https://a")
+            workers[1].add("failed", 6, "Upload failed for user 6", "https://b")
+            for worker in workers:
+                await worker.close()
+            mock_send.assert_not_called()
+            await asyncio.sleep(0.08)
+            mock_send.assert_called_once()
+            assert mock_send.call_args[0][1].startswith("Admin digest: 3 events from 2 users")
+            workers[0].add("sent", 7, "Video sent to user 7: C", "https://c")
+            await frontend.close()
+        assert mock_send.call_count == 2
+        assert "sent: 1" in mock_send.call_args[0][1]
+
+    @pytest.mark.asyncio
+    async def test_flush_without_events_sends_nothing(self):
+        from ytdl_bot import AdminDigest
+        with patch("ytdl_bot.send_message", new_callable=AsyncMock) as mock_send:
+            await AdminDigest().close()
+        mock_send.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# Inline mode from cached uploads
+# ---------------------------------------------------------------------------
+
+def make_inline_query(text, user_id=100, query_id="q1"):
+    return Mock(id=query_id, query=text, from_user=Mock(id=user_id))
+
+
+@pytest.fixture
+def inline_state():
+    """Fresh inline dedup state, with a short debounce."""
+    from ytdl_bot import TTLCache
+    with patch("ytdl_bot.INLINE_PENDING", TTLCache(16, 600)), \
+         patch("ytdl_bot.INLINE_LATEST", {}), \
+         patch("ytdl_bot.INLINE_DEBOUNCE", 0.01):
+        yield
+
+
+class TestInlineMode:
+
+    def test_upload_cache_persists_and_evicts(self, tmp_path):
+        from ytdl_bot import UploadCache
+        path = str(tmp_path / "uploads.json")
+        cache = UploadCache(path, max_entries=2)
+        cache.set("https://youtube.com/watch?v=a&si=x", "video", {"file_id": "A"})
+        cache.set("https://b", "video", {"file_id": "B"})
+        assert cache.get("https://youtube.com/watch?v=a", "video") == {"file_id": "A"}
+        assert cache.get("https://b", "audio") is None
+        # A second process sees the entry and evicts the oldest one
+        other = UploadCache(path, max_entries=2)
+        other.set("https://c", "audio", {"file_id": "C"})
+        assert cache.get("https://c", "audio") == {"file_id": "C"}
+        assert cache.get("https://youtube.com/watch?v=a", "video") is None
+
+    def test_record_upload_stores_bot_file_id(self, tmp_path):
+        import datetime
+        from telethon.tl.types import Document, DocumentAttributeVideo
+        from ytdl_bot import UploadCache, record_upload
+        cache = UploadCache(str(tmp_path / "uploads.json"))
+        document = Document(id=1, access_hash=2, file_reference=b"", date=datetime.datetime.now(),
+                            mime_type="video/mp4", size=10, dc_id=2,
+                            attributes=[DocumentAttributeVideo(duration=1, w=2, h=2)])
+        with patch("ytdl_bot.UPLOAD_CACHE", cache):
+            record_upload("https://v", "video", Mock(document=document), None, "Title\n\nSource: https://v", 1)
+            record_upload("https://w", "video", Mock(document=None), None, "Other", 1)
+        entry = cache.get("https://v", "video")
+        assert entry["file_id"] and entry["title"] == "Title"
+        assert cache.get("https://w", "video") is None
+
+    @pytest.mark.asyncio
+    async def test_inline_answers_with_bot_api_file_id(self, tmp_path):
+        """Inline results send the file_id the Bot API returned, never Telethon's packed id."""
+        from ytdl_bot import UploadCache, record_upload, get_bot_file_id, inline_results, FILE_ID_CHAT_ID
+        cache = UploadCache(str(tmp_path / "uploads.json"))
+        mock_bot = AsyncMock()
+        mock_bot.forward_message.return_value = Mock(message_id=9, video=Mock(file_id="BAACAgIAAxkBAAIB"))
+        document = Mock()
+        with patch("ytdl_bot.UPLOAD_CACHE", cache), patch("ytdl_bot.BOT", mock_bot), \
+             patch("telethon.utils.pack_bot_file_id", return_value="packed"):
+            bot_file_id = await get_bot_file_id(5, 42, "video")
+            record_upload("https://v", "video", Mock(document=document), "Title", "Title", 1, None, bot_file_id)
+            record_upload("https://old", "video", Mock(document=document), "Old", "Old", 1)
+            results = inline_results("https://v")
+            assert inline_results("https://old") == []
+        mock_bot.forward_message.assert_called_once_with(FILE_ID_CHAT_ID, 5, 42, disable_notification=True)
+        mock_bot.delete_message.assert_called_once_with(FILE_ID_CHAT_ID, 9)
+        assert cache.get("https://v", "video")["file_id"] == "packed"
+        result, = results
+        assert result.to_dict()["video_file_id"] == "BAACAgIAAxkBAAIB"
+
+    @pytest.mark.asyncio
+    async def test_bot_file_id_is_none_when_forward_fails(self):
+        from ytdl_bot import get_bot_file_id
+        mock_bot = AsyncMock()
+        mock_bot.forward_message.side_effect = RuntimeError("chat not found")
+        with patch("ytdl_bot.BOT", mock_bot):
+            assert await get_bot_file_id(5, 42, "audio") is None
+
+    @pytest.mark.asyncio
+    async def test_inline_hit_answers_with_cached_media(self, tmp_path):
+        from ytdl_bot import UploadCache
+        cache = UploadCache(str(tmp_path / "uploads.json"))
+        cache.set("https://youtube.com/watch?v=a", "video",
+                  {"file_id": "packed", "bot_file_id": "VID", "title": "A", "caption": "A"})
+        cache.set("https://youtube.com/watch?v=a", "audio",
+                  {"file_id": "packed", "bot_file_id": "AUD", "title": "A", "caption": "A"})
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.UPLOAD_CACHE", cache), \
+             patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.USER_MANAGER", Mock(is_approved=Mock(return_value=True))), \
+             patch("ytdl_bot.dispatch_job", new_callable=AsyncMock) as mock_dispatch:
+            from ytdl_bot import handle_inline_query
+            await handle_inline_query(make_inline_query("https://youtube.com/watch?v=a"))
+        results = mock_bot.answer_inline_query.call_args[0][1]
+        assert [r.video_file_id if r.type == "video" else r.audio_file_id for r in results] == ["VID", "AUD"]
+        mock_dispatch.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_inline_miss_starts_one_download(self, tmp_path, inline_state):
+        from ytdl_bot import UploadCache
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.UPLOAD_CACHE", UploadCache(str(tmp_path / "uploads.json"))), \
+             patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.USER_MANAGER", Mock(is_approved=Mock(return_value=True))), \
+             patch("ytdl_bot.dispatch_job", new_callable=AsyncMock) as mock_dispatch:
+            from ytdl_bot import handle_inline_query
+            await handle_inline_query(make_inline_query("https://youtube.com/watch?v=new", user_id=7))
+            await handle_inline_query(make_inline_query("https://youtube.com/watch?v=new", user_id=7))
+            await asyncio.sleep(0)
+        mock_dispatch.assert_called_once_with("video", 7, 7, "https://youtube.com/watch?v=new")
+        args, kwargs = mock_bot.answer_inline_query.call_args
+        assert args[1][0].id == "processing"
+        assert kwargs["cache_time"] == 0
+
+    @pytest.mark.asyncio
+    async def test_inline_typing_dispatches_only_the_finished_url(self, tmp_path, inline_state):
+        from ytdl_bot import UploadCache
+        typed = ["https://yo", "https://youtube.com/", "https://youtube.com/watch?v=ne",
+                 "https://youtube.com/watch?v=new"]
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.UPLOAD_CACHE", UploadCache(str(tmp_path / "uploads.json"))), \
+             patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.USER_MANAGER", Mock(is_approved=Mock(return_value=True))), \
+             patch("ytdl_bot.dispatch_job", new_callable=AsyncMock) as mock_dispatch:
+            from ytdl_bot import handle_inline_query
+            await asyncio.gather(*(handle_inline_query(make_inline_query(text, user_id=7, query_id=f"q{i}"))
+                                   for i, text in enumerate(typed)))
+            await asyncio.sleep(0)
+        mock_dispatch.assert_called_once_with("video", 7, 7, "https://youtube.com/watch?v=new")
+        # Incomplete URLs get an empty answer instead of a placeholder
+        assert mock_bot.answer_inline_query.call_args_list[0][0][1] == []
+
+    @pytest.mark.asyncio
+    async def test_inline_pending_dedups_normalized_urls(self, tmp_path, inline_state):
+        from ytdl_bot import UploadCache, inline_pending_key
+        assert inline_pending_key("http://WWW.YouTube.com/watch?v=new&si=x#t=3") == \
+            inline_pending_key("https://youtube.com/watch?v=new")
+        assert inline_pending_key("https://x.com/a/status/1/") == "https://x.com/a/status/1"
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.UPLOAD_CACHE", UploadCache(str(tmp_path / "uploads.json"))), \
+             patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.USER_MANAGER", Mock(is_approved=Mock(return_value=True))), \
+             patch("ytdl_bot.dispatch_job", new_callable=AsyncMock) as mock_dispatch:
+            from ytdl_bot import handle_inline_query
+            await handle_inline_query(make_inline_query("https://www.youtube.com/watch?v=new&si=abc", user_id=7))
+            await handle_inline_query(make_inline_query("https://youtube.com/watch?v=new", user_id=8))
+            await asyncio.sleep(0)
+        mock_dispatch.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_inline_unapproved_user_is_sent_to_private_chat(self):
+        mock_bot = AsyncMock()
+        with patch("ytdl_bot.BOT", mock_bot), \
+             patch("ytdl_bot.USER_MANAGER", Mock(is_approved=Mock(return_value=False))), \
+             patch("ytdl_bot.dispatch_job", new_callable=AsyncMock) as mock_dispatch:
+            from ytdl_bot import handle_inline_query
+            await handle_inline_query(make_inline_query("https://youtube.com/watch?v=a"))
+        assert mock_bot.answer_inline_query.call_args[1]["switch_pm_parameter"] == "start"
+        mock_dispatch.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# Structured logging
+# ---------------------------------------------------------------------------
+
+class TestStructuredLogging:
+
+    @pytest.fixture
+    def log_file(self, tmp_path):
+        from ytdl_bot import setup_logging, stop_logging
+        path = tmp_path / "logs" / "bot.log"
+        setup_logging("WARNING", str(path))
+        yield path
+        stop_logging()
+
+    def read_records(self, path):
+        from ytdl_bot import stop_logging
+        stop_logging()
+        return [json.loads(line) for line in path.read_text().splitlines()]
+
+    @pytest.mark.asyncio
+    async def test_job_records_carry_job_id_stage_and_fields(self, log_file):
+        import io
+        import ytdl_bot
+        from ytdl_bot import run_job, log, log_stage
+        console = io.StringIO()
+        ytdl_bot._LOG_LISTENER.handlers[0].setStream(console)
+
+        async def handler(chat_id, user_id, url):
+            log_stage("download")
+            log("VIDEO", "in loop", size=3)
+            await asyncio.to_thread(log, "VIDEO", "in thread")
+            log("VIDEO", "retrying", level=30)
+
+        with patch("ytdl_bot.get_job_handler", return_value=handler):
+            await run_job("video", 1, 2, "https://a", job_id=17)
+        records = self.read_records(log_file)
+        by_message = {r["message"]: r for r in records}
+        assert by_message["in loop"]["job"] == 17 and by_message["in loop"]["stage"] == "download"
+        assert by_message["in loop"]["size"] == 3 and by_message["in loop"]["tag"] == "VIDEO"
+        assert by_message["in thread"]["job"] == 17
+        assert by_message["download took 0.0s"]["stage_seconds"] >= 0
+        assert records[-1]["message"].startswith("Finished video")
+        assert "job_seconds" in records[-1]
+        # Console only gets WARNING and up
+        out = console.getvalue()
+        assert "[VIDEO] [job 17/download] retrying" in out
+        assert "in loop" not in out
+
+    def test_records_outside_jobs_have_no_job_fields(self, log_file):
+        from ytdl_bot import log
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            log("PROBE", "failed", level=40, exc_info=True)
+        record, = self.read_records(log_file)
+        assert "job" not in record and record["level"] == "ERROR"
+        assert "ValueError: boom" in record["exc_text"]
+
+    def test_full_queue_drops_records_instead_of_blocking(self):
+        import logging
+        import queue
+        from ytdl_bot import NonBlockingQueueHandler, Metrics
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        record = logging.LogRecord("ytdl", logging.INFO, __file__, 1, "msg", None, None)
+        metrics = Metrics()
+        with patch("ytdl_bot.METRICS", metrics):
+            handler.emit(record)
+            handler.emit(record)
+        assert handler.queue.qsize() == 1
+        assert metrics.counters["ytdl_log_records_dropped_total"][()] == 1
+
+    def test_worker_log_path(self):
+        from ytdl_bot import worker_log_path
+        assert worker_log_path("/var/log/ytdl_bot.log", 2) == "/var/log/ytdl_bot.worker2.log"
+
+
+# ---------------------------------------------------------------------------
+# Audio quality ladder
+# ---------------------------------------------------------------------------
+
+class TestAudioQualityLadder:
+
+    def fake_encode(self, source_path, out_dir):
+        from ytdl_bot import AUDIO_RENDITIONS
+        renditions = {}
+        for name, spec in AUDIO_RENDITIONS.items():
+            renditions[name] = os.path.join(out_dir, f"{name}.{spec['ext']}")
+            with open(renditions[name], "wb") as f:
+                f.write(name.encode())
+        return renditions
+
+    def test_encode_runs_one_ffmpeg_with_an_output_per_rendition(self, tmp_path):
+        from ytdl_bot import encode_audio_renditions, AUDIO_RENDITIONS
+
+        def run(command, **kwargs):
+            for arg in command:
+                if arg.startswith(str(tmp_path)) and arg != str(tmp_path / "source.webm"):
+                    open(arg, "wb").write(b"x")
+            return Mock(returncode=0)
+
+        with patch("ytdl_bot.subprocess.run", side_effect=run) as mock_run:
+            result = encode_audio_renditions(str(tmp_path / "source.webm"), str(tmp_path))
+        command = mock_run.call_args[0][0]
+        assert mock_run.call_count == 1
+        assert command.count("-i") == 1
+        assert command.count("-map") == len(AUDIO_RENDITIONS)
+        assert set(result) == set(AUDIO_RENDITIONS)
+        assert result["voice"].endswith("voice.ogg") and "libopus" in command
+
+    def test_encode_failure_returns_nothing(self, tmp_path):
+        from ytdl_bot import encode_audio_renditions
+        with patch("ytdl_bot.subprocess.run", return_value=Mock(returncode=1, stderr="bad")):
+            assert encode_audio_renditions(str(tmp_path / "source.webm"), str(tmp_path)) == {}
+
+    def test_cache_store_get_and_prune(self, tmp_path):
+        import time
+        from ytdl_bot import AudioRenditionCache
+        work = tmp_path / "work"
+        work.mkdir()
+        cache = AudioRenditionCache(str(tmp_path / "cache"), ttl=100, max_bytes=10 ** 6)
+        cache.store("https://youtube.com/watch?v=a&si=x", self.fake_encode(None, str(work)),
+                    {"title": "A", "duration": 60})
+        entry = cache.get("https://youtube.com/watch?v=a", "128")
+        assert entry["title"] == "A" and open(entry["path"]).read() == "128"
+        assert entry["thumbnail"] is None
+        assert cache.get("https://youtube.com/watch?v=b", "128") is None
+
+        cache.prune(now=time.time() + 101)
+        assert cache.get("https://youtube.com/watch?v=a", "128") is None
+
+    def test_cache_evicts_least_recently_used_over_size(self, tmp_path):
+        from ytdl_bot import AudioRenditionCache
+        cache = AudioRenditionCache(str(tmp_path / "cache"), max_bytes=30)
+        for url in ("https://a", "https://b"):
+            work = tmp_path / url[-1]
+            work.mkdir()
+            cache.store(url, self.fake_encode(None, str(work)), {"title": url, "duration": 1})
+        assert cache.get("https://a", "64") is None
+        assert cache.get("https://b", "64") is not None
+
+    @pytest.mark.asyncio
+    async def test_second_quality_is_served_without_download(self, tmp_path):
+        from ytdl_bot import AudioRenditionCache, process_audio_rendition
+        cache = AudioRenditionCache(str(tmp_path / "cache"))
+
+        async def download(url, temp_dir, keep_source=False):
+            assert keep_source
+            path = os.path.join(temp_dir, "source.webm")
+            open(path, "wb").write(b"source")
+            return path, None
+
+        with patch("ytdl_bot.AUDIO_RENDITION_CACHE", cache), \
+             patch("ytdl_bot.TEMP_ROOT", str(tmp_path / "work")), \
+             patch("ytdl_bot.AUDIO_TEMP_ROOT", None), \
+             patch("ytdl_bot.download_audio", side_effect=download) as mock_download, \
+             patch("ytdl_bot.encode_audio_renditions", side_effect=self.fake_encode) as mock_encode, \
+             patch("ytdl_bot.get_video_title", return_value="Song"), \
+             patch("ytdl_bot.get_audio_duration", return_value=200), \
+             patch("ytdl_bot.get_thumbnail", return_value=None), \
+             patch("ytdl_bot.reserve_disk", new_callable=AsyncMock, return_value=None), \
+             patch("ytdl_bot.search_spotify", new_callable=AsyncMock, return_value=None), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.send_audio_telethon", new_callable=AsyncMock) as mock_send:
+            await process_audio_rendition(1, 1, "https://youtube.com/watch?v=a", "320")
+            await process_audio_rendition(1, 1, "https://youtube.com/watch?v=a", "voice")
+        assert mock_download.call_count == 1 and mock_encode.call_count == 1
+        sent = [call.args[1] for call in mock_send.call_args_list]
+        assert sent[0].endswith("320.mp3") and sent[1].endswith("voice.ogg")
+        assert mock_send.call_args.args[3:5] == ("Song", 200)
+        assert not os.listdir(tmp_path / "work")
+
+    @pytest.mark.asyncio
+    async def test_download_keeps_source_stream(self, tmp_path):
+        def run(command, *args, **kwargs):
+            assert "-x" not in command
+            (tmp_path / "source.webm").write_bytes(b"audio")
+            return Mock(returncode=0)
+
+        with patch("ytdl_bot.run_download_process", side_effect=run):
+            from ytdl_bot import download_audio
+            path, error = await download_audio("https://youtube.com/watch?v=a", str(tmp_path), keep_source=True)
+        assert path == str(tmp_path / "source.webm") and error is None
+
+    @pytest.mark.asyncio
+    async def test_format_choice_offers_and_dispatches_renditions(self):
+        from ytdl_bot import AUDIO_RENDITIONS
+        mock_telebot = MagicMock()
+        with patch("ytdl_bot.telebot", mock_telebot), \
+             patch("ytdl_bot.PENDING_CHOICES", {}), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.add_status_message"):
+            from ytdl_bot import show_format_choice
+            await show_format_choice(1, 1, "https://youtube.com/watch?v=a")
+            await show_format_choice(1, 1, "https://youtube.com/watch?v=a", approved=False)
+        markup = mock_telebot.types.InlineKeyboardMarkup.return_value
+        rows = [len(call.args) for call in markup.row.call_args_list]
+        assert rows == [2, len(AUDIO_RENDITIONS), 2]
+
+        pending = {1: {"url": "https://test.com", "user_id": 100, "timestamp": 0, "approved": True}}
+        with patch("ytdl_bot.PENDING_CHOICES", pending), \
+             patch("ytdl_bot.BOT", AsyncMock()), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}), \
+             patch("ytdl_bot.dispatch_job", new_callable=AsyncMock) as mock_dispatch:
+            from ytdl_bot import handle_format_choice, get_job_handler
+            call = make_mock_callback(data="dl_audio_128", message_id=1)
+            await handle_format_choice(call)
+        assert mock_dispatch.call_args.args[0] == "audio_128"
+        with patch("ytdl_bot.process_audio_rendition", new_callable=AsyncMock) as mock_process:
+            await get_job_handler("audio_128")(1, 2, "https://test.com")
+        mock_process.assert_called_once_with(1, 2, "https://test.com", "128")
+
+
+# ---------------------------------------------------------------------------
+# mmap part uploader
+# ---------------------------------------------------------------------------
+
+class TestMmapUpload:
+
+    @pytest.mark.asyncio
+    async def test_small_file_parts_and_md5(self, tmp_path):
+        import hashlib
+        from ytdl_bot import MmapUpload
+        data = bytes(range(256)) * 10
+        path = tmp_path / "small.mp3"
+        path.write_bytes(data)
+        client = AsyncMock(return_value=True)
+        progress = []
+
+        upload = MmapUpload(str(path), part_size=1024)
+        handle = await upload.upload(client, lambda current, total: progress.append(current))
+
+        requests = [call.args[0] for call in client.call_args_list]
+        assert [r.file_part for r in requests] == [0, 1, 2]
+        assert b"".join(r.bytes for r in requests) == data
+        assert {r.file_id for r in requests} == {upload.file_id}
+        assert progress == [1024, 2048, len(data)]
+        assert (handle.id, handle.parts, handle.name) == (upload.file_id, 3, "small.mp3")
+        assert handle.md5_checksum == hashlib.md5(data).hexdigest() and handle.size == len(data)
+
+    @pytest.mark.asyncio
+    async def test_retry_sends_only_missing_parts(self, tmp_path):
+        from ytdl_bot import MmapUpload
+        path = tmp_path / "video.mp4"
+        path.write_bytes(b"v" * 5000)
+        client = AsyncMock(side_effect=[True, True, ConnectionError("lost"), True, True, True])
+
+        upload = MmapUpload(str(path), part_size=1024)
+        with pytest.raises(ConnectionError):
+            await upload.upload(client)
+        assert upload.done == {0, 1} and upload.sent_bytes() == 2048
+        await upload.upload(client)
+        assert [call.args[0].file_part for call in client.call_args_list] == [0, 1, 2, 2, 3, 4]
+        assert upload.sent_bytes() == 5000
+
+    @pytest.mark.asyncio
+    async def test_big_file_uses_big_parts(self, tmp_path):
+        from ytdl_bot import MmapUpload
+        path = tmp_path / "big.mp4"
+        path.write_bytes(b"b" * 4096)
+        client = AsyncMock(return_value=True)
+        with patch("ytdl_bot.UPLOAD_BIG_FILE_SIZE", 1000):
+            handle = await MmapUpload(str(path), part_size=1024).upload(client)
+        request = client.call_args.args[0]
+        assert type(request).__name__ == "SaveBigFilePartRequest" and request.file_total_parts == 4
+        assert type(handle).__name__ == "InputFileBig"
+
+    def test_empty_file_rejected(self, tmp_path):
+        from ytdl_bot import MmapUpload
+        path = tmp_path / "empty.mp4"
+        path.write_bytes(b"")
+        with pytest.raises(ValueError):
+            MmapUpload(str(path))
+
+    @pytest.mark.asyncio
+    async def test_upload_benchmark_reports_both_methods(self):
+        from ytdl_bot_bench import run_upload_benchmark, format_upload_report
+        results = await run_upload_benchmark(size=1024 * 1024, parallel=2, part_size=64 * 1024)
+        assert [r["method"] for r in results] == ["read", "mmap"]
+        for r in results:
+            assert r["uploaded_bytes"] == 2 * 1024 * 1024 and r["parts"] == 32
+            assert r["cpu_per_gib"] >= 0 and r["peak_rss_delta"] >= 0
+        assert "CPU s/GiB" in format_upload_report(results)
+
+
+# ---------------------------------------------------------------------------
+# Duplicate media detection
+# ---------------------------------------------------------------------------
+
+class TestDuplicateMedia:
+
+    def test_fingerprint_samples_head_and_tail(self, tmp_path):
+        from ytdl_bot import media_fingerprint
+        head, middle, tail = b"h" * 1024 * 1024, b"m" * 4096, b"t" * 1024 * 1024
+        a, b, c = tmp_path / "a.mp4", tmp_path / "b.mp4", tmp_path / "c.mp4"
+        a.write_bytes(head + middle + tail)
+        b.write_bytes(head + b"x" * 4096 + tail)  # differs only in the unsampled middle
+        c.write_bytes(head + middle + tail[:-1] + b"!")
+        fingerprint = media_fingerprint(str(a), 60, 1280, 720)
+        assert fingerprint == media_fingerprint(str(b), 60, 1280, 720)
+        assert fingerprint != media_fingerprint(str(c), 60, 1280, 720)
+        assert fingerprint != media_fingerprint(str(a), 61, 1280, 720)
+        assert fingerprint != media_fingerprint(str(a), 60, 1920, 1080)
+        assert media_fingerprint(str(tmp_path / "missing.mp4"), 60, 1280, 720) is None
+
+    def test_record_upload_indexes_fingerprint(self, tmp_path):
+        from telethon.tl.types import Document
+        from ytdl_bot import UploadCache, FingerprintIndex, record_upload
+        cache = UploadCache(str(tmp_path / "uploads.json"))
+        index = FingerprintIndex(str(tmp_path / "fingerprints.json"))
+        document = Document(id=1, access_hash=2, file_reference=b"", date=None, mime_type="video/mp4",
+                            size=10, dc_id=4, attributes=[])
+        with patch("ytdl_bot.UPLOAD_CACHE", cache), patch("ytdl_bot.FINGERPRINT_INDEX", index):
+            record_upload("https://v", "video", Mock(document=document), None, "Title\n\nSource: https://v", 1, "fp")
+        entry = FingerprintIndex(str(tmp_path / "fingerprints.json")).get("fp", "video")
+        assert entry["file_id"] == cache.get("https://v", "video")["file_id"]
+        assert entry["url"] == "https://v"
+        assert index.get("fp", "audio") is None
+
+    async def download(self, tmp_path, index, client):
+        """process_download of a 2 KiB clip (over MAX_VIDEO_SIZE) with probing and upload mocked."""
+        from ytdl_bot import DiskBudget, TTLCache, UploadCache, media_fingerprint
+        video = tmp_path / "clip.mp4"
+        video.write_bytes(b"clip" * 512)
+        work = tmp_path / "work"
+        work.mkdir()
+        mock_video = Mock()
+        mock_video.get_resolution.return_value = (1280, 720)
+        mock_video.get_length.return_value = 60
+        cache = UploadCache(str(tmp_path / "uploads.json"))
+        with patch("ytdl_bot.DISK_BUDGET", DiskBudget()), \
+             patch("ytdl_bot.MEDIA_PROBE_CACHE", TTLCache()), \
+             patch("ytdl_bot.tempfile.mkdtemp", return_value=str(work)), \
+             patch("ytdl_bot.get_video_title", return_value="Title"), \
+             patch("ytdl_bot.download_video", new_callable=AsyncMock, return_value=(str(video), None)), \
+             patch("ytdl_bot.Video", mock_video), \
+             patch("ytdl_bot.MAX_VIDEO_SIZE", 1024), \
+             patch("ytdl_bot.compress_video", return_value=(str(video), 640, 360)) as mock_compress, \
+             patch("ytdl_bot.get_thumbnail", return_value=None), \
+             patch("ytdl_bot.send_video_telethon", new_callable=AsyncMock) as mock_upload, \
+             patch("ytdl_bot.TELETHON_CLIENT", client), \
+             patch("ytdl_bot.FINGERPRINT_INDEX", index), \
+             patch("ytdl_bot.UPLOAD_CACHE", cache), \
+             patch("ytdl_bot.send_message", new_callable=AsyncMock, return_value=Mock(message_id=1)), \
+             patch("ytdl_bot.notify_admin", new_callable=AsyncMock), \
+             patch("ytdl_bot.clear_status_messages", new_callable=AsyncMock), \
+             patch("ytdl_bot.STATUS_MESSAGES", {}):
+            from ytdl_bot import process_download
+            await process_download(100, 100, "https://yt.com/new")
+        return media_fingerprint(str(video), 60, 1280, 720), mock_compress, mock_upload, cache
+
+    @pytest.mark.asyncio
+    async def test_new_clip_uploads_with_fingerprint(self, tmp_path):
+        from ytdl_bot import FingerprintIndex
+        index = FingerprintIndex(str(tmp_path / "fingerprints.json"))
+        client = AsyncMock()
+        client.is_connected = Mock(return_value=True)
+        fingerprint, mock_compress, mock_upload, _ = await self.download(tmp_path, index, client)
+        mock_compress.assert_called_once()
+        assert mock_upload.call_args.kwargs["fingerprint"] == fingerprint
+        client.send_file.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_known_clip_is_resent_without_compress_or_upload(self, tmp_path):
+        from ytdl_bot import FingerprintIndex, media_fingerprint
+        index = FingerprintIndex(str(tmp_path / "fingerprints.json"))
+        (tmp_path / "clip.mp4").write_bytes(b"clip" * 512)
+        fingerprint = media_fingerprint(str(tmp_path / "clip.mp4"), 60, 1280, 720)
+        index.set(fingerprint, "video", {"file_id": "BAAD", "title": "Old", "caption": "Old", "url": "https://old"})
+        client = AsyncMock()
+        client.is_connected = Mock(return_value=True)
+        _, mock_compress, mock_upload, cache = await self.download(tmp_path, index, client)
+        mock_compress.assert_not_called()
+        mock_upload.assert_not_called()
+        assert client.send_file.call_args.kwargs["file"] == "BAAD"
+        assert "Source: https://yt.com/new" in client.send_file.call_args.kwargs["caption"]
+        entry = cache.get("https://yt.com/new", "video")
+        assert entry["file_id"] == "BAAD" and "url" not in entry
+
+    @pytest.mark.asyncio
+    async def test_failed_resend_falls_back_to_upload(self, tmp_path):
+        from ytdl_bot import FingerprintIndex, media_fingerprint
+        index = FingerprintIndex(str(tmp_path / "fingerprints.json"))
+        (tmp_path / "clip.mp4").write_bytes(b"clip" * 512)
+        fingerprint = media_fingerprint(str(tmp_path / "clip.mp4"), 60, 1280, 720)
+        index.set(fingerprint, "video", {"file_id": "BAAD", "title": "Old", "caption": "Old", "url": "https://old"})
+        client = AsyncMock()
+        client.is_connected = Mock(return_value=True)
+        client.send_file.side_effect = Exception("FILE_REFERENCE_EXPIRED")
+        _, mock_compress, mock_upload, _ = await self.download(tmp_path, index, client)
+        mock_compress.assert_called_once()
+        mock_upload.assert_called_once()